@@ -0,0 +1,79 @@
+"""
+Ansible callback plugin, writing result of every task as JSON line to file in XOPERA_TASK_RESULTS_FILE, so
+xopera-rest-api can read task results without parsing stdout.
+"""
+import datetime
+import json
+import os
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = '''
+    name: xopera_task_results
+    type: aggregate
+    short_description: Writes task results as JSON lines
+    description:
+      - Appends result of every task on every host as JSON line to file in XOPERA_TASK_RESULTS_FILE
+'''
+
+# stdout and stderr of tasks are limited, full output is part of invocation's stdout anyway
+MAX_OUTPUT_LENGTH = 4096
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'xopera_task_results'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super().__init__()
+        self.results_file = os.getenv('XOPERA_TASK_RESULTS_FILE')
+        self.playbook = None
+        self.play = None
+
+    def v2_playbook_on_start(self, playbook):
+        self.playbook = os.path.basename(playbook._file_name)
+
+    def v2_playbook_on_play_start(self, play):
+        self.play = play.get_name()
+
+    def v2_runner_on_ok(self, result):
+        self._write(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._write(result, 'failed', ignore_errors)
+
+    def v2_runner_on_unreachable(self, result):
+        self._write(result, 'unreachable')
+
+    def v2_runner_on_skipped(self, result):
+        self._write(result, 'skipped')
+
+    def _write(self, result, status: str, ignored: bool = False):
+        if not self.results_file:
+            return
+        task_result = result._result
+        line = {
+            'playbook': self.playbook,
+            'play': self.play,
+            'task': result._task.get_name(),
+            'host': result._host.get_name(),
+            'status': status,
+            'ignored': bool(ignored),
+            'changed': bool(task_result.get('changed', False)),
+            'msg': _limit(task_result.get('msg')),
+            'stderr': _limit(task_result.get('stderr')),
+            'rc': task_result.get('rc'),
+            'timestamp': datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+        }
+        # single write of line to file opened for appending, concurrent playbooks do not interleave lines
+        with open(self.results_file, 'a') as f:
+            f.write(json.dumps(line, default=str) + '\n')
+
+
+def _limit(value):
+    if value is None:
+        return None
+    value = str(value)
+    return value if len(value) <= MAX_OUTPUT_LENGTH else value[:MAX_OUTPUT_LENGTH] + '...'
@@ -1,13 +1,15 @@
 import os
+import threading
+import time
 
 import connexion
 
 from opera.api.log import get_logger
-from opera.api.openapi import encoder
 from opera.api.service import csardb_service
-from opera.api.service.sqldb_service import PostgreSQL
+from opera.api.service.sqldb_service import PostgreSQL, SqlDBFailedException
+from opera.api.service.workdir_service import WorkdirService
 from opera.api.settings import Settings
-from opera.api.util import xopera_util
+from opera.api.util import compression, serialization, xopera_util
 
 DEBUG = os.getenv("DEBUG", "false") == "true"
 logger = get_logger(__name__)
@@ -19,6 +21,18 @@ def main():
     xopera_util.init_data()
     xopera_util.configure_ssh_keys()
     PostgreSQL.initialize()
+    # controllers create workers pools, so workers are forked before any background thread of this process runs
+    from opera.api.controllers.deployment_controller import invocation_service
+    from opera.api.controllers.job_controller import job_service
+    WorkdirService.start_trash()
+    if Settings.reconcile_version_counters:
+        threading.Thread(target=CSAR_db.reconcile_version_counters, daemon=True).start()
+    if Settings.invocation_archive_interval > 0:
+        threading.Thread(target=archive_invocations, daemon=True).start()
+    if Settings.reconcile_interval > 0 and Settings.heartbeat_interval > 0:
+        threading.Thread(target=reconcile_invocations, args=(invocation_service, job_service), daemon=True).start()
+    if Settings.workdir_gc_interval > 0:
+        threading.Thread(target=collect_workdirs, daemon=True).start()
 
     if DEBUG:
         logger.info("Running in debug mode: flask backend.")
@@ -31,18 +45,66 @@ def main():
         serve_spec=True,
         swagger_ui=True
     ))
-    app.app.json_encoder = encoder.JSONEncoder
     app.add_api("openapi.yaml", arguments={"title": "xOpera REST API"}, pythonic_params=True)
+    serialization.configure(app.app)
+    app.app.after_request(compression.compress_response)
     app.run(port=8080, debug=DEBUG)
 
 
+def archive_invocations():
+    """
+    Periodically moves invocations, older than retention, to archive and deletes expired Idempotency-Keys and jobs
+    """
+    while True:
+        try:
+            while PostgreSQL.archive_invocations(Settings.invocation_retention_days) > 0:
+                pass
+            PostgreSQL.delete_expired_idempotency_keys(Settings.idempotency_key_ttl)
+            PostgreSQL.delete_expired_jobs(Settings.job_ttl)
+        except SqlDBFailedException as e:
+            logger.error(f"Could not archive invocations: {str(e)}")
+        time.sleep(Settings.invocation_archive_interval)
+
+
+def reconcile_invocations(invocation_service, job_service):
+    """
+    Marks invocations and jobs, left behind by dead workers, interrupted on startup and periodically afterwards
+    """
+    while True:
+        try:
+            interrupted_jobs = job_service.reconcile()
+            if interrupted_jobs:
+                logger.info(f"Marked {interrupted_jobs} jobs interrupted")
+            interrupted = invocation_service.reconcile()
+            if interrupted:
+                logger.info(f"Marked {interrupted} invocations interrupted")
+        except SqlDBFailedException as e:
+            logger.error(f"Could not reconcile invocations: {str(e)}")
+        time.sleep(Settings.reconcile_interval)
+
+
+def collect_workdirs():
+    """
+    Periodically removes trash and leaked workdirs and keeps workdirs under quota
+    """
+    while True:
+        try:
+            freed = WorkdirService.collect()
+            if freed:
+                logger.info(f"Removed {freed // (1024 * 1024)} MB of unused workdirs")
+        except SqlDBFailedException as e:
+            logger.error(f"Could not collect workdirs: {str(e)}")
+        time.sleep(Settings.workdir_gc_interval)
+
+
 def test():
     app = connexion.App(__name__, specification_dir="./openapi/openapi/", options=dict(
         serve_spec=False,
         swagger_ui=False
     ))
-    app.app.json_encoder = encoder.JSONEncoder
     app.add_api("openapi.yaml")
+    serialization.configure(app.app)
+    app.app.after_request(compression.compress_response)
     app.testing = True
     return app
 
@@ -1,14 +1,22 @@
+import contextlib
+import copyreg
 import datetime
+import functools
+import hashlib
 import json
 import multiprocessing
 import os
+import pickle
 import shutil
+import socket
 import sys
 import tempfile
+import threading
+import time
 import traceback
 import uuid
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
 from opera.commands.deploy import deploy_service_template as opera_deploy
 from opera.commands.diff import diff_instances as opera_diff_instances
@@ -25,11 +33,13 @@ from werkzeug.datastructures import FileStorage
 from opera.api.blueprint_converters import csar_to_blueprint
 from opera.api.blueprint_converters.blueprint2CSAR import entry_definitions
 from opera.api.cli import CSAR_db
-from opera.api.service.sqldb_service import PostgreSQL
+from opera.api.service.sqldb_service import PostgreSQL, SqlDBFailedException
+from opera.api.service.workdir_service import WorkdirService
 from opera.api.log import get_logger
-from opera.api.openapi.models import Invocation, InvocationState, OperationType
+from opera.api.controllers.background_rollout import RolloutCredentialsExpired, RolloutService
+from opera.api.openapi.models import ExecutionProfile, Invocation, InvocationState, OperationType, Rollout
 from opera.api.settings import Settings
-from opera.api.util import xopera_util, file_util
+from opera.api.util import xopera_util, file_util, metrics, timestamp_util
 
 logger = get_logger(__name__)
 
@@ -38,6 +48,70 @@ class MissingDeploymentDataError(BaseException):
     pass
 
 
+class AdmissionRejected(Exception):
+    """
+    Invocation is over limit of pending and running invocations
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class IdempotencyKeyReused(Exception):
+    """
+    Idempotency-Key was already used for different operation or deployment
+    """
+    pass
+
+
+class DeploymentBusy(Exception):
+    """
+    Previous operation on deployment is still pending or running
+    """
+    pass
+
+
+class SandboxError(Exception):
+    pass
+
+
+class SandboxTraceback(Exception):
+    """Traceback of exception in child process, set as cause of exception, raised in worker"""
+
+    def __init__(self, tb: str):
+        super().__init__(tb)
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+def _rebuild_operation_error(args, tosca_name, interface, operation):
+    error = OperationError.__new__(OperationError)
+    error.args = args
+    error.tosca_name = tosca_name
+    error.interface = interface
+    error.operation = operation
+    return error
+
+
+# opera errors do not pass their own arguments to Exception, so they cannot be unpickled by default
+copyreg.pickle(ParseError, lambda e: (ParseError, (str(e), e.loc)))
+copyreg.pickle(OperationError, lambda e: (_rebuild_operation_error, (e.args, e.tosca_name, e.interface, e.operation)))
+copyreg.pickle(AggregatedOperationError, lambda e: (AggregatedOperationError, (str(e), e.inner_exceptions)))
+
+
+def picklable_exception(e: BaseException) -> BaseException:
+    """
+    Returns exception, if it survives pickling, otherwise SandboxError with its message
+    """
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return SandboxError("{}: {}".format(e.__class__.__name__, str(e)))
+
+
 class ExtendedInvocation(Invocation):
     def __init__(self, access_token=None, blueprint_id=None,
                  version_id=None, deployment_id=None, user_id=None,
@@ -45,30 +119,177 @@ class ExtendedInvocation(Invocation):
                  timestamp_submission=None, timestamp_start=None,
                  timestamp_end=None, inputs=None, instance_state=None,
                  outputs=None, exception=None, stdout=None,
-                 stderr=None, workers=None, clean_state=None):
+                 stderr=None, workers=None, clean_state=None, profile=None, rollout_id=None, timings=None):
         super().__init__(blueprint_id=blueprint_id, version_id=version_id, deployment_id=deployment_id,
                          user_id=user_id, deployment_label=deployment_label, state=state, operation=operation,
                          timestamp_submission=timestamp_submission, timestamp_start=timestamp_start,
                          timestamp_end=timestamp_end, inputs=inputs, instance_state=instance_state,
                          outputs=outputs, exception=exception, stdout=stdout, stderr=stderr,
-                         workers=workers, clean_state=clean_state)
+                         workers=workers, clean_state=clean_state, profile=profile, rollout_id=rollout_id,
+                         timings=timings)
         self.access_token = access_token
 
 
+class Heartbeat:
+    """
+    Records in database every heartbeat_interval seconds, that worker (or instance, holding queue of pending
+    invocations or jobs) is alive and which invocation or job it runs. Reconciler interrupts invocations and jobs,
+    nobody alive runs.
+    """
+    # heartbeats with running thread, process forks only while they are paused
+    running = set()
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.hostname = socket.gethostname()
+        self.pid = os.getpid()
+        self.owner_id = f"{self.hostname[:20]}-{self.pid}-{uuid.uuid4().hex[:16]}"
+        self.started = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+        self.invocation_id = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def beat(self):
+        try:
+            PostgreSQL.save_heartbeat(self.owner_id, self.kind, self.hostname, self.pid, self.started,
+                                      self.invocation_id)
+        except SqlDBFailedException as e:
+            logger.warning(f"Could not record heartbeat: {str(e)}")
+
+    def claim(self, invocation_id: Optional[str]):
+        """
+        Records invocation (or job), worker runs from now on, None after it finished
+        """
+        self.invocation_id = invocation_id
+        if Settings.heartbeat_interval > 0:
+            self.beat()
+
+    def start(self):
+        if Settings.heartbeat_interval > 0:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            Heartbeat.running.add(self)
+
+    def stop(self):
+        """
+        Stops thread after its current beat
+        """
+        Heartbeat.running.discard(self)
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.beat()
+            self.stopped.wait(Settings.heartbeat_interval)
+
+    @classmethod
+    @contextlib.contextmanager
+    def paused(cls):
+        """
+        Stops heartbeat threads of this process and starts them again afterwards. Fork inside is done from single
+        thread, so child does not inherit locks (logging, database connection), held by heartbeat thread. Heartbeats
+        are started again in parent only, since child does not leave the block.
+        """
+        heartbeats = [heartbeat for heartbeat in cls.running if heartbeat.pid == os.getpid()]
+        for heartbeat in heartbeats:
+            heartbeat.stop()
+        try:
+            yield
+        finally:
+            for heartbeat in heartbeats:
+                heartbeat.start()
+
+    @staticmethod
+    def alive() -> list:
+        """
+        Returns heartbeats, marked alive or not. Process on this host is alive, as long as it runs, even if it could
+        not record its heartbeat (e.g. database was unreachable), process on other host, while its heartbeat is fresh.
+        """
+        hostname = socket.gethostname()
+        heartbeats = PostgreSQL.get_heartbeats(Settings.heartbeat_timeout)
+        for heartbeat in heartbeats:
+            if heartbeat['hostname'] == hostname:
+                heartbeat['alive'] = xopera_util.process_alive(heartbeat['pid'])
+            else:
+                heartbeat['alive'] = heartbeat['fresh']
+        return heartbeats
+
+    @staticmethod
+    def orphaned(heartbeats: list, item_id: str, state: str, submitted: str, instance_id: str = None) -> bool:
+        """
+        Running invocation or job is orphaned, if no live worker claims it, pending one, if instance, which holds it
+        in queue, is dead. Of pending one, saved without instance, no live instance, started before its submission,
+        may hold it.
+        """
+        alive = [heartbeat for heartbeat in heartbeats if heartbeat['alive']]
+        if state == InvocationState.IN_PROGRESS:
+            return not any(heartbeat['invocation_id'] == item_id for heartbeat in alive)
+        if instance_id:
+            return not any(heartbeat['owner_id'] == instance_id for heartbeat in alive)
+        submitted = timestamp_util.str_to_datetime(submitted)
+        submitted = submitted.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return not any(heartbeat['started'] <= submitted for heartbeat in alive if heartbeat['kind'] == 'instance')
+
+    @staticmethod
+    def unconfirmed(heartbeats: list, item_id: str) -> bool:
+        """
+        Orphaned invocation or job is still claimed by worker on other host, which stopped recording heartbeat. It
+        may still run there, so its workdir must not be touched.
+        """
+        hostname = socket.gethostname()
+        return any(heartbeat['invocation_id'] == item_id and heartbeat['hostname'] != hostname
+                   for heartbeat in heartbeats)
+
+    @staticmethod
+    def dead(heartbeats: list) -> list:
+        """
+        Returns owner ids of heartbeats of dead processes
+        """
+        return [heartbeat['owner_id'] for heartbeat in heartbeats if not heartbeat['alive']]
+
+
 class InvocationWorkerProcess:
 
     @staticmethod
-    def run_internal(work_queue: multiprocessing.Queue):
+    def run_internal(work_queue: multiprocessing.Queue, instance_id: str = None):
 
+        metrics.WORKERS.labels('invocation').inc()
+        # updates of rollouts are submitted by worker, which finished previous update
+        invocation_service = InvocationService(work_queue=work_queue, instance_id=instance_id)
+        heartbeat = Heartbeat('worker')
+        heartbeat.start()
         while True:
             inv: ExtendedInvocation = work_queue.get(block=True)
             inv.timestamp_start = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+            metrics.WORKERS_BUSY.labels('invocation').inc()
+            inv.timings = {'queue': timestamp_util.seconds_between(inv.timestamp_submission, inv.timestamp_start)}
+            metrics.INVOCATION_QUEUE_WAIT.labels(inv.operation).observe(inv.timings['queue'])
 
             invocation_id = PostgreSQL.get_last_invocation_id(inv.deployment_id)
+            if PostgreSQL.get_invocation_state(invocation_id) == InvocationState.INTERRUPTED:
+                # reconciler took instance, holding invocation in queue, for dead
+                logger.warning(f"Invocation {invocation_id} of deployment_id={inv.deployment_id} has been marked "
+                               f"interrupted while pending, skipping it")
+                metrics.WORKERS_BUSY.labels('invocation').dec()
+                continue
             location = InvocationService.deployment_location(inv.deployment_id, inv.blueprint_id)
+            if location.exists():
+                # left behind by interrupted invocation
+                WorkdirService.reclaim(location)
+                location = InvocationService.deployment_location(inv.deployment_id, inv.blueprint_id)
 
+            # claim invocation before it is in progress, so reconciler does not take it for orphan
+            heartbeat.claim(invocation_id)
             inv.state = InvocationState.IN_PROGRESS
             InvocationService.save_invocation(invocation_id, inv)
+            xopera_util.cleanup_ssh_control_dirs()
+            task_results_file = InvocationService.task_results_file(location)
+            xopera_util.enable_task_results(task_results_file)
+            xopera_util.enable_fact_cache(InvocationService.facts_dir(location))
 
             # for catching stdout&err
             file_stdout = open(InvocationService.stdout_file(inv.deployment_id), "w")
@@ -88,6 +309,7 @@ class InvocationWorkerProcess:
                     outputs = InvocationWorkerProcess._deploy_continue(location, inv)
                 elif inv.operation == OperationType.UNDEPLOY:
                     InvocationWorkerProcess._undeploy(location, inv)
+                    xopera_util.close_ssh_masters(inv.deployment_id)
                     outputs = None
                 elif inv.operation == OperationType.UPDATE:
                     outputs = InvocationWorkerProcess._update(location, inv)
@@ -119,159 +341,331 @@ class InvocationWorkerProcess:
 
                 sys.stdout.flush()
                 sys.stderr.flush()
-                inv.stdout = InvocationWorkerProcess.read_file(InvocationService.stdout_file(inv.deployment_id))
-                inv.stderr = InvocationWorkerProcess.read_file(InvocationService.stderr_file(inv.deployment_id))
+                inv.stdout, stdout_truncated = InvocationWorkerProcess.read_log(
+                    InvocationService.stdout_file(inv.deployment_id))
+                inv.stderr, stderr_truncated = InvocationWorkerProcess.read_log(
+                    InvocationService.stderr_file(inv.deployment_id))
                 file_stdout.close()
                 file_stderr.close()
+                task_results = xopera_util.read_task_results(task_results_file)
                 if operation_exception:
-                    inv.node_error = InvocationWorkerProcess.try_extract_error(inv, operation_exception)
+                    inv.node_error = InvocationWorkerProcess.try_extract_error(inv, operation_exception, task_results)
                 # Restore stdout&&err
                 os.dup2(stdout_copy, 1)
                 os.dup2(stderr_copy, 2)
 
                 inv.timestamp_end = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
 
-                if InvocationService.deployment_exists(inv):
-                    InvocationService.save_dot_opera_to_db(inv, location)
+                deployment_exists = InvocationService.deployment_exists(inv)
+                # reconciler took worker for dead (e.g. its heartbeat was lost), invocation could have been
+                # continued or undeployed since, so its state and result are not saved over it
+                interrupted = deployment_exists and \
+                    PostgreSQL.get_invocation_state(invocation_id) == InvocationState.INTERRUPTED
+                if deployment_exists and not interrupted:
+                    with timestamp_util.timing(inv.timings, 'state_save'):
+                        InvocationService.save_dot_opera_to_db(inv, location)
+                        InvocationService.save_ansible_facts(inv, location)
+                        if inv.state == InvocationState.SUCCESS and inv.operation != OperationType.UNDEPLOY:
+                            PostgreSQL.save_deployment_outputs(inv.deployment_id, inv.outputs)
+                        PostgreSQL.save_task_results(invocation_id, inv.deployment_id, inv.timestamp_submission,
+                                                     task_results)
+                        if stdout_truncated:
+                            InvocationService.save_full_log(invocation_id, inv, 'stdout')
+                        if stderr_truncated:
+                            InvocationService.save_full_log(invocation_id, inv, 'stderr')
+
+                # clean, workdirs are deleted in background, so worker is free for next invocation
+                with timestamp_util.timing(inv.timings, 'cleanup'):
+                    WorkdirService.reclaim(location)
+                    WorkdirService.reclaim(InvocationService.stdstream_dir(inv.deployment_id))
+
+                if interrupted:
+                    logger.error(f"Invocation {invocation_id} of deployment_id={inv.deployment_id} has been marked "
+                                 f"interrupted while it ran, therefore I cannot save following invocation to DB:"
+                                 f"\n" + inv.to_str())
+                elif deployment_exists:
                     InvocationService.save_invocation(invocation_id, inv)
                 else:
                     logger.error(f"Deployment with deployment_id={inv.deployment_id} does not exist any more, it could "
                                  f"have been deleted with force, therefore I cannot save following invocation to DB:"
                                  f"\n" + inv.to_str())
 
-                # clean
-                shutil.rmtree(location)
-                shutil.rmtree(InvocationService.stdstream_dir(inv.deployment_id))
+                metrics.INVOCATION_DURATION.labels(inv.operation, inv.state).observe(
+                    timestamp_util.seconds_between(inv.timestamp_start, inv.timestamp_end))
+                metrics.WORKERS_BUSY.labels('invocation').dec()
+                heartbeat.claim(None)
+
+                if inv.rollout_id and not interrupted:
+                    try:
+                        RolloutService.advance(inv.rollout_id, inv.deployment_id, inv.state, functools.partial(
+                            invocation_service.rollout_update, username=inv.user_id, access_token=inv.access_token))
+                    except Exception as e:
+                        logger.error(f"Could not advance rollout {inv.rollout_id}: {str(e)}")
 
     @staticmethod
     def _deploy_fresh(location: Path, inv: ExtendedInvocation):
-        CSAR_db.get_revision(inv.blueprint_id, location, inv.version_id)
+        owner = InvocationWorkerProcess.owner(inv)
+        with timestamp_util.timing(inv.timings, 'blueprint_fetch'):
+            CSAR_db.get_revision(inv.blueprint_id, location, inv.version_id, owner)
+
+        def run():
+            opera_storage = Storage.create(".opera")
+            service_template = entry_definitions(location)
+            opera_deploy(service_template, inv.inputs, opera_storage,
+                         verbose_mode=False, num_workers=inv.workers, delete_existing_state=True)
+
+            return opera_outputs(opera_storage)
 
         with xopera_util.cwd(location):
-            try:
-                if inv.user_id and Settings.secure_workdir:
-                    xopera_util.setup_user([location], inv.user_id, inv.access_token)
-                opera_storage = Storage.create(".opera")
-                service_template = entry_definitions(location)
-                opera_deploy(service_template, inv.inputs, opera_storage,
-                             verbose_mode=False, num_workers=inv.workers, delete_existing_state=True)
-
-                outputs = opera_outputs(opera_storage)
-                return outputs
-            finally:
-                if inv.user_id and Settings.secure_workdir:
-                    xopera_util.cleanup_user()
+            return InvocationWorkerProcess.run_sandboxed(inv, [location], run)
 
     @staticmethod
     def _deploy_continue(location: Path, inv: ExtendedInvocation):
+        owner = InvocationWorkerProcess.owner(inv)
 
         # get blueprint
-        CSAR_db.get_revision(inv.blueprint_id, location, inv.version_id)
+        with timestamp_util.timing(inv.timings, 'blueprint_fetch'):
+            CSAR_db.get_revision(inv.blueprint_id, location, inv.version_id, owner)
         # get session data (.opera)
-        InvocationService.get_dot_opera_from_db(inv.deployment_id, location)
+        with timestamp_util.timing(inv.timings, 'session_restore'):
+            InvocationService.get_dot_opera_from_db(inv.deployment_id, location, owner)
+            InvocationService.restore_ansible_facts(inv.deployment_id, location, owner)
+
+        def run():
+            opera_storage = Storage.create(".opera")
+            service_template = entry_definitions(location)
+            opera_deploy(service_template, inv.inputs, opera_storage,
+                         verbose_mode=False, num_workers=inv.workers, delete_existing_state=inv.clean_state)
+            return opera_outputs(opera_storage)
 
         with xopera_util.cwd(location):
-            try:
-                if inv.user_id and Settings.secure_workdir:
-                    xopera_util.setup_user([location], inv.user_id, inv.access_token)
-                opera_storage = Storage.create(".opera")
-                service_template = entry_definitions(location)
-                opera_deploy(service_template, inv.inputs, opera_storage,
-                             verbose_mode=False, num_workers=inv.workers, delete_existing_state=inv.clean_state)
-                outputs = opera_outputs(opera_storage)
-                return outputs
-            finally:
-                if inv.user_id and Settings.secure_workdir:
-                    xopera_util.cleanup_user()
+            return InvocationWorkerProcess.run_sandboxed(inv, [location], run)
 
     @staticmethod
     def _undeploy(location: Path, inv: ExtendedInvocation):
+        owner = InvocationWorkerProcess.owner(inv)
 
         # get blueprint
-        CSAR_db.get_revision(inv.blueprint_id, location, inv.version_id)
+        with timestamp_util.timing(inv.timings, 'blueprint_fetch'):
+            CSAR_db.get_revision(inv.blueprint_id, location, inv.version_id, owner)
         # get session data (.opera)
-        if not InvocationService.get_dot_opera_from_db(inv.deployment_id, location):
+        with timestamp_util.timing(inv.timings, 'session_restore'):
+            dot_opera_restored = InvocationService.get_dot_opera_from_db(inv.deployment_id, location, owner)
+            InvocationService.restore_ansible_facts(inv.deployment_id, location, owner)
+        if not dot_opera_restored:
             raise MissingDeploymentDataError('Could not get .opera data from previous job, aborting...')
 
+        def run():
+            opera_storage = Storage.create(".opera")
+            if inv.inputs:
+                opera_storage.write_json(inv.inputs, "inputs")
+            opera_undeploy(opera_storage, verbose_mode=False, num_workers=inv.workers)
+
         with xopera_util.cwd(location):
-            try:
-                if inv.user_id and Settings.secure_workdir:
-                    xopera_util.setup_user([location], inv.user_id, inv.access_token)
-                opera_storage = Storage.create(".opera")
-                if inv.inputs:
-                    opera_storage.write_json(inv.inputs, "inputs")
-                opera_undeploy(opera_storage, verbose_mode=False, num_workers=inv.workers)
-                # Outputs in undeployment are not returned
-                return None
-            finally:
-                if inv.user_id and Settings.secure_workdir:
-                    xopera_util.cleanup_user()
+            InvocationWorkerProcess.run_sandboxed(inv, [location], run)
+        # Outputs in undeployment are not returned
+        return None
 
     @staticmethod
     def _update(location: Path, inv: ExtendedInvocation):
+        owner = InvocationWorkerProcess.owner(inv)
+
+        revision = None
+        if inv.rollout_id:
+            with timestamp_util.timing(inv.timings, 'blueprint_fetch'):
+                revision = RolloutService.revision(inv.rollout_id, inv.blueprint_id, inv.version_id)
 
         storage_old, location_old, storage_new, location_new = InvocationWorkerProcess.prepare_two_workdirs(
-            inv.deployment_id, inv.blueprint_id, inv.version_id, inv.inputs, location)
+            inv.deployment_id, inv.blueprint_id, inv.version_id, inv.inputs, location, inv.timings, owner, revision)
 
-        assert location_new == str(location)
+        with timestamp_util.timing(inv.timings, 'session_restore'):
+            InvocationService.restore_ansible_facts(inv.deployment_id, location, owner)
+
+        def run():
+            instance_diff = opera_diff_instances(storage_old, location_old,
+                                                 storage_new, location_new,
+                                                 opera_TemplateComparer(), opera_InstanceComparer(),
+                                                 verbose_mode=False)
+
+            opera_update(storage_old, location_old,
+                         storage_new, location_new,
+                         opera_InstanceComparer(), instance_diff,
+                         verbose_mode=False, num_workers=inv.workers, overwrite=False)
+            return opera_outputs(storage_new)
 
         with xopera_util.cwd(location_new):
             try:
-                if inv.user_id and Settings.secure_workdir:
-                    xopera_util.setup_user([location_old, location_new], inv.user_id, inv.access_token)
-                instance_diff = opera_diff_instances(storage_old, location_old,
-                                                     storage_new, location_new,
-                                                     opera_TemplateComparer(), opera_InstanceComparer(),
-                                                     verbose_mode=False)
-
-                opera_update(storage_old, location_old,
-                             storage_new, location_new,
-                             opera_InstanceComparer(), instance_diff,
-                             verbose_mode=False, num_workers=inv.workers, overwrite=False)
-                outputs = opera_outputs(storage_new)
-                return outputs
+                return InvocationWorkerProcess.run_sandboxed(inv, [location_old, location_new], run)
             finally:
-                if inv.user_id and Settings.secure_workdir:
-                    xopera_util.cleanup_user()
-                shutil.rmtree(location_old)
+                with timestamp_util.timing(inv.timings, 'cleanup'):
+                    WorkdirService.reclaim(location_old)
                 # location_new is needed in __run_internal and deleted afterwards
 
+    @staticmethod
+    def owner(inv: ExtendedInvocation) -> Optional[tuple]:
+        """
+        (uid, gid) of system user, invocation runs as, None if it runs as worker's user. Workdir is created owned by it.
+        """
+        if inv.user_id and Settings.secure_workdir:
+            with timestamp_util.timing(inv.timings, 'user_setup'):
+                return xopera_util.get_owner(inv.user_id)
+        return None
+
+    @staticmethod
+    def run_sandboxed(inv: ExtendedInvocation, locations: list, run: Callable):
+        """
+        Runs opera in child process, forked from worker for this invocation only. Worker has opera and API modules
+        imported already, so fork is cheap. Child drops privileges to system user of invocation (with
+        secure_workdir), so worker stays root and no process state (environment, tempfile.tempdir) is carried over
+        to next invocation. Child attaches to user's ssh-agent, which worker keeps between invocations. Result or
+        exception of run is sent back through pipe.
+        """
+        agent_socket = None
+        if inv.user_id and Settings.secure_workdir and inv.access_token:
+            # Vault is queried by worker for every invocation, keys are loaded to user's long-lived ssh-agent, kept by
+            # worker, only if they changed
+            with timestamp_util.timing(inv.timings, 'user_setup'):
+                try:
+                    keys = xopera_util.get_user_keys(inv.user_id, inv.access_token)
+                    agent_socket = xopera_util.acquire_user_agent(inv.user_id, keys)
+                except Exception as e:
+                    logger.warning("An error occurred setting up SSH keys: " + str(e))
+
+        # SSH master connections of deployment's hosts persist between invocations
+        control_dir = None
+        if inv.deployment_id and Settings.ssh_control_persist > 0:
+            try:
+                control_dir = xopera_util.prepare_ssh_control_dir(inv.deployment_id, inv.user_id,
+                                                                  InvocationWorkerProcess.owner(inv))
+            except OSError as e:
+                logger.warning("Could not create SSH control dir: " + str(e))
+        env = xopera_util.ansible_ssh_env(control_dir)
+        env.update(xopera_util.ansible_profile_env(inv.profile))
+        if agent_socket:
+            env["SSH_AUTH_SOCK"] = agent_socket
+
+        data, status = b'', 0
+        try:
+            read_fd, write_fd = os.pipe()
+            try:
+                with Heartbeat.paused():
+                    pid = os.fork()
+                    if pid == 0:
+                        os.close(read_fd)
+                        InvocationWorkerProcess._run_child(inv, locations, env, run, write_fd)
+            except OSError:
+                os.close(read_fd)
+                os.close(write_fd)
+                raise
+
+            os.close(write_fd)
+            with os.fdopen(read_fd, 'rb') as pipe:
+                data = pipe.read()
+            _, status = os.waitpid(pid, 0)
+            metrics.mark_process_dead(pid)
+        finally:
+            if agent_socket:
+                xopera_util.release_user_agent(inv.user_id)
+        if not data:
+            raise SandboxError(f"Invocation process exited with status {os.waitstatus_to_exitcode(status)}")
+
+        success, result, timings, child_traceback = pickle.loads(data)
+        if inv.timings is not None:
+            for phase, seconds in timings.items():
+                inv.timings[phase] = round(inv.timings.get(phase, 0) + seconds, 3)
+        if not success:
+            raise result from SandboxTraceback(child_traceback)
+        return result
+
+    @staticmethod
+    def _run_child(inv: ExtendedInvocation, locations: list, env: dict, run: Callable, write_fd: int):
+        timings = {}
+        try:
+            try:
+                if inv.user_id and Settings.secure_workdir:
+                    with timestamp_util.timing(timings, 'user_setup'):
+                        xopera_util.setup_user(locations, inv.user_id, owned=True)
+                os.environ.update(env)
+                with timestamp_util.timing(timings, 'opera_run'):
+                    result = (True, run(), timings, None)
+            except BaseException as e:
+                result = (False, picklable_exception(e), timings, traceback.format_exc())
+            try:
+                data = pickle.dumps(result)
+            except Exception as e:
+                data = pickle.dumps((False, SandboxError(f"Result of invocation could not be sent: {str(e)}"),
+                                     timings, traceback.format_exc()))
+            with os.fdopen(write_fd, 'wb') as pipe:
+                pipe.write(data)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # skip cleanup of worker's state (atexit, pool, database connections), which child shares with worker
+            os._exit(0)
+
     @staticmethod
     def prepare_two_workdirs(deployment_id: str, blueprint_id: str, version_id: str,
-                             inputs: dict, location: Path = None):
-        location_old = InvocationService.deployment_location(str(uuid.uuid4()), str(uuid.uuid4()))
-        location_new = location or InvocationService.deployment_location(str(uuid.uuid4()), str(uuid.uuid4()))
+                             inputs: dict, location: Path, timings: dict = None, owner: tuple = None,
+                             revision: Path = None):
+        """
+        Prepares workdirs of deployed instance and of new blueprint. New blueprint is copied from revision, prepared
+        in advance, if given.
+        """
+        # next to workdir of invocation (or in job dir of diff), so workdir collector knows, who uses it
+        location_old = location.parent / f'{location.name}-old'
+        location_new = location
+        WorkdirService.reclaim(location_old)
 
         # old Deployed instance
         # TODO Next line should use PostgreSQL.get_deployment_status(deployment_id), had to be changed since
         #  old blueprint_id is part of second to last invocation, last is already current
         inv_old = PostgreSQL.get_last_completed_invocation(deployment_id)
-        CSAR_db.get_revision(inv_old.blueprint_id, location_old, inv_old.version_id)
-        InvocationService.get_dot_opera_from_db(deployment_id, location_old)
+        with timestamp_util.timing(timings, 'blueprint_fetch'):
+            if revision:
+                CSAR_db.get_revision(inv_old.blueprint_id, location_old, inv_old.version_id, owner)
+                if owner:
+                    file_util.copy_tree(revision, location_new, owner)
+                else:
+                    shutil.copytree(revision, location_new)
+            elif str(inv_old.blueprint_id) == str(blueprint_id):
+                # both versions from single clone
+                CSAR_db.get_revisions(blueprint_id, [inv_old.version_id, version_id], [location_old, location_new],
+                                      owner)
+            else:
+                CSAR_db.get_revision(inv_old.blueprint_id, location_old, inv_old.version_id, owner)
+                CSAR_db.get_revision(blueprint_id, location_new, version_id, owner)
+
+        with timestamp_util.timing(timings, 'session_restore'):
+            InvocationService.get_dot_opera_from_db(deployment_id, location_old, owner)
         storage_old = Storage.create(str(location_old / '.opera'))
 
         # new blueprint
-        CSAR_db.get_revision(blueprint_id, location_new, version_id)
         storage_new = Storage.create(str(location_new / '.opera'))
         storage_new.write_json(inputs or {}, "inputs")
         storage_new.write(str(entry_definitions(location_new)), "root_file")
+        if owner:
+            xopera_util.setup_user_dir(location_new / '.opera', *owner)
 
         return storage_old, location_old, storage_new, location_new
 
     @staticmethod
-    def diff(deployment_id: str, blueprint_id: str, version_id: str, inputs: dict):
-
-        storage_old, location_old, storage_new, location_new = InvocationWorkerProcess.prepare_two_workdirs(
-            deployment_id, blueprint_id, version_id, inputs)
-
-        with xopera_util.cwd(location_new):
-            instance_diff = opera_diff_instances(storage_old, location_old,
-                                                 storage_new, location_new,
-                                                 opera_TemplateComparer(), opera_InstanceComparer(),
-                                                 verbose_mode=False)
-        shutil.rmtree(location_new)
-        shutil.rmtree(location_old)
-        return instance_diff
+    def diff(deployment_id: str, blueprint_id: str, version_id: str, inputs: dict, job_dir: Path):
+        """
+        Workdirs are prepared in locked job dir, so workdir collector leaves them alone, while diff runs, and job dir
+        is reclaimed afterwards
+        """
+        try:
+            with WorkdirService.locked_job_dir(job_dir):
+                storage_old, location_old, storage_new, location_new = InvocationWorkerProcess.prepare_two_workdirs(
+                    deployment_id, blueprint_id, version_id, inputs, job_dir / 'diff')
+
+                with xopera_util.cwd(location_new):
+                    return opera_diff_instances(storage_old, location_old,
+                                                storage_new, location_new,
+                                                opera_TemplateComparer(), opera_InstanceComparer(),
+                                                verbose_mode=False)
+        finally:
+            WorkdirService.reclaim(job_dir)
 
     @staticmethod
     def validate(blueprint_id: str, version_tag: str, inputs: dict):
@@ -288,12 +682,16 @@ class InvocationWorkerProcess:
 
     @staticmethod
     def validate_new(CSAR: FileStorage, inputs: dict):
+        with tempfile.TemporaryDirectory() as csar_workdir:
+            csar_path = Path(csar_workdir) / Path(CSAR.filename)
+            CSAR.save(Path(csar_path).open('wb'))
+            return InvocationWorkerProcess.validate_csar(csar_path, inputs)
+
+    @staticmethod
+    def validate_csar(csar_path: Path, inputs: dict):
         try:
             with tempfile.TemporaryDirectory() as location:
-                with tempfile.TemporaryDirectory() as csar_workdir:
-                    csar_path = Path(csar_workdir) / Path(CSAR.filename)
-                    CSAR.save(Path(csar_path).open('wb'))
-                    csar_to_blueprint(csar=csar_path, dst=location)
+                csar_to_blueprint(csar=csar_path, dst=location)
 
                 with xopera_util.cwd(location):
                     opera_storage = Storage.create(".opera")
@@ -301,7 +699,8 @@ class InvocationWorkerProcess:
                     opera_validate(service_template, inputs, opera_storage, verbose=False, executors=False)
                 return None
         except Exception as e:
-            return "{}: {}".format(e.__class__.__name__, xopera_util.mask_workdirs([location, csar_workdir], str(e)), )
+            return "{}: {}".format(e.__class__.__name__,
+                                   xopera_util.mask_workdirs([location, Path(csar_path).parent], str(e)))
 
     @staticmethod
     def outputs(deployment_id: str):
@@ -319,13 +718,25 @@ class InvocationWorkerProcess:
         with open(filename, "r") as f:
             return f.read()
 
+    @staticmethod
+    def read_log(filename):
+        """
+        Reads captured stream, keeping only its head and tail if it exceeds limits. Returns text and if it was truncated
+        """
+        return file_util.read_head_tail(Path(filename), Settings.log_capture_head_kb * 1024,
+                                        Settings.log_capture_tail_kb * 1024)
+
     @staticmethod
     def rm_file(filename):
         Path(filename).unlink(missing_ok=True)
 
     @staticmethod
-    def try_extract_error(invocation, exception: AggregatedOperationError):
-        failed_tasks = xopera_util.try_get_failed_tasks(invocation.stdout)
+    def try_extract_error(invocation, exception: AggregatedOperationError, task_results: list = None):
+        if task_results:
+            failed_tasks = xopera_util.get_failed_tasks(task_results)
+        else:
+            # callback plugin did not run, fall back to parsing stdout
+            failed_tasks = xopera_util.try_get_failed_tasks(invocation.stdout)
 
         result = {}
         for _, inner_ex in exception.inner_exceptions.items():
@@ -338,20 +749,37 @@ class InvocationWorkerProcess:
 
 class InvocationService:
 
-    def __init__(self, workers_num=10):
+    def __init__(self, workers_num=10, work_queue: multiprocessing.Queue = None, instance_id: str = None):
         """
         Initializes InvocationService
 
-        It creates work_queue for invocations and workers_pool with [workers_num] workers
+        It creates work_queue for invocations and workers_pool with [workers_num] workers. With work_queue, service
+        only submits invocations to existing workers.
         Args:
             workers_num: number of workers
+            work_queue: work_queue of existing workers_pool
+            instance_id: owner_id of heartbeat of instance, holding work_queue
         """
+        if work_queue:
+            self.work_queue = work_queue
+            self.workers_pool = None
+            self.instance_id = instance_id
+            return
+        xopera_util.cleanup_stale_agents()
+        # pending invocations live in work_queue of this instance only, they are saved with its heartbeat
+        self.heartbeat = Heartbeat('instance')
+        self.instance_id = self.heartbeat.owner_id
         self.work_queue: multiprocessing.Queue = multiprocessing.Queue()
-        self.workers_pool = multiprocessing.Pool(workers_num, InvocationWorkerProcess.run_internal, (self.work_queue,))
+        with Heartbeat.paused():
+            self.workers_pool = multiprocessing.Pool(workers_num, InvocationWorkerProcess.run_internal,
+                                                     (self.work_queue, self.instance_id))
+        self.heartbeat.start()
 
     def invoke(self, operation_type: OperationType, blueprint_id: uuid, version_id: uuid,
                workers: int, inputs: dict, deployment_id: uuid = None, username: str = None,
-               clean_state: bool = None, deployment_label: str = None, access_token: str = None) -> Invocation:
+               clean_state: bool = None, deployment_label: str = None, access_token: str = None,
+               profile: dict = None, rollout_id: str = None, admission: bool = True,
+               idempotency_key: str = None, require_idle: bool = False) -> Invocation:
 
         now = datetime.datetime.now(tz=datetime.timezone.utc)
         logger.info("Invoking %s with ID %s at %s", operation_type, deployment_id, now.isoformat())
@@ -372,17 +800,207 @@ class InvocationService:
         inv.exception = None
         inv.stdout = None
         inv.stderr = None
-        inv.workers = workers
+        inv.profile = self.execution_profile(blueprint_id, deployment_id, dict(profile or {}, workers=workers))
+        inv.workers = inv.profile.workers or 1
         inv.clean_state = clean_state
         inv.user_id = username
         inv.access_token = access_token
+        inv.rollout_id = rollout_id
+
+        request = dict(version_id=version_id, inputs=inputs, workers=workers, clean_state=clean_state,
+                       profile=profile, deployment_label=deployment_label)
+        fingerprint = self.fingerprint(operation_type, blueprint_id, deployment_id, request)
+        with self.idempotent(idempotency_key, username, fingerprint) as replayed:
+            if replayed:
+                return replayed
+            # checked after replay, so retry of still running invocation gets it instead of refusal
+            if require_idle and deployment_id:
+                status = PostgreSQL.get_deployment_status(deployment_id)
+                if status and status.state in [InvocationState.PENDING, InvocationState.IN_PROGRESS]:
+                    raise DeploymentBusy("Previous operation on this deployment still running")
+            with self.admit(blueprint_id, username) if admission else contextlib.nullcontext():
+                self.stdstream_dir(inv.deployment_id).mkdir(parents=True, exist_ok=True)
+                self.save_invocation(invocation_id, inv, self.instance_id)
+                if idempotency_key:
+                    PostgreSQL.save_idempotency_key(idempotency_key, username, fingerprint, invocation_id)
+
+            self.work_queue.put(inv)
+        return inv
 
-        self.stdstream_dir(inv.deployment_id).mkdir(parents=True, exist_ok=True)
-        self.save_invocation(invocation_id, inv)
+    @staticmethod
+    def fingerprint(operation_type: OperationType, blueprint_id: uuid, deployment_id: uuid = None,
+                    request: dict = None) -> str:
+        """
+        Identifies request, submitted with Idempotency-Key, by operation, target and hash of request parameters
+        """
+        digest = hashlib.sha256(json.dumps(request or {}, sort_keys=True, default=str).encode()).hexdigest()
+        return f"{operation_type}/{blueprint_id}/{deployment_id or ''}/{digest}"
 
-        self.work_queue.put(inv)
+    @classmethod
+    def replay(cls, idempotency_key: Optional[str], username: Optional[str], fingerprint: str) -> Optional[Invocation]:
+        """
+        Returns invocation, submitted with the same Idempotency-Key by the same user, if any. Raises
+        IdempotencyKeyReused, if key was used for different request.
+        """
+        if not idempotency_key:
+            return None
+        saved = PostgreSQL.get_idempotency_key(idempotency_key, username, Settings.idempotency_key_ttl)
+        if not saved:
+            return None
+        saved_fingerprint, inv = saved
+        if saved_fingerprint != fingerprint:
+            raise IdempotencyKeyReused(f"Idempotency-Key {idempotency_key} was already used for another request")
+        logger.info(f"Replaying invocation of {inv.deployment_id} with Idempotency-Key {idempotency_key}")
         return inv
 
+    @classmethod
+    @contextlib.contextmanager
+    def idempotent(cls, idempotency_key: Optional[str], username: Optional[str], fingerprint: str):
+        """
+        Yields invocation, submitted with the same Idempotency-Key, else None. Concurrent submissions with the same
+        key wait for each other, so only the first one is queued.
+        """
+        if not idempotency_key:
+            yield None
+            return
+        with PostgreSQL.advisory_lock(f'idempotency/{username or ""}/{idempotency_key}'):
+            yield cls.replay(idempotency_key, username, fingerprint)
+
+    @classmethod
+    @contextlib.contextmanager
+    def admit(cls, blueprint_id: uuid, username: str = None):
+        """
+        Raises AdmissionRejected, if pending and running invocations reach any of admission limits. Counting and
+        saving of new invocation are serialized among instances, so burst of submissions cannot overshoot limits.
+        """
+        limits = [(Settings.admission_max_invocations, 'total'),
+                  (Settings.admission_max_invocations_project, 'project'),
+                  (Settings.admission_max_invocations_user, 'user')]
+        if not any(limit for limit, _ in limits):
+            yield
+            return
+
+        with PostgreSQL.advisory_lock('admission'):
+            project_domain = PostgreSQL.get_project_domain(blueprint_id) if limits[1][0] else None
+            counts = PostgreSQL.count_unfinished_invocations(username, project_domain)
+            cls.publish_queue_depth(counts)
+            for limit, scope in limits:
+                if not limit or (scope == 'project' and not project_domain) or (scope == 'user' and not username):
+                    continue
+                if counts[scope] >= limit:
+                    metrics.INVOCATIONS_REJECTED.labels(scope).inc()
+                    of = {'total': 'in total', 'project': f'of project {project_domain}', 'user': f'of user {username}'}
+                    raise AdmissionRejected(f"Too many invocations {of[scope]}: {counts[scope]} pending or running, "
+                                            f"limit is {limit}", Settings.admission_retry_after)
+            yield
+
+    @classmethod
+    def publish_queue_depth(cls, counts: dict = None):
+        """
+        Sets queue depth metric from counts of unfinished invocations, counts them, if not given
+        """
+        counts = counts or PostgreSQL.count_unfinished_invocations()
+        metrics.INVOCATION_QUEUE_DEPTH.labels(InvocationState.PENDING).set(counts['pending'])
+        metrics.INVOCATION_QUEUE_DEPTH.labels(InvocationState.IN_PROGRESS).set(counts['total'] - counts['pending'])
+
+    def rollout_update(self, rollout: Rollout, deployment_id: str, username: str = None,
+                       access_token: str = None) -> Invocation:
+        """
+        Submits update of deployment to blueprint version of rollout. Updates bypass admission control: rollout
+        limits them with max_parallel already, and update rejected in the middle of rollout would count as failed
+        deployment and could exhaust failure budget. Update is not submitted with expired access token, it would only
+        fail on Vault.
+        """
+        if access_token and xopera_util.token_expired(access_token):
+            raise RolloutCredentialsExpired(f"Access token of user {username} expired, next updates of rollout "
+                                            f"could not load SSH keys from Vault, start new rollout")
+        inv = PostgreSQL.get_deployment_status(deployment_id)
+        if not inv:
+            raise RuntimeError(f"Deployment {deployment_id} does not exist")
+        if inv.state in [InvocationState.PENDING, InvocationState.IN_PROGRESS]:
+            raise RuntimeError(f"Previous operation on deployment {deployment_id} still running")
+        return self.invoke(OperationType.UPDATE, rollout.blueprint_id, rollout.version_id, workers=None,
+                           inputs=rollout.inputs, deployment_id=deployment_id, username=username,
+                           access_token=access_token, profile=rollout.profile and rollout.profile.to_dict(),
+                           rollout_id=rollout.rollout_id, admission=False)
+
+    def reconcile(self) -> int:
+        """
+        Marks invocations, left behind by dead workers, interrupted (see Heartbeat.orphaned).
+        Returns number of interrupted invocations
+        """
+        heartbeats = Heartbeat.alive()
+
+        interrupted = 0
+        for invocation_id, inv, instance_id in PostgreSQL.get_unfinished_invocations():
+            if Heartbeat.orphaned(heartbeats, invocation_id, inv.state, inv.timestamp_submission, instance_id):
+                self.interrupt(invocation_id, inv, reclaim=not Heartbeat.unconfirmed(heartbeats, invocation_id))
+                interrupted += 1
+        PostgreSQL.delete_heartbeats(Heartbeat.dead(heartbeats))
+        return interrupted
+
+    def interrupt(self, invocation_id: str, inv: Invocation, reclaim: bool = True):
+        """
+        Marks invocation interrupted. Partial .opera state, logs and task results, left on this host, are saved,
+        workdir and stdstream dir are removed. With reclaim False (worker may still run on other host), they are left
+        alone.
+        """
+        logger.warning(f"Invocation {invocation_id} of deployment_id={inv.deployment_id} has no live worker, "
+                       f"marking it interrupted")
+        inv.state = InvocationState.INTERRUPTED
+        inv.timestamp_end = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+        inv.exception = "Invocation was interrupted, its worker stopped before it finished"
+
+        location = self.deployment_location(inv.deployment_id, inv.blueprint_id)
+        if reclaim:
+            try:
+                if (location / '.opera').exists():
+                    inv.instance_state = self.get_instance_state(location)
+                    self.save_dot_opera_to_db(inv, location)
+                task_results_file = self.task_results_file(location)
+                if task_results_file.exists():
+                    PostgreSQL.save_task_results(invocation_id, inv.deployment_id, inv.timestamp_submission,
+                                                 xopera_util.read_task_results(task_results_file))
+                for stream in ('stdout', 'stderr'):
+                    log_file = self.stdout_file(inv.deployment_id) if stream == 'stdout' \
+                        else self.stderr_file(inv.deployment_id)
+                    if not log_file.exists():
+                        continue
+                    log, truncated = InvocationWorkerProcess.read_log(log_file)
+                    setattr(inv, stream, log)
+                    if truncated:
+                        self.save_full_log(invocation_id, inv, stream)
+            except Exception as e:
+                logger.error(f"Could not salvage state of invocation {invocation_id}: {str(e)}")
+
+            WorkdirService.reclaim(location)
+            WorkdirService.reclaim(location.parent / f'{location.name}-old')
+            WorkdirService.reclaim(self.stdstream_dir(inv.deployment_id))
+
+        self.save_invocation(invocation_id, inv)
+        metrics.INVOCATIONS_INTERRUPTED.labels(inv.operation).inc()
+
+        if inv.rollout_id:
+            try:
+                # access token is not saved with invocation, rollout keeps it
+                RolloutService.advance(inv.rollout_id, inv.deployment_id, inv.state, functools.partial(
+                    self.rollout_update, username=inv.user_id,
+                    access_token=PostgreSQL.get_rollout_access_token(inv.rollout_id)))
+            except Exception as e:
+                logger.error(f"Could not advance rollout {inv.rollout_id}: {str(e)}")
+
+    @classmethod
+    def execution_profile(cls, blueprint_id: uuid, deployment_id: Optional[uuid], overrides: dict) -> ExecutionProfile:
+        """
+        Effective execution profile of invocation. Deployment's profile overrides blueprint's, settings of request
+        override both.
+        """
+        profile = dict(PostgreSQL.get_execution_profile(blueprint_id) or {})
+        if deployment_id:
+            profile.update(PostgreSQL.get_execution_profile(deployment_id) or {})
+        profile.update({key: value for key, value in overrides.items() if value is not None})
+        return ExecutionProfile.from_dict(profile)
+
     @classmethod
     def stdstream_dir(cls, deployment_id: uuid) -> Path:
         return Path(Settings.STDFILE_DIR) / str(deployment_id)
@@ -395,9 +1013,31 @@ class InvocationService:
     def stderr_file(cls, deployment_id: str) -> Path:
         return cls.stdstream_dir(deployment_id) / 'stderr.txt'
 
+    @classmethod
+    def task_results_file(cls, location: Path) -> Path:
+        """
+        File, where Ansible callback plugin writes task results. It is inside location, so it is writable by
+        system user of invocation and deleted together with location.
+        """
+        return location / '.task_results.jsonl'
+
+    @classmethod
+    def facts_dir(cls, location: Path) -> Path:
+        """
+        Ansible's fact cache of invocation, kept next to .opera
+        """
+        return Path(location).absolute() / '.facts'
+
     @classmethod
     def deployment_location(cls, deployment_id: uuid, blueprint_id: uuid) -> Path:
-        return (Path(Settings.DEPLOYMENT_DIR) / str(blueprint_id) / str(deployment_id)).absolute()
+        """
+        Workdir of invocation on tmpfs or disk, where it already exists, else where new workdir should be created
+        """
+        for root in WorkdirService.deployment_roots():
+            location = root / str(blueprint_id) / str(deployment_id)
+            if location.exists():
+                return location
+        return WorkdirService.deployment_root() / str(blueprint_id) / str(deployment_id)
 
     @classmethod
     def load_invocation(cls, deployment_id: str) -> Optional[Invocation]:
@@ -407,8 +1047,8 @@ class InvocationService:
             return None
         try:
             if inv.state == InvocationState.IN_PROGRESS:
-                inv.stdout = InvocationWorkerProcess.read_file(cls.stdout_file(inv.deployment_id))
-                inv.stderr = InvocationWorkerProcess.read_file(cls.stderr_file(inv.deployment_id))
+                inv.stdout, _ = InvocationWorkerProcess.read_log(cls.stdout_file(inv.deployment_id))
+                inv.stderr, _ = InvocationWorkerProcess.read_log(cls.stderr_file(inv.deployment_id))
                 location = InvocationService.deployment_location(inv.deployment_id, inv.blueprint_id)
                 inv.instance_state = InvocationService.get_instance_state(location)
         except BaseException as e:
@@ -419,14 +1059,44 @@ class InvocationService:
 
         return inv
 
+    @classmethod
+    def status_version(cls, deployment_id: str) -> Optional[tuple]:
+        """
+        Version of deployment status, without loading invocation. Status of running invocation is completed with
+        logs and instance state from workdir, so their sizes and modification times are part of version.
+        """
+        version = PostgreSQL.get_deployment_status_version(deployment_id)
+        if not version or version[2] != InvocationState.IN_PROGRESS:
+            return version
+        location = cls.deployment_location(deployment_id, version[1])
+        files = [cls.stdout_file(deployment_id), cls.stderr_file(deployment_id)]
+        files += sorted((location / '.opera' / 'instances').glob('*'))
+        stats = []
+        for path in files:
+            try:
+                stat = path.stat()
+                stats.append((path.name, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                stats.append((path.name, None, None))
+        return version + tuple(stats)
+
     @classmethod
     def deployment_exists(cls, inv: Invocation) -> bool:
         """Check if records about deployment exist in DB"""
         return PostgreSQL.get_deployment_status(inv.deployment_id) is not None
 
     @classmethod
-    def save_invocation(cls, invocation_id: uuid, inv: Invocation):
-        PostgreSQL.update_deployment_log(invocation_id, inv)
+    def save_invocation(cls, invocation_id: uuid, inv: Invocation, instance_id: str = None):
+        PostgreSQL.update_deployment_log(invocation_id, inv, instance_id)
+
+    @classmethod
+    def save_full_log(cls, invocation_id: uuid, inv: Invocation, stream: str):
+        """
+        Saves compressed full log of truncated stream, so it can be downloaded later
+        """
+        log_file = cls.stdout_file(inv.deployment_id) if stream == 'stdout' else cls.stderr_file(inv.deployment_id)
+        PostgreSQL.save_invocation_log(invocation_id, inv.deployment_id, inv.timestamp_submission, stream,
+                                       file_util.compress_file(log_file))
 
     @classmethod
     def save_dot_opera_to_db(cls, inv: Invocation, location: Path) -> None:
@@ -434,22 +1104,45 @@ class InvocationService:
         PostgreSQL.save_opera_session_data(inv.deployment_id, data)
 
     @classmethod
-    def get_dot_opera_from_db(cls, deployment_id: uuid, location: Path) -> bool:
+    def get_dot_opera_from_db(cls, deployment_id: uuid, location: Path, owner: tuple = None) -> bool:
         dot_opera_data = PostgreSQL.get_opera_session_data(deployment_id)
         if not dot_opera_data:
             logger.error(f"sqldb_service.get_opera_session_data failed: deployment_id: {deployment_id}")
             return False
         else:
-            file_util.json_to_dir(dot_opera_data['tree'], (location / '.opera'))
+            file_util.json_to_dir(dot_opera_data['tree'], (location / '.opera'), owner)
             return True
 
+    @classmethod
+    def save_ansible_facts(cls, inv: Invocation, location: Path) -> None:
+        if Settings.fact_cache_ttl <= 0:
+            return
+        if inv.operation == OperationType.UNDEPLOY and inv.state == InvocationState.SUCCESS:
+            # hosts are gone
+            facts = {}
+        else:
+            facts = xopera_util.read_fact_cache(cls.facts_dir(location))
+        PostgreSQL.save_ansible_facts(inv.deployment_id, facts)
+
+    @classmethod
+    def restore_ansible_facts(cls, deployment_id: uuid, location: Path, owner: tuple = None) -> None:
+        if Settings.fact_cache_ttl <= 0:
+            return
+        try:
+            facts = PostgreSQL.get_ansible_facts(deployment_id)
+        except SqlDBFailedException as e:
+            logger.warning(f"Could not get cached facts: {str(e)}")
+            return
+        restored = xopera_util.write_fact_cache(facts, cls.facts_dir(location), owner)
+        logger.debug(f"Restored cached facts of {restored} hosts of deployment_id={deployment_id}")
+
     @classmethod
     def prepare_location(cls, deployment_id: uuid, location: Path):
         """
         Prepare location with blueprint and session_data (.opera dir)
         """
         inv = PostgreSQL.get_deployment_status(deployment_id)
-        if not CSAR_db.get_revision(inv.blueprint_id, location, inv.version_tag):
+        if not CSAR_db.get_revision(inv.blueprint_id, location, inv.version_id):
             logger.error(f'csardb_service.get_revision failed: blueprint_id: {inv.blueprint_id}, '
                          f'location: {location}, version_d: {inv.version_id}')
         InvocationService.get_dot_opera_from_db(deployment_id, location)
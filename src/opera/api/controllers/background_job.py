@@ -0,0 +1,245 @@
+import datetime
+import hashlib
+import json
+import multiprocessing
+import traceback
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from werkzeug.datastructures import FileStorage
+
+from opera.api.controllers.background_invocation import Heartbeat, InvocationWorkerProcess
+from opera.api.log import get_logger
+from opera.api.openapi.models import BlueprintValidation, InvocationState, Job, JobType
+from opera.api.service.sqldb_service import PostgreSQL, SqlDBFailedException
+from opera.api.service.workdir_service import WorkdirService
+from opera.api.settings import Settings
+from opera.api.util import metrics, xopera_util
+
+logger = get_logger(__name__)
+
+
+class ExtendedJob(Job):
+    def __init__(self, inputs=None, csar_path=None, cache_key=None,
+                 job_id=None, job_type=None, state=None, blueprint_id=None,
+                 version_id=None, deployment_id=None, timestamp_submission=None, timestamp_start=None,
+                 timestamp_end=None, cached=None, result=None, exception=None):
+        super().__init__(job_id=job_id, job_type=job_type, state=state, blueprint_id=blueprint_id,
+                         version_id=version_id, deployment_id=deployment_id,
+                         timestamp_submission=timestamp_submission,
+                         timestamp_start=timestamp_start, timestamp_end=timestamp_end, cached=cached,
+                         result=result, exception=exception)
+        self.inputs = inputs
+        self.csar_path = csar_path
+        self.cache_key = cache_key
+
+
+class JobWorkerProcess:
+
+    @staticmethod
+    def run_internal(work_queue: multiprocessing.Queue):
+
+        metrics.WORKERS.labels('job').inc()
+        heartbeat = Heartbeat('worker')
+        heartbeat.start()
+        while True:
+            job: ExtendedJob = work_queue.get(block=True)
+            job.timestamp_start = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+            metrics.WORKERS_BUSY.labels('job').inc()
+            # claim job before it is in progress, so reconciler does not take it for orphan
+            heartbeat.claim(job.job_id)
+            job.state = InvocationState.IN_PROGRESS
+            JobService.save_job(job)
+
+            try:
+                job.result = JobWorkerProcess.run_job(job)
+                job.state = InvocationState.SUCCESS
+            except BaseException as e:
+                job.state = InvocationState.FAILED
+                job.exception = "{}: {}\n\n{}".format(e.__class__.__name__, str(e), traceback.format_exc())
+            finally:
+                job.timestamp_end = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+                JobService.save_job(job)
+                WorkdirService.reclaim(JobService.job_dir(job.job_id))
+                heartbeat.claim(None)
+                metrics.WORKERS_BUSY.labels('job').dec()
+
+    @staticmethod
+    def run_job(job: ExtendedJob) -> dict:
+        if job.job_type == JobType.VALIDATE:
+            exception = InvocationWorkerProcess.validate(job.blueprint_id, job.version_id, job.inputs)
+        elif job.job_type == JobType.VALIDATE_NEW:
+            exception = InvocationWorkerProcess.validate_csar(job.csar_path, job.inputs)
+        elif job.job_type == JobType.DIFF:
+            return InvocationWorkerProcess.diff(job.deployment_id, job.blueprint_id, job.version_id,
+                                                job.inputs, JobService.job_dir(job.job_id)).outputs()
+        else:
+            raise RuntimeError("Unknown job type:" + str(job.job_type))
+
+        return xopera_util.model_to_dict(BlueprintValidation(exception is None, exception))
+
+
+class JobService:
+
+    def __init__(self, workers_num=2):
+        """
+        Initializes JobService
+
+        Jobs are short-lived (e.g. validation), so they get their own work_queue and workers_pool with
+        [workers_num] workers and do not wait behind long running deployments in InvocationService
+        Args:
+            workers_num: number of workers
+        """
+        # pending jobs live in work_queue of this instance only, they are saved with its heartbeat
+        self.heartbeat = Heartbeat('instance')
+        self.work_queue: multiprocessing.Queue = multiprocessing.Queue()
+        with Heartbeat.paused():
+            self.workers_pool = multiprocessing.Pool(workers_num, JobWorkerProcess.run_internal, (self.work_queue,))
+        self.heartbeat.start()
+
+    def submit(self, job_type: JobType, cache_key: str = None, blueprint_id: uuid = None, version_id: str = None,
+               deployment_id: uuid = None, inputs: dict = None, csar: FileStorage = None,
+               username: str = None) -> Job:
+
+        now = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+        job = ExtendedJob()
+        job.job_id = str(uuid.uuid4())
+        job.job_type = job_type
+        job.state = InvocationState.PENDING
+        job.blueprint_id = blueprint_id and str(blueprint_id)
+        job.version_id = version_id
+        job.deployment_id = deployment_id and str(deployment_id)
+        job.timestamp_submission = now
+        job.inputs = inputs
+        job.cache_key = cache_key
+        logger.info("Submitting %s job with ID %s at %s", job_type, job.job_id, now)
+
+        cached = self.load_cached(cache_key)
+        if cached:
+            job.state = InvocationState.SUCCESS
+            job.cached = True
+            job.result = cached.result
+            job.timestamp_start = now
+            job.timestamp_end = now
+            self.save_job(job, username)
+            return job
+
+        if csar:
+            job.csar_path = self.job_dir(job.job_id) / Path(csar.filename).name
+            job.csar_path.parent.mkdir(parents=True, exist_ok=True)
+            csar.save(str(job.csar_path))
+
+        self.save_job(job, username, self.heartbeat.owner_id)
+        self.work_queue.put(job)
+        return job
+
+    @classmethod
+    def reconcile(cls) -> int:
+        """
+        Marks jobs, left behind by dead workers, interrupted (see Heartbeat.orphaned).
+        Returns number of interrupted jobs
+        """
+        heartbeats = Heartbeat.alive()
+
+        interrupted = 0
+        for job, instance_id in PostgreSQL.get_unfinished_jobs():
+            if Heartbeat.orphaned(heartbeats, job.job_id, job.state, job.timestamp_submission, instance_id):
+                logger.warning(f"Job {job.job_id} has no live worker, marking it interrupted")
+                job.state = InvocationState.INTERRUPTED
+                job.timestamp_end = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+                job.exception = "Job was interrupted, its worker stopped before it finished"
+                PostgreSQL.update_job(job)
+                if not Heartbeat.unconfirmed(heartbeats, job.job_id):
+                    WorkdirService.reclaim(cls.job_dir(job.job_id))
+                interrupted += 1
+        return interrupted
+
+    @classmethod
+    def job_dir(cls, job_id: uuid) -> Path:
+        return (Path(Settings.JOB_DIR) / str(job_id)).absolute()
+
+    @classmethod
+    def save_job(cls, job: ExtendedJob, username: str = None, instance_id: str = None):
+        PostgreSQL.update_job(job, job.cache_key, username, instance_id)
+
+    @classmethod
+    def save_result(cls, job_type: JobType, result, cache_key: str,
+                    blueprint_id: uuid = None, version_id: str = None, deployment_id: uuid = None):
+        """
+        Records result of synchronously run job, so it can be served from cache next time
+        """
+        if not cache_key:
+            return
+        now = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+        job = ExtendedJob(job_id=str(uuid.uuid4()), job_type=job_type, state=InvocationState.SUCCESS,
+                          blueprint_id=blueprint_id and str(blueprint_id), version_id=version_id,
+                          deployment_id=deployment_id and str(deployment_id), timestamp_submission=now,
+                          timestamp_start=now, timestamp_end=now,
+                          result=xopera_util.model_to_dict(result), cache_key=cache_key)
+        try:
+            cls.save_job(job)
+        except SqlDBFailedException as e:
+            logger.warning(f"Could not cache result of {job_type} job: {str(e)}")
+
+    @classmethod
+    def load_cached(cls, cache_key: str) -> Optional[Job]:
+        if not cache_key:
+            return None
+        try:
+            return PostgreSQL.get_cached_job(cache_key)
+        except SqlDBFailedException as e:
+            logger.warning(f"Could not load cached job: {str(e)}")
+            return None
+
+    @classmethod
+    def cache_key(cls, *parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    @classmethod
+    def blueprint_cache_key(cls, job_type: JobType, blueprint_id: uuid, version_id: str,
+                            inputs: dict) -> Optional[str]:
+        """
+        Cache key of job on blueprint version, which is identified by its commit, None if it cannot be cached
+        """
+        try:
+            blueprint_meta = PostgreSQL.get_blueprint_meta(blueprint_id, version_id)
+        except SqlDBFailedException as e:
+            logger.warning(f"Could not get blueprint meta: {str(e)}")
+            return None
+        if not blueprint_meta or not blueprint_meta.get('commit_sha'):
+            return None
+        return cls.cache_key(job_type, str(blueprint_id), blueprint_meta['version_id'],
+                             blueprint_meta['commit_sha'], inputs)
+
+    @classmethod
+    def diff_cache_key(cls, deployment_id: uuid, blueprint_id: uuid, version_id: str,
+                       inputs: dict) -> Optional[str]:
+        """
+        Cache key of diff between deployment state and blueprint version, None if it cannot be cached
+        """
+        try:
+            state_hash = PostgreSQL.get_opera_session_data_hash(deployment_id)
+            inv_old = PostgreSQL.get_last_completed_invocation(deployment_id)
+        except SqlDBFailedException as e:
+            logger.warning(f"Could not get deployment state: {str(e)}")
+            return None
+        if not state_hash or not inv_old:
+            return None
+        blueprint_key = cls.blueprint_cache_key(JobType.DIFF, blueprint_id, version_id, inputs)
+        if not blueprint_key:
+            return None
+        return cls.cache_key(str(deployment_id), state_hash, str(inv_old.blueprint_id), inv_old.version_id,
+                             blueprint_key)
+
+    @classmethod
+    def csar_cache_key(cls, job_type: JobType, csar: FileStorage, inputs: dict, username: str = None) -> str:
+        """
+        Cache key of job on uploaded CSAR, which is identified by its content. Uploaded CSAR is not bound to any
+        project, so results are cached for the user only.
+        """
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: csar.stream.read(65536), b''):
+            digest.update(chunk)
+        csar.stream.seek(0)
+        return cls.cache_key(job_type, digest.hexdigest(), inputs, username or None)
@@ -0,0 +1,164 @@
+import datetime
+import fcntl
+import shutil
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from opera.api.cli import CSAR_db
+from opera.api.log import get_logger
+from opera.api.openapi.models import ExecutionProfile, Invocation, InvocationState, Rollout, RolloutDeployment, \
+    RolloutDeploymentState, RolloutRequest, RolloutState
+from opera.api.service.sqldb_service import PostgreSQL
+from opera.api.service.workdir_service import WorkdirService
+from opera.api.settings import Settings
+
+logger = get_logger(__name__)
+
+DEPLOYMENT_STATES = [RolloutDeploymentState.PENDING, RolloutDeploymentState.IN_PROGRESS, RolloutDeploymentState.SUCCESS,
+                     RolloutDeploymentState.FAILED, RolloutDeploymentState.SKIPPED]
+
+
+class RolloutCredentialsExpired(Exception):
+    """
+    Access token, rollout was started with, expired, so next updates could not load SSH keys of user from Vault
+    """
+
+
+class RolloutService:
+
+    @classmethod
+    def create(cls, blueprint_id: uuid, version_id: str, request: RolloutRequest, profile: dict = None) -> Rollout:
+        canary = min(request.canary, len(request.deployment_ids))
+        rollout = Rollout(
+            rollout_id=str(uuid.uuid4()),
+            blueprint_id=str(blueprint_id),
+            version_id=version_id,
+            state=RolloutState.IN_PROGRESS,
+            max_parallel=request.max_parallel,
+            failure_budget=request.failure_budget,
+            canary=canary,
+            inputs=request.inputs,
+            profile=ExecutionProfile.from_dict(profile) if profile else None,
+            timestamp_submission=datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            deployments=[RolloutDeployment(deployment_id=str(deployment_id), state=RolloutDeploymentState.PENDING,
+                                            canary=i < canary)
+                         for i, deployment_id in enumerate(request.deployment_ids)]
+        )
+        cls.update_progress(rollout)
+        return rollout
+
+    @classmethod
+    def update_progress(cls, rollout: Rollout):
+        counts = Counter(item.state for item in rollout.deployments)
+        rollout.progress = {state: counts.get(state, 0) for state in DEPLOYMENT_STATES}
+
+    @classmethod
+    def schedule(cls, rollout: Rollout) -> List[RolloutDeployment]:
+        """
+        Decides, which pending deployments are updated next and marks them in_progress. Once canaries or failure
+        budget fail or rollout got exception, pending deployments are skipped. Rollout ends, when no deployment is
+        pending or in progress.
+        """
+        if rollout.state != RolloutState.IN_PROGRESS:
+            return []
+
+        failed = [item for item in rollout.deployments if item.state == RolloutDeploymentState.FAILED]
+        canary_failed = any(item.canary for item in failed)
+        stopped = canary_failed or len(failed) > rollout.failure_budget or bool(rollout.exception)
+        if stopped:
+            for item in rollout.deployments:
+                if item.state == RolloutDeploymentState.PENDING:
+                    item.state = RolloutDeploymentState.SKIPPED
+
+        running = [item for item in rollout.deployments if item.state == RolloutDeploymentState.IN_PROGRESS]
+        canaries_done = all(item.state == RolloutDeploymentState.SUCCESS for item in rollout.deployments if item.canary)
+        candidates = [item for item in rollout.deployments
+                      if item.state == RolloutDeploymentState.PENDING and (item.canary or canaries_done)]
+        scheduled = candidates[:max(rollout.max_parallel - len(running), 0)]
+        for item in scheduled:
+            item.state = RolloutDeploymentState.IN_PROGRESS
+
+        if not running and not scheduled:
+            rollout.state = RolloutState.FAILED if stopped else RolloutState.SUCCESS
+            rollout.timestamp_end = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+            WorkdirService.reclaim(cls.rollout_dir(rollout.rollout_id))
+        cls.update_progress(rollout)
+        return scheduled
+
+    @classmethod
+    def submit_next(cls, rollout: Rollout, submit: Callable[[Rollout, str], Invocation], access_token: str = None):
+        """
+        Submits updates of scheduled deployments. Deployment, whose update could not be submitted, counts as failed.
+        Once access token of rollout expired, no update is submitted any more, rollout fails with exception.
+        """
+        scheduled = cls.schedule(rollout)
+        while scheduled:
+            for item in scheduled:
+                if rollout.exception:
+                    item.state = RolloutDeploymentState.SKIPPED
+                    continue
+                try:
+                    inv = submit(rollout, item.deployment_id)
+                    item.timestamp_submission = inv.timestamp_submission
+                except RolloutCredentialsExpired as e:
+                    logger.error(f"Rollout {rollout.rollout_id} is stopped: {str(e)}")
+                    rollout.exception = str(e)
+                    item.state = RolloutDeploymentState.SKIPPED
+                except Exception as e:
+                    logger.warning(f"Could not submit update of {item.deployment_id} in rollout "
+                                   f"{rollout.rollout_id}: {str(e)}")
+                    item.state = RolloutDeploymentState.FAILED
+            scheduled = cls.schedule(rollout)
+        PostgreSQL.save_rollout(rollout, access_token)
+
+    @classmethod
+    def start(cls, rollout: Rollout, submit: Callable[[Rollout, str], Invocation], access_token: str = None):
+        """
+        Submits first updates. Access token of user is saved with rollout, until it ends, so updates, submitted after
+        interrupted ones, can load SSH keys of user as well.
+        """
+        with PostgreSQL.advisory_lock(rollout.rollout_id):
+            cls.submit_next(rollout, submit, access_token)
+
+    @classmethod
+    def advance(cls, rollout_id: str, deployment_id: str, state: InvocationState,
+                submit: Callable[[Rollout, str], Invocation]) -> Optional[Rollout]:
+        """
+        Records result of deployment's update and submits next updates. Called by worker, which ran the update,
+        lock serializes workers, finishing updates of the same rollout at once.
+        """
+        with PostgreSQL.advisory_lock(rollout_id):
+            rollout = PostgreSQL.get_rollout(rollout_id)
+            if not rollout:
+                logger.error(f"Rollout {rollout_id} does not exist")
+                return None
+            for item in rollout.deployments:
+                if item.deployment_id == str(deployment_id) and item.state == RolloutDeploymentState.IN_PROGRESS:
+                    item.state = RolloutDeploymentState.SUCCESS if state == InvocationState.SUCCESS \
+                        else RolloutDeploymentState.FAILED
+            cls.submit_next(rollout, submit)
+            return rollout
+
+    @classmethod
+    def rollout_dir(cls, rollout_id: str) -> Path:
+        return (Path(Settings.ROLLOUT_DIR) / str(rollout_id)).absolute()
+
+    @classmethod
+    def revision(cls, rollout_id: str, blueprint_id: str, version_id: str) -> Optional[Path]:
+        """
+        Blueprint revision of rollout, fetched from git by first update and shared by all updates of rollout
+        """
+        rollout_dir = cls.rollout_dir(rollout_id)
+        rollout_dir.mkdir(parents=True, exist_ok=True)
+        revision = rollout_dir / 'revision'
+        with open(rollout_dir / '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not revision.exists():
+                tmp = rollout_dir / f'tmp-{uuid.uuid4()}'
+                if not CSAR_db.get_revision(blueprint_id, tmp, version_id):
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    return None
+                tmp.rename(revision)
+        return revision
@@ -6,7 +6,7 @@ from opera.api.controllers import security_controller
 from opera.api.log import get_logger
 from opera.api.openapi.models import Blueprint, BlueprintVersion
 from opera.api.settings import Settings
-from opera.api.util import timestamp_util
+from opera.api.util import pagination, timestamp_util
 
 logger = get_logger(__name__)
 
@@ -61,7 +61,7 @@ def post_new_blueprint(revision_msg=None, blueprint_name=None, aadm_id=None, use
     return blueprint_meta, 201
 
 
-def get_blueprints_user_domain(username=None, project_domain=None, active=True):
+def get_blueprints_user_domain(username=None, project_domain=None, active=True, limit=None, after=None, fields=None):
     """Get blueprints for user or project domain
 
     :param username: username
@@ -70,18 +70,32 @@ def get_blueprints_user_domain(username=None, project_domain=None, active=True):
     :type project_domain: str
     :param active: Obtain only list of blueprints with deployments.
     :type active: bool
+    :param limit: Maximum number of items in response
+    :type limit: int
+    :param after: Cursor of page
+    :type after: str
+    :param fields: Return only selected fields of items
+    :type fields: List[str]
 
     :rtype: List[Blueprint]
     """
     if not username and not project_domain:
         return "At least on of (user, project_domain) must be present", 400
 
-    data = PostgreSQL.get_blueprints_by_user_or_project(username=username, project_domain=project_domain, active=active)
+    try:
+        after_keys = pagination.decode_cursor(after)
+        pagination.check_fields(Blueprint, fields)
+    except ValueError as e:
+        return str(e), 400
 
-    if not data:
+    data = PostgreSQL.get_blueprints_by_user_or_project(username=username, project_domain=project_domain, active=active,
+                                                        limit=limit, after=after_keys)
+
+    if not data and not after:
         return "Blueprints not found", 404
 
-    return [Blueprint.from_dict(datum) for datum in data], 200
+    headers = pagination.next_cursor_headers(data, limit, lambda x: (x['timestamp'], x['blueprint_id']))
+    return pagination.select_fields([Blueprint.from_dict(datum) for datum in data], fields), 200, headers
 
 
 @security_controller.check_role_auth_blueprint
@@ -146,6 +160,7 @@ def delete_blueprint(blueprint_id, force=None):
 
     if status_code == 200:
         PostgreSQL.delete_blueprint_meta(blueprint_id)
+        PostgreSQL.delete_execution_profile(blueprint_id)
         PostgreSQL.save_git_transaction_data(blueprint_id=blueprint_id,
                                                revision_msg=f"Deleted blueprint",
                                                job='delete',
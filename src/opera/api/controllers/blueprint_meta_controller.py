@@ -1,7 +1,8 @@
 from opera.api.service.sqldb_service import PostgreSQL
 from opera.api.controllers import security_controller
 from opera.api.log import get_logger
-from opera.api.openapi.models import BlueprintVersion, GitLog, Deployment
+from opera.api.openapi.models import BlueprintVersion, GitLog, Deployment, ExecutionProfile
+from opera.api.util import etag, pagination, xopera_util
 
 logger = get_logger(__name__)
 
@@ -17,10 +18,15 @@ def get_blueprint_meta(blueprint_id):  # noqa: E501
 
     :rtype: Blueprint
     """
+    version = PostgreSQL.get_blueprint_meta_version(blueprint_id)
+    tag = etag.make(version) if version else None
+    if etag.matches(tag):
+        return etag.not_modified(tag)
+
     data = PostgreSQL.get_blueprint_meta(blueprint_id)
     if not data:
         return "Blueprint meta not found", 404
-    return BlueprintVersion.from_dict(data), 200
+    return BlueprintVersion.from_dict(data), 200, etag.headers(tag)
 
 
 @security_controller.check_role_auth_blueprint
@@ -36,10 +42,15 @@ def get_blueprint_version_meta(blueprint_id, version_id):  # noqa: E501
 
     :rtype: Blueprint
     """
+    version = PostgreSQL.get_blueprint_meta_version(blueprint_id, version_id)
+    tag = etag.make(version) if version else None
+    if etag.matches(tag):
+        return etag.not_modified(tag)
+
     data = PostgreSQL.get_blueprint_meta(blueprint_id, version_id)
     if not data:
         return "Blueprint meta not found", 404
-    return BlueprintVersion.from_dict(data), 200
+    return BlueprintVersion.from_dict(data), 200, etag.headers(tag)
 
 
 @security_controller.check_role_auth_blueprint
@@ -78,7 +89,7 @@ def post_blueprint_name(blueprint_id, name):  # noqa: E501
 
 
 @security_controller.check_role_auth_blueprint
-def get_blueprint_deployments(blueprint_id, active=True):  # noqa: E501
+def get_blueprint_deployments(blueprint_id, active=True, limit=None, after=None, fields=None):  # noqa: E501
     """Get deployments for current blueprint
 
      # noqa: E501
@@ -87,25 +98,104 @@ def get_blueprint_deployments(blueprint_id, active=True):  # noqa: E501
     :type blueprint_id:
     :param active: Obtain only list of active deployments.
     :type active: bool
+    :param limit: Maximum number of items in response
+    :type limit: int
+    :param after: Cursor of page
+    :type after: str
+    :param fields: Return only selected fields of items
+    :type fields: List[str]
 
     :rtype: List[Deployment]
     """
-    data = PostgreSQL.get_deployments_for_blueprint(blueprint_id, active)
-    if not data:
+    try:
+        after_keys = pagination.decode_cursor(after)
+        pagination.check_fields(Deployment, fields)
+    except ValueError as e:
+        return str(e), 400
+
+    data = PostgreSQL.get_deployments_for_blueprint(blueprint_id, active, limit=limit, after=after_keys)
+    if not data and not after:
         return "Deployments not found", 404
-    return [Deployment.from_dict(item) for item in data], 200
+    headers = pagination.next_cursor_headers(data, limit, lambda x: (x['timestamp'], x['deployment_id']))
+    return pagination.select_fields([Deployment.from_dict(item) for item in data], fields), 200, headers
 
 
 @security_controller.check_role_auth_project_domain
-def get_git_log(blueprint_id):
+def get_git_log(blueprint_id, limit=None, after=None, fields=None):
     """List all update/delete transactions to git repository with blueprint.
 
     :param blueprint_id: Id of blueprint
     :type blueprint_id:
+    :param limit: Maximum number of items in response
+    :type limit: int
+    :param after: Cursor of page
+    :type after: str
+    :param fields: Return only selected fields of items
+    :type fields: List[str]
 
     :rtype: List[GitLog]
     """
-    data = PostgreSQL.get_git_transaction_data(blueprint_id)
-    if not data:
+    try:
+        after_keys = pagination.decode_cursor(after)
+        pagination.check_fields(GitLog, fields)
+    except ValueError as e:
+        return str(e), 400
+
+    version = PostgreSQL.get_git_transaction_data_version(blueprint_id)
+    tag = etag.make(version, limit, after, fields) if version else None
+    if etag.matches(tag):
+        return etag.not_modified(tag)
+
+    data = PostgreSQL.get_git_transaction_data(blueprint_id, limit=limit, after=after_keys)
+    if not data and not after:
         return "Log not found", 404
-    return [GitLog.from_dict(item) for item in data], 200
+    headers = pagination.next_cursor_headers(data, limit, lambda x: (x['timestamp'], x['version_id']))
+    return pagination.select_fields([GitLog.from_dict(item) for item in data], fields), 200, \
+        dict(headers, **etag.headers(tag))
+
+
+@security_controller.check_role_auth_blueprint
+def get_blueprint_profile(blueprint_id):
+    """Get execution profile of blueprint
+
+    :param blueprint_id: Id of blueprint
+    :type blueprint_id:
+
+    :rtype: ExecutionProfile
+    """
+    profile = PostgreSQL.get_execution_profile(blueprint_id)
+    if profile is None:
+        return "Execution profile not found", 404
+    return ExecutionProfile.from_dict(profile), 200
+
+
+@security_controller.check_role_auth_blueprint
+def put_blueprint_profile(blueprint_id, body):
+    """Set execution profile of blueprint
+
+    :param blueprint_id: Id of blueprint
+    :type blueprint_id:
+    :param body: Execution profile
+    :type body: dict
+
+    :rtype: ExecutionProfile
+    """
+    profile = xopera_util.model_to_dict(ExecutionProfile.from_dict(body))
+    if not PostgreSQL.save_execution_profile(blueprint_id, profile):
+        return "Failed to save execution profile", 500
+    return ExecutionProfile.from_dict(profile), 200
+
+
+@security_controller.check_role_auth_blueprint
+def delete_blueprint_profile(blueprint_id):
+    """Delete execution profile of blueprint
+
+    :param blueprint_id: Id of blueprint
+    :type blueprint_id:
+
+    :rtype: str
+    """
+    if PostgreSQL.get_execution_profile(blueprint_id) is None:
+        return "Execution profile not found", 404
+    PostgreSQL.delete_execution_profile(blueprint_id)
+    return "Execution profile deleted", 200
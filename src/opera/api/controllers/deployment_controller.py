@@ -1,30 +1,96 @@
+import uuid
+
+from flask import Response
+
 from opera.api.service.sqldb_service import PostgreSQL
 from opera.api.controllers import security_controller
+from opera.api.controllers.background_invocation import AdmissionRejected, DeploymentBusy, IdempotencyKeyReused
 from opera.api.controllers.background_invocation import InvocationService
 from opera.api.controllers.background_invocation import InvocationWorkerProcess
+from opera.api.controllers.background_job import JobService
+from opera.api.controllers.job_controller import job_service
 from opera.api.log import get_logger
-from opera.api.openapi.models import InvocationState
+from opera.api.openapi.models import ExecutionProfile, InvocationState, JobType
 from opera.api.openapi.models import OperationType, Invocation
 from opera.api.settings import Settings
-from opera.api.util import xopera_util
+from opera.api.util import etag, file_util, pagination, xopera_util
 
 logger = get_logger(__name__)
 invocation_service = InvocationService(workers_num=Settings.invocation_service_workers)
 
 
 @security_controller.check_role_auth_deployment
-def get_deploy_log(deployment_id):
+def get_deploy_log(deployment_id, limit=None, after=None, fields=None):
     """Get deployment history
 
     :param deployment_id: Id of deployment
     :type deployment_id:
+    :param limit: Maximum number of items in response
+    :type limit: int
+    :param after: Cursor of page
+    :type after: str
+    :param fields: Return only selected fields of items
+    :type fields: List[str]
 
     :rtype: List[Invocation]
     """
-    history = PostgreSQL.get_deployment_history(deployment_id)
-    if not history:
+    try:
+        after_keys = pagination.decode_cursor(after)
+        pagination.check_fields(Invocation, fields)
+    except ValueError as e:
+        return str(e), 400
+
+    version = PostgreSQL.get_deployment_history_version(deployment_id)
+    tag = etag.make(version, limit, after, fields) if version else None
+    if etag.matches(tag):
+        return etag.not_modified(tag)
+
+    history = PostgreSQL.get_deployment_history(deployment_id, limit=limit, after=after_keys)
+    if not history and not after:
         return "History not found", 404
-    return history, 200
+    headers = pagination.next_cursor_headers(history, limit, lambda x: (x[1].timestamp_submission, x[0]))
+    return pagination.select_fields([inv for _, inv in history], fields), 200, dict(headers, **etag.headers(tag))
+
+
+@security_controller.check_role_auth_deployment
+def get_full_log(deployment_id, stream='stdout', timestamp=None):
+    """Get full log of invocation
+
+    Invocation keeps only head and tail of long stdout and stderr, full log of truncated stream is streamed from
+    compressed store.
+
+    :param deployment_id: Id of deployment
+    :type deployment_id:
+    :param stream: Stream of log
+    :type stream: str
+    :param timestamp: timestamp_submission of invocation, last invocation if omitted
+    :type timestamp: str
+
+    :rtype: str
+    """
+    log = PostgreSQL.get_invocation_log(deployment_id, stream, timestamp)
+    if log is None:
+        return "Full log not found", 404
+    return Response(file_util.decompress_chunks(log), status=200, content_type='text/plain; charset=utf-8')
+
+
+@security_controller.check_role_auth_deployment
+def get_task_results(deployment_id, status=None, timestamp=None):
+    """Get Ansible task results of invocation
+
+    :param deployment_id: Id of deployment
+    :type deployment_id:
+    :param status: Return only task results with status
+    :type status: str
+    :param timestamp: timestamp_submission of invocation, last invocation if omitted
+    :type timestamp: str
+
+    :rtype: List[TaskResult]
+    """
+    task_results = PostgreSQL.get_task_results(deployment_id, timestamp, status)
+    if not task_results and not status:
+        return "Task results not found", 404
+    return task_results, 200
 
 
 @security_controller.check_role_auth_deployment
@@ -36,20 +102,53 @@ def get_status(deployment_id):
 
     :rtype: Invocation
     """
+    version = InvocationService.status_version(deployment_id)
+    tag = etag.make(version) if version else None
+    if etag.matches(tag):
+        return etag.not_modified(tag)
+
     inv = invocation_service.load_invocation(deployment_id)
     if not inv:
         return "Job not found", 404
-    return inv, 200
+    return inv, 200, etag.headers(tag)
+
+
+@security_controller.check_role_auth_deployment
+def get_outputs(deployment_id, reevaluate=False):
+    """Get deployment outputs
+
+    Outputs are saved at the end of each invocation and served until deployment state changes. To evaluate
+    them again from deployment state, use reevaluate.
+
+    :param deployment_id: Id of deployment
+    :type deployment_id:
+    :param reevaluate: Evaluate outputs again from deployment state
+    :type reevaluate: bool
+
+    :rtype: object
+    """
+    if not reevaluate:
+        outputs = PostgreSQL.get_deployment_outputs(deployment_id)
+        if outputs is not None:
+            return outputs, 200
+
+    outputs, exception = InvocationWorkerProcess.outputs(deployment_id)
+    if exception:
+        return "{}: {}".format(*exception), 500
+    PostgreSQL.save_deployment_outputs(deployment_id, outputs)
+    return outputs, 200
 
 
 @security_controller.check_role_auth_deployment
-def post_deploy_continue(deployment_id, workers=1, clean_state=False):
+def post_deploy_continue(deployment_id, workers=None, profile=None, clean_state=False):
     """Continue deploy
 
     :param deployment_id: Id of deployment
     :type deployment_id:
-    :param workers: Number of workers
+    :param workers: Number of workers, overrides execution profile
     :type workers: int
+    :param profile: Settings of execution profile for this operation only
+    :type profile: dict
     :param clean_state: Clean previous state and start over
     :type clean_state: bool
 
@@ -61,27 +160,34 @@ def post_deploy_continue(deployment_id, workers=1, clean_state=False):
 
     inv = PostgreSQL.get_deployment_status(deployment_id)
 
-    if inv.state in [InvocationState.PENDING, InvocationState.IN_PROGRESS]:
-        return f"Previous operation on this deployment still running", 403
-
-    result = invocation_service.invoke(
-        operation_type=OperationType.DEPLOY_CONTINUE,
-        blueprint_id=inv.blueprint_id,
-        version_id=inv.version_id,
-        deployment_label=inv.deployment_label,
-        deployment_id=deployment_id,
-        workers=workers,
-        inputs=inputs,
-        clean_state=clean_state,
-        username=username,
-        access_token=xopera_util.get_access_token()
-    )
+    try:
+        result = invocation_service.invoke(
+            operation_type=OperationType.DEPLOY_CONTINUE,
+            blueprint_id=inv.blueprint_id,
+            version_id=inv.version_id,
+            deployment_label=inv.deployment_label,
+            deployment_id=deployment_id,
+            workers=workers,
+            profile=profile,
+            inputs=inputs,
+            clean_state=clean_state,
+            username=username,
+            access_token=xopera_util.get_access_token(),
+            idempotency_key=xopera_util.get_idempotency_key(),
+            require_idle=True
+        )
+    except AdmissionRejected as e:
+        return str(e), 429, {'Retry-After': str(e.retry_after)}
+    except IdempotencyKeyReused as e:
+        return str(e), 422
+    except DeploymentBusy as e:
+        return str(e), 403
     logger.info(f"Deploying '{inv.blueprint_id}', version_id: {inv.version_id}")
     return result, 202
 
 
 @security_controller.check_role_auth_blueprint
-def post_deploy_fresh(blueprint_id, version_id=None, deployment_label=None, workers=None):  # noqa: E501
+def post_deploy_fresh(blueprint_id, version_id=None, deployment_label=None, workers=None, profile=None):  # noqa: E501
     """Initialize deployment and deploy
 
     :param blueprint_id: Id of blueprint
@@ -90,31 +196,40 @@ def post_deploy_fresh(blueprint_id, version_id=None, deployment_label=None, work
     :type version_id: str
     :param deployment_label: Human-readable deployment label
     :type deployment_label: str
-    :param workers: Number of workers
+    :param workers: Number of workers, overrides execution profile
     :type workers: int
+    :param profile: Settings of execution profile for this operation only
+    :type profile: dict
 
     :rtype: Invocation
     """
     inputs = xopera_util.get_preprocessed_inputs()
     username = security_controller.get_username()
 
-    result = invocation_service.invoke(
-        operation_type=OperationType.DEPLOY_FRESH,
-        blueprint_id=blueprint_id,
-        version_id=version_id,
-        deployment_label=deployment_label,
-        workers=workers,
-        inputs=inputs,
-        username=username,
-        access_token=xopera_util.get_access_token()
-    )
+    try:
+        result = invocation_service.invoke(
+            operation_type=OperationType.DEPLOY_FRESH,
+            blueprint_id=blueprint_id,
+            version_id=version_id,
+            deployment_label=deployment_label,
+            workers=workers,
+            profile=profile,
+            inputs=inputs,
+            username=username,
+            access_token=xopera_util.get_access_token(),
+            idempotency_key=xopera_util.get_idempotency_key()
+        )
+    except AdmissionRejected as e:
+        return str(e), 429, {'Retry-After': str(e.retry_after)}
+    except IdempotencyKeyReused as e:
+        return str(e), 422
     logger.info(f"Deploying '{blueprint_id}', version_id: {version_id}")
     return result, 202
 
 
 @security_controller.check_role_auth_blueprint
 @security_controller.check_role_auth_deployment
-def post_diff(deployment_id, blueprint_id, version_id=None):
+def post_diff(deployment_id, blueprint_id, version_id=None, background=False):
     """Calculate diff between deployment and new blueprint.
 
     Calculates the diff between Deployed instance model (DI1) and New blueprint version (DB2 = B2 + V2 + I2)
@@ -125,22 +240,40 @@ def post_diff(deployment_id, blueprint_id, version_id=None):
     :type blueprint_id:
     :param version_id: Id of version of The new blueprint (V2)
     :type version_id: str
+    :param background: Calculate diff as background job
+    :type background: bool
 
     :rtype: object
     """
     inputs = xopera_util.get_preprocessed_inputs()
+    cache_key = JobService.diff_cache_key(deployment_id, blueprint_id, version_id, inputs)
 
-    return InvocationWorkerProcess.diff(deployment_id, blueprint_id, version_id, inputs).outputs(), 200
+    if background:
+        return job_service.submit(JobType.DIFF, cache_key, blueprint_id=blueprint_id, version_id=version_id,
+                                  deployment_id=deployment_id, inputs=inputs,
+                                  username=security_controller.get_username()), 202
+
+    cached_job = JobService.load_cached(cache_key)
+    if cached_job:
+        return cached_job.result, 200
+
+    # in job dir of its own, like diff in background job
+    diff = InvocationWorkerProcess.diff(deployment_id, blueprint_id, version_id, inputs,
+                                        JobService.job_dir(uuid.uuid4())).outputs()
+    JobService.save_result(JobType.DIFF, diff, cache_key, blueprint_id, version_id, deployment_id)
+    return diff, 200
 
 
 @security_controller.check_role_auth_deployment
-def post_undeploy(deployment_id, workers=1, force=False):
+def post_undeploy(deployment_id, workers=None, profile=None, force=False):
     """Undeploy deployment.
 
     :param deployment_id: Id of deployment
     :type deployment_id:
-    :param workers: Number of workers
+    :param workers: Number of workers, overrides execution profile
     :type workers: int
+    :param profile: Settings of execution profile for this operation only
+    :type profile: dict
     :param force: Undeploy forcefully (for stuck deployments).
     :type force: bool
 
@@ -150,28 +283,35 @@ def post_undeploy(deployment_id, workers=1, force=False):
     username = security_controller.get_username()
 
     inv = PostgreSQL.get_deployment_status(deployment_id)
-    if not force:
-        if inv.state in [InvocationState.PENDING, InvocationState.IN_PROGRESS]:
-            return f"Previous operation on this deployment still running", 403
 
-    result = invocation_service.invoke(
-        operation_type=OperationType.UNDEPLOY,
-        blueprint_id=inv.blueprint_id,
-        version_id=inv.version_id,
-        deployment_label=inv.deployment_label,
-        deployment_id=deployment_id,
-        workers=workers,
-        inputs=inputs,
-        username=username,
-        access_token=xopera_util.get_access_token()
-    )
+    try:
+        result = invocation_service.invoke(
+            operation_type=OperationType.UNDEPLOY,
+            blueprint_id=inv.blueprint_id,
+            version_id=inv.version_id,
+            deployment_label=inv.deployment_label,
+            deployment_id=deployment_id,
+            workers=workers,
+            profile=profile,
+            inputs=inputs,
+            username=username,
+            access_token=xopera_util.get_access_token(),
+            idempotency_key=xopera_util.get_idempotency_key(),
+            require_idle=not force
+        )
+    except AdmissionRejected as e:
+        return str(e), 429, {'Retry-After': str(e.retry_after)}
+    except IdempotencyKeyReused as e:
+        return str(e), 422
+    except DeploymentBusy as e:
+        return str(e), 403
     logger.info(f"Undeploying '{deployment_id}'")
     return result, 202
 
 
 @security_controller.check_role_auth_blueprint
 @security_controller.check_role_auth_deployment
-def post_update(deployment_id, blueprint_id, version_id=None, workers=1):
+def post_update(deployment_id, blueprint_id, version_id=None, workers=None, profile=None):
     """Update deployment with new blueprint.
 
     Deploys Instance model (DI2), where DI2 &#x3D; diff(DI1, (B2,V2,I2))
@@ -182,28 +322,36 @@ def post_update(deployment_id, blueprint_id, version_id=None, workers=1):
     :type blueprint_id:
     :param version_id: Id of version of the new blueprint (V2)
     :type version_id: str
-    :param workers: Number of workers
+    :param workers: Number of workers, overrides execution profile
     :type workers: int
+    :param profile: Settings of execution profile for this operation only
+    :type profile: dict
 
     :rtype: Invocation
     """
     inputs = xopera_util.get_preprocessed_inputs()
     username = security_controller.get_username()
 
-    inv = PostgreSQL.get_deployment_status(deployment_id)
-    if inv.state in [InvocationState.PENDING, InvocationState.IN_PROGRESS]:
-        return f"Previous operation on this deployment still running", 403
-
-    result = invocation_service.invoke(
-        operation_type=OperationType.UPDATE,
-        blueprint_id=blueprint_id,
-        version_id=version_id,
-        deployment_id=deployment_id,
-        workers=workers,
-        inputs=inputs,
-        username=username,
-        access_token=xopera_util.get_access_token()
-    )
+    try:
+        result = invocation_service.invoke(
+            operation_type=OperationType.UPDATE,
+            blueprint_id=blueprint_id,
+            version_id=version_id,
+            deployment_id=deployment_id,
+            workers=workers,
+            profile=profile,
+            inputs=inputs,
+            username=username,
+            access_token=xopera_util.get_access_token(),
+            idempotency_key=xopera_util.get_idempotency_key(),
+            require_idle=True
+        )
+    except AdmissionRejected as e:
+        return str(e), 429, {'Retry-After': str(e.retry_after)}
+    except IdempotencyKeyReused as e:
+        return str(e), 422
+    except DeploymentBusy as e:
+        return str(e), 403
     logger.info(f"Updating '{deployment_id}' with blueprint '{blueprint_id}', version_id: {version_id}")
     return result, 202
 
@@ -230,7 +378,56 @@ def delete_deployment(deployment_id, force=False):
 
     success_deployment = PostgreSQL.delete_deployment(deployment_id)
     success_session_data = PostgreSQL.delete_opera_session_data(deployment_id)
+    PostgreSQL.delete_deployment_outputs(deployment_id)
+    xopera_util.close_ssh_masters(deployment_id)
     if not (success_deployment and success_session_data):
         return "Failed to delete deployment", 500
 
     return 'Deployment deleted', 200
+
+
+@security_controller.check_role_auth_deployment
+def get_deployment_profile(deployment_id):
+    """Get execution profile of deployment
+
+    :param deployment_id: Id of deployment
+    :type deployment_id:
+
+    :rtype: ExecutionProfile
+    """
+    profile = PostgreSQL.get_execution_profile(deployment_id)
+    if profile is None:
+        return "Execution profile not found", 404
+    return ExecutionProfile.from_dict(profile), 200
+
+
+@security_controller.check_role_auth_deployment
+def put_deployment_profile(deployment_id, body):
+    """Set execution profile of deployment
+
+    :param deployment_id: Id of deployment
+    :type deployment_id:
+    :param body: Execution profile
+    :type body: dict
+
+    :rtype: ExecutionProfile
+    """
+    profile = xopera_util.model_to_dict(ExecutionProfile.from_dict(body))
+    if not PostgreSQL.save_execution_profile(deployment_id, profile):
+        return "Failed to save execution profile", 500
+    return ExecutionProfile.from_dict(profile), 200
+
+
+@security_controller.check_role_auth_deployment
+def delete_deployment_profile(deployment_id):
+    """Delete execution profile of deployment
+
+    :param deployment_id: Id of deployment
+    :type deployment_id:
+
+    :rtype: str
+    """
+    if PostgreSQL.get_execution_profile(deployment_id) is None:
+        return "Execution profile not found", 404
+    PostgreSQL.delete_execution_profile(deployment_id)
+    return "Execution profile deleted", 200
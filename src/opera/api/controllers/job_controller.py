@@ -0,0 +1,23 @@
+from opera.api.controllers import security_controller
+from opera.api.controllers.background_job import JobService
+from opera.api.log import get_logger
+from opera.api.service.sqldb_service import PostgreSQL
+from opera.api.settings import Settings
+
+logger = get_logger(__name__)
+job_service = JobService(workers_num=Settings.job_service_workers)
+
+
+@security_controller.check_role_auth_job
+def get_job(job_id):
+    """Get background job
+
+    :param job_id: Id of job
+    :type job_id:
+
+    :rtype: Job
+    """
+    job = PostgreSQL.get_job(job_id, security_controller.get_username())
+    if not job:
+        return "Job not found", 404
+    return job, 200
@@ -0,0 +1,22 @@
+from flask import Response
+
+from opera.api.controllers.background_invocation import InvocationService
+from opera.api.log import get_logger
+from opera.api.service.sqldb_service import SqlDBFailedException
+from opera.api.util import metrics
+
+logger = get_logger(__name__)
+
+
+def get_metrics():
+    """Get metrics
+
+    Metrics of xOpera REST API in Prometheus text format
+
+    :rtype: str
+    """
+    try:
+        InvocationService.publish_queue_depth()
+    except SqlDBFailedException as e:
+        logger.warning(f"Could not count pending and running invocations: {str(e)}")
+    return Response(metrics.collect(), status=200, content_type=metrics.CONTENT_TYPE_LATEST)
@@ -0,0 +1,64 @@
+from opera.api.cli import CSAR_db
+from opera.api.controllers import security_controller
+from opera.api.controllers.background_rollout import RolloutService
+from opera.api.controllers.deployment_controller import invocation_service
+from opera.api.log import get_logger
+from opera.api.openapi.models import InvocationState, OperationType, RolloutRequest
+from opera.api.service.sqldb_service import PostgreSQL
+from opera.api.util import xopera_util
+
+logger = get_logger(__name__)
+
+
+@security_controller.check_role_auth_blueprint
+def post_rollout(blueprint_id, body, version_id=None, profile=None):
+    """Roll blueprint version out to deployments
+
+    :param blueprint_id: Id of blueprint
+    :type blueprint_id:
+    :param body: Deployments to update and rollout policy
+    :type body: dict
+    :param version_id: Version of blueprint, last version if not specified
+    :type version_id: str
+    :param profile: Settings of execution profile for updates of rollout
+    :type profile: dict
+
+    :rtype: Rollout
+    """
+    request = RolloutRequest.from_dict(body)
+
+    for deployment_id in request.deployment_ids:
+        inv = PostgreSQL.get_deployment_status(deployment_id)
+        if not inv:
+            return f"Deployment with id: {deployment_id} does not exist", 404
+        project_domain = PostgreSQL.get_project_domain(inv.blueprint_id)
+        if project_domain and not security_controller.check_roles(project_domain):
+            return f"Unauthorized request for project: {project_domain}", 401
+        if inv.state in [InvocationState.PENDING, InvocationState.IN_PROGRESS]:
+            return f"Previous operation on deployment {deployment_id} still running", 403
+        # rollout only updates, deployment without completed invocation has no instance model to update
+        last_completed = PostgreSQL.get_last_completed_invocation(deployment_id)
+        if not last_completed or (last_completed.operation == OperationType.UNDEPLOY and
+                                  last_completed.state == InvocationState.SUCCESS):
+            return f"Deployment {deployment_id} has nothing deployed to update, it must be deployed first", 400
+
+    rollout = RolloutService.create(blueprint_id, version_id or CSAR_db.get_last_tag(blueprint_id), request, profile)
+    username = security_controller.get_username()
+    access_token = xopera_util.get_access_token()
+    RolloutService.start(rollout, lambda r, deployment_id: invocation_service.rollout_update(
+        r, deployment_id, username=username, access_token=access_token), access_token)
+    logger.info(f"Rolling '{blueprint_id}', version_id: {rollout.version_id} out to "
+                f"{len(rollout.deployments)} deployments")
+    return rollout, 202
+
+
+@security_controller.check_role_auth_rollout
+def get_rollout(rollout_id):
+    """Get rollout progress
+
+    :param rollout_id: Id of rollout
+    :type rollout_id:
+
+    :rtype: Rollout
+    """
+    return PostgreSQL.get_rollout(rollout_id), 200
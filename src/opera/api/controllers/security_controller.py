@@ -9,6 +9,7 @@ import requests
 from opera.api.cli import CSAR_db
 from opera.api.service.sqldb_service import PostgreSQL
 from opera.api.settings import Settings
+from opera.api.util import metrics
 
 # use connection pool for OAuth tokeninfo
 adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=100)
@@ -45,7 +46,8 @@ def token_info(access_token) -> dict:
         b64encode(basic_auth_bytes).decode('utf-8')
     )
     try:
-        token_request = session.post(token_info_url, data=request, headers=headers)
+        with metrics.OIDC_DURATION.time():
+            token_request = session.post(token_info_url, data=request, headers=headers)
         if not token_request.ok:
             return None
         json = token_request.json()
@@ -166,3 +168,51 @@ def check_role_auth_deployment(func):
         return func(*args, **kwargs)
 
     return wrapper_check_role_auth
+
+
+def check_role_auth_job(func):
+    @functools.wraps(func)
+    def wrapper_check_role_auth(*args, **kwargs):
+        job_id = kwargs.get("job_id")
+        if not job_id:
+            return f"Authorization configuration error", 401
+
+        # jobs are visible to user, who submitted them, only
+        job = PostgreSQL.get_job(job_id, get_username())
+        if not job:
+            return f"Job with id: {job_id} does not exist", 404
+
+        # jobs on new blueprints (validate_new) are not bound to any project
+        blueprint_ids = [job.blueprint_id]
+        if job.deployment_id:
+            inv = PostgreSQL.get_deployment_status(job.deployment_id)
+            blueprint_ids.append(inv and inv.blueprint_id)
+
+        for blueprint_id in filter(None, blueprint_ids):
+            project_domain = PostgreSQL.get_project_domain(blueprint_id)
+            if project_domain and not check_roles(project_domain):
+                return f"Unauthorized request for project: {project_domain}", 401
+
+        return func(*args, **kwargs)
+
+    return wrapper_check_role_auth
+
+
+def check_role_auth_rollout(func):
+    @functools.wraps(func)
+    def wrapper_check_role_auth(*args, **kwargs):
+        rollout_id = kwargs.get("rollout_id")
+        if not rollout_id:
+            return f"Authorization configuration error", 401
+
+        rollout = PostgreSQL.get_rollout(rollout_id)
+        if not rollout:
+            return f"Rollout with id: {rollout_id} does not exist", 404
+
+        project_domain = PostgreSQL.get_project_domain(rollout.blueprint_id)
+        if project_domain and not check_roles(project_domain):
+            return f"Unauthorized request for project: {project_domain}", 401
+
+        return func(*args, **kwargs)
+
+    return wrapper_check_role_auth
@@ -2,7 +2,10 @@ import connexion
 
 from opera.api.controllers import security_controller
 from opera.api.controllers.background_invocation import InvocationWorkerProcess
+from opera.api.controllers.background_job import JobService
+from opera.api.controllers.job_controller import job_service
 from opera.api.log import get_logger
+from opera.api.openapi.models import JobType
 from opera.api.openapi.models.blueprint_validation import BlueprintValidation
 from opera.api.util import xopera_util
 
@@ -10,25 +13,25 @@ logger = get_logger(__name__)
 
 
 @security_controller.check_role_auth_blueprint
-def validate_existing(blueprint_id):
+def validate_existing(blueprint_id, background=False):
     """Validate last version of existing blueprint.
 
     Validates TOSCA service template
 
     :param blueprint_id: Id of TOSCA blueprint
     :type blueprint_id:
+    :param background: Run validation as background job
+    :type background: bool
 
     :rtype: str
     """
     inputs = xopera_util.get_preprocessed_inputs()
 
-    exception = InvocationWorkerProcess.validate(blueprint_id, None, inputs)
-    blueprint_valid = exception is None
-    return BlueprintValidation(blueprint_valid, exception), 200
+    return validate_blueprint_version(blueprint_id, None, inputs, background)
 
 
 @security_controller.check_role_auth_blueprint
-def validate_existing_version(blueprint_id, version_id):
+def validate_existing_version(blueprint_id, version_id, background=False):
     """Validate specific version of existing blueprint.
 
     Validates TOSCA service template
@@ -37,26 +40,59 @@ def validate_existing_version(blueprint_id, version_id):
     :type blueprint_id:
     :param version_id: Id of blueprint version
     :type version_id: str
+    :param background: Run validation as background job
+    :type background: bool
 
     :rtype: str
     """
     inputs = xopera_util.get_preprocessed_inputs()
 
-    exception = InvocationWorkerProcess.validate(blueprint_id, version_id, inputs)
-    blueprint_valid = exception is None
-    return BlueprintValidation(blueprint_valid, exception), 200
+    return validate_blueprint_version(blueprint_id, version_id, inputs, background)
 
 
-def validate_new():
+def validate_new(background=False):
     """Validate new blueprint.
 
     Validates TOSCA service template
 
+    :param background: Run validation as background job
+    :type background: bool
+
     :rtype: str
     """
     inputs = xopera_util.get_preprocessed_inputs()
     csar_file = connexion.request.files['CSAR']
+    username = security_controller.get_username()
+    cache_key = JobService.csar_cache_key(JobType.VALIDATE_NEW, csar_file, inputs, username)
+
+    if background:
+        return job_service.submit(JobType.VALIDATE_NEW, cache_key, inputs=inputs, csar=csar_file,
+                                  username=username), 202
+
+    cached_job = JobService.load_cached(cache_key)
+    if cached_job:
+        return BlueprintValidation.from_dict(cached_job.result), 200
 
     exception = InvocationWorkerProcess.validate_new(csar_file, inputs)
     blueprint_valid = exception is None
-    return BlueprintValidation(blueprint_valid, exception), 200
+    validation = BlueprintValidation(blueprint_valid, exception)
+    JobService.save_result(JobType.VALIDATE_NEW, validation, cache_key)
+    return validation, 200
+
+
+def validate_blueprint_version(blueprint_id, version_id, inputs, background):
+    cache_key = JobService.blueprint_cache_key(JobType.VALIDATE, blueprint_id, version_id, inputs)
+
+    if background:
+        return job_service.submit(JobType.VALIDATE, cache_key, blueprint_id=blueprint_id, version_id=version_id,
+                                  inputs=inputs, username=security_controller.get_username()), 202
+
+    cached_job = JobService.load_cached(cache_key)
+    if cached_job:
+        return BlueprintValidation.from_dict(cached_job.result), 200
+
+    exception = InvocationWorkerProcess.validate(blueprint_id, version_id, inputs)
+    blueprint_valid = exception is None
+    validation = BlueprintValidation(blueprint_valid, exception)
+    JobService.save_result(JobType.VALIDATE, validation, cache_key, blueprint_id, version_id)
+    return validation, 200
@@ -1,16 +1,23 @@
+import contextlib
+import fcntl
 import shutil
 import tempfile
 import time
 import uuid
 from pathlib import Path
+from typing import Tuple
 
 import git
 
+from opera.api.util import file_util, metrics
 from . import tag_util
 from .connectors import Connector
 
 
 class GitCsarDB:
+    # held by process, which uses clone, workdir collector skips locked clones
+    CLONE_LOCK = '.clone.lock'
+
     class GitCsarDBError(Exception):
         pass
 
@@ -29,58 +36,99 @@ class GitCsarDB:
         self.commit_mail = commit_mail
         self.timeout = timeout
 
+    @property
+    def connector_type(self):
+        return type(self.git_connector).__name__
+
+    def clone(self, csar_token: uuid, repo_dst: Path):
+        with metrics.GIT_DURATION.labels(self.connector_type, 'clone').time():
+            return self.git_connector.clone(repo_name=self.repo_name(csar_token), repo_dst=repo_dst)
+
     def generate_repo_path(self, csar_token):
         return self.workdir / Path(str(uuid.uuid4())) / Path(self.repo_name(csar_token))
 
-    def save_CSAR(self, csar_path: Path, csar_token: uuid, message: str = None, minor_to_increment: str = None):
+    @contextlib.contextmanager
+    def clone_path(self, csar_token):
+        """
+        Yields path for clone of repo in its own dir, which is locked while in use and removed afterwards
+        """
+        repo_path = self.generate_repo_path(csar_token)
+        repo_path.parent.mkdir(parents=True)
+        try:
+            with open(repo_path.parent / self.CLONE_LOCK, 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                yield repo_path
+        finally:
+            shutil.rmtree(path=repo_path.parent, ignore_errors=True)
+
+    def save_CSAR(self, csar_path: Path, csar_token: uuid, message: str = None, minor_to_increment: str = None,
+                  tag_name: str = None):
+        """
+        Commits content of csar_path to repo and tags the commit. If tag_name is None, tag is calculated from tags of
+        freshly cloned repo, else tag_name, allocated in advance, is used and not recalculated on retries.
+        """
         if not self.CSAR_exists(csar_token):
             self.git_connector.init_repo(self.repo_name(csar_token))
 
-        repo_path = self.generate_repo_path(csar_token)
-        start_time = time.time()
-        while True:
-            try:
-                shutil.rmtree(path=repo_path, ignore_errors=True)
-                repo = self.git_connector.clone(repo_name=self.repo_name(csar_token), repo_dst=repo_path)
-
-                repo.config_writer().set_value("user", "name", self.commit_name).release()
-                repo.config_writer().set_value("user", "email", self.commit_mail).release()
-
+        with self.clone_path(csar_token) as repo_path:
+            start_time = time.time()
+            while True:
                 try:
-                    repo.git.rm('*')
-                except git.exc.GitCommandError:
-                    pass
-                self.copy_content(csar_path, repo_path)
-                repo.git.add('--all')
-                if minor_to_increment:
-                    tag_name = tag_util.next_minor(repo.tags, minor_to_increment)
-                else:
-                    tag_name = tag_util.next_major(repo.tags)
-                commit_msg = f'gitCsarDB: {message or tag_name}'
-                commit_obj = repo.index.commit(message=commit_msg)
-                commit_sha = str(commit_obj)
-                repo.remotes.origin.push()
+                    shutil.rmtree(path=repo_path, ignore_errors=True)
+                    repo = self.clone(csar_token, repo_path)
+
+                    repo.config_writer().set_value("user", "name", self.commit_name).release()
+                    repo.config_writer().set_value("user", "email", self.commit_mail).release()
+
+                    try:
+                        repo.git.rm('*')
+                    except git.exc.GitCommandError:
+                        pass
+                    self.copy_content(csar_path, repo_path)
+                    repo.git.add('--all')
+                    if tag_name:
+                        version_tag = tag_name
+                    elif minor_to_increment:
+                        version_tag = tag_util.next_minor(repo.tags, minor_to_increment)
+                    else:
+                        version_tag = tag_util.next_major(repo.tags)
+                    commit_msg = f'gitCsarDB: {message or version_tag}'
+                    commit_obj = repo.index.commit(message=commit_msg)
+                    commit_sha = str(commit_obj)
+                    with metrics.GIT_DURATION.labels(self.connector_type, 'push').time():
+                        repo.remotes.origin.push()
+                    if not tag_name:
+                        self.add_tag(csar_token, commit_sha, version_tag, commit_msg)
+                    break
+                except Exception as e:
+
+                    if time.time() - start_time > self.timeout:
+                        # 5 min
+                        return {
+                            'success': False,
+                            'message': f'Timeout of {self.timeout}s exceeded',
+                            'exception': str(e)
+                        }
+                    else:
+                        # apparently, there was a fail in pushing repo back to remote. Just repeat procedure.
+                        pass
+
+        if tag_name:
+            try:
                 self.add_tag(csar_token, commit_sha, tag_name, commit_msg)
-                break
             except Exception as e:
-
-                if time.time() - start_time > self.timeout:
-                    # 5 min
-                    shutil.rmtree(path=repo_path)
-                    return {
-                        'success': False,
-                        'message': f'Timeout of {self.timeout}s exceeded',
-                        'exception': str(e)
-                    }
-                else:
-                    # apparently, there was a fail in pushing repo back to remote. Just repeat procedure.
-                    pass
-
-        shutil.rmtree(path=repo_path)
+                # tag was allocated in advance, pushing the commit again would not help
+                return {
+                    'success': False,
+                    'message': f"Could not add tag '{tag_name}'",
+                    'exception': str(e),
+                    'token': str(csar_token),
+                    'commit_sha': commit_sha
+                }
         return {
             'success': True,
             'token': str(csar_token),
-            'version_tag': tag_name,
+            'version_tag': version_tag,
             'commit_sha': commit_sha
         }
 
@@ -88,29 +136,66 @@ class GitCsarDB:
         self.git_connector.add_tag(repo_name=self.repo_name(csar_token), commit_sha=commit_sha,
                                    tag=tag, tag_msg=tag_msg)
 
-    def get_CSAR(self, csar_token, version_tag=None, dst: Path = None):
+    def get_CSAR(self, csar_token, version_tag=None, dst: Path = None, owner: Tuple[int, int] = None):
         if not self.CSAR_exists(csar_token):
             raise FileNotFoundError(f"CSAR with token '{csar_token}' not found")
 
-        git_clone_path = self.generate_repo_path(csar_token)
-        shutil.rmtree(path=git_clone_path, ignore_errors=True)
-        self.git_connector.clone(repo_name=self.repo_name(csar_token), repo_dst=git_clone_path)
-        if version_tag:
-            try:
-                g = git.Git(git_clone_path)
-                g.init()
-                g.checkout(version_tag)
-            except Exception:
-                raise FileNotFoundError(f"Tag '{version_tag}' not found")
-        repo_path = dst or git_clone_path
-        if repo_path != git_clone_path:
-            shutil.copytree(git_clone_path, repo_path, dirs_exist_ok=True)
-            # remove .git dir
-            shutil.rmtree(Path(repo_path / Path(".git")))
-            shutil.rmtree(git_clone_path)
+        repo_path = Path(dst) if dst else None
+        if not repo_path:
+            # clone itself is returned, it is not removed or locked
+            repo_path = self.generate_repo_path(csar_token)
+            self.clone(csar_token, repo_path)
+            if version_tag:
+                self.checkout(repo_path, version_tag, cleanup=repo_path.parent)
+            return repo_path
+
+        with self.clone_path(csar_token) as git_clone_path:
+            self.clone(csar_token, git_clone_path)
+            if version_tag:
+                self.checkout(git_clone_path, version_tag)
+            if owner:
+                file_util.copy_tree(git_clone_path, repo_path, owner, ignore=['.git'])
+            else:
+                shutil.copytree(git_clone_path, repo_path, dirs_exist_ok=True)
+                # remove .git dir
+                shutil.rmtree(Path(repo_path / Path(".git")))
 
         return repo_path
 
+    @staticmethod
+    def checkout(git_clone_path: Path, version_tag: str, cleanup: Path = None):
+        try:
+            g = git.Git(git_clone_path)
+            g.init()
+            g.checkout(version_tag)
+        except Exception:
+            if cleanup:
+                shutil.rmtree(cleanup, ignore_errors=True)
+            raise FileNotFoundError(f"Tag '{version_tag}' not found")
+
+    def get_CSAR_versions(self, csar_token, version_tags: list, dsts: list, owner: Tuple[int, int] = None):
+        """
+        Checks out multiple versions of CSAR from single clone of repo, every version to its own dst.
+        If version_tag is None, last commit is checked out. If owner (uid, gid) is given, copies are owned by it.
+        """
+        if not self.CSAR_exists(csar_token):
+            raise FileNotFoundError(f"CSAR with token '{csar_token}' not found")
+
+        with self.clone_path(csar_token) as git_clone_path:
+            repo = self.clone(csar_token, git_clone_path)
+            last_commit = repo.head.commit.hexsha
+            for version_tag, dst in zip(version_tags, dsts):
+                try:
+                    repo.git.checkout(version_tag or last_commit)
+                except git.exc.GitCommandError:
+                    raise FileNotFoundError(f"Tag '{version_tag}' not found")
+                if owner:
+                    file_util.copy_tree(git_clone_path, dst, owner, ignore=['.git'])
+                else:
+                    shutil.copytree(git_clone_path, dst, dirs_exist_ok=True, ignore=shutil.ignore_patterns('.git'))
+
+        return dsts
+
     def delete_tag(self, csar_token: uuid, version_tag):
         if not self.CSAR_exists(csar_token):
             raise FileNotFoundError(f"CSAR with token '{csar_token}' not found")
@@ -157,12 +242,9 @@ class GitCsarDB:
         return self.git_connector.tag_exists(repo_name=repo_name, tag_name=tag_name)
 
     def get_tags_list(self, csar_token):
-        repo_path = self.generate_repo_path(csar_token)
-        shutil.rmtree(path=repo_path, ignore_errors=True)
-        repo = self.git_connector.clone(repo_name=self.repo_name(csar_token), repo_dst=repo_path)
-        tags = [str(tag) for tag in repo.tags]
-        shutil.rmtree(path=repo_path)
-        return tags
+        with self.clone_path(csar_token) as repo_path:
+            repo = self.clone(csar_token, repo_path)
+            return [str(tag) for tag in repo.tags]
 
     @staticmethod
     def copy_content(src: Path, dst: Path):
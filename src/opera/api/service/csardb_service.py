@@ -2,13 +2,16 @@ import shutil
 import tempfile
 import uuid
 from pathlib import Path
+from typing import Tuple
 
 from werkzeug.datastructures import FileStorage
 
 from opera.api import gitCsarDB
 from opera.api.blueprint_converters import csar_to_blueprint
 from opera.api.blueprint_converters.blueprint2CSAR import validate_csar
+from opera.api.gitCsarDB import tag_util
 from opera.api.log import get_logger
+from opera.api.service.sqldb_service import PostgreSQL, SqlDBFailedException
 from opera.api.util.timestamp_util import datetime_now_to_string
 
 logger = get_logger(__name__)
@@ -42,11 +45,55 @@ class GitDB:
         return self.connection.get_tags_list(csar_token=blueprint_id)
 
     def get_last_tag(self, blueprint_id: uuid):
+        """
+        returns highest version tag of blueprint, from blueprint metadata if possible, to avoid cloning repo
+        """
+        try:
+            version_id = PostgreSQL.get_last_version_id(blueprint_id)
+            if version_id:
+                return version_id
+        except SqlDBFailedException as e:
+            logger.warning(f"Could not get blueprint meta: {str(e)}")
+        tags = tag_util.parse_tags(self.get_tags(blueprint_id))
+        return tag_util.encode_tag(tags[-1]) if tags else None
+
+    def next_tag(self, blueprint_id: uuid, minor_to_increment: str = None, new_blueprint: bool = False):
+        """
+        Allocates next version tag from version counter in PostgreSQL, without any git operation. Counter of
+        blueprint, which does not have it yet, is first reconciled with its git tags.
+        Returns None if counter is not available, tag is then calculated from git tags by gitCsarDB
+        """
         try:
-            return self.get_tags(blueprint_id)[-1]
-        except IndexError:
+            if not new_blueprint and not PostgreSQL.version_counter_exists(blueprint_id):
+                self.reconcile_version_counter(blueprint_id)
+            return PostgreSQL.next_version_tag(blueprint_id, minor_to_increment)
+        except SqlDBFailedException as e:
+            logger.warning(f"Could not allocate version tag: {str(e)}")
             return None
 
+    def reconcile_version_counter(self, blueprint_id: uuid):
+        """
+        Raises version counter of blueprint to its git tags, since git tags are projection of counter
+        """
+        return PostgreSQL.reconcile_version_counter(blueprint_id, self.get_tags(blueprint_id))
+
+    def reconcile_version_counters(self):
+        """
+        Reconciles version counters of all blueprints with their git tags
+        """
+        try:
+            blueprint_ids = PostgreSQL.get_blueprint_ids()
+        except SqlDBFailedException as e:
+            logger.error(f"Could not reconcile version counters: {str(e)}")
+            return
+        for blueprint_id in blueprint_ids:
+            try:
+                if self.check_token_exists(blueprint_id):
+                    self.reconcile_version_counter(blueprint_id)
+            except Exception as e:
+                logger.error(f"Could not reconcile version counter for blueprint_id={blueprint_id}: {str(e)}")
+        logger.info(f"Reconciled version counters of {len(blueprint_ids)} blueprints")
+
     def add_revision(self, blueprint_id: uuid = None, CSAR: FileStorage = None,
                      blueprint_path: Path = None, revision_msg: str = None, minor_to_increment: str = None):
         """
@@ -81,8 +128,17 @@ class GitDB:
         elif blueprint_path is None:
             # both params cannot be None
             raise AttributeError('Both CSAR and blueprint path cannot be None')
-        result = self.connection.save_CSAR(csar_path=path, csar_token=token,
-                                           message=revision_msg, minor_to_increment=minor_to_increment)
+        tag_name = self.next_tag(token, minor_to_increment, new_blueprint=blueprint_id is None)
+        result = self.connection.save_CSAR(csar_path=path, csar_token=token, message=revision_msg,
+                                           minor_to_increment=minor_to_increment, tag_name=tag_name)
+        if not result['success'] and result.get('commit_sha'):
+            # version counter was behind git tags, tag commit with next free tag
+            result = self.retag_revision(token, result['commit_sha'], revision_msg, minor_to_increment)
+        if not result['success']:
+            logger.error(f"{result['message']}: {result.get('exception')}")
+            if CSAR is not None:
+                shutil.rmtree(str(path))
+            return None, result['message']
         https_url = self.connection.get_repo_url(csar_token=token)
         users = self.connection.get_user_list(csar_token=token)
         if CSAR is not None:
@@ -98,16 +154,48 @@ class GitDB:
                    'timestamp': datetime_now_to_string()
                }, None
 
-    def get_revision(self, blueprint_id: uuid, dst: Path, version_id: str = None):
+    def retag_revision(self, blueprint_id: uuid, commit_sha: str, revision_msg: str = None,
+                       minor_to_increment: str = None):
+        """
+        Reconciles version counter with git tags and tags already pushed commit with newly allocated tag
+        """
+        self.reconcile_version_counter(blueprint_id)
+        tag_name = self.next_tag(blueprint_id, minor_to_increment)
+        if not tag_name:
+            return {'success': False, 'message': 'Could not allocate version tag'}
+        try:
+            self.add_tag(blueprint_id, commit_sha, tag_name, f'gitCsarDB: {revision_msg or tag_name}')
+        except Exception as e:
+            return {'success': False, 'message': f"Could not add tag '{tag_name}'", 'exception': str(e)}
+        return {
+            'success': True,
+            'token': str(blueprint_id),
+            'version_tag': tag_name,
+            'commit_sha': commit_sha
+        }
+
+    def get_revision(self, blueprint_id: uuid, dst: Path, version_id: str = None, owner: Tuple[int, int] = None):
         """
         Retrieves blueprint and saves it to destination.
         - if version_tag not None -> retrieves by blueprint_token and version_tag
         - if both None -> retrieves just by blueprint_token
+        - if owner (uid, gid) not None -> files are created owned by owner
         In case of no results returns None
         """
 
         try:
-            return self.connection.get_CSAR(csar_token=blueprint_id, version_tag=version_id, dst=dst)
+            return self.connection.get_CSAR(csar_token=blueprint_id, version_tag=version_id, dst=dst, owner=owner)
+        except FileNotFoundError:
+            return None
+
+    def get_revisions(self, blueprint_id: uuid, version_ids: list, dsts: list, owner: Tuple[int, int] = None):
+        """
+        Retrieves multiple versions of blueprint with single clone and saves them to destinations.
+        In case of no results returns None
+        """
+        try:
+            return self.connection.get_CSAR_versions(csar_token=blueprint_id, version_tags=version_ids, dsts=dsts,
+                                                     owner=owner)
         except FileNotFoundError:
             return None
 
@@ -0,0 +1,122 @@
+"""
+Online migration of blueprint and git_log tables from timestamp primary key to surrogate key with indexes.
+
+Existing rows are numbered in small batches and indexes are built concurrently, so REST API can keep serving requests
+while migration runs. Every step is idempotent, interrupted migration can be started again.
+
+Usage:
+    python3 -m opera.api.service.sqldb_migration [--batch-size 1000]
+"""
+import argparse
+
+import psycopg2
+from psycopg2 import sql
+
+from opera.api.log import get_logger
+from opera.api.service.sqldb_service import PostgreSQL
+from opera.api.settings import Settings
+
+logger = get_logger(__name__)
+
+
+def primary_key_columns(dbcur, table: str) -> list:
+    dbcur.execute(sql.SQL("""select a.attname from pg_index i
+                                join pg_attribute a on a.attrelid = i.indrelid and a.attnum = any(i.indkey)
+                                where i.indrelid = {table}::regclass and i.indisprimary;""").format(
+        table=sql.Literal(table)
+    ))
+    return [line[0] for line in dbcur.fetchall()]
+
+
+def primary_key_constraint(dbcur, table: str):
+    dbcur.execute(sql.SQL("""select conname from pg_constraint
+                                where conrelid = {table}::regclass and contype = 'p';""").format(
+        table=sql.Literal(table)
+    ))
+    line = dbcur.fetchone()
+    return line[0] if line else None
+
+
+def migrate_table(conn, table: str, batch_size: int = 1000) -> bool:
+    """
+    Moves table to surrogate primary key id. Returns False, if table has already been migrated
+    """
+    dbcur = conn.cursor()
+    if primary_key_columns(dbcur, table) == ['id']:
+        logger.info(f"Table {table} already has surrogate key")
+        return False
+
+    sequence = f'{table}_id_seq'
+    unique_index = f'{table}_id_key'
+
+    # new rows get id immediately, adding column without default does not rewrite table
+    dbcur.execute(sql.SQL("create sequence if not exists {sequence};").format(sequence=sql.Identifier(sequence)))
+    dbcur.execute(sql.SQL("alter table {table} add column if not exists id bigint;").format(
+        table=sql.Identifier(table)))
+    dbcur.execute(sql.SQL("alter table {table} alter column id set default nextval({sequence});").format(
+        table=sql.Identifier(table), sequence=sql.Literal(sequence)))
+    dbcur.execute(sql.SQL("alter sequence {sequence} owned by {table}.id;").format(
+        sequence=sql.Identifier(sequence), table=sql.Identifier(table)))
+
+    # number existing rows in batches, to keep row locks short
+    numbered = 0
+    while True:
+        dbcur.execute(sql.SQL("""update {table} set id = nextval({sequence})
+                                    where ctid = any(array(select ctid from {table} where id is null limit {limit}));
+                                    """).format(
+            table=sql.Identifier(table), sequence=sql.Literal(sequence), limit=sql.Literal(batch_size)))
+        if dbcur.rowcount <= 0:
+            break
+        numbered += dbcur.rowcount
+    logger.info(f"Numbered {numbered} rows of table {table}")
+
+    dbcur.execute(sql.SQL("create unique index concurrently if not exists {index} on {table} (id);").format(
+        index=sql.Identifier(unique_index), table=sql.Identifier(table)))
+    # set not null scans table under exclusive lock, unless validated check constraint proves it (PostgreSQL 12+),
+    # validation scans table without blocking writes
+    check = sql.Identifier(f'{table}_id_not_null')
+    dbcur.execute(sql.SQL("alter table {table} drop constraint if exists {check}, "
+                          "add constraint {check} check (id is not null) not valid;").format(
+        table=sql.Identifier(table), check=check))
+    dbcur.execute(sql.SQL("alter table {table} validate constraint {check};").format(
+        table=sql.Identifier(table), check=check))
+    dbcur.execute(sql.SQL("alter table {table} alter column id set not null;").format(table=sql.Identifier(table)))
+    dbcur.execute(sql.SQL("alter table {table} drop constraint {check};").format(
+        table=sql.Identifier(table), check=check))
+
+    constraint = primary_key_constraint(dbcur, table)
+    drop_constraint = sql.SQL("drop constraint {constraint}, ").format(
+        constraint=sql.Identifier(constraint)) if constraint else sql.SQL('')
+    dbcur.execute(sql.SQL("alter table {table} {drop_constraint}add constraint {pkey} primary key using index {index};")
+                  .format(table=sql.Identifier(table), drop_constraint=drop_constraint,
+                          pkey=sql.Identifier(f'{table}_pkey'), index=sql.Identifier(unique_index)))
+    logger.info(f"Table {table} moved to surrogate key")
+    return True
+
+
+def migrate(batch_size: int = 1000):
+    conn = psycopg2.connect(**Settings.sql_config)
+    # concurrent index builds cannot run inside transaction
+    conn.autocommit = True
+    try:
+        for table in (Settings.blueprint_table, Settings.git_log_table):
+            migrate_table(conn, table, batch_size)
+        dbcur = conn.cursor()
+        for stmt in PostgreSQL.index_statements(concurrently=True):
+            dbcur.execute(stmt)
+        logger.info("Indexes created")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate blueprint and git_log tables to surrogate keys online")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of rows, numbered in one statement")
+    args = parser.parse_args()
+
+    Settings.load_settings()
+    migrate(args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
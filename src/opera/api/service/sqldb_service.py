@@ -1,14 +1,19 @@
+import datetime
 import json
 import uuid
+import zlib
+from typing import Optional
 
 import psycopg2
 from psycopg2 import sql
 from contextlib import contextmanager
 
 from opera.api.log import get_logger
-from opera.api.openapi.models import Invocation, InvocationState, BlueprintVersion, OperationType
+from opera.api.openapi.models import Invocation, InvocationState, BlueprintVersion, OperationType, Job, TaskResult, \
+    Rollout, RolloutState
+from opera.api.gitCsarDB import tag_util
 from opera.api.settings import Settings
-from opera.api.util import timestamp_util, file_util
+from opera.api.util import timestamp_util, file_util, metrics, serialization
 
 logger = get_logger(__name__)
 
@@ -36,6 +41,20 @@ class PostgreSQL:
         with cls.connection() as conn:
             yield conn.cursor()
 
+    @classmethod
+    @contextmanager
+    def advisory_lock(cls, key: str):
+        """
+        Holds PostgreSQL advisory lock on key, to serialize processes, working on the same object
+        """
+        with cls.connection() as conn:
+            dbcur = conn.cursor()
+            dbcur.execute(sql.SQL("select pg_advisory_lock(hashtext({key}));").format(key=sql.Literal(str(key))))
+            try:
+                yield
+            finally:
+                dbcur.execute(sql.SQL("select pg_advisory_unlock(hashtext({key}));").format(key=sql.Literal(str(key))))
+
     @classmethod
     def execute(cls, command, replacements=None):
 
@@ -69,8 +88,61 @@ class PostgreSQL:
                         operation varchar(36),
                         timestamp timestamp, 
                         _log text,  
+                        user_id varchar(250),
+                        instance_id varchar(64),
                         primary key (invocation_id)
                         );""".format(Settings.invocation_table))
+        # user_id column, counted by admission control, is added to older tables without rewriting them, unfinished
+        # invocations get it from their log. instance_id (heartbeat of instance, holding pending invocation in queue)
+        # stays empty for them.
+        cls.execute("""alter table {} add column if not exists user_id varchar(250),
+                                    add column if not exists instance_id varchar(64);""".format(
+            Settings.invocation_table))
+        cls.execute(sql.SQL("""update {invocation_table} set user_id = _log::json->>'user_id'
+                                where user_id is null and state in ({pending}, {in_progress});""").format(
+            invocation_table=sql.Identifier(Settings.invocation_table),
+            pending=sql.Literal(InvocationState.PENDING),
+            in_progress=sql.Literal(InvocationState.IN_PROGRESS)
+        ))
+
+        # old invocations are archived with compressed logs, in partitions by month
+        cls.execute("""
+                        create table if not exists {} (
+                        invocation_id varchar (36), 
+                        deployment_id varchar (36),
+                        deployment_label varchar(250),
+                        blueprint_id varchar (36),
+                        version_id varchar(36),
+                        state varchar(36),
+                        operation varchar(36),
+                        timestamp timestamp, 
+                        _log bytea,  
+                        primary key (invocation_id, timestamp)
+                        ) partition by range (timestamp);""".format(Settings.invocation_archive_table))
+        cls.execute("""
+                        create index if not exists {0}_deployment_id_timestamp_idx 
+                        on {0} (deployment_id, timestamp);""".format(Settings.invocation_archive_table))
+
+        cls.execute("""
+                        create table if not exists {} (
+                        invocation_id varchar (36), 
+                        stream varchar (6),
+                        deployment_id varchar (36),
+                        timestamp timestamp, 
+                        log bytea,
+                        primary key (invocation_id, stream)
+                        );""".format(Settings.invocation_log_table))
+
+        cls.execute("""
+                        create table if not exists {} (
+                        invocation_id varchar (36), 
+                        seq integer,
+                        deployment_id varchar (36),
+                        timestamp timestamp, 
+                        status varchar (16),
+                        result text,
+                        primary key (invocation_id, seq)
+                        );""".format(Settings.task_result_table))
         cls.execute("""
                         create table if not exists {} (
                         blueprint_id varchar (36),
@@ -82,7 +154,8 @@ class PostgreSQL:
                         url text,
                         timestamp timestamp default current_timestamp, 
                         commit_sha text,
-                        primary key (timestamp)
+                        id bigserial,
+                        primary key (id)
                         );""".format(Settings.blueprint_table))
 
         cls.execute("""
@@ -95,7 +168,8 @@ class PostgreSQL:
                         git_backend text,
                         repo_url text,
                         commit_sha text,
-                        primary key (timestamp)
+                        id bigserial,
+                        primary key (id)
                         );""".format(Settings.git_log_table))
 
         cls.execute("""
@@ -106,7 +180,116 @@ class PostgreSQL:
                         primary key (deployment_id)
                         );""".format(Settings.opera_session_data_table))
 
+        cls.execute("""
+                        create table if not exists {} (
+                        deployment_id varchar (36),
+                        timestamp timestamp default current_timestamp, 
+                        facts text,
+                        primary key (deployment_id)
+                        );""".format(Settings.ansible_facts_table))
+
+        cls.execute("""
+                        create table if not exists {} (
+                        profile_id varchar (36),
+                        timestamp timestamp default current_timestamp, 
+                        profile text,
+                        primary key (profile_id)
+                        );""".format(Settings.execution_profile_table))
+
+        cls.execute("""
+                        create table if not exists {} (
+                        rollout_id varchar (36),
+                        blueprint_id varchar (36),
+                        state varchar (16),
+                        timestamp timestamp default current_timestamp, 
+                        _log text,
+                        access_token text,
+                        primary key (rollout_id)
+                        );""".format(Settings.rollout_table))
+
+        cls.execute("""
+                        create table if not exists {} (
+                        owner_id varchar (64),
+                        kind varchar (16),
+                        hostname varchar (255),
+                        pid integer,
+                        started timestamp,
+                        timestamp timestamp default current_timestamp, 
+                        invocation_id varchar (36),
+                        primary key (owner_id)
+                        );""".format(Settings.heartbeat_table))
+
+        cls.execute("""
+                        create table if not exists {} (
+                        idempotency_key varchar (255),
+                        username varchar (250),
+                        fingerprint text,
+                        invocation_id varchar (36),
+                        timestamp timestamp default current_timestamp,
+                        primary key (idempotency_key, username)
+                        );""".format(Settings.idempotency_key_table))
+
+        cls.execute("""
+                        create table if not exists {} (
+                        job_id varchar (36),
+                        job_type varchar(36),
+                        cache_key varchar(64),
+                        state varchar(36),
+                        username varchar(250),
+                        instance_id varchar(64),
+                        timestamp timestamp default current_timestamp,
+                        _log text,
+                        primary key (job_id)
+                        );""".format(Settings.job_table))
+
+        cls.execute("""
+                        create table if not exists {} (
+                        deployment_id varchar (36),
+                        timestamp timestamp default current_timestamp,
+                        state_hash varchar(32),
+                        outputs text,
+                        primary key (deployment_id)
+                        );""".format(Settings.deployment_outputs_table))
+
+        cls.execute("""
+                        create table if not exists {} (
+                        blueprint_id varchar (36),
+                        major integer,
+                        minor integer,
+                        primary key (blueprint_id, major)
+                        );""".format(Settings.version_counter_table))
+
+        for stmt in cls.index_statements():
+            cls.execute(stmt)
+
+    @classmethod
+    def index_statements(cls, concurrently: bool = False) -> list:
+        """
+        Statements, creating indexes of invocation, invocation_log, task_result, blueprint and git_log tables. With concurrently, indexes are built
+        without blocking writes, but statements must not run inside transaction
+        """
+        indexes = [
+            (Settings.invocation_table, ['deployment_id', 'timestamp']),
+            (Settings.invocation_table, ['state']),
+            (Settings.invocation_log_table, ['deployment_id', 'timestamp']),
+            (Settings.task_result_table, ['deployment_id', 'timestamp']),
+            (Settings.blueprint_table, ['blueprint_id', 'version_id']),
+            (Settings.blueprint_table, ['username']),
+            (Settings.blueprint_table, ['project_domain']),
+            (Settings.git_log_table, ['blueprint_id', 'version_id']),
+            (Settings.git_log_table, ['blueprint_id', 'timestamp']),
+        ]
+        return [
+            sql.SQL("create index {concurrently} if not exists {name} on {table} ({columns});").format(
+                concurrently=sql.SQL('concurrently' if concurrently else ''),
+                name=sql.Identifier('_'.join([table] + columns + ['idx'])),
+                table=sql.Identifier(table),
+                columns=sql.SQL(', ').join(sql.Identifier(column) for column in columns)
+            ) for table, columns in indexes
+        ]
+
     @classmethod
+    @metrics.observe_sql
     def version_exists(cls, blueprint_id: uuid, version_id=None) -> bool:
         """
         Checks if, according to records in git_log table blueprint (version) exists
@@ -158,6 +341,7 @@ class PostgreSQL:
             return True
 
     @classmethod
+    @metrics.observe_sql
     def get_deployment_ids(cls, blueprint_id: uuid, version_id: str = None):
         """
         Returns list of deployment_ids od all deployments created from blueprint with blueprint_id (and version_id)
@@ -187,6 +371,7 @@ class PostgreSQL:
             return deployment_ids
 
     @classmethod
+    @metrics.observe_sql
     def blueprint_used_in_deployment(cls, blueprint_id: uuid, version_id: str = None):
         """
         Checks if blueprint is part of any deployment. If version is specified, it checks if it is used in current
@@ -213,6 +398,7 @@ class PostgreSQL:
         return True
 
     @classmethod
+    @metrics.observe_sql
     def save_opera_session_data(cls, deployment_id: uuid, tree: dict):
         """
         Saves .opera file tree to database
@@ -233,6 +419,7 @@ class PostgreSQL:
         return response
 
     @classmethod
+    @metrics.observe_sql
     def get_opera_session_data(cls, deployment_id):
         """
         Returns dict with keys [deployment_id, timestamp, tree], where tree is content of .opera dir
@@ -255,6 +442,25 @@ class PostgreSQL:
             return session_data
 
     @classmethod
+    @metrics.observe_sql
+    def get_opera_session_data_hash(cls, deployment_id: uuid):
+        """
+        Returns md5 hash of .opera file tree, which changes with every change of deployment state
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select md5(tree) from {session_data_table} 
+                                where deployment_id = {deployment_id};""").format(
+                session_data_table=sql.Identifier(Settings.opera_session_data_table),
+                deployment_id=sql.Literal(str(deployment_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return line[0]
+
+    @classmethod
+    @metrics.observe_sql
     def delete_opera_session_data(cls, deployment_id: uuid):
         """
         Deletes opera session data
@@ -277,24 +483,193 @@ class PostgreSQL:
         return success
 
     @classmethod
-    def update_deployment_log(cls, invocation_id: uuid, inv: Invocation):
+    @metrics.observe_sql
+    def save_ansible_facts(cls, deployment_id: uuid, facts: dict):
+        """
+        Saves Ansible fact cache of deployment, facts of every host with time, they were gathered
+        """
+        stmt = sql.SQL("""insert into {facts_table} (deployment_id, facts)
+                            values ({deployment_id}, {facts})
+                            ON CONFLICT (deployment_id) DO UPDATE
+                                SET timestamp=current_timestamp,
+                                    facts=excluded.facts;""").format(
+            facts_table=sql.Identifier(Settings.ansible_facts_table),
+            deployment_id=sql.Literal(str(deployment_id)),
+            facts=sql.Literal(json.dumps(facts))
+        )
+        response = cls.execute(stmt)
+        if response:
+            logger.debug(f'Updated ansible facts for deployment_id={deployment_id} in PostgreSQL database')
+        else:
+            logger.error(f'Failed to update ansible facts for deployment_id={deployment_id} in PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_ansible_facts(cls, deployment_id: uuid) -> dict:
+        """
+        Returns Ansible fact cache of deployment, empty if there is none
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select facts from {facts_table} 
+                                where deployment_id = {deployment_id};""").format(
+                facts_table=sql.Identifier(Settings.ansible_facts_table),
+                deployment_id=sql.Literal(str(deployment_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return {}
+            return json.loads(line[0])
+
+    @classmethod
+    @metrics.observe_sql
+    def save_execution_profile(cls, profile_id: uuid, profile: dict):
+        """
+        Saves execution profile of deployment or blueprint with profile_id
+        """
+        stmt = sql.SQL("""insert into {profile_table} (profile_id, profile)
+                            values ({profile_id}, {profile})
+                            ON CONFLICT (profile_id) DO UPDATE
+                                SET timestamp=current_timestamp,
+                                    profile=excluded.profile;""").format(
+            profile_table=sql.Identifier(Settings.execution_profile_table),
+            profile_id=sql.Literal(str(profile_id)),
+            profile=sql.Literal(json.dumps(profile))
+        )
+        response = cls.execute(stmt)
+        if response:
+            logger.debug(f'Updated execution profile {profile_id} in PostgreSQL database')
+        else:
+            logger.error(f'Failed to update execution profile {profile_id} in PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_execution_profile(cls, profile_id: uuid):
+        """
+        Returns execution profile of deployment or blueprint with profile_id, None if there is none
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select profile from {profile_table} 
+                                where profile_id = {profile_id};""").format(
+                profile_table=sql.Identifier(Settings.execution_profile_table),
+                profile_id=sql.Literal(str(profile_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return json.loads(line[0])
+
+    @classmethod
+    @metrics.observe_sql
+    def delete_execution_profile(cls, profile_id: uuid):
+        """
+        Deletes execution profile of deployment or blueprint with profile_id
+        """
+        stmt = sql.SQL("""delete from {profile_table} 
+                            where profile_id = {profile_id}""").format(
+            profile_table=sql.Identifier(Settings.execution_profile_table),
+            profile_id=sql.Literal(str(profile_id))
+        )
+        success = cls.execute(stmt)
+        if success:
+            logger.debug(f'Deleted execution profile {profile_id} from PostgreSQL database')
+        else:
+            logger.error(f'Failed to delete execution profile {profile_id} from PostgreSQL database')
+        return success
+
+    @classmethod
+    @metrics.observe_sql
+    def save_deployment_outputs(cls, deployment_id: uuid, outputs: dict):
+        """
+        Saves outputs of deployment, together with hash of current .opera file tree, they were evaluated from
+        """
+        stmt = sql.SQL("""insert into {outputs_table} (deployment_id, state_hash, outputs)
+                            select deployment_id, md5(tree), {outputs} from {session_data_table}
+                                where deployment_id = {deployment_id}
+                            ON CONFLICT (deployment_id) DO UPDATE
+                                SET timestamp=current_timestamp,
+                                    state_hash=excluded.state_hash,
+                                    outputs=excluded.outputs;""").format(
+            outputs_table=sql.Identifier(Settings.deployment_outputs_table),
+            session_data_table=sql.Identifier(Settings.opera_session_data_table),
+            outputs=sql.Literal(json.dumps(outputs)),
+            deployment_id=sql.Literal(str(deployment_id))
+        )
+        response = cls.execute(stmt)
+        if response:
+            logger.debug(f'Updated outputs for deployment_id={deployment_id} in PostgreSQL database')
+        else:
+            logger.error(f'Failed to update outputs for deployment_id={deployment_id} in PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_deployment_outputs(cls, deployment_id: uuid):
+        """
+        Returns saved outputs of deployment, if they were evaluated from current .opera file tree, else None
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select o.outputs from {outputs_table} o
+                                join {session_data_table} s on o.deployment_id = s.deployment_id
+                                where o.deployment_id = {deployment_id} and o.state_hash = md5(s.tree);""").format(
+                outputs_table=sql.Identifier(Settings.deployment_outputs_table),
+                session_data_table=sql.Identifier(Settings.opera_session_data_table),
+                deployment_id=sql.Literal(str(deployment_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return json.loads(line[0])
+
+    @classmethod
+    @metrics.observe_sql
+    def delete_deployment_outputs(cls, deployment_id: uuid):
+        """
+        Deletes saved outputs of deployment
+        """
+        stmt = sql.SQL("""delete from {outputs_table} 
+                            where deployment_id = {deployment_id}""").format(
+            outputs_table=sql.Identifier(Settings.deployment_outputs_table),
+            deployment_id=sql.Literal(str(deployment_id))
+        )
+
+        success = cls.execute(stmt)
+
+        if success:
+            logger.debug(f'Deleted outputs for deployment_id={deployment_id} from PostgreSQL database')
+        else:
+            logger.error(f'Failed to delete outputs for deployment_id={deployment_id} from PostgreSQL database')
+
+        return success
+
+    @classmethod
+    @metrics.observe_sql
+    def update_deployment_log(cls, invocation_id: uuid, inv: Invocation, instance_id: str = None):
         """
-        updates deployment log with deployment_id, timestamp_submission, invocation_id, _log
+        updates deployment log with deployment_id, timestamp_submission, invocation_id, _log. Interrupted invocation
+        is final, it is not updated any more. instance_id is saved with new invocation only.
         """
 
         response = cls.execute(
-            """insert into {} (deployment_id, deployment_label, timestamp, invocation_id, 
-                              blueprint_id, version_id, state, operation, _log)
-               values (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """insert into {0} (deployment_id, deployment_label, timestamp, invocation_id, 
+                              blueprint_id, version_id, state, operation, _log, user_id, instance_id)
+               values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                ON CONFLICT (invocation_id) DO UPDATE
                    SET timestamp=excluded.timestamp,
                        state=excluded.state,
                        operation=excluded.operation,
-                        _log=excluded._log;"""
+                        _log=excluded._log,
+                       user_id=excluded.user_id
+                   WHERE {0}.state <> %s;"""
                 .format(Settings.invocation_table),
             (str(inv.deployment_id), inv.deployment_label, str(inv.timestamp_submission), str(invocation_id),
              str(inv.blueprint_id),
-             inv.version_id, inv.state, inv.operation, json.dumps(inv.to_dict(), cls=file_util.UUIDEncoder)))
+             inv.version_id, inv.state, inv.operation, serialization.dumps(inv), inv.user_id or None, instance_id,
+             InvocationState.INTERRUPTED))
         deployment_id = inv.deployment_id
         if response:
             logger.debug(
@@ -306,6 +681,7 @@ class PostgreSQL:
         return response
 
     @classmethod
+    @metrics.observe_sql
     def get_deployment_status(cls, deployment_id: uuid):
         """
         Get last deployment log
@@ -327,135 +703,353 @@ class PostgreSQL:
 
             return inv
 
-    # TODO Implemented due to update's need for one before last invocation
-    #   remove when solved properly
-    @classmethod
-    def get_last_completed_invocation(cls, deployment_id: uuid):
-        history = cls.get_deployment_history(deployment_id)
-        if len(history) == 0:
-            return None
-        history_completed = [x for x in history if x.state in (InvocationState.SUCCESS, InvocationState.FAILED)]
-        return history_completed[-1]
-
     @classmethod
-    def get_deployment_history(cls, deployment_id: uuid):
+    @metrics.observe_sql
+    def get_deployment_status_version(cls, deployment_id: uuid) -> Optional[tuple]:
         """
-        Get all deployment logs for one deployment
+        Returns (invocation_id, blueprint_id, state, row version) of last invocation, without loading its log. Row
+        version (xmin) changes with every update of invocation.
         """
         with cls.cursor() as dbcur:
-            stmt = sql.SQL("""select timestamp, _log from {invocation_table} 
+            stmt = sql.SQL("""select invocation_id, blueprint_id, state, xmin::text from {invocation_table}
                                 where deployment_id = {deployment_id}
-                                order by timestamp;""").format(
+                                order by timestamp desc limit 1;""").format(
                 invocation_table=sql.Identifier(Settings.invocation_table),
                 deployment_id=sql.Literal(str(deployment_id))
             )
-
             dbcur.execute(stmt)
-            lines = dbcur.fetchall()
-            history = [Invocation.from_dict(json.loads(line[1])) for line in lines]
+            line = dbcur.fetchone()
+            return tuple(line) if line else None
 
-            return history
+    @staticmethod
+    def completed_condition() -> sql.Composable:
+        """
+        Condition on invocation rows, which can be continued or updated from. Interrupted invocation counts, if its
+        partial .opera state has been saved.
+        """
+        return sql.SQL("""(state in ({success}, {failed})
+                           or (state = {interrupted} and _log::json->>'instance_state' is not null))""").format(
+            success=sql.Literal(InvocationState.SUCCESS),
+            failed=sql.Literal(InvocationState.FAILED),
+            interrupted=sql.Literal(InvocationState.INTERRUPTED)
+        )
 
     @classmethod
-    def get_last_invocation_id(cls, deployment_id: uuid):
+    @metrics.observe_sql
+    def get_last_completed_invocation(cls, deployment_id: uuid):
         """
-        This method exists since we do not want to have invocation_id in Invocation object, to not confuse users
+        Get last completed invocation of deployment. It is never archived, so only live invocations are searched.
         """
         with cls.cursor() as dbcur:
-            stmt = sql.SQL("""select timestamp, invocation_id from {invocation_table} 
-                                where deployment_id = {deployment_id} 
+            stmt = sql.SQL("""select timestamp, _log from {invocation_table}
+                                where deployment_id = {deployment_id} and {completed}
                                 order by timestamp desc limit 1;""").format(
                 invocation_table=sql.Identifier(Settings.invocation_table),
-                deployment_id=sql.Literal(str(deployment_id))
+                deployment_id=sql.Literal(str(deployment_id)),
+                completed=cls.completed_condition()
             )
-
             dbcur.execute(stmt)
             line = dbcur.fetchone()
             if not line:
                 return None
-            inv = line[1]
-
-            return inv
+            return Invocation.from_dict(json.loads(line[1]))
 
     @classmethod
-    def save_git_transaction_data(cls, blueprint_id: uuid, revision_msg: str, job: str, git_backend: str,
-                                  repo_url: str, version_id: str = None, commit_sha: str = None):
+    @metrics.observe_sql
+    def get_deployment_history(cls, deployment_id: uuid, limit: int = None, after: list = None):
         """
-        Saves transaction data to database
-        """
-        response = cls.execute(
-            """insert into {} (blueprint_id, version_id, revision_msg, job, git_backend, repo_url, commit_sha) 
-            values (%s, %s, %s, %s, %s, %s, %s)""".format(Settings.git_log_table),
-            (str(blueprint_id), version_id, revision_msg, job, git_backend, repo_url, commit_sha))
-        if response:
-            logger.debug(
-                f'Updated git log for blueprint_id={blueprint_id} and version_id={version_id} in PostgreSQL database')
-        else:
-            logger.error(
-                f'Failed to update git log blueprint_id={blueprint_id} and version_id={version_id} in '
-                f'PostgreSQL database')
-        return response
+        Get deployment logs for one deployment as (invocation_id, invocation) pairs, oldest first, including archived
+        logs
 
-    @classmethod
-    def get_git_transaction_data(cls, blueprint_id: uuid):
-        """
-        Gets all transaction data for some blueprint
+        Page of logs is selected with keyset (timestamp and invocation_id of last log of previous page) in after and
+        limit
         """
         with cls.cursor() as dbcur:
-            stmt = sql.SQL("""select blueprint_id, version_id, revision_msg, job, git_backend, 
-                                                     repo_url, commit_sha, timestamp from {git_log_table} 
-                                                     where blueprint_id = {blueprint_id}
-                                                     order by timestamp desc""").format(
-                git_log_table=sql.Identifier(Settings.git_log_table),
-                blueprint_id=sql.Literal(str(blueprint_id))
+            stmt = sql.SQL("""select timestamp, invocation_id, _log, archived_log from (
+                                    select timestamp, invocation_id, _log, null::bytea as archived_log
+                                    from {invocation_table}
+                                    where deployment_id = {deployment_id}
+                                    union all
+                                    select timestamp, invocation_id, null, _log from {invocation_archive_table}
+                                    where deployment_id = {deployment_id}
+                                ) as history
+                                where true {after}
+                                order by timestamp, invocation_id {limit};""").format(
+                invocation_table=sql.Identifier(Settings.invocation_table),
+                invocation_archive_table=sql.Identifier(Settings.invocation_archive_table),
+                deployment_id=sql.Literal(str(deployment_id)),
+                after=cls.keyset_condition(['timestamp', 'invocation_id'], after, descending=False),
+                limit=cls.limit_clause(limit)
             )
 
             dbcur.execute(stmt)
             lines = dbcur.fetchall()
-            git_transaction_data_list = [
-                {
-                    'blueprint_id': line[0],
-                    'version_id': line[1],
-                    'revision_msg': line[2],
-                    'job': line[3],
-                    'git_backend': line[4],
-                    'repo_url': line[5],
-                    'commit_sha': line[6],
-                    'timestamp': timestamp_util.datetime_to_str(line[7])
-                } for line in lines
-            ]
+            history = [(line[1], Invocation.from_dict(json.loads(line[2] if line[2] is not None else
+                                                                 zlib.decompress(bytes(line[3])).decode())))
+                       for line in lines]
 
-            return git_transaction_data_list
+            return history
 
     @classmethod
-    def get_project_domain(cls, blueprint_id: uuid):
+    @metrics.observe_sql
+    def get_deployment_history_version(cls, deployment_id: uuid) -> Optional[tuple]:
         """
-        returns project domain for blueprint
+        Returns (number of invocations, latest row version, number of archived invocations) of deployment, without
+        loading logs
         """
         with cls.cursor() as dbcur:
-            stmt = sql.SQL("""select blueprint_id, project_domain from {blueprint_table} 
-                               where blueprint_id = {blueprint_id};""").format(
-                blueprint_table=sql.Identifier(Settings.blueprint_table),
-                blueprint_id=sql.Literal(str(blueprint_id))
+            stmt = sql.SQL("""select count(*), max(xmin::text::bigint),
+                                     (select count(*) from {invocation_archive_table}
+                                        where deployment_id = {deployment_id})
+                                from {invocation_table}
+                                where deployment_id = {deployment_id};""").format(
+                invocation_table=sql.Identifier(Settings.invocation_table),
+                invocation_archive_table=sql.Identifier(Settings.invocation_archive_table),
+                deployment_id=sql.Literal(str(deployment_id))
             )
             dbcur.execute(stmt)
             line = dbcur.fetchone()
-            if not line:
+            if not line or not (line[0] or line[2]):
                 return None
-            project_domain = line[1]
+            return tuple(line)
 
-            return project_domain
+    @classmethod
+    @metrics.observe_sql
+    def save_invocation_log(cls, invocation_id: uuid, deployment_id: uuid, timestamp: str, stream: str,
+                            log: bytes):
+        """
+        Saves full compressed log of invocation's stream
+        """
+        response = cls.execute(
+            """insert into {} (invocation_id, stream, deployment_id, timestamp, log)
+               values (%s, %s, %s, %s, %s)
+               ON CONFLICT (invocation_id, stream) DO UPDATE
+                   SET log=excluded.log;""".format(Settings.invocation_log_table),
+            (str(invocation_id), stream, str(deployment_id), str(timestamp), psycopg2.Binary(log)))
+        if response:
+            logger.debug(f'Saved full {stream} for invocation_id={invocation_id} in PostgreSQL database')
+        else:
+            logger.error(f'Failed to save full {stream} for invocation_id={invocation_id} in PostgreSQL database')
+        return response
 
     @classmethod
-    def get_blueprint_name(cls, blueprint_id: uuid):
+    @metrics.observe_sql
+    def get_invocation_log(cls, deployment_id: uuid, stream: str, timestamp: str = None) -> Optional[bytes]:
         """
-        Returns human-readable name for blueprint
+        Returns full compressed log of invocation's stream, of last invocation if timestamp is None
         """
         with cls.cursor() as dbcur:
-            stmt = sql.SQL("""select blueprint_id, blueprint_name from {blueprint_table} 
-                               where blueprint_id = {blueprint_id}""").format(
-                blueprint_table=sql.Identifier(Settings.blueprint_table),
-                blueprint_id=sql.Literal(str(blueprint_id)),
+            stmt = sql.SQL("""select log from {invocation_log_table}
+                                where deployment_id = {deployment_id} and stream = {stream} {timestamp}
+                                order by timestamp desc limit 1;""").format(
+                invocation_log_table=sql.Identifier(Settings.invocation_log_table),
+                deployment_id=sql.Literal(str(deployment_id)),
+                stream=sql.Literal(stream),
+                timestamp=sql.SQL("and timestamp = {}").format(sql.Literal(timestamp)) if timestamp else sql.SQL('')
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return bytes(line[0])
+
+    @classmethod
+    @metrics.observe_sql
+    def save_task_results(cls, invocation_id: uuid, deployment_id: uuid, timestamp: str, task_results: list):
+        """
+        Saves results of Ansible tasks of invocation, in order of completion
+        """
+        if not task_results:
+            return True
+        stmt = sql.SQL("""insert into {task_result_table} (invocation_id, seq, deployment_id, timestamp, status, result)
+                          values {values}
+                          ON CONFLICT (invocation_id, seq) DO NOTHING;""").format(
+            task_result_table=sql.Identifier(Settings.task_result_table),
+            values=sql.SQL(', ').join(
+                sql.SQL('({})').format(sql.SQL(', ').join(map(sql.Literal, [
+                    str(invocation_id), seq, str(deployment_id), str(timestamp), result.get('status'),
+                    json.dumps(result)
+                ]))) for seq, result in enumerate(task_results)
+            )
+        )
+        response = cls.execute(stmt)
+        if response:
+            logger.debug(f'Saved {len(task_results)} task results for invocation_id={invocation_id} in PostgreSQL database')
+        else:
+            logger.error(f'Failed to save task results for invocation_id={invocation_id} in PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_task_results(cls, deployment_id: uuid, timestamp: str = None, status: str = None) -> list:
+        """
+        Returns results of Ansible tasks of invocation, of last invocation with task results if timestamp is None
+        """
+        with cls.cursor() as dbcur:
+            deployment_condition = sql.SQL("deployment_id = {}").format(sql.Literal(str(deployment_id)))
+            if timestamp:
+                timestamp_value = sql.Literal(timestamp)
+            else:
+                timestamp_value = sql.SQL("(select max(timestamp) from {task_result_table} where {condition})").format(
+                    task_result_table=sql.Identifier(Settings.task_result_table), condition=deployment_condition)
+            stmt = sql.SQL("""select result from {task_result_table}
+                                where {condition} and timestamp = {timestamp} {status}
+                                order by seq;""").format(
+                task_result_table=sql.Identifier(Settings.task_result_table),
+                condition=deployment_condition,
+                timestamp=timestamp_value,
+                status=sql.SQL("and status = {}").format(sql.Literal(status)) if status else sql.SQL('')
+            )
+            dbcur.execute(stmt)
+            return [TaskResult.from_dict(json.loads(line[0])) for line in dbcur.fetchall()]
+
+    @classmethod
+    @metrics.observe_sql
+    def get_invocation_state(cls, invocation_id: uuid) -> Optional[str]:
+        """
+        Get state of invocation, without parsing its log
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select state from {invocation_table} 
+                                where invocation_id = {invocation_id};""").format(
+                invocation_table=sql.Identifier(Settings.invocation_table),
+                invocation_id=sql.Literal(str(invocation_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return line[0]
+
+    @classmethod
+    @metrics.observe_sql
+    def get_last_invocation_id(cls, deployment_id: uuid):
+        """
+        This method exists since we do not want to have invocation_id in Invocation object, to not confuse users
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select timestamp, invocation_id from {invocation_table} 
+                                where deployment_id = {deployment_id} 
+                                order by timestamp desc limit 1;""").format(
+                invocation_table=sql.Identifier(Settings.invocation_table),
+                deployment_id=sql.Literal(str(deployment_id))
+            )
+
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            inv = line[1]
+
+            return inv
+
+    @classmethod
+    @metrics.observe_sql
+    def save_git_transaction_data(cls, blueprint_id: uuid, revision_msg: str, job: str, git_backend: str,
+                                  repo_url: str, version_id: str = None, commit_sha: str = None):
+        """
+        Saves transaction data to database
+        """
+        response = cls.execute(
+            """insert into {} (blueprint_id, version_id, revision_msg, job, git_backend, repo_url, commit_sha) 
+            values (%s, %s, %s, %s, %s, %s, %s)""".format(Settings.git_log_table),
+            (str(blueprint_id), version_id, revision_msg, job, git_backend, repo_url, commit_sha))
+        if response:
+            logger.debug(
+                f'Updated git log for blueprint_id={blueprint_id} and version_id={version_id} in PostgreSQL database')
+        else:
+            logger.error(
+                f'Failed to update git log blueprint_id={blueprint_id} and version_id={version_id} in '
+                f'PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_git_transaction_data(cls, blueprint_id: uuid, limit: int = None, after: list = None):
+        """
+        Gets transaction data for some blueprint, newest first
+
+        Page of transactions is selected with keyset (timestamp and version_id of last transaction of previous page) in
+        after and limit
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select blueprint_id, version_id, revision_msg, job, git_backend, 
+                                                     repo_url, commit_sha, timestamp from {git_log_table} 
+                                                     where blueprint_id = {blueprint_id} {after}
+                                                     order by timestamp desc, version_id desc {limit}""").format(
+                git_log_table=sql.Identifier(Settings.git_log_table),
+                blueprint_id=sql.Literal(str(blueprint_id)),
+                after=cls.keyset_condition(['timestamp', 'version_id'], after, descending=True),
+                limit=cls.limit_clause(limit)
+            )
+
+            dbcur.execute(stmt)
+            lines = dbcur.fetchall()
+            git_transaction_data_list = [
+                {
+                    'blueprint_id': line[0],
+                    'version_id': line[1],
+                    'revision_msg': line[2],
+                    'job': line[3],
+                    'git_backend': line[4],
+                    'repo_url': line[5],
+                    'commit_sha': line[6],
+                    'timestamp': timestamp_util.datetime_to_str(line[7])
+                } for line in lines
+            ]
+
+            return git_transaction_data_list
+
+    @classmethod
+    @metrics.observe_sql
+    def get_git_transaction_data_version(cls, blueprint_id: uuid) -> Optional[tuple]:
+        """
+        Returns (number of transactions, timestamp of latest transaction) of blueprint. Transactions are never
+        updated. Surrogate key id is not used, table may not have been migrated yet.
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select count(*), max(timestamp)::text from {git_log_table}
+                                where blueprint_id = {blueprint_id};""").format(
+                git_log_table=sql.Identifier(Settings.git_log_table),
+                blueprint_id=sql.Literal(str(blueprint_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line or not line[0]:
+                return None
+            return tuple(line)
+
+    @classmethod
+    @metrics.observe_sql
+    def get_project_domain(cls, blueprint_id: uuid):
+        """
+        returns project domain for blueprint
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select blueprint_id, project_domain from {blueprint_table} 
+                               where blueprint_id = {blueprint_id} limit 1;""").format(
+                blueprint_table=sql.Identifier(Settings.blueprint_table),
+                blueprint_id=sql.Literal(str(blueprint_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            project_domain = line[1]
+
+            return project_domain
+
+    @classmethod
+    @metrics.observe_sql
+    def get_blueprint_name(cls, blueprint_id: uuid):
+        """
+        Returns human-readable name for blueprint
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select blueprint_id, blueprint_name from {blueprint_table} 
+                               where blueprint_id = {blueprint_id}""").format(
+                blueprint_table=sql.Identifier(Settings.blueprint_table),
+                blueprint_id=sql.Literal(str(blueprint_id)),
             )
             dbcur.execute(stmt)
             line = dbcur.fetchone()
@@ -465,6 +1059,7 @@ class PostgreSQL:
             return name
 
     @classmethod
+    @metrics.observe_sql
     def update_blueprint_name(cls, blueprint_id: uuid, name: str):
         """
         updates blueprint name
@@ -484,6 +1079,113 @@ class PostgreSQL:
         return success
 
     @classmethod
+    @metrics.observe_sql
+    def next_version_tag(cls, blueprint_id: uuid, minor_to_increment: str = None) -> Optional[str]:
+        """
+        Allocates next version tag of blueprint from its version counter. Allocation is serialized per blueprint with
+        advisory lock, so concurrent uploads to the same blueprint never get the same tag.
+
+        if minor_to_increment not None, minor version of tag will be incremented, else, major version
+        """
+        if minor_to_increment:
+            major, minor = tag_util.decode_tag(minor_to_increment)
+            allocate = sql.SQL("""insert into {counter_table} (blueprint_id, major, minor)
+                                    values ({blueprint_id}, {major}, {minor})
+                                    ON CONFLICT (blueprint_id, major) DO UPDATE
+                                        SET minor = {counter_table}.minor + 1
+                                    returning major, minor;""").format(
+                counter_table=sql.Identifier(Settings.version_counter_table),
+                blueprint_id=sql.Literal(str(blueprint_id)),
+                major=sql.Literal(major),
+                minor=sql.Literal(minor)
+            )
+        else:
+            allocate = sql.SQL("""insert into {counter_table} (blueprint_id, major, minor)
+                                    select {blueprint_id}, coalesce(max(major), 0) + 1, 0 from {counter_table}
+                                        where blueprint_id = {blueprint_id}
+                                    returning major, minor;""").format(
+                counter_table=sql.Identifier(Settings.version_counter_table),
+                blueprint_id=sql.Literal(str(blueprint_id))
+            )
+        stmt = sql.SQL("select pg_advisory_xact_lock(hashtext({blueprint_id})); {allocate}").format(
+            blueprint_id=sql.Literal(str(blueprint_id)),
+            allocate=allocate
+        )
+
+        with cls.connection() as conn:
+            dbcur = conn.cursor()
+            try:
+                dbcur.execute(stmt)
+                line = dbcur.fetchone()
+                conn.commit()
+            except psycopg2.Error as e:
+                logger.error(f'Failed to allocate version tag for blueprint_id={blueprint_id}: {str(e)}')
+                dbcur.execute("ROLLBACK")
+                conn.commit()
+                return None
+
+        if not line:
+            return None
+        version_tag = tag_util.encode_tag((line[0], line[1]))
+        logger.debug(f'Allocated version tag {version_tag} for blueprint_id={blueprint_id}')
+        return version_tag
+
+    @classmethod
+    @metrics.observe_sql
+    def version_counter_exists(cls, blueprint_id: uuid) -> bool:
+        """
+        checks if version counter of blueprint exists
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select 1 from {counter_table}
+                                where blueprint_id = {blueprint_id} limit 1;""").format(
+                counter_table=sql.Identifier(Settings.version_counter_table),
+                blueprint_id=sql.Literal(str(blueprint_id))
+            )
+            dbcur.execute(stmt)
+            return dbcur.fetchone() is not None
+
+    @classmethod
+    @metrics.observe_sql
+    def reconcile_version_counter(cls, blueprint_id: uuid, tags: list) -> bool:
+        """
+        Raises version counter of blueprint to cover all tags. Counter is never lowered, so tags of deleted versions
+        are not handed out again
+        """
+        tags_parsed = tag_util.parse_tags(tags)
+        if not tags_parsed:
+            return True
+        stmt = sql.SQL("""insert into {counter_table} (blueprint_id, major, minor) values {values}
+                            ON CONFLICT (blueprint_id, major) DO UPDATE
+                                SET minor = greatest({counter_table}.minor, excluded.minor);""").format(
+            counter_table=sql.Identifier(Settings.version_counter_table),
+            values=sql.SQL(', ').join(
+                sql.SQL("({}, {}, {})").format(sql.Literal(str(blueprint_id)), sql.Literal(major), sql.Literal(minor))
+                for major, minor in {major: minor for major, minor in tags_parsed}.items()
+            )
+        )
+        response = cls.execute(stmt)
+        if response:
+            logger.debug(f'Reconciled version counter for blueprint_id={blueprint_id} in PostgreSQL database')
+        else:
+            logger.error(f'Failed to reconcile version counter for blueprint_id={blueprint_id} in PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_blueprint_ids(cls) -> list:
+        """
+        returns ids of all blueprints
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("select distinct blueprint_id from {blueprint_table};").format(
+                blueprint_table=sql.Identifier(Settings.blueprint_table)
+            )
+            dbcur.execute(stmt)
+            return [line[0] for line in dbcur.fetchall()]
+
+    @classmethod
+    @metrics.observe_sql
     def get_blueprint_meta(cls, blueprint_id: uuid, version_id: str = None):
         """
         returns blueprint (version's) metadata
@@ -524,6 +1226,47 @@ class PostgreSQL:
             return blueprint_meta
 
     @classmethod
+    @metrics.observe_sql
+    def get_last_version_id(cls, blueprint_id: uuid) -> Optional[str]:
+        """
+        returns highest saved version of blueprint, versions are compared by major and minor number, not by time of
+        saving, since minor version of older major can be saved later
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select version_id from {blueprint_table}
+                                where blueprint_id = {blueprint_id}
+                                order by substring(version_id from '^v([0-9]+)')::int desc,
+                                         coalesce(substring(version_id from '[.]([0-9]+)$')::int, 0) desc
+                                limit 1;""").format(
+                blueprint_table=sql.Identifier(Settings.blueprint_table),
+                blueprint_id=sql.Literal(str(blueprint_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            return line[0] if line else None
+
+    @classmethod
+    @metrics.observe_sql
+    def get_blueprint_meta_version(cls, blueprint_id: uuid, version_id: str = None) -> Optional[tuple]:
+        """
+        Returns (timestamp, row version) of blueprint (version's) metadata, row version changes with renaming of
+        blueprint. Surrogate key id is not used, table may not have been migrated yet.
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select timestamp::text, xmin::text from {blueprint_table}
+                                where blueprint_id = {blueprint_id} {version_id}
+                                order by timestamp desc limit 1;""").format(
+                blueprint_table=sql.Identifier(Settings.blueprint_table),
+                blueprint_id=sql.Literal(str(blueprint_id)),
+                version_id=sql.SQL("and version_id = {}").format(sql.Literal(version_id)) if version_id
+                else sql.SQL('')
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            return tuple(line) if line else None
+
+    @classmethod
+    @metrics.observe_sql
     def save_blueprint_meta(cls, blueprint_meta: BlueprintVersion):
         """
         saves metadata of blueprint version
@@ -542,6 +1285,7 @@ class PostgreSQL:
         return success
 
     @classmethod
+    @metrics.observe_sql
     def delete_blueprint_meta(cls, blueprint_id: uuid, version_id: str = None):
         """
         deletes blueprint meta of one or all versions
@@ -575,6 +1319,7 @@ class PostgreSQL:
         return success
 
     @classmethod
+    @metrics.observe_sql
     def get_inputs(cls, deployment_id: uuid):
         """
         extracts inputs from last invocation, belonging to deployment with this deployment_id
@@ -596,21 +1341,33 @@ class PostgreSQL:
                 return None
 
     @classmethod
-    def get_deployments_for_blueprint(cls, blueprint_id: uuid, active: bool):
+    @metrics.observe_sql
+    def get_deployments_for_blueprint(cls, blueprint_id: uuid, active: bool, limit: int = None, after: list = None):
         """
-        Returns [Deployment] for every deployment, created from blueprint
+        Returns [Deployment] for every deployment, created from blueprint, last changed first
+
+        Page of deployments is selected with keyset (timestamp and deployment_id of last deployment of previous page)
+        in after and limit
         """
         with cls.cursor() as dbcur:
-            stmt = sql.SQL("""select distinct on (deployment_id) deployment_id, state, operation, 
-                                timestamp, deployment_label from {invocation_table}
-                                where deployment_id in (
-                                    select deployment_id
+            stmt = sql.SQL("""select deployment_id, state, operation, timestamp, deployment_label, inputs from (
+                                    select distinct on (deployment_id) deployment_id, state, operation, 
+                                    timestamp, deployment_label, _log::json->>'inputs' as inputs
                                     from {invocation_table}
-                                    where blueprint_id = {blueprint_id}
-                                )
-                       order by deployment_id, timestamp desc;""").format(
+                                    where deployment_id in (
+                                        select deployment_id
+                                        from {invocation_table}
+                                        where blueprint_id = {blueprint_id}
+                                    )
+                                    order by deployment_id, timestamp desc
+                                ) as deployments
+                                where true {active} {after}
+                                order by timestamp desc, deployment_id desc {limit};""").format(
                 invocation_table=sql.Identifier(Settings.invocation_table),
                 blueprint_id=sql.Literal(str(blueprint_id)),
+                active=cls.active_condition() if active else sql.SQL(''),
+                after=cls.keyset_condition(['timestamp', 'deployment_id'], after, descending=True),
+                limit=cls.limit_clause(limit)
             )
             dbcur.execute(stmt)
             lines = dbcur.fetchall()
@@ -620,46 +1377,60 @@ class PostgreSQL:
                     'state': line[1],
                     'operation': line[2],
                     'timestamp': timestamp_util.datetime_to_str(line[3]),
-                    'last_inputs': cls.get_inputs(line[0]),
+                    'last_inputs': cls.load_json(line[5]),
                     'deployment_label': line[4]
                 } for line in lines
             ]
-            deployment_list.sort(key=lambda x: x['timestamp'], reverse=True)
-            if active:
-                # remove successfully completed undeploy jobs
-                deployment_list = [x for x in deployment_list if not (x['operation'] == OperationType.UNDEPLOY and
-                                                                      x['state'] == InvocationState.SUCCESS)]
 
             return deployment_list
 
     @classmethod
-    def get_blueprints_by_user_or_project(cls, username: str = None, project_domain: str = None, active: bool = True):
+    @metrics.observe_sql
+    def get_blueprints_by_user_or_project(cls, username: str = None, project_domain: str = None, active: bool = True,
+                                          limit: int = None, after: list = None):
         """
-        Returns [blueprint_id] for every blueprint, that belongs to user or project (or both)
+        Returns [blueprint_id] for every blueprint, that belongs to user or project (or both), newest first
+
+        Page of blueprints is selected with keyset (timestamp and blueprint_id of last blueprint of previous page)
+        in after and limit
         """
         with cls.cursor() as dbcur:
-            if username and not project_domain:
-                stmt = sql.SQL("""select distinct on (blueprint_id) blueprint_id, blueprint_name, aadm_id, 
-                                    username, project_domain, timestamp from {blueprint_table}
-                                    where username={username}""").format(
-                    blueprint_table=sql.Identifier(Settings.blueprint_table),
-                    username=sql.Literal(username),
-                )
-            elif not username and project_domain:
-                stmt = sql.SQL("""select distinct on (blueprint_id) blueprint_id, blueprint_name, aadm_id, 
-                                    username, project_domain, timestamp from {blueprint_table}
-                                    where project_domain={project_domain}""").format(
-                    blueprint_table=sql.Identifier(Settings.blueprint_table),
-                    project_domain=sql.Literal(project_domain)
+            conditions = []
+            if username:
+                conditions.append(sql.SQL("username = {}").format(sql.Literal(username)))
+            if project_domain:
+                conditions.append(sql.SQL("project_domain = {}").format(sql.Literal(project_domain)))
+
+            if active:
+                # only blueprints with active deployment
+                active_condition = sql.SQL("""and blueprint_id in (
+                                                select blueprint_id from (
+                                                    select distinct on (deployment_id) blueprint_id, state, operation
+                                                    from {invocation_table}
+                                                    order by deployment_id, timestamp desc
+                                                ) as deployments
+                                                where true {active}
+                                            )""").format(
+                    invocation_table=sql.Identifier(Settings.invocation_table),
+                    active=cls.active_condition()
                 )
             else:
-                stmt = sql.SQL("""select distinct on (blueprint_id) blueprint_id, blueprint_name, aadm_id, 
+                active_condition = sql.SQL('')
+
+            stmt = sql.SQL("""select blueprint_id, blueprint_name, aadm_id, username, project_domain, timestamp from (
+                                    select distinct on (blueprint_id) blueprint_id, blueprint_name, aadm_id, 
                                     username, project_domain, timestamp from {blueprint_table}
-                                    where username={username} and project_domain={project_domain}""").format(
-                    blueprint_table=sql.Identifier(Settings.blueprint_table),
-                    username=sql.Literal(username),
-                    project_domain=sql.Literal(project_domain)
-                )
+                                    where {conditions}
+                                    order by blueprint_id, timestamp
+                                ) as blueprints
+                                where true {active} {after}
+                                order by timestamp desc, blueprint_id desc {limit};""").format(
+                blueprint_table=sql.Identifier(Settings.blueprint_table),
+                conditions=sql.SQL(' and ').join(conditions),
+                active=active_condition,
+                after=cls.keyset_condition(['timestamp', 'blueprint_id'], after, descending=True),
+                limit=cls.limit_clause(limit)
+            )
             dbcur.execute(stmt)
             lines = dbcur.fetchall()
             blueprint_list = [
@@ -673,38 +1444,148 @@ class PostgreSQL:
                 } for line in lines
             ]
 
-            if active:
-                # remove blueprints with no active deployment
+            return blueprint_list
 
-                # get all deployments and their last state and operations
-                stmt2 = sql.SQL("""select distinct on (deployment_id) deployment_id, blueprint_id, state, operation, 
-                                                timestamp from {invocation_table}
-                                                where deployment_id in (
-                                                    select deployment_id
-                                                    from {invocation_table}
-                                                )
-                                       order by deployment_id, timestamp desc;""").format(
-                    invocation_table=sql.Identifier(Settings.invocation_table)
-                )
-                dbcur.execute(stmt2)
-                lines2 = dbcur.fetchall()
+    @classmethod
+    @metrics.observe_sql
+    def archive_invocations(cls, retention_days: int, batch_size: int = 500) -> int:
+        """
+        Moves batch of invocations, older than retention_days, to archive, with compressed logs. Last invocation and
+        last completed invocation of every deployment are never archived.
+        Returns number of archived invocations
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+        select_stmt = sql.SQL("""select invocation_id, deployment_id, deployment_label, blueprint_id, version_id, 
+                                    state, operation, timestamp, _log from {invocation_table}
+                                    where timestamp < {cutoff}
+                                    and invocation_id not in (
+                                        select distinct on (deployment_id) invocation_id from {invocation_table}
+                                        order by deployment_id, timestamp desc
+                                    )
+                                    and invocation_id not in (
+                                        select distinct on (deployment_id) invocation_id from {invocation_table}
+                                        where {completed}
+                                        order by deployment_id, timestamp desc
+                                    )
+                                    order by timestamp limit {limit}
+                                    for update skip locked;""").format(
+            invocation_table=sql.Identifier(Settings.invocation_table),
+            cutoff=sql.Literal(cutoff),
+            completed=cls.completed_condition(),
+            limit=sql.Literal(batch_size)
+        )
+
+        with cls.connection() as conn:
+            dbcur = conn.cursor()
+            try:
+                dbcur.execute(select_stmt)
+                lines = dbcur.fetchall()
+                if not lines:
+                    conn.commit()
+                    return 0
+
+                for month in sorted({(line[7].year, line[7].month) for line in lines}):
+                    dbcur.execute(cls.archive_partition_statement(*month))
+                dbcur.execute(sql.SQL("""insert into {invocation_archive_table} (invocation_id, deployment_id, 
+                                            deployment_label, blueprint_id, version_id, state, operation, timestamp, 
+                                            _log) values {values};""").format(
+                    invocation_archive_table=sql.Identifier(Settings.invocation_archive_table),
+                    values=sql.SQL(', ').join(
+                        sql.SQL("({})").format(sql.SQL(', ').join(
+                            [sql.Literal(value) for value in line[:8]] +
+                            [sql.Literal(psycopg2.Binary(zlib.compress((line[8] or '').encode())))]
+                        )) for line in lines
+                    )
+                ))
+                dbcur.execute(sql.SQL("""delete from {invocation_table}
+                                            where invocation_id in ({invocation_ids});""").format(
+                    invocation_table=sql.Identifier(Settings.invocation_table),
+                    invocation_ids=sql.SQL(', ').join(sql.Literal(line[0]) for line in lines)
+                ))
+                conn.commit()
+            except psycopg2.Error as e:
+                logger.error(f'Failed to archive invocations: {str(e)}')
+                dbcur.execute("ROLLBACK")
+                conn.commit()
+                return 0
 
-                # get active deployments
-                blueprint_ids = [line[1] for line in lines2 if not (line[2] == InvocationState.SUCCESS and
-                                                                    line[3] == OperationType.UNDEPLOY)]
+        logger.debug(f'Archived {len(lines)} invocations older than {cutoff}')
+        return len(lines)
 
-                blueprint_list = [x for x in blueprint_list if (x['blueprint_id'] in blueprint_ids)]
+    @staticmethod
+    def archive_partition_statement(year: int, month: int) -> sql.Composable:
+        """
+        Statement, creating partition of invocation archive for month
+        """
+        next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return sql.SQL("""create table if not exists {partition} partition of {invocation_archive_table}
+                            for values from ({start}) to ({end});""").format(
+            partition=sql.Identifier(f'{Settings.invocation_archive_table}_{year}_{month:02d}'),
+            invocation_archive_table=sql.Identifier(Settings.invocation_archive_table),
+            start=sql.Literal(f'{year}-{month:02d}-01'),
+            end=sql.Literal(f'{next_year}-{next_month:02d}-01')
+        )
 
-            return blueprint_list
+    @staticmethod
+    def keyset_condition(columns: list, after: list, descending: bool) -> sql.Composable:
+        """
+        Condition, selecting rows after keyset, when ordered by columns
+        """
+        if not after:
+            return sql.SQL('')
+        return sql.SQL("and ({columns}) {operator} ({values})").format(
+            columns=sql.SQL(', ').join(sql.Identifier(column) for column in columns),
+            operator=sql.SQL('<' if descending else '>'),
+            values=sql.SQL(', ').join(sql.Literal(value) for value in after)
+        )
+
+    @staticmethod
+    def limit_clause(limit: int) -> sql.Composable:
+        if not limit:
+            return sql.SQL('')
+        return sql.SQL("limit {}").format(sql.Literal(int(limit)))
+
+    @staticmethod
+    def active_condition() -> sql.Composable:
+        """
+        Condition, removing deployments with successfully completed undeploy as last invocation
+        """
+        return sql.SQL("and not (operation = {undeploy} and state = {success})").format(
+            undeploy=sql.Literal(OperationType.UNDEPLOY),
+            success=sql.Literal(InvocationState.SUCCESS)
+        )
+
+    @staticmethod
+    def load_json(text: str):
+        try:
+            return json.loads(text)
+        except (json.decoder.JSONDecodeError, TypeError):
+            return None
 
     @classmethod
+    @metrics.observe_sql
     def delete_deployment(cls, deployment_id: uuid):
         """
         Deletes deployment data
         """
         stmt = sql.SQL("""delete from {invocation_table} 
-                            where deployment_id = {deployment_id}""").format(
+                            where deployment_id = {deployment_id};
+                          delete from {invocation_archive_table} 
+                            where deployment_id = {deployment_id};
+                          delete from {invocation_log_table} 
+                            where deployment_id = {deployment_id};
+                          delete from {task_result_table} 
+                            where deployment_id = {deployment_id};
+                          delete from {facts_table} 
+                            where deployment_id = {deployment_id};
+                          delete from {profile_table} 
+                            where profile_id = {deployment_id};""").format(
+            profile_table=sql.Identifier(Settings.execution_profile_table),
+            task_result_table=sql.Identifier(Settings.task_result_table),
+            facts_table=sql.Identifier(Settings.ansible_facts_table),
             invocation_table=sql.Identifier(Settings.invocation_table),
+            invocation_archive_table=sql.Identifier(Settings.invocation_archive_table),
+            invocation_log_table=sql.Identifier(Settings.invocation_log_table),
             deployment_id=sql.Literal(str(deployment_id))
         )
 
@@ -718,3 +1599,370 @@ class PostgreSQL:
                 f'Failed to delete deployment for deployment_id={deployment_id} from PostgreSQL database')
 
         return success
+
+    @classmethod
+    @metrics.observe_sql
+    def update_job(cls, job: Job, cache_key: str = None, username: str = None, instance_id: str = None):
+        """
+        Saves background job with its state and result. Username of submitter and instance_id (heartbeat of instance,
+        holding job in queue) are saved with new job only.
+        """
+        response = cls.execute(
+            """insert into {} (job_id, job_type, cache_key, state, username, instance_id, _log)
+               values (%s, %s, %s, %s, %s, %s, %s)
+               ON CONFLICT (job_id) DO UPDATE
+                   SET state=excluded.state,
+                       cache_key=excluded.cache_key,
+                       _log=excluded._log;"""
+                .format(Settings.job_table),
+            (str(job.job_id), job.job_type, cache_key, job.state, username or None, instance_id,
+             json.dumps(job.to_dict(), cls=file_util.UUIDEncoder)))
+        if response:
+            logger.debug(f'Updated job with job_id={job.job_id} in PostgreSQL database')
+        else:
+            logger.error(f'Failed to update job with job_id={job.job_id} in PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_job(cls, job_id: uuid, username: str = None):
+        """
+        Get background job, only if it was submitted by username, if given
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select _log from {job_table} 
+                                where job_id = {job_id} {username};""").format(
+                job_table=sql.Identifier(Settings.job_table),
+                job_id=sql.Literal(str(job_id)),
+                username=sql.SQL("and username = {}").format(sql.Literal(username)) if username else sql.SQL('')
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return Job.from_dict(json.loads(line[0]))
+
+    @classmethod
+    @metrics.observe_sql
+    def save_rollout(cls, rollout: Rollout, access_token: str = None):
+        """
+        Saves rollout with state of its deployments. Access token, it was started with, is kept until rollout ends.
+        """
+        stmt = sql.SQL("""insert into {rollout_table} (rollout_id, blueprint_id, state, _log, access_token)
+                            values ({rollout_id}, {blueprint_id}, {state}, {log}, {access_token})
+                            ON CONFLICT (rollout_id) DO UPDATE
+                                SET state=excluded.state,
+                                    _log=excluded._log,
+                                    access_token=case when excluded.state = {in_progress} then
+                                        coalesce(excluded.access_token, {rollout_table}.access_token) end;
+                            """).format(
+            rollout_table=sql.Identifier(Settings.rollout_table),
+            rollout_id=sql.Literal(str(rollout.rollout_id)),
+            blueprint_id=sql.Literal(str(rollout.blueprint_id)),
+            state=sql.Literal(rollout.state),
+            log=sql.Literal(json.dumps(rollout.to_dict(), cls=file_util.UUIDEncoder)),
+            access_token=sql.Literal(access_token if rollout.state == RolloutState.IN_PROGRESS else None),
+            in_progress=sql.Literal(RolloutState.IN_PROGRESS)
+        )
+        response = cls.execute(stmt)
+        if response:
+            logger.debug(f'Updated rollout with rollout_id={rollout.rollout_id} in PostgreSQL database')
+        else:
+            logger.error(f'Failed to update rollout with rollout_id={rollout.rollout_id} in PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_rollout(cls, rollout_id: uuid):
+        """
+        Get rollout
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select _log from {rollout_table} 
+                                where rollout_id = {rollout_id};""").format(
+                rollout_table=sql.Identifier(Settings.rollout_table),
+                rollout_id=sql.Literal(str(rollout_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return Rollout.from_dict(json.loads(line[0]))
+
+    @classmethod
+    @metrics.observe_sql
+    def get_rollout_access_token(cls, rollout_id: uuid) -> Optional[str]:
+        """
+        Get access token of rollout in progress
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select access_token from {rollout_table} 
+                                where rollout_id = {rollout_id};""").format(
+                rollout_table=sql.Identifier(Settings.rollout_table),
+                rollout_id=sql.Literal(str(rollout_id))
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return line[0]
+
+    @classmethod
+    @metrics.observe_sql
+    def save_heartbeat(cls, owner_id: str, kind: str, hostname: str, pid: int, started: str,
+                       invocation_id: str = None):
+        """
+        Records, that worker (or instance) is alive and which invocation it runs
+        """
+        stmt = sql.SQL("""insert into {heartbeat_table} (owner_id, kind, hostname, pid, started, invocation_id)
+                            values ({owner_id}, {kind}, {hostname}, {pid}, {started}, {invocation_id})
+                            ON CONFLICT (owner_id) DO UPDATE
+                                SET timestamp=current_timestamp,
+                                    invocation_id=excluded.invocation_id;""").format(
+            heartbeat_table=sql.Identifier(Settings.heartbeat_table),
+            owner_id=sql.Literal(owner_id),
+            kind=sql.Literal(kind),
+            hostname=sql.Literal(hostname),
+            pid=sql.Literal(pid),
+            started=sql.Literal(started),
+            invocation_id=sql.Literal(invocation_id and str(invocation_id))
+        )
+        response = cls.execute(stmt)
+        if not response:
+            logger.error(f'Failed to update heartbeat of {owner_id} in PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_heartbeats(cls, timeout: int) -> list:
+        """
+        Get heartbeats of workers and instances, fresh is False, if heartbeat is older than timeout seconds
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select owner_id, kind, hostname, pid, started, invocation_id,
+                                timestamp > current_timestamp - make_interval(secs => {timeout})
+                                from {heartbeat_table};""").format(
+                heartbeat_table=sql.Identifier(Settings.heartbeat_table),
+                timeout=sql.Literal(timeout)
+            )
+            dbcur.execute(stmt)
+            return [
+                {
+                    "owner_id": line[0],
+                    "kind": line[1],
+                    "hostname": line[2],
+                    "pid": line[3],
+                    "started": line[4],
+                    "invocation_id": line[5],
+                    "fresh": line[6]
+                } for line in dbcur.fetchall()
+            ]
+
+    @classmethod
+    @metrics.observe_sql
+    def delete_heartbeats(cls, owner_ids: list):
+        """
+        Deletes heartbeats of dead workers and instances
+        """
+        if not owner_ids:
+            return True
+        stmt = sql.SQL("""delete from {heartbeat_table}
+                            where owner_id in ({owner_ids});""").format(
+            heartbeat_table=sql.Identifier(Settings.heartbeat_table),
+            owner_ids=sql.SQL(', ').join(sql.Literal(owner_id) for owner_id in owner_ids)
+        )
+        return cls.execute(stmt)
+
+    @classmethod
+    @metrics.observe_sql
+    def save_idempotency_key(cls, idempotency_key: str, username: Optional[str], fingerprint: str,
+                             invocation_id: uuid):
+        """
+        Saves Idempotency-Key of user with invocation, submitted with it
+        """
+        stmt = sql.SQL("""insert into {idempotency_key_table} (idempotency_key, username, fingerprint, invocation_id)
+                            values ({idempotency_key}, {username}, {fingerprint}, {invocation_id})
+                            ON CONFLICT (idempotency_key, username) DO UPDATE
+                                SET fingerprint=excluded.fingerprint,
+                                    invocation_id=excluded.invocation_id,
+                                    timestamp=current_timestamp;""").format(
+            idempotency_key_table=sql.Identifier(Settings.idempotency_key_table),
+            idempotency_key=sql.Literal(idempotency_key),
+            username=sql.Literal(username or ''),
+            fingerprint=sql.Literal(fingerprint),
+            invocation_id=sql.Literal(str(invocation_id))
+        )
+        response = cls.execute(stmt)
+        if not response:
+            logger.error(f'Failed to save Idempotency-Key {idempotency_key} in PostgreSQL database')
+        return response
+
+    @classmethod
+    @metrics.observe_sql
+    def get_idempotency_key(cls, idempotency_key: str, username: Optional[str], ttl: int) -> Optional[tuple]:
+        """
+        Returns (fingerprint, invocation) of Idempotency-Key of user, saved less than ttl seconds ago
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select ik.fingerprint, inv._log from {idempotency_key_table} ik
+                                join {invocation_table} inv on inv.invocation_id = ik.invocation_id
+                                where ik.idempotency_key = {idempotency_key} and ik.username = {username}
+                                and ik.timestamp > current_timestamp - make_interval(secs => {ttl});""").format(
+                idempotency_key_table=sql.Identifier(Settings.idempotency_key_table),
+                invocation_table=sql.Identifier(Settings.invocation_table),
+                idempotency_key=sql.Literal(idempotency_key),
+                username=sql.Literal(username or ''),
+                ttl=sql.Literal(ttl)
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return line[0], Invocation.from_dict(json.loads(line[1]))
+
+    @classmethod
+    @metrics.observe_sql
+    def delete_expired_idempotency_keys(cls, ttl: int):
+        """
+        Deletes Idempotency-Keys, older than ttl seconds
+        """
+        stmt = sql.SQL("""delete from {idempotency_key_table}
+                            where timestamp < current_timestamp - make_interval(secs => {ttl});""").format(
+            idempotency_key_table=sql.Identifier(Settings.idempotency_key_table),
+            ttl=sql.Literal(ttl)
+        )
+        return cls.execute(stmt)
+
+    @classmethod
+    @metrics.observe_sql
+    def get_unfinished_invocations(cls) -> list:
+        """
+        Get (invocation_id, invocation, instance_id) of all pending and running invocations
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select invocation_id, _log, instance_id from {invocation_table}
+                                where state in ({pending}, {in_progress})
+                                order by timestamp;""").format(
+                invocation_table=sql.Identifier(Settings.invocation_table),
+                pending=sql.Literal(InvocationState.PENDING),
+                in_progress=sql.Literal(InvocationState.IN_PROGRESS)
+            )
+            dbcur.execute(stmt)
+            return [(line[0], Invocation.from_dict(json.loads(line[1])), line[2]) for line in dbcur.fetchall()]
+
+    @classmethod
+    @metrics.observe_sql
+    def get_unfinished_deployment_ids(cls) -> set:
+        """
+        Get ids of deployments with pending or running invocation
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select distinct deployment_id from {invocation_table}
+                                where state in ({pending}, {in_progress});""").format(
+                invocation_table=sql.Identifier(Settings.invocation_table),
+                pending=sql.Literal(InvocationState.PENDING),
+                in_progress=sql.Literal(InvocationState.IN_PROGRESS)
+            )
+            dbcur.execute(stmt)
+            return {line[0] for line in dbcur.fetchall()}
+
+    @classmethod
+    @metrics.observe_sql
+    def get_unfinished_jobs(cls) -> list:
+        """
+        Get (job, instance_id) of all pending and running background jobs
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select _log, instance_id from {job_table}
+                                where state in ({pending}, {in_progress})
+                                order by timestamp;""").format(
+                job_table=sql.Identifier(Settings.job_table),
+                pending=sql.Literal(InvocationState.PENDING),
+                in_progress=sql.Literal(InvocationState.IN_PROGRESS)
+            )
+            dbcur.execute(stmt)
+            return [(Job.from_dict(json.loads(line[0])), line[1]) for line in dbcur.fetchall()]
+
+    @classmethod
+    @metrics.observe_sql
+    def delete_expired_jobs(cls, ttl: int):
+        """
+        Deletes finished background jobs with their cached results, older than ttl seconds
+        """
+        stmt = sql.SQL("""delete from {job_table}
+                            where timestamp < current_timestamp - make_interval(secs => {ttl})
+                            and state not in ({pending}, {in_progress});""").format(
+            job_table=sql.Identifier(Settings.job_table),
+            ttl=sql.Literal(ttl),
+            pending=sql.Literal(InvocationState.PENDING),
+            in_progress=sql.Literal(InvocationState.IN_PROGRESS)
+        )
+        return cls.execute(stmt)
+
+    @classmethod
+    @metrics.observe_sql
+    def get_unfinished_job_ids(cls) -> set:
+        """
+        Get ids of pending and running background jobs
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select job_id from {job_table}
+                                where state in ({pending}, {in_progress});""").format(
+                job_table=sql.Identifier(Settings.job_table),
+                pending=sql.Literal(InvocationState.PENDING),
+                in_progress=sql.Literal(InvocationState.IN_PROGRESS)
+            )
+            dbcur.execute(stmt)
+            return {line[0] for line in dbcur.fetchall()}
+
+    @classmethod
+    @metrics.observe_sql
+    def count_unfinished_invocations(cls, username: str = None, project_domain: str = None) -> dict:
+        """
+        Counts pending and running invocations: all, pending only, of user and of blueprints of project domain.
+        Only columns are read, logs are not parsed.
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select count(*),
+                                     count(*) filter (where state = {pending}),
+                                     count(*) filter (where user_id = {username}),
+                                     count(*) filter (where blueprint_id in (
+                                        select blueprint_id from {blueprint_table}
+                                        where project_domain = {project_domain}))
+                                from {invocation_table}
+                                where state in ({pending}, {in_progress});""").format(
+                invocation_table=sql.Identifier(Settings.invocation_table),
+                blueprint_table=sql.Identifier(Settings.blueprint_table),
+                username=sql.Literal(username),
+                project_domain=sql.Literal(project_domain),
+                pending=sql.Literal(InvocationState.PENDING),
+                in_progress=sql.Literal(InvocationState.IN_PROGRESS)
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            return {
+                'total': line[0],
+                'pending': line[1],
+                'user': line[2],
+                'project': line[3]
+            }
+
+    @classmethod
+    @metrics.observe_sql
+    def get_cached_job(cls, cache_key: str):
+        """
+        Get last successfully finished job with the same cache key
+        """
+        with cls.cursor() as dbcur:
+            stmt = sql.SQL("""select _log from {job_table} 
+                                where cache_key = {cache_key} and state = {state}
+                                order by timestamp desc limit 1;""").format(
+                job_table=sql.Identifier(Settings.job_table),
+                cache_key=sql.Literal(cache_key),
+                state=sql.Literal(InvocationState.SUCCESS)
+            )
+            dbcur.execute(stmt)
+            line = dbcur.fetchone()
+            if not line:
+                return None
+            return Job.from_dict(json.loads(line[0]))
@@ -0,0 +1,229 @@
+import contextlib
+import fcntl
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import List, Optional
+
+from opera.api.gitCsarDB import GitCsarDB
+from opera.api.log import get_logger
+from opera.api.openapi.models import RolloutState
+from opera.api.service.sqldb_service import PostgreSQL
+from opera.api.settings import Settings
+from opera.api.util import file_util
+
+logger = get_logger(__name__)
+
+# prefix of workdirs, moved to trash next to themselves, since trash dir is on another filesystem
+TRASH_PREFIX = '.trash-'
+# younger entries may be just being created
+MIN_AGE = 60
+# trash, left by workers, is deleted by thread of main process within seconds
+TRASH_SWEEP_INTERVAL = 10
+# held in job dir by process, which uses it
+JOB_LOCK = '.lock'
+
+
+class WorkdirService:
+    _trash_queue: Optional[queue.Queue] = None
+    _trash_pid: Optional[int] = None
+
+    @classmethod
+    def trash_dir(cls) -> Path:
+        return Path(Settings.API_WORKDIR).absolute() / 'trash'
+
+    @classmethod
+    def reclaim(cls, path: Path):
+        """
+        Moves directory to trash, so caller does not wait for slow delete. It is deleted by trash thread of main
+        process: at once, if it was reclaimed by main process, else by next sweep of trash.
+        """
+        path = Path(path)
+        if not path.exists():
+            return
+        trash_dir = cls.trash_dir()
+        trash_dir.mkdir(parents=True, exist_ok=True)
+        target = trash_dir / str(uuid.uuid4())
+        try:
+            os.rename(path, target)
+        except OSError:
+            # workdir on tmpfs cannot be moved to trash on disk
+            target = path.parent / f'{TRASH_PREFIX}{uuid.uuid4()}'
+            try:
+                os.rename(path, target)
+            except OSError as e:
+                logger.warning(f"Could not move {path} to trash, deleting it: {str(e)}")
+                shutil.rmtree(path, ignore_errors=True)
+                return
+        if cls._trash_pid == os.getpid():
+            cls._trash_queue.put(target)
+
+    @classmethod
+    def start_trash(cls) -> queue.Queue:
+        """
+        Starts trash thread in this process and returns its queue. It is started by main process only, after workers
+        pools, so no worker has thread running, when it forks.
+        """
+        if cls._trash_pid != os.getpid():
+            cls._trash_queue = queue.Queue()
+            cls._trash_pid = os.getpid()
+            threading.Thread(target=cls.empty_trash, args=(cls._trash_queue,), daemon=True).start()
+        return cls._trash_queue
+
+    @classmethod
+    def empty_trash(cls, trash_queue: queue.Queue):
+        while True:
+            try:
+                path = trash_queue.get(timeout=TRASH_SWEEP_INTERVAL)
+            except queue.Empty:
+                cls.sweep_trash()
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            trash_queue.task_done()
+
+    @classmethod
+    def sweep_trash(cls):
+        """
+        Deletes trash, left by workers
+        """
+        trash = list(cls.trash_dir().glob('*'))
+        for root in cls.deployment_roots():
+            trash += root.glob(f'*/{TRASH_PREFIX}*')
+        for path in trash:
+            shutil.rmtree(path, ignore_errors=True)
+
+    @classmethod
+    def deployment_roots(cls) -> List[Path]:
+        roots = [Path(Settings.DEPLOYMENT_DIR).absolute()]
+        if Settings.tmpfs_workdir:
+            roots.insert(0, Path(Settings.tmpfs_workdir).absolute() / 'deployment_dir')
+        return roots
+
+    @classmethod
+    def deployment_root(cls) -> Path:
+        """
+        Root of new workdir of invocation: tmpfs, if enabled and it has at least tmpfs_min_free_mb free, else disk
+        """
+        if Settings.tmpfs_workdir:
+            tmpfs_root = cls.deployment_roots()[0]
+            try:
+                tmpfs_root.mkdir(parents=True, exist_ok=True)
+                free = shutil.disk_usage(tmpfs_root).free
+                if free >= Settings.tmpfs_min_free_mb * 1024 * 1024:
+                    return tmpfs_root
+                logger.info(f"Only {free // (1024 * 1024)} MB free on tmpfs, creating workdir on disk")
+            except OSError as e:
+                logger.warning(f"Could not use tmpfs workdir: {str(e)}")
+        return Path(Settings.DEPLOYMENT_DIR).absolute()
+
+    @classmethod
+    def entries(cls) -> list:
+        """
+        Reclaimable workdirs with id of deployment, rollout, job or clone, which uses them
+        """
+        entries = [(path, None) for path in cls.trash_dir().glob('*')]
+        for root in cls.deployment_roots():
+            # deployment_dir/<blueprint_id>/<deployment_id>[-old]
+            entries += [(path, path.name[:36]) for path in root.glob('*/*')]
+        entries += [(path, path.name) for path in Path(Settings.STDFILE_DIR).absolute().glob('*')]
+        entries += [(path, path.name) for path in Path(Settings.ROLLOUT_DIR).absolute().glob('*')]
+        entries += [(path, path.name) for path in Path(Settings.JOB_DIR).absolute().glob('*')]
+        entries += [(path, path.name) for path in cls.clone_dirs()]
+        return entries
+
+    @classmethod
+    def clone_dirs(cls) -> List[Path]:
+        # clones of gitCsarDB in <workdir>/<uuid>/<repo>
+        return list(Path(Settings.git_config['workdir']).absolute().glob('*-*-*-*-*'))
+
+    @staticmethod
+    def locked(path: Path) -> bool:
+        """
+        Checks if lock file is held by any process
+        """
+        try:
+            with open(path, 'r') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    @classmethod
+    @contextlib.contextmanager
+    def locked_job_dir(cls, job_dir: Path):
+        """
+        Holds lock in job dir, so it is in use, even if there is no unfinished job with its id
+        """
+        job_dir.mkdir(parents=True, exist_ok=True)
+        with open(job_dir / JOB_LOCK, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield job_dir
+
+    @classmethod
+    def in_use(cls) -> set:
+        """
+        Ids of deployments with pending or running invocation, of rollouts in progress, of pending and running jobs
+        and of job dirs and gitCsarDB clones, locked by process, which uses them
+        """
+        ids = PostgreSQL.get_unfinished_deployment_ids() | PostgreSQL.get_unfinished_job_ids()
+        ids.update(path.name for path in Path(Settings.JOB_DIR).absolute().glob('*') if cls.locked(path / JOB_LOCK))
+        for path in Path(Settings.ROLLOUT_DIR).absolute().glob('*'):
+            rollout = PostgreSQL.get_rollout(path.name)
+            if rollout and rollout.state == RolloutState.IN_PROGRESS:
+                ids.add(path.name)
+        ids.update(path.name for path in cls.clone_dirs() if cls.locked(path / GitCsarDB.CLONE_LOCK))
+        return ids
+
+    @classmethod
+    def collect(cls) -> int:
+        """
+        Deletes trash and workdirs, left unused for workdir_gc_max_age. Over workdir_quota_mb also deletes newer unused
+        workdirs, oldest first. Returns number of freed bytes.
+        """
+        in_use = cls.in_use()
+        now = time.time()
+        unused = []
+        total = 0
+        for path, owner_id in cls.entries():
+            try:
+                mtime = path.lstat().st_mtime
+            except OSError:
+                continue
+            size = file_util.dir_size(path) if path.is_dir() else path.lstat().st_size
+            total += size
+            if owner_id in in_use or now - mtime < MIN_AGE:
+                continue
+            expired = path.parent == cls.trash_dir() or path.name.startswith(TRASH_PREFIX) or \
+                now - mtime > Settings.workdir_gc_max_age
+            unused.append((not expired, mtime, size, path))
+
+        freed = 0
+        quota = Settings.workdir_quota_mb * 1024 * 1024
+        # expired first, then oldest first
+        for keep, _, size, path in sorted(unused):
+            if keep and (not quota or total - freed <= quota):
+                break
+            logger.debug(f"Removing unused workdir {path}")
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+            freed += size
+        for root in cls.deployment_roots():
+            for blueprint_dir in root.glob('*'):
+                try:
+                    if now - blueprint_dir.lstat().st_mtime > MIN_AGE:
+                        blueprint_dir.rmdir()
+                except OSError:
+                    # not empty
+                    pass
+        if quota and total - freed > quota:
+            logger.warning(f"Workdirs take {(total - freed) // (1024 * 1024)} MB, over quota of "
+                           f"{Settings.workdir_quota_mb} MB")
+        return freed
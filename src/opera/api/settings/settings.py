@@ -20,16 +20,82 @@ class Settings:
     STDFILE_DIR = None
     INVOCATION_DIR = None
     DEPLOYMENT_DIR = None
+    JOB_DIR = None
+    ROLLOUT_DIR = None
 
     # maximum number of invocations at the same time
     invocation_service_workers = 10
 
+    # maximum number of lightweight jobs (validation) at the same time
+    job_service_workers = 2
+
+    # finished jobs and cached job results are deleted after job_ttl seconds
+    job_ttl = 604800
+
+    # reconcile version counters with git tags on startup
+    reconcile_version_counters = False
+
+    # invocations older than retention are moved to archive every archive interval (seconds), 0 disables archival
+    invocation_retention_days = 30
+    invocation_archive_interval = 3600
+
+    # invocation keeps first and last KB of stdout and stderr, full log of truncated stream is stored compressed
+    log_capture_head_kb = 64
+    log_capture_tail_kb = 256
+
+    # facts of hosts, gathered by Ansible, are kept with deployment and reused for fact_cache_ttl seconds, 0 disables
+    fact_cache_ttl = 86400
+
+    # workers and instance record heartbeat every heartbeat_interval seconds (0 disables), invocations of workers
+    # without heartbeat for heartbeat_timeout seconds are marked interrupted every reconcile_interval seconds
+    # (0 disables)
+    heartbeat_interval = 30
+    heartbeat_timeout = 120
+    reconcile_interval = 300
+
+    # finished workdirs are moved to trash and deleted in background, every workdir_gc_interval seconds (0 disables)
+    # trash and workdirs, left unused for workdir_gc_max_age seconds, are removed, over workdir_quota_mb (0 disables)
+    # also newer unused workdirs
+    workdir_gc_interval = 600
+    workdir_gc_max_age = 3600
+    workdir_quota_mb = 0
+    # workdirs of invocations are created on tmpfs, while it has tmpfs_min_free_mb free, else on disk
+    tmpfs_workdir = None
+    tmpfs_min_free_mb = 256
+
+    # invocation is rejected with 429, while pending and running invocations, in total, of blueprints of the same
+    # project domain or of the same user, reach limit (0 disables), client should retry after admission_retry_after
+    # seconds
+    admission_max_invocations = 0
+    admission_max_invocations_project = 0
+    admission_max_invocations_user = 0
+    admission_retry_after = 30
+
+    # repeated submission of invocation with the same Idempotency-Key returns original invocation for
+    # idempotency_key_ttl seconds
+    idempotency_key_ttl = 86400
+
+    # responses larger than compression_min_size bytes are compressed with gzip or br, if client accepts it
+    response_compression = True
+    compression_min_size = 1024
+
     # PostgreSQL config
     sql_config = None
     invocation_table = 'invocation'
     blueprint_table = 'blueprint'
     git_log_table = 'git_log'
     opera_session_data_table = 'opera_session_data'
+    job_table = 'job'
+    deployment_outputs_table = 'deployment_outputs'
+    version_counter_table = 'version_counter'
+    invocation_archive_table = 'invocation_archive'
+    invocation_log_table = 'invocation_log'
+    task_result_table = 'task_result'
+    ansible_facts_table = 'ansible_facts'
+    execution_profile_table = 'execution_profile'
+    rollout_table = 'rollout'
+    heartbeat_table = 'worker_heartbeat'
+    idempotency_key_table = 'idempotency_key'
 
     # gitCsarDB config
     git_config = None
@@ -47,6 +113,13 @@ class Settings:
     secure_workdir = True
     ssh_key_path_template = "ssh/{username}"
     ssh_key_secret_name = "ssh_pkey"
+    # idle ssh-agent of user is kept by worker for following invocations of user, 0 stops agent after every invocation
+    ssh_agent_ttl = 900
+    # SSH connections of Ansible are multiplexed per deployment, user and host, idle master connection persists for
+    # ssh_control_persist seconds (0 disables multiplexing)
+    ssh_control_persist = 600
+    ssh_control_dir = None
+    ansible_pipelining = True
 
     @staticmethod
     def load_settings():
@@ -54,8 +127,14 @@ class Settings:
         Settings.STDFILE_DIR = f"{Settings.API_WORKDIR}/in_progress"
         Settings.INVOCATION_DIR = f"{Settings.API_WORKDIR}/invocations"
         Settings.DEPLOYMENT_DIR = f"{Settings.API_WORKDIR}/deployment_dir"
+        Settings.JOB_DIR = f"{Settings.API_WORKDIR}/jobs"
+        Settings.ROLLOUT_DIR = f"{Settings.API_WORKDIR}/rollouts"
         Settings.workdir = Path(Settings.API_WORKDIR) / "git_db/mockConnector"
         Settings.secure_workdir = os.getenv("XOPERA_SECURE_WORKDIR", "True").lower() == "true"
+        Settings.ssh_agent_ttl = int(os.getenv("SSH_AGENT_TTL", '900'))
+        Settings.ssh_control_persist = int(os.getenv("SSH_CONTROL_PERSIST", '600'))
+        Settings.ssh_control_dir = os.getenv("SSH_CONTROL_DIR", f"{Settings.API_WORKDIR}/cp")
+        Settings.ansible_pipelining = os.getenv("XOPERA_ANSIBLE_PIPELINING", "true").lower() == "true"
 
         Settings.git_config = {
             'type': os.getenv('XOPERA_GIT_TYPE', 'mock'),
@@ -86,6 +165,29 @@ class Settings:
         Settings.apiKey = os.getenv("AUTH_API_KEY", "")
 
         Settings.invocation_service_workers = int(os.getenv("INVOCATION_SERVICE_WORKERS", '10'))
+        Settings.job_service_workers = int(os.getenv("JOB_SERVICE_WORKERS", '2'))
+        Settings.job_ttl = int(os.getenv("JOB_TTL", '604800'))
+        Settings.reconcile_version_counters = os.getenv("RECONCILE_VERSION_COUNTERS", "false") == "true"
+        Settings.invocation_retention_days = int(os.getenv("INVOCATION_RETENTION_DAYS", '30'))
+        Settings.invocation_archive_interval = int(os.getenv("INVOCATION_ARCHIVE_INTERVAL", '3600'))
+        Settings.log_capture_head_kb = int(os.getenv("LOG_CAPTURE_HEAD_KB", '64'))
+        Settings.log_capture_tail_kb = int(os.getenv("LOG_CAPTURE_TAIL_KB", '256'))
+        Settings.fact_cache_ttl = int(os.getenv("FACT_CACHE_TTL", '86400'))
+        Settings.heartbeat_interval = int(os.getenv("HEARTBEAT_INTERVAL", '30'))
+        Settings.heartbeat_timeout = int(os.getenv("HEARTBEAT_TIMEOUT", '120'))
+        Settings.reconcile_interval = int(os.getenv("RECONCILE_INTERVAL", '300'))
+        Settings.workdir_gc_interval = int(os.getenv("WORKDIR_GC_INTERVAL", '600'))
+        Settings.workdir_gc_max_age = int(os.getenv("WORKDIR_GC_MAX_AGE", '3600'))
+        Settings.workdir_quota_mb = int(os.getenv("WORKDIR_QUOTA_MB", '0'))
+        Settings.tmpfs_workdir = os.getenv("XOPERA_TMPFS_WORKDIR") or None
+        Settings.tmpfs_min_free_mb = int(os.getenv("TMPFS_MIN_FREE_MB", '256'))
+        Settings.admission_max_invocations = int(os.getenv("ADMISSION_MAX_INVOCATIONS", '0'))
+        Settings.admission_max_invocations_project = int(os.getenv("ADMISSION_MAX_INVOCATIONS_PROJECT", '0'))
+        Settings.admission_max_invocations_user = int(os.getenv("ADMISSION_MAX_INVOCATIONS_USER", '0'))
+        Settings.admission_retry_after = int(os.getenv("ADMISSION_RETRY_AFTER", '30'))
+        Settings.idempotency_key_ttl = int(os.getenv("IDEMPOTENCY_KEY_TTL", '86400'))
+        Settings.response_compression = os.getenv("RESPONSE_COMPRESSION", "true").lower() == "true"
+        Settings.compression_min_size = int(os.getenv("COMPRESSION_MIN_SIZE", '1024'))
 
         Settings.vault_secret_storage_uri = os.getenv("VAULT_SECRET_URI", "http://localhost:8200/v1/")
         Settings.vault_login_uri = os.getenv("VAULT_LOGIN_URI", "http://localhost:8200/v1/auth/jwt/login")
@@ -109,6 +211,33 @@ class Settings:
             },
             "auth_api_key": Settings.apiKey,
             "invocation_service_workers": Settings.invocation_service_workers,
+            "job_service_workers": Settings.job_service_workers,
+            "job_ttl": Settings.job_ttl,
+            "reconcile_version_counters": Settings.reconcile_version_counters,
+            "invocation_retention_days": Settings.invocation_retention_days,
+            "invocation_archive_interval": Settings.invocation_archive_interval,
+            "log_capture_head_kb": Settings.log_capture_head_kb,
+            "log_capture_tail_kb": Settings.log_capture_tail_kb,
+            "fact_cache_ttl": Settings.fact_cache_ttl,
+            "heartbeat_interval": Settings.heartbeat_interval,
+            "heartbeat_timeout": Settings.heartbeat_timeout,
+            "reconcile_interval": Settings.reconcile_interval,
+            "workdir_gc_interval": Settings.workdir_gc_interval,
+            "workdir_gc_max_age": Settings.workdir_gc_max_age,
+            "workdir_quota_mb": Settings.workdir_quota_mb,
+            "tmpfs_workdir": Settings.tmpfs_workdir,
+            "tmpfs_min_free_mb": Settings.tmpfs_min_free_mb,
+            "admission_max_invocations": Settings.admission_max_invocations,
+            "admission_max_invocations_project": Settings.admission_max_invocations_project,
+            "admission_max_invocations_user": Settings.admission_max_invocations_user,
+            "admission_retry_after": Settings.admission_retry_after,
+            "idempotency_key_ttl": Settings.idempotency_key_ttl,
+            "response_compression": Settings.response_compression,
+            "compression_min_size": Settings.compression_min_size,
+            "ssh_agent_ttl": Settings.ssh_agent_ttl,
+            "ssh_control_persist": Settings.ssh_control_persist,
+            "ssh_control_dir": Settings.ssh_control_dir,
+            "ansible_pipelining": Settings.ansible_pipelining,
             "sql_config": Settings.sql_config,
             "git_config": __debug_git_config
         }, indent=2))
@@ -16,6 +16,9 @@ from opera.api.openapi.models import Invocation, InvocationState, OperationType,
 from opera.api.settings import Settings
 from opera.api.util import timestamp_util, xopera_util
 
+# workers of tests have no database to record heartbeats to
+Settings.heartbeat_interval = 0
+
 
 def pytest_sessionstart(session):
     """
@@ -41,6 +44,7 @@ def change_API_WORKDIR(new_workdir: str):
     Settings.STDFILE_DIR = f"{Settings.API_WORKDIR}/in_progress"
     Settings.INVOCATION_DIR = f"{Settings.API_WORKDIR}/invocations"
     Settings.DEPLOYMENT_DIR = f"{Settings.API_WORKDIR}/deployment_dir"
+    Settings.JOB_DIR = f"{Settings.API_WORKDIR}/jobs"
     Settings.workdir = Path(Settings.API_WORKDIR) / "git_db/mockConnector"
 
 
@@ -1,9 +1,16 @@
+import os
+import stat
 import tempfile
 import uuid
 from pathlib import Path
 
+import pytest
+
 import opera.api.gitCsarDB as gitCsarDB
 from opera.api.gitCsarDB import GitCsarDB
+from opera.api.service.csardb_service import GitDB
+from opera.api.service.sqldb_service import SqlDBFailedException
+from opera.api.service.workdir_service import WorkdirService
 
 
 def test_connect_function():
@@ -59,6 +66,17 @@ def test_get_CSAR(db: GitCsarDB, generic_dir: Path):
     assert len([file for file in repo_path.glob("[!.git]*")]) > 0, "Repo empty"
 
 
+def test_no_clones_left(generic_dir: Path, tmp_path: Path):
+    db = GitCsarDB(connector=gitCsarDB.MockConnector(workdir=tmp_path / 'repos'), workdir=tmp_path / 'clones')
+    csar_token = uuid.uuid4()
+    db.save_CSAR(csar_path=generic_dir, csar_token=csar_token)
+    db.get_CSAR(csar_token=csar_token, dst=tmp_path / 'dst')
+    with pytest.raises(FileNotFoundError):
+        db.get_CSAR(csar_token=csar_token, version_tag='v9.0', dst=tmp_path / 'missing')
+
+    assert list((tmp_path / 'clones').iterdir()) == [], "Clone dirs left in workdir"
+
+
 def test_save_update_CSAR(db: GitCsarDB, generic_dir: Path):
     csar_token = uuid.uuid4()
     db.save_CSAR(csar_path=generic_dir, csar_token=csar_token)
@@ -104,3 +122,144 @@ def test_get_tag_msg(db: GitCsarDB, generic_dir: Path):
 
     assert db.get_tag_msg(csar_token=csar_token, tag_name='v1.0') == 'gitCsarDB: v1.0'
     assert db.get_tag_msg(csar_token=csar_token, tag_name='v2.0') == 'gitCsarDB: custom_message'
+
+
+def test_get_CSAR_versions(db: GitCsarDB, generic_dir: Path):
+    csar_token = uuid.uuid4()
+    db.save_CSAR(csar_path=generic_dir, csar_token=csar_token)
+    (generic_dir / '0-new.txt').unlink()
+    db.save_CSAR(csar_path=generic_dir, csar_token=csar_token)
+    assert db.CSAR_exists(csar_token), "Did not correctly saved repo, test useless"
+
+    dst_old, dst_new = Path(tempfile.mkdtemp()), Path(tempfile.mkdtemp())
+    db.get_CSAR_versions(csar_token=csar_token, version_tags=['v1.0', None], dsts=[dst_old, dst_new])
+
+    assert (dst_old / '0-new.txt').exists(), "Old version not checked out"
+    assert not (dst_new / '0-new.txt').exists(), "New version not checked out"
+    assert (dst_new / '1-new.txt').exists(), "New version not checked out"
+    assert not (dst_old / '.git').exists() and not (dst_new / '.git').exists(), ".git dir copied"
+
+
+def test_get_CSAR_owner(db: GitCsarDB, generic_dir: Path):
+    csar_token = uuid.uuid4()
+    (generic_dir / 'roles').mkdir()
+    (generic_dir / 'roles' / 'main.yml').write_text('---')
+    db.save_CSAR(csar_path=generic_dir, csar_token=csar_token)
+
+    dst = Path(tempfile.mkdtemp()) / 'blueprint'
+    db.get_CSAR(csar_token=csar_token, dst=dst, owner=(os.getuid(), os.getgid()))
+
+    assert (dst / 'roles' / 'main.yml').read_text() == '---', "Blueprint not copied"
+    assert not (dst / '.git').exists(), ".git dir copied"
+    for path in [dst, dst / 'roles', dst / 'roles' / 'main.yml', dst / '0-new.txt']:
+        assert stat.S_IMODE(path.stat().st_mode) == 0o700, f"Wrong mode of {path}"
+        assert path.stat().st_uid == os.getuid(), f"Wrong owner of {path}"
+
+
+def test_get_CSAR_versions_no_tag(db: GitCsarDB, generic_dir: Path):
+    csar_token = uuid.uuid4()
+    db.save_CSAR(csar_path=generic_dir, csar_token=csar_token)
+
+    with pytest.raises(FileNotFoundError, match="v42.0"):
+        db.get_CSAR_versions(csar_token=csar_token, version_tags=['v1.0', 'v42.0'],
+                             dsts=[Path(tempfile.mkdtemp()), Path(tempfile.mkdtemp())])
+
+
+def test_save_CSAR_allocated_tag(db: GitCsarDB, generic_dir: Path):
+    csar_token = uuid.uuid4()
+    result = db.save_CSAR(csar_path=generic_dir, csar_token=csar_token, tag_name='v3.0')
+
+    assert result['success']
+    assert result['version_tag'] == 'v3.0'
+    assert db.get_tags_list(csar_token) == ['v3.0']
+
+
+def test_save_CSAR_allocated_tag_exists(db: GitCsarDB, generic_dir: Path):
+    csar_token = uuid.uuid4()
+    db.save_CSAR(csar_path=generic_dir, csar_token=csar_token)
+    result = db.save_CSAR(csar_path=generic_dir, csar_token=csar_token, tag_name='v1.0')
+
+    assert not result['success']
+    assert result['commit_sha'] is not None
+    assert db.get_tags_list(csar_token) == ['v1.0']
+
+
+class TestVersionCounter:
+
+    @pytest.fixture()
+    def git_db(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            yield GitDB(type='mock', mock_workdir=workdir)
+
+    def test_add_revision_allocated_tag(self, mocker, git_db: GitDB, generic_dir: Path):
+        mock_exists = mocker.MagicMock(name='version_counter_exists', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.version_counter_exists', new=mock_exists)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.next_version_tag', return_value='v7.0')
+        mock_get_tags = mocker.spy(git_db, 'get_tags')
+
+        result, _ = git_db.add_revision(blueprint_path=generic_dir)
+        assert result['version_id'] == 'v7.0'
+        mock_exists.assert_not_called()
+        mock_get_tags.assert_not_called()
+
+    def test_add_revision_counter_unavailable(self, mocker, git_db: GitDB, generic_dir: Path):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.next_version_tag',
+                     side_effect=SqlDBFailedException('Could not connect to PostgreSQL DB'))
+
+        result, _ = git_db.add_revision(blueprint_path=generic_dir)
+        assert result['version_id'] == 'v1.0'
+
+    def test_add_revision_seed_counter(self, mocker, git_db: GitDB, generic_dir: Path):
+        blueprint_id = uuid.uuid4()
+        git_db.connection.save_CSAR(csar_path=generic_dir, csar_token=blueprint_id)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.version_counter_exists', return_value=False)
+        mock_reconcile = mocker.MagicMock(name='reconcile_version_counter', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.reconcile_version_counter', new=mock_reconcile)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.next_version_tag', return_value='v2.0')
+
+        result, _ = git_db.add_revision(blueprint_id=blueprint_id, blueprint_path=generic_dir)
+        assert result['version_id'] == 'v2.0'
+        mock_reconcile.assert_called_with(blueprint_id, ['v1.0'])
+
+    def test_add_revision_counter_behind(self, mocker, git_db: GitDB, generic_dir: Path):
+        blueprint_id = uuid.uuid4()
+        git_db.connection.save_CSAR(csar_path=generic_dir, csar_token=blueprint_id)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.version_counter_exists', return_value=True)
+        mock_reconcile = mocker.MagicMock(name='reconcile_version_counter', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.reconcile_version_counter', new=mock_reconcile)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.next_version_tag', side_effect=['v1.0', 'v2.0'])
+
+        result, _ = git_db.add_revision(blueprint_id=blueprint_id, blueprint_path=generic_dir)
+        assert result['version_id'] == 'v2.0'
+        mock_reconcile.assert_called_with(blueprint_id, ['v1.0'])
+        assert git_db.get_tags(blueprint_id) == ['v1.0', 'v2.0']
+
+    def test_get_last_tag_from_meta(self, mocker, git_db: GitDB):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_version_id', return_value='v3.0')
+        mock_get_tags = mocker.spy(git_db, 'get_tags')
+
+        assert git_db.get_last_tag(uuid.uuid4()) == 'v3.0'
+        mock_get_tags.assert_not_called()
+
+    def test_get_last_tag_highest(self, mocker, git_db: GitDB):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_version_id', return_value=None)
+        mocker.patch.object(git_db, 'get_tags', return_value=['v1.0', 'v10.0', 'v2.0', 'v1.1'])
+
+        assert git_db.get_last_tag(uuid.uuid4()) == 'v10.0'
+
+    def test_reconcile_version_counters(self, mocker, git_db: GitDB, generic_dir: Path):
+        blueprint_id = uuid.uuid4()
+        git_db.connection.save_CSAR(csar_path=generic_dir, csar_token=blueprint_id)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_ids',
+                     return_value=[str(blueprint_id), str(uuid.uuid4())])
+        mock_reconcile = mocker.MagicMock(name='reconcile_version_counter', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.reconcile_version_counter', new=mock_reconcile)
+
+        git_db.reconcile_version_counters()
+        mock_reconcile.assert_called_once_with(str(blueprint_id), ['v1.0'])
+
+
+def test_clone_path_locked(db: GitCsarDB):
+    with db.clone_path(uuid.uuid4()) as repo_path:
+        assert WorkdirService.locked(repo_path.parent / GitCsarDB.CLONE_LOCK), "Clone not locked"
+    assert not repo_path.parent.exists(), "Clone dir not removed"
@@ -2,13 +2,16 @@ import datetime
 import json
 import logging
 import uuid
+import zlib
 
 import psycopg2
 from assertpy import assert_that
 import pytest
 
-from opera.api.openapi.models import BlueprintVersion, InvocationState, OperationType, Deployment, GitLog, Invocation
+from opera.api.openapi.models import BlueprintVersion, InvocationState, OperationType, Deployment, GitLog, Invocation, \
+    Job, JobType, Rollout
 from opera.api.openapi.models.base_model_ import Model as BaseModel
+from opera.api.service import sqldb_migration
 from opera.api.service.sqldb_service import PostgreSQL, SqlDBFailedException
 from opera.api.util import timestamp_util
 
@@ -164,7 +167,7 @@ class GetBlueprintMetaCursor(NoneCursor):
         return [
             [
                 deployment.deployment_id, deployment.state, deployment.operation,
-                deployment.timestamp, deployment.deployment_label
+                deployment.timestamp, deployment.deployment_label, None
             ]
         ]
 
@@ -175,10 +178,13 @@ class GetDeploymentsCursor(NoneCursor):
     def fetchall(cls):
         # used to get deployments
         deployments = [Deployment.from_dict(x) for x in TestBlueprintMeta.deployments]
+        if "and not (operation = " in cls.command:
+            deployments = [x for x in deployments if not (x.operation == OperationType.UNDEPLOY and
+                                                          x.state == InvocationState.SUCCESS)]
         return [
             [
                 deployment.deployment_id, deployment.state, deployment.operation,
-                deployment.timestamp, deployment.deployment_label
+                deployment.timestamp, deployment.deployment_label, None
             ] for deployment in deployments
         ]
 
@@ -192,10 +198,17 @@ class GetBlueprintCursor(NoneCursor):
 
             return [list(x.values()) for x in items_marshalled]
 
+        blueprints = TestGetBlueprint.blueprints
         if "select distinct on (deployment_id)" in cls.command:
-            return items_to_lines(TestGetBlueprint.deployments)
-        else:
-            return items_to_lines(TestGetBlueprint.blueprints)
+            # last invocation of every deployment
+            last_invocations = {}
+            for deployment in sorted(TestGetBlueprint.deployments, key=lambda x: x['timestamp']):
+                last_invocations[deployment['deployment_id']] = deployment
+            active_blueprint_ids = [x['blueprint_id'] for x in last_invocations.values()
+                                    if not (x['operation'] == OperationType.UNDEPLOY and
+                                            x['state'] == InvocationState.SUCCESS)]
+            blueprints = [x for x in blueprints if x['blueprint_id'] in active_blueprint_ids]
+        return items_to_lines(blueprints)
 
 
 class GitTransactionDataCursor(NoneCursor):
@@ -224,11 +237,11 @@ class InvocationCursor(NoneCursor):
 
     @classmethod
     def fetchall(cls):
-        if "select timestamp, _log" in cls.command:
+        if "select timestamp, invocation_id, _log" in cls.command:
             inv = TestInvocation.inv
             return [
                 [
-                    inv.timestamp_submission, json.dumps(inv.to_dict())
+                    inv.timestamp_submission, TestInvocation.invocation_id, json.dumps(inv.to_dict()), None
                 ]
             ]
 
@@ -249,6 +262,18 @@ class InvocationCursor(NoneCursor):
             ]
 
 
+class JobCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return [json.dumps(TestJob.job.to_dict())]
+
+
+class UnfinishedJobCursor(NoneCursor):
+    @classmethod
+    def fetchall(cls):
+        return [[json.dumps(TestJob.job.to_dict()), "instance"]]
+
+
 class OperaSessionDataCursor(NoneCursor):
     @classmethod
     def fetchone(cls):
@@ -272,7 +297,85 @@ class TestConnection:
         mock_execute = mocker.MagicMock(name='execute')
         mocker.patch('opera.api.service.sqldb_service.PostgreSQL.execute', new=mock_execute)
         PostgreSQL.initialize()
-        assert mock_execute.call_count == 4
+        assert mock_execute.call_count == 27
+
+
+class MigrationCursor:
+    """Records commands, numbers 1500 rows in batches of 1000"""
+
+    def __init__(self, primary_key):
+        self.commands = []
+        self.primary_key = primary_key
+        self.rows_left = 1500
+        self.rowcount = -1
+        self.last = ""
+
+    def execute(self, command, replacements=None):
+        self.last = command.as_string(None) if isinstance(command, psycopg2.sql.Composable) else command
+        self.commands.append(self.last)
+        if self.last.startswith("update"):
+            self.rowcount = min(1000, self.rows_left)
+            self.rows_left -= self.rowcount
+
+    def fetchall(self):
+        return [[column] for column in self.primary_key]
+
+    def fetchone(self):
+        return ["blueprint_pkey"]
+
+
+class MigrationConnection:
+    def __init__(self, primary_key):
+        self.dbcur = MigrationCursor(primary_key)
+
+    def cursor(self):
+        return self.dbcur
+
+
+class TestMigration:
+
+    @pytest.fixture(autouse=True)
+    def as_string(self, monkeypatch):
+        # render statements without real connection
+        monkeypatch.setattr(psycopg2.sql.Identifier, 'as_string', lambda self, context: '"{}"'.format(*self.strings))
+        monkeypatch.setattr(psycopg2.sql.Literal, 'as_string', lambda self, context: repr(self.wrapped))
+
+    def test_migrate_table(self):
+        conn = MigrationConnection(['timestamp'])
+        assert_that(sqldb_migration.migrate_table(conn, 'blueprint', batch_size=1000)).is_true()
+        commands = conn.dbcur.commands
+
+        assert_that([x for x in commands if x.startswith("update")]).is_length(3)
+        assert_that(commands).contains('alter table "blueprint" add column if not exists id bigint;')
+        assert_that(commands).contains('create unique index concurrently if not exists "blueprint_id_key" on '
+                                       '"blueprint" (id);')
+        # not null is proven by validated check constraint, not by scan under exclusive lock
+        not_null = commands.index('alter table "blueprint" alter column id set not null;')
+        assert_that(commands[not_null - 2:not_null + 2]).is_equal_to([
+            'alter table "blueprint" drop constraint if exists "blueprint_id_not_null", '
+            'add constraint "blueprint_id_not_null" check (id is not null) not valid;',
+            'alter table "blueprint" validate constraint "blueprint_id_not_null";',
+            'alter table "blueprint" alter column id set not null;',
+            'alter table "blueprint" drop constraint "blueprint_id_not_null";'
+        ])
+        assert_that(commands[-1]).is_equal_to('alter table "blueprint" drop constraint "blueprint_pkey", add constraint '
+                                              '"blueprint_pkey" primary key using index "blueprint_id_key";')
+
+    def test_migrate_table_done(self):
+        conn = MigrationConnection(['id'])
+        assert_that(sqldb_migration.migrate_table(conn, 'blueprint')).is_false()
+        assert_that(conn.dbcur.commands).is_length(1)
+
+    def test_migrate(self, mocker):
+        conn = MigrationConnection(['id'])
+        conn.close = mocker.MagicMock(name='close')
+        mocker.patch('psycopg2.connect', return_value=conn)
+
+        sqldb_migration.migrate()
+        assert_that(conn.autocommit).is_true()
+        index_commands = [x for x in conn.dbcur.commands if x.startswith("create index concurrently")]
+        assert_that(index_commands).is_length(9)
+        conn.close.assert_called_once()
 
 
 class TestVersionExists:
@@ -424,6 +527,17 @@ class TestBlueprintMeta:
         ))).is_equal_to(
             blueprint_meta)
 
+    def test_get_last_version_id(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_last_version_id("blueprint")).is_none()
+        # versions are ordered numerically, not by timestamp of saving
+        assert_that(NoneCursor.get_command()).contains("'^v([0-9]+)')::int desc").does_not_contain("order by timestamp")
+        monkeypatch.setattr(FakePostgres, 'cursor', GetStringCursor)
+        assert_that(db.get_last_version_id("blueprint")).is_equal_to("")
+
     def test_get_project_blueprint_meta_missing(self, mocker, caplog, generic_blueprint_meta):
         # test set up
         caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
@@ -713,6 +827,128 @@ class TestGetBlueprint:
         assert db.get_blueprints_by_user_or_project(username='username', active=True) == [self.blueprints[0]]
 
 
+class TestPagination:
+
+    def test_deployment_history_page(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', InvocationCursor)
+
+        db.get_deployment_history(uuid.uuid4(), limit=10, after=['2021-10-15T10:33:50.318695', 'a'])
+        assert_that(InvocationCursor.get_command()).contains(
+            "SQL('and ('), Composed([Identifier('timestamp'), SQL(', '), Identifier('invocation_id')]), SQL(') '), "
+            "SQL('>')", "order by timestamp, invocation_id", "Literal(10)")
+
+    def test_git_log_page(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', GitTransactionDataCursor)
+
+        db.get_git_transaction_data(uuid.uuid4(), limit=10, after=['2021-10-15T10:33:50.318695', 'v1'])
+        assert_that(GitTransactionDataCursor.get_command()).contains(
+            "Composed([Identifier('timestamp'), SQL(', '), Identifier('version_id')])", "SQL('<')",
+            "order by timestamp desc, version_id desc", "Literal(10)")
+
+    def test_deployments_page(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', GetDeploymentsCursor)
+
+        db.get_deployments_for_blueprint(uuid.uuid4(), active=False, limit=10, after=['2021-10-15', 'a'])
+        command = GetDeploymentsCursor.get_command()
+        assert_that(command).contains("Identifier('timestamp'), SQL(', '), Identifier('deployment_id')", "SQL('<')",
+                                      "Literal('2021-10-15'), SQL(', '), Literal('a')", "Literal(10)")
+        assert_that(command).does_not_contain("and not (operation = ")
+
+    def test_blueprints_page(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', GetBlueprintCursor)
+
+        db.get_blueprints_by_user_or_project(username='username', active=False, limit=10, after=['2021-10-15', 'a'])
+        command = GetBlueprintCursor.get_command()
+        assert_that(command).contains("Identifier('timestamp'), SQL(', '), Identifier('blueprint_id')", "SQL('<')",
+                                      "Literal('username')", "Literal(10)")
+        assert_that(command).does_not_contain("project_domain = ")
+
+
+class ArchivedInvocationCursor(NoneCursor):
+    @classmethod
+    def fetchall(cls):
+        inv = TestInvocation.inv
+        return [
+            [inv.timestamp_submission, 'a', json.dumps(inv.to_dict()), None],
+            [inv.timestamp_submission, 'b', None, zlib.compress(json.dumps(inv.to_dict()).encode())]
+        ]
+
+
+class ArchiveCursor(NoneCursor):
+    commands = []
+
+    @classmethod
+    def execute(cls, command, replacements=None):
+        super().execute(command, replacements)
+        cls.commands.append(cls.command)
+
+    @classmethod
+    def fetchall(cls):
+        return [
+            ['a', 'deployment', 'label', 'blueprint', 'v1.0', InvocationState.SUCCESS, OperationType.DEPLOY_FRESH,
+             datetime.datetime(2021, 12, 3), '{"log": "log"}'],
+            ['b', 'deployment', 'label', 'blueprint', 'v1.0', InvocationState.SUCCESS, OperationType.UPDATE,
+             datetime.datetime(2022, 1, 3), '{"log": "log"}'],
+        ]
+
+
+class TestInvocationArchive:
+
+    def test_get_deployment_history_archived(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', ArchivedInvocationCursor)
+
+        history = db.get_deployment_history(uuid.uuid4())
+        assert_that([invocation_id for invocation_id, _ in history]).is_equal_to(['a', 'b'])
+        assert_that([obj_to_json(x) for _, x in history]).is_equal_to([TestInvocation.inv.to_dict()] * 2)
+        assert_that(ArchivedInvocationCursor.get_command()).contains("union all", "invocation_archive")
+
+    def test_archive_invocations(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', ArchiveCursor)
+        ArchiveCursor.commands = []
+
+        assert_that(db.archive_invocations(30)).is_equal_to(2)
+        select, partition_2021_12, partition_2022_01, insert, delete = ArchiveCursor.commands
+        assert_that(select).contains("for update skip locked", "instance_state")
+        assert_that(partition_2021_12).contains("invocation_archive_2021_12", "2021-12-01", "2022-01-01")
+        assert_that(partition_2022_01).contains("invocation_archive_2022_01", "2022-01-01", "2022-02-01")
+        assert_that(insert).contains("insert into").does_not_contain('{"log": "log"}')
+        assert_that(delete).contains("Literal('a'), SQL(', '), Literal('b')")
+
+    def test_archive_invocations_nothing(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.archive_invocations(30)).is_equal_to(0)
+
+    def test_archive_invocations_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        assert_that(db.archive_invocations(30)).is_equal_to(0)
+        assert_that(caplog.text).contains("Failed to archive invocations")
+
+
 class TestGitTransactionData:
     git_log = GitLog.from_dict(
         {
@@ -811,13 +1047,26 @@ class TestInvocation:
 
         assert_that(db.get_last_invocation_id(uuid.uuid4())).is_equal_to(self.invocation_id)
 
+    def test_get_invocation_state(self, monkeypatch, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        assert_that(db.get_invocation_state(self.invocation_id)).is_none()
+
+        monkeypatch.setattr(FakePostgres, 'cursor', StateCursor)
+        assert_that(db.get_invocation_state(self.invocation_id)).is_equal_to(InvocationState.INTERRUPTED)
+        assert_that(StateCursor.get_command()).contains("select state", self.invocation_id)
+
     def test_get_deployment_history(self, monkeypatch, mocker):
         # test set up
         mocker.patch('psycopg2.connect', new=FakePostgres)
         db = PostgreSQL()
         monkeypatch.setattr(FakePostgres, 'cursor', InvocationCursor)
 
-        assert_that([obj_to_json(x) for x in db.get_deployment_history(uuid.uuid4())]).is_equal_to([self.inv.to_dict()])
+        assert_that(db.get_deployment_history(uuid.uuid4())).is_length(1)
+        invocation_id, inv = db.get_deployment_history(uuid.uuid4())[0]
+        assert_that(invocation_id).is_equal_to(self.invocation_id)
+        assert_that(obj_to_json(inv)).is_equal_to(self.inv.to_dict())
 
     def test_get_last_completed_invocation(self, monkeypatch, mocker):
         # test set up
@@ -826,6 +1075,8 @@ class TestInvocation:
         monkeypatch.setattr(FakePostgres, 'cursor', InvocationCursor)
 
         assert_that(obj_to_json(db.get_last_completed_invocation(uuid.uuid4()))).is_equal_to(self.inv.to_dict())
+        assert_that(InvocationCursor.get_command()).contains("limit 1", "instance_state").does_not_contain(
+            "invocation_archive")
 
     def test_get_last_completed_invocation_fail(self, mocker):
         # test set up
@@ -856,6 +1107,7 @@ class TestInvocation:
         db = PostgreSQL()
 
         assert_that(db.update_deployment_log(self.invocation_id, self.inv)).is_true()
+        assert_that(NoneCursor.get_command()).contains("user_id")
 
         assert_that(caplog.text).contains("Updated deployment log",
                                           str(self.inv.deployment_id),
@@ -931,6 +1183,8 @@ class TestInvocation:
         deployment_id = uuid.uuid4()
         assert_that(db.delete_deployment(deployment_id)).is_true()
         assert_that(caplog.text).contains("Deleted deployment", str(deployment_id))
+        assert_that(NoneCursor.get_command()).contains("invocation_archive", "invocation_log", "task_result",
+                                                        "ansible_facts", "execution_profile")
 
     def test_delete_deployment_fail(self, mocker, monkeypatch, caplog):
         # test set up
@@ -985,6 +1239,22 @@ class TestSessionData:
 
         assert_that(db.get_opera_session_data(self.session_data['deployment_id'])).is_none()
 
+    def test_get_opera_session_data_hash(self, monkeypatch, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', GetStringCursor)
+
+        assert_that(db.get_opera_session_data_hash(self.session_data['deployment_id'])).is_equal_to("")
+        assert_that(GetStringCursor.get_command()).contains('md5(tree)')
+
+    def test_get_opera_session_data_hash_fail(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_opera_session_data_hash(self.session_data['deployment_id'])).is_none()
+
     def test_delete_opera_session_data(self, mocker, caplog):
         # test set up
         caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
@@ -1005,3 +1275,720 @@ class TestSessionData:
         deployment_id = uuid.uuid4()
         assert_that(db.delete_opera_session_data(deployment_id)).is_false()
         assert_that(caplog.text).contains("Failed to delete opera_session_data", str(deployment_id))
+
+
+class OutputsCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return [json.dumps({"output": {"value": 42}})]
+
+
+class TestDeploymentOutputs:
+
+    def test_save_deployment_outputs(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        deployment_id = uuid.uuid4()
+        assert_that(db.save_deployment_outputs(deployment_id, {"output": {"value": 42}})).is_true()
+        assert_that(caplog.text).contains("Updated outputs", str(deployment_id))
+
+    def test_save_deployment_outputs_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        deployment_id = uuid.uuid4()
+        assert_that(db.save_deployment_outputs(deployment_id, {})).is_false()
+        assert_that(caplog.text).contains("Failed to update outputs", str(deployment_id))
+
+    def test_get_deployment_outputs(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', OutputsCursor)
+
+        assert_that(db.get_deployment_outputs(uuid.uuid4())).is_equal_to({"output": {"value": 42}})
+        assert_that(OutputsCursor.get_command()).contains('md5(s.tree)')
+
+    def test_get_deployment_outputs_missing(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_deployment_outputs(uuid.uuid4())).is_none()
+
+    def test_delete_deployment_outputs(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        deployment_id = uuid.uuid4()
+        assert_that(db.delete_deployment_outputs(deployment_id)).is_true()
+        assert_that(caplog.text).contains("Deleted outputs", str(deployment_id))
+
+
+class AnsibleFactsCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return [json.dumps({"host": {"timestamp": 1.0, "facts": {"ansible_facts": {}}}})]
+
+
+class TestAnsibleFacts:
+
+    def test_save_ansible_facts(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        deployment_id = uuid.uuid4()
+        assert_that(db.save_ansible_facts(deployment_id, {"host": {"timestamp": 1.0, "facts": {}}})).is_true()
+        assert_that(caplog.text).contains("Updated ansible facts", str(deployment_id))
+
+    def test_save_ansible_facts_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        deployment_id = uuid.uuid4()
+        assert_that(db.save_ansible_facts(deployment_id, {})).is_false()
+        assert_that(caplog.text).contains("Failed to update ansible facts", str(deployment_id))
+
+    def test_get_ansible_facts(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', AnsibleFactsCursor)
+
+        assert_that(db.get_ansible_facts(uuid.uuid4())).contains_key("host")
+
+    def test_get_ansible_facts_missing(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_ansible_facts(uuid.uuid4())).is_empty()
+
+
+class ExecutionProfileCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return [json.dumps({"forks": 20})]
+
+
+class TestExecutionProfile:
+
+    def test_save_execution_profile(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        profile_id = uuid.uuid4()
+        assert_that(db.save_execution_profile(profile_id, {"forks": 20})).is_true()
+        assert_that(caplog.text).contains("Updated execution profile", str(profile_id))
+
+    def test_save_execution_profile_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        profile_id = uuid.uuid4()
+        assert_that(db.save_execution_profile(profile_id, {})).is_false()
+        assert_that(caplog.text).contains("Failed to update execution profile", str(profile_id))
+
+    def test_get_execution_profile(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', ExecutionProfileCursor)
+
+        assert_that(db.get_execution_profile(uuid.uuid4())).is_equal_to({"forks": 20})
+
+    def test_get_execution_profile_missing(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_execution_profile(uuid.uuid4())).is_none()
+
+    def test_delete_execution_profile(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        profile_id = uuid.uuid4()
+        assert_that(db.delete_execution_profile(profile_id)).is_true()
+        assert_that(caplog.text).contains("Deleted execution profile", str(profile_id))
+
+
+class RolloutCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return [json.dumps({"rollout_id": "rollout", "state": "in_progress",
+                            "deployments": [{"deployment_id": "deployment", "state": "pending", "canary": True}]})]
+
+
+class TestRollout:
+
+    def test_save_rollout(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        rollout = Rollout(rollout_id=str(uuid.uuid4()), blueprint_id=str(uuid.uuid4()), state='in_progress')
+        assert_that(db.save_rollout(rollout, 'token')).is_true()
+        assert_that(caplog.text).contains("Updated rollout", rollout.rollout_id)
+        assert_that(NoneCursor.get_command()).contains("'token'")
+
+        # access token is not kept after rollout ended
+        rollout.state = 'success'
+        assert_that(db.save_rollout(rollout, 'token')).is_true()
+        assert_that(NoneCursor.get_command()).does_not_contain("'token'")
+
+    def test_get_rollout_access_token(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        assert_that(db.get_rollout_access_token("rollout")).is_none()
+
+        monkeypatch.setattr(FakePostgres, 'cursor', GetStringCursor)
+        assert_that(db.get_rollout_access_token("rollout")).is_equal_to("")
+        assert_that(GetStringCursor.get_command()).contains("select access_token", "'rollout'")
+
+    def test_save_rollout_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        rollout = Rollout(rollout_id=str(uuid.uuid4()), blueprint_id=str(uuid.uuid4()), state='in_progress')
+        assert_that(db.save_rollout(rollout)).is_false()
+        assert_that(caplog.text).contains("Failed to update rollout", rollout.rollout_id)
+
+    def test_get_rollout(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', RolloutCursor)
+
+        rollout = db.get_rollout("rollout")
+        assert_that(rollout).is_instance_of(Rollout)
+        assert_that(rollout.deployments[0].canary).is_true()
+
+    def test_get_rollout_missing(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_rollout(uuid.uuid4())).is_none()
+
+    def test_advisory_lock(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        with db.advisory_lock("rollout"):
+            assert_that(NoneCursor.get_command()).contains("pg_advisory_lock")
+        assert_that(NoneCursor.get_command()).contains("pg_advisory_unlock")
+
+
+class HeartbeatCursor(NoneCursor):
+    @classmethod
+    def fetchall(cls):
+        return [["owner", "worker", "host", 42, datetime.datetime(2022, 1, 1), "inv", True]]
+
+
+class UnfinishedInvocationCursor(NoneCursor):
+    @classmethod
+    def fetchall(cls):
+        return [["inv", json.dumps({"deployment_id": "deployment", "state": "in_progress"}), "instance"]]
+
+
+class StateCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return ["interrupted"]
+
+
+class IdsCursor(NoneCursor):
+    @classmethod
+    def fetchall(cls):
+        return [("first",), ("second",)]
+
+
+class CountCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return 5, 2, 1, 3
+
+
+class IdempotencyKeyCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return "deploy_fresh/blueprint/", json.dumps({"deployment_id": "deployment", "state": "pending"})
+
+
+class VersionCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return 3, 42, 1
+
+
+class TestVersion:
+
+    def test_deployment_status_version(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_deployment_status_version("deployment")).is_none()
+        assert_that(NoneCursor.get_command()).contains("xmin").does_not_contain("_log")
+        monkeypatch.setattr(FakePostgres, 'cursor', VersionCursor)
+        assert_that(db.get_deployment_status_version("deployment")).is_equal_to((3, 42, 1))
+
+    def test_deployment_history_version(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', VersionCursor)
+
+        assert_that(db.get_deployment_history_version("deployment")).is_equal_to((3, 42, 1))
+        assert_that(VersionCursor.get_command()).contains("invocation_archive").does_not_contain("_log")
+
+    def test_blueprint_meta_version(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_blueprint_meta_version("blueprint", "v1.0")).is_none()
+        # id exists only after migration of table
+        assert_that(NoneCursor.get_command()).contains("select timestamp::text, xmin", "'v1.0'").does_not_contain(" id")
+
+    def test_git_transaction_data_version(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_git_transaction_data_version("blueprint")).is_none()
+        assert_that(NoneCursor.get_command()).contains("max(timestamp)").does_not_contain("max(id)")
+        monkeypatch.setattr(FakePostgres, 'cursor', VersionCursor)
+        assert_that(db.get_git_transaction_data_version("blueprint")).is_equal_to((3, 42, 1))
+
+
+class TestHeartbeat:
+
+    def test_save_heartbeat(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.save_heartbeat("owner", "worker", "host", 42, "2022-01-01T00:00:00+00:00", "inv")).is_true()
+        assert_that(NoneCursor.get_command()).contains("ON CONFLICT", "'inv'")
+
+    def test_save_heartbeat_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        assert_that(db.save_heartbeat("owner", "worker", "host", 42, "2022-01-01T00:00:00+00:00")).is_false()
+        assert_that(caplog.text).contains("Failed to update heartbeat", "owner")
+
+    def test_get_heartbeats(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', HeartbeatCursor)
+
+        heartbeats = db.get_heartbeats(120)
+        assert_that(heartbeats).is_length(1)
+        assert_that(heartbeats[0]).contains_entry({"pid": 42}, {"invocation_id": "inv"}, {"fresh": True})
+
+    def test_delete_heartbeats(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.delete_heartbeats(['first', 'second'])).is_true()
+        assert_that(NoneCursor.get_command()).contains("delete from", "'first'", "'second'")
+
+    def test_get_unfinished_invocations(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', UnfinishedInvocationCursor)
+
+        invocation_id, inv, instance_id = db.get_unfinished_invocations()[0]
+        assert_that(invocation_id).is_equal_to("inv")
+        assert_that(instance_id).is_equal_to("instance")
+        assert_that(inv.state).is_equal_to(InvocationState.IN_PROGRESS)
+
+    def test_get_unfinished_ids(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', IdsCursor)
+
+        assert_that(db.get_unfinished_deployment_ids()).is_equal_to({"first", "second"})
+        assert_that(IdsCursor.get_command()).contains("select distinct deployment_id", "'pending'", "'in_progress'")
+        assert_that(db.get_unfinished_job_ids()).is_equal_to({"first", "second"})
+        assert_that(IdsCursor.get_command()).contains("select job_id", "'pending'", "'in_progress'")
+
+    def test_count_unfinished_invocations(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', CountCursor)
+
+        counts = db.count_unfinished_invocations("user", "project")
+        assert_that(counts).is_equal_to({"total": 5, "pending": 2, "user": 1, "project": 3})
+        assert_that(CountCursor.get_command()).contains("user_id").does_not_contain("_log")
+
+
+class TestIdempotencyKey:
+
+    def test_save_idempotency_key(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.save_idempotency_key("key", None, "deploy_fresh/blueprint/", "inv")).is_true()
+        assert_that(NoneCursor.get_command()).contains("ON CONFLICT", "'key'", "''", "'inv'")
+
+    def test_save_idempotency_key_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        assert_that(db.save_idempotency_key("key", "user", "deploy_fresh/blueprint/", "inv")).is_false()
+        assert_that(caplog.text).contains("Failed to save Idempotency-Key key")
+
+    def test_get_idempotency_key(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', IdempotencyKeyCursor)
+
+        fingerprint, inv = db.get_idempotency_key("key", "user", 86400)
+        assert_that(fingerprint).is_equal_to("deploy_fresh/blueprint/")
+        assert_that(inv.deployment_id).is_equal_to("deployment")
+
+    def test_get_idempotency_key_missing(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_idempotency_key("key", "user", 86400)).is_none()
+
+    def test_delete_expired_idempotency_keys(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.delete_expired_idempotency_keys(86400)).is_true()
+        assert_that(NoneCursor.get_command()).contains("delete from", "86400")
+
+
+class InvocationLogCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return memoryview(b'compressed'),
+
+
+class TestInvocationLog:
+
+    def test_save_invocation_log(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        invocation_id = uuid.uuid4()
+        assert_that(db.save_invocation_log(invocation_id, uuid.uuid4(), '2021-01-01T00:00:00', 'stdout',
+                                           b'compressed')).is_true()
+        assert_that(caplog.text).contains("Saved full stdout", str(invocation_id))
+
+    def test_save_invocation_log_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        invocation_id = uuid.uuid4()
+        assert_that(db.save_invocation_log(invocation_id, uuid.uuid4(), '2021-01-01T00:00:00', 'stderr',
+                                           b'compressed')).is_false()
+        assert_that(caplog.text).contains("Failed to save full stderr", str(invocation_id))
+
+    def test_get_invocation_log(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', InvocationLogCursor)
+
+        assert_that(db.get_invocation_log(uuid.uuid4(), 'stdout')).is_equal_to(b'compressed')
+        assert_that(InvocationLogCursor.get_command()).contains("Literal('stdout')").does_not_contain(
+            "and timestamp")
+
+    def test_get_invocation_log_timestamp(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', InvocationLogCursor)
+
+        db.get_invocation_log(uuid.uuid4(), 'stderr', '2021-01-01T00:00:00')
+        assert_that(InvocationLogCursor.get_command()).contains("and timestamp", "2021-01-01T00:00:00")
+
+    def test_get_invocation_log_missing(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_invocation_log(uuid.uuid4(), 'stdout')).is_none()
+
+
+class TaskResultCursor(NoneCursor):
+    @classmethod
+    def fetchall(cls):
+        return [('{"task": "task", "host": "opera", "status": "failed", "msg": "error"}',)]
+
+
+class TestTaskResults:
+
+    def test_save_task_results(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        invocation_id = uuid.uuid4()
+        task_results = [{"task": "a", "status": "ok"}, {"task": "b", "status": "failed"}]
+        assert_that(db.save_task_results(invocation_id, uuid.uuid4(), '2021-01-01T00:00:00', task_results)).is_true()
+        assert_that(caplog.text).contains("Saved 2 task results", str(invocation_id))
+        assert_that(NoneCursor.get_command()).contains("Literal(0)", "Literal(1)", "Literal('failed')")
+
+    def test_save_task_results_empty(self, mocker):
+        # test set up
+        mock_execute = mocker.MagicMock(name='execute')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.execute', new=mock_execute)
+
+        assert_that(PostgreSQL.save_task_results(uuid.uuid4(), uuid.uuid4(), '2021-01-01T00:00:00', [])).is_true()
+        mock_execute.assert_not_called()
+
+    def test_save_task_results_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        invocation_id = uuid.uuid4()
+        assert_that(db.save_task_results(invocation_id, uuid.uuid4(), '2021-01-01T00:00:00',
+                                         [{"task": "a", "status": "ok"}])).is_false()
+        assert_that(caplog.text).contains("Failed to save task results", str(invocation_id))
+
+    def test_get_task_results(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', TaskResultCursor)
+
+        task_results = db.get_task_results(uuid.uuid4(), status='failed')
+        assert_that(task_results).is_length(1)
+        assert_that(task_results[0].task).is_equal_to("task")
+        assert_that(task_results[0].status).is_equal_to("failed")
+        assert_that(TaskResultCursor.get_command()).contains("max(timestamp)", "Literal('failed')")
+
+    def test_get_task_results_timestamp(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', TaskResultCursor)
+
+        db.get_task_results(uuid.uuid4(), '2021-01-01T00:00:00')
+        assert_that(TaskResultCursor.get_command()).contains("2021-01-01T00:00:00").does_not_contain(
+            "max(timestamp)", "and status")
+
+
+class VersionCounterCursor(NoneCursor):
+    @classmethod
+    def fetchone(cls):
+        return 3, 1
+
+    @classmethod
+    def fetchall(cls):
+        return [('a',), ('b',)]
+
+
+class TestVersionCounter:
+
+    def test_next_version_tag_major(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', VersionCounterCursor)
+
+        assert_that(db.next_version_tag(uuid.uuid4())).is_equal_to('v3.1')
+        command = VersionCounterCursor.get_command()
+        assert_that(command).contains('pg_advisory_xact_lock', 'coalesce(max(major), 0) + 1')
+
+    def test_next_version_tag_minor(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', VersionCounterCursor)
+
+        assert_that(db.next_version_tag(uuid.uuid4(), 'v3.0')).is_equal_to('v3.1')
+        command = VersionCounterCursor.get_command()
+        assert_that(command).contains('pg_advisory_xact_lock', 'ON CONFLICT', 'minor + 1')
+
+    def test_next_version_tag_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        assert_that(db.next_version_tag(uuid.uuid4())).is_none()
+        assert_that(caplog.text).contains("Failed to allocate version tag")
+
+    def test_version_counter_exists(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.version_counter_exists(uuid.uuid4())).is_false()
+        monkeypatch.setattr(FakePostgres, 'cursor', VersionCounterCursor)
+        assert_that(db.version_counter_exists(uuid.uuid4())).is_true()
+
+    def test_reconcile_version_counter(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        mock_execute = mocker.MagicMock(name='execute', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.execute', new=mock_execute)
+        db = PostgreSQL()
+
+        blueprint_id = uuid.uuid4()
+        assert_that(db.reconcile_version_counter(blueprint_id, ['v1.0', 'v2.0', 'v2.3', 'v2.1'])).is_true()
+        command = repr(mock_execute.call_args[0][0])
+        assert_that(command).contains('greatest', "Literal(2), SQL(', '), Literal(3)")\
+            .does_not_contain("Literal(2), SQL(', '), Literal(1)")
+        assert_that(caplog.text).contains("Reconciled version counter", str(blueprint_id))
+
+    def test_reconcile_version_counter_no_tags(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        mock_execute = mocker.MagicMock(name='execute', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.execute', new=mock_execute)
+        db = PostgreSQL()
+
+        assert_that(db.reconcile_version_counter(uuid.uuid4(), [])).is_true()
+        mock_execute.assert_not_called()
+
+    def test_get_blueprint_ids(self, mocker, monkeypatch):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', VersionCounterCursor)
+
+        assert_that(db.get_blueprint_ids()).is_equal_to(['a', 'b'])
+
+
+class TestJob:
+    job = Job(
+        job_id=str(uuid.uuid4()),
+        job_type=JobType.VALIDATE,
+        state=InvocationState.SUCCESS,
+        blueprint_id=str(uuid.uuid4()),
+        version_id='v1.0',
+        timestamp_submission=timestamp_util.datetime_now_to_string(),
+        result={'blueprint_valid': True}
+    )
+
+    def test_update_job_success(self, mocker, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.update_job(self.job, 'cache_key', 'alice')).is_true()
+        assert_that(caplog.text).contains("Updated job", self.job.job_id)
+        assert_that(NoneCursor.get_replacements()).contains(self.job.job_id, 'cache_key', 'alice')
+
+    def test_update_job_fail(self, mocker, monkeypatch, caplog):
+        # test set up
+        caplog.set_level(logging.DEBUG, logger="opera.api.service.sqldb_service")
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', PsycopgErrorCursor)
+
+        assert_that(db.update_job(self.job)).is_false()
+        assert_that(caplog.text).contains("Failed to update job", self.job.job_id)
+
+    def test_get_job(self, monkeypatch, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', JobCursor)
+
+        assert_that(obj_to_json(db.get_job(self.job.job_id))).is_equal_to(self.job.to_dict())
+        assert_that(JobCursor.get_command()).does_not_contain("username")
+
+        db.get_job(self.job.job_id, 'alice')
+        assert_that(JobCursor.get_command()).contains("username", "Literal('alice')")
+
+    def test_get_job_fail(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_job(self.job.job_id)).is_none()
+
+    def test_get_cached_job(self, monkeypatch, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', JobCursor)
+
+        assert_that(obj_to_json(db.get_cached_job('cache_key'))).is_equal_to(self.job.to_dict())
+        assert_that(JobCursor.get_command()).contains('cache_key', InvocationState.SUCCESS)
+
+    def test_get_cached_job_fail(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.get_cached_job('cache_key')).is_none()
+
+    def test_get_unfinished_jobs(self, monkeypatch, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+        monkeypatch.setattr(FakePostgres, 'cursor', UnfinishedJobCursor)
+
+        assert_that([(obj_to_json(job), instance_id) for job, instance_id in db.get_unfinished_jobs()]).is_equal_to(
+            [(self.job.to_dict(), "instance")])
+        assert_that(UnfinishedJobCursor.get_command()).contains(InvocationState.PENDING, InvocationState.IN_PROGRESS)
+
+    def test_delete_expired_jobs(self, mocker):
+        # test set up
+        mocker.patch('psycopg2.connect', new=FakePostgres)
+        db = PostgreSQL()
+
+        assert_that(db.delete_expired_jobs(604800)).is_true()
+        assert_that(NoneCursor.get_command()).contains("delete from", "604800", "not in")
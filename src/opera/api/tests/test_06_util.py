@@ -1,13 +1,18 @@
+import base64
 import datetime
+import json
 import os
 import stat
+import time
 from pathlib import Path
 
+import pytest
 from assertpy import assert_that
 from pytest_mock import mocker as Mock
 
+from opera.api.openapi.models import ExecutionProfile, GitLog
 from opera.api.settings import Settings
-from opera.api.util import file_util, xopera_util, timestamp_util
+from opera.api.util import file_util, xopera_util, timestamp_util, pagination
 
 
 class TestFileUtil:
@@ -25,6 +30,60 @@ class TestFileUtil:
         for key in tree.keys():
             assert_that(f'{path}/{key}').exists()
 
+    def test_json_to_dir_owner(self, tmp_path: Path):
+        tree = {'instances/node.json': '{}', 'inputs': '{}'}
+        path = tmp_path / '.opera'
+
+        file_util.json_to_dir(tree, path, (os.getuid(), os.getgid()))
+        for subpath in ['', 'instances', 'instances/node.json', 'inputs']:
+            assert_that(stat.S_IMODE((path / subpath).stat().st_mode)).is_equal_to(0o700)
+        assert_that((path / 'instances/node.json').read_text()).is_equal_to('{}')
+
+    def test_copy_tree(self, tmp_path: Path):
+        src = tmp_path / 'src'
+        (src / '.git').mkdir(parents=True)
+        (src / 'roles' / 'role').mkdir(parents=True)
+        (src / 'roles' / 'role' / 'main.yml').write_text('---')
+        (src / 'service.yaml').write_text('tosca')
+        os.chmod(src / 'service.yaml', 0o644)
+
+        dst = tmp_path / 'dst'
+        file_util.copy_tree(src, dst, (os.getuid(), os.getgid()), ignore=['.git'])
+        assert_that(str(dst / '.git')).does_not_exist()
+        assert_that((dst / 'roles' / 'role' / 'main.yml').read_text()).is_equal_to('---')
+        for subpath in ['', 'roles', 'roles/role', 'roles/role/main.yml', 'service.yaml']:
+            assert_that(stat.S_IMODE((dst / subpath).stat().st_mode)).is_equal_to(0o700)
+
+    def test_read_head_tail(self, tmp_path: Path):
+        path = tmp_path / 'log.txt'
+        path.write_text('a' * 10 + 'b' * 100 + 'c' * 20)
+
+        text, truncated = file_util.read_head_tail(path, 10, 20)
+        assert_that(truncated).is_true()
+        assert_that(text).starts_with('a' * 10).ends_with('c' * 20).contains('[... 100 bytes omitted ...]')
+        assert_that(text).does_not_contain('bb')
+
+    def test_read_head_tail_short(self, tmp_path: Path):
+        path = tmp_path / 'log.txt'
+        path.write_text('short log')
+
+        assert_that(file_util.read_head_tail(path, 10, 20)).is_equal_to(('short log', False))
+
+    def test_read_head_tail_unlimited(self, tmp_path: Path):
+        path = tmp_path / 'log.txt'
+        path.write_text('x' * 1000)
+
+        assert_that(file_util.read_head_tail(path, 0, 0)).is_equal_to(('x' * 1000, False))
+
+    def test_compress_round_trip(self, tmp_path: Path):
+        path = tmp_path / 'log.txt'
+        content = os.urandom(5000).hex().encode()
+        path.write_bytes(content)
+
+        compressed = file_util.compress_file(path, chunk_size=1024)
+        assert_that(b''.join(file_util.decompress_chunks(compressed, chunk_size=1024))).is_equal_to(content)
+
+
 
 class TestXoperaUtil:
 
@@ -152,7 +211,44 @@ class TestXoperaUtil:
     def test_validate_username_invalid(self):
         assert xopera_util.validate_username("test=") is False
 
-    def test_setup_user(self, mocker, tmp_path_factory):
+    def test_get_system_user_cached(self, mocker, monkeypatch):
+        monkeypatch.setattr(xopera_util, '_system_users', {})
+        user = mocker.MagicMock(pw_uid=1000, pw_gid=1001)
+        user_mock = mocker.patch("pwd.getpwnam", side_effect=[KeyError('test'), user])
+        create_mock = mocker.patch("opera.api.util.xopera_util.create_user", return_value=user)
+
+        assert_that(xopera_util.get_owner("test")).is_equal_to((1000, 1001))
+        assert_that(xopera_util.get_owner("test")).is_equal_to((1000, 1001))
+        user_mock.assert_called_once_with("test")
+        create_mock.assert_called_once_with("test")
+
+    def test_get_system_user_invalid(self):
+        with pytest.raises(ValueError):
+            xopera_util.get_system_user("test=")
+
+    def test_setup_user_owned(self, mocker, monkeypatch, tmp_path_factory):
+        monkeypatch.setattr(xopera_util, '_system_users', {})
+        location = tmp_path_factory.mktemp("temp")
+        file = location / "hello.txt"
+        file.write_text("hello")
+        os.chmod(file, 0o755)
+        mock = mocker.MagicMock()
+        mock.pw_uid = os.getuid()
+        mock.pw_gid = os.getgid()
+        mock.pw_dir = str(location)
+        mocker.patch("pwd.getpwnam", return_value=mock)
+        mocker.patch("os.setgid")
+        mocker.patch("os.setuid")
+        walk_mock = mocker.patch("opera.api.util.xopera_util.setup_user_dir")
+
+        xopera_util.setup_user([Path(location)], "test", owned=True)
+
+        walk_mock.assert_not_called()
+        assert_that(oct(os.stat(location / "tmp").st_mode & stat.S_IRWXU)).is_equal_to('0o700')
+        assert_that(stat.S_IMODE(os.stat(file).st_mode)).is_equal_to(0o755)
+
+    def test_setup_user(self, mocker, monkeypatch, tmp_path_factory):
+        monkeypatch.setattr(xopera_util, '_system_users', {})
         location = tmp_path_factory.mktemp("temp")
         file = location / "hello.txt"
         file.write_text("hello")
@@ -184,6 +280,29 @@ class TestXoperaUtil:
         secret_mock.assert_called_once_with(Settings.ssh_key_path_template.format(username='test') + '/secret', 'test', 'ACCESS_TOKEN')
         add_mock.assert_called_once_with(valid_ssh_key)
 
+    def test_get_user_keys(self, mocker, valid_ssh_key, invalid_ssh_key):
+        keys = {"valid": {Settings.ssh_key_secret_name: valid_ssh_key},
+                "invalid": {Settings.ssh_key_secret_name: invalid_ssh_key}}
+        mocker.patch("opera.api.util.xopera_util.list_secrets", return_value=["valid", "invalid"])
+        mocker.patch("opera.api.util.xopera_util.get_secret", side_effect=lambda path, *_: keys[path.split('/')[-1]])
+
+        assert_that(xopera_util.get_user_keys("test", "ACCESS_TOKEN")).is_equal_to([valid_ssh_key])
+
+    def test_setup_user_with_keys(self, mocker, monkeypatch, tmp_path_factory):
+        monkeypatch.setattr(xopera_util, '_system_users', {})
+        location = tmp_path_factory.mktemp("temp")
+        mock = mocker.MagicMock()
+        mock.pw_uid = os.getuid()
+        mock.pw_gid = os.getgid()
+        mock.pw_dir = str(location)
+        mocker.patch("pwd.getpwnam", return_value=mock)
+        mocker.patch("os.setgid")
+        mocker.patch("os.setuid")
+        add_mock = mocker.patch("opera.api.util.xopera_util.add_user_keys")
+
+        xopera_util.setup_user([Path(location)], "test", ["key"])
+        add_mock.assert_called_once_with(["key"])
+
     def test_setup_user_keys_invalid(self, mocker, valid_ssh_key, invalid_ssh_key):
         keys = {Settings.ssh_key_secret_name: invalid_ssh_key}
         list_secret_mock = mocker.patch("opera.api.util.xopera_util.list_secrets", return_value=["secret"])
@@ -195,11 +314,221 @@ class TestXoperaUtil:
         secret_mock.assert_called_once_with(Settings.ssh_key_path_template.format(username='test') + '/secret', 'test', 'ACCESS_TOKEN')
         add_mock.assert_not_called()
 
+    @pytest.fixture
+    def agent_pool(self, mocker, monkeypatch, tmp_path: Path):
+        monkeypatch.setattr(xopera_util, '_agents', {})
+        process = mocker.MagicMock()
+        process.poll.return_value = None
+        start_mock = mocker.patch("opera.api.util.xopera_util._start_user_agent", side_effect=lambda username: {
+            'process': process, 'dir': tmp_path, 'socket': str(tmp_path / 'agent.sock'), 'fingerprint': None,
+            'expires': None})
+        run_mock = mocker.patch("subprocess.run")
+        add_mock = mocker.patch("opera.api.util.xopera_util.add_key")
+        return start_mock, run_mock, add_mock, process
+
+    def test_acquire_user_agent(self, agent_pool):
+        start_mock, run_mock, add_mock, _ = agent_pool
+
+        socket = xopera_util.acquire_user_agent("test", ["key"])
+        xopera_util.release_user_agent("test")
+        assert_that(xopera_util.acquire_user_agent("test", ["key"])).is_equal_to(socket)
+
+        start_mock.assert_called_once_with("test")
+        run_mock.assert_called_once()
+        add_mock.assert_called_once_with("key", socket)
+
+    def test_acquire_user_agent_keys_changed(self, agent_pool):
+        start_mock, run_mock, add_mock, _ = agent_pool
+
+        xopera_util.acquire_user_agent("test", ["key"])
+        xopera_util.acquire_user_agent("test", ["key", "other"])
+
+        start_mock.assert_called_once()
+        assert_that(run_mock.call_count).is_equal_to(2)
+        assert_that(run_mock.call_args.args[0]).is_equal_to(['/usr/bin/ssh-add', '-D'])
+        assert_that(add_mock.call_count).is_equal_to(3)
+
+    def test_acquire_user_agent_no_keys(self, agent_pool):
+        start_mock, _, _, process = agent_pool
+
+        xopera_util.acquire_user_agent("test", ["key"])
+        assert_that(xopera_util.acquire_user_agent("test", [])).is_none()
+        process.terminate.assert_called_once()
+        assert_that(xopera_util._agents).is_empty()
+
+    def test_release_user_agent_ttl(self, agent_pool, monkeypatch):
+        _, _, _, process = agent_pool
+        monkeypatch.setattr(Settings, 'ssh_agent_ttl', 60)
+
+        xopera_util.acquire_user_agent("test", ["key"])
+        xopera_util.release_user_agent("test")
+        assert_that(xopera_util._agents["test"]['expires']).is_not_none()
+        xopera_util.kill_expired_agents()
+        process.terminate.assert_not_called()
+
+        xopera_util._agents["test"]['expires'] = 0.001
+        xopera_util.kill_expired_agents()
+        process.terminate.assert_called_once()
+
+    def test_release_user_agent_no_ttl(self, agent_pool, monkeypatch):
+        _, _, _, process = agent_pool
+        monkeypatch.setattr(Settings, 'ssh_agent_ttl', 0)
+
+        xopera_util.acquire_user_agent("test", ["key"])
+        xopera_util.release_user_agent("test")
+        process.terminate.assert_called_once()
+        assert_that(xopera_util._agents).is_empty()
+
+    def test_cleanup_stale_agents(self, monkeypatch, tmp_path: Path):
+        monkeypatch.setattr(Settings, 'API_WORKDIR', str(tmp_path))
+        agent_dir = tmp_path / "agents" / "test-stale"
+        agent_dir.mkdir(parents=True)
+        (agent_dir / "agent.pid").write_text("999999999")
+
+        xopera_util.cleanup_stale_agents()
+        assert_that(str(agent_dir)).does_not_exist()
+
+    def test_ansible_ssh_env(self, monkeypatch, tmp_path: Path):
+        monkeypatch.setattr(Settings, 'ssh_control_dir', str(tmp_path))
+        monkeypatch.setattr(Settings, 'ssh_control_persist', 60)
+        monkeypatch.setattr(Settings, 'ansible_pipelining', True)
+
+        control_dir = xopera_util.prepare_ssh_control_dir("deployment", "test", None)
+        assert_that(str(control_dir)).is_directory().starts_with(str(tmp_path))
+        assert_that(stat.S_IMODE(control_dir.stat().st_mode)).is_equal_to(0o700)
+        assert_that(control_dir).is_equal_to(xopera_util.ssh_control_dir("deployment", "test"))
+        assert_that(control_dir).is_not_equal_to(xopera_util.ssh_control_dir("deployment", "other"))
+
+        env = xopera_util.ansible_ssh_env(control_dir)
+        assert_that(env["ANSIBLE_SSH_ARGS"]).contains("ControlMaster=auto", "ControlPersist=60s")
+        assert_that(env["ANSIBLE_SSH_CONTROL_PATH_DIR"]).is_equal_to(str(control_dir))
+        assert_that(env["ANSIBLE_PIPELINING"]).is_equal_to("True")
+
+        monkeypatch.setattr(Settings, 'ssh_control_persist', 0)
+        assert_that(xopera_util.ansible_ssh_env(control_dir)).is_equal_to({"ANSIBLE_PIPELINING": "True"})
+
+    def test_ansible_profile_env(self):
+        profile = ExecutionProfile(workers=4, forks=20, pipelining=False, task_timeout=0)
+        assert_that(xopera_util.ansible_profile_env(profile)).is_equal_to({
+            "ANSIBLE_FORKS": "20", "ANSIBLE_PIPELINING": "False", "ANSIBLE_TASK_TIMEOUT": "0"})
+        assert_that(xopera_util.ansible_profile_env(None)).is_empty()
+
+    def test_close_ssh_masters(self, mocker, monkeypatch, tmp_path: Path):
+        monkeypatch.setattr(Settings, 'ssh_control_dir', str(tmp_path))
+        run_mock = mocker.patch("subprocess.run")
+        control_dir = xopera_util.prepare_ssh_control_dir("deployment", "test", None)
+        mocker.patch.object(Path, "is_socket", return_value=True)
+        (control_dir / "socket").touch()
+
+        xopera_util.close_ssh_masters("deployment")
+        run_mock.assert_called_once()
+        assert_that(run_mock.call_args.args[0]).contains("-O", "exit", f"ControlPath={control_dir / 'socket'}")
+        assert_that(str(control_dir.parent)).does_not_exist()
+
+        xopera_util.close_ssh_masters("missing")
+        run_mock.assert_called_once()
+
+    def test_cleanup_ssh_control_dirs(self, monkeypatch, tmp_path: Path):
+        monkeypatch.setattr(Settings, 'ssh_control_dir', str(tmp_path))
+        monkeypatch.setattr(Settings, 'ssh_control_persist', 60)
+        empty_dir = xopera_util.prepare_ssh_control_dir("empty", "test", None)
+        used_dir = xopera_util.prepare_ssh_control_dir("used", "test", None)
+        (used_dir / "socket").touch()
+        for control_dir in (empty_dir, used_dir):
+            os.utime(control_dir, (0, 0))
+
+        xopera_util.cleanup_ssh_control_dirs()
+        assert_that(str(empty_dir.parent)).does_not_exist()
+        assert_that(str(used_dir)).is_directory()
+
     def test_try_get_failed_tasks(self, error_stdout):
         failed_tasks = xopera_util.try_get_failed_tasks(error_stdout)
         assert len(failed_tasks) == 1
         assert failed_tasks['Fail'] == {'msg': 'Failed.', 'stderr': None}
 
+    def test_enable_task_results(self, monkeypatch, tmp_path: Path):
+        monkeypatch.setenv("ANSIBLE_CALLBACKS_ENABLED", "profile_tasks")
+        monkeypatch.delenv("ANSIBLE_CALLBACK_PLUGINS", raising=False)
+        monkeypatch.delenv("XOPERA_TASK_RESULTS_FILE", raising=False)
+        results_file = tmp_path / 'results.jsonl'
+
+        xopera_util.enable_task_results(results_file)
+        xopera_util.enable_task_results(results_file)
+        assert_that(os.environ["ANSIBLE_CALLBACKS_ENABLED"]).is_equal_to("profile_tasks,xopera_task_results")
+        assert_that(os.environ["ANSIBLE_CALLBACK_PLUGINS"]).is_equal_to(str(xopera_util.TASK_RESULTS_PLUGINS_DIR))
+        assert_that(os.environ["XOPERA_TASK_RESULTS_FILE"]).is_equal_to(str(results_file))
+        assert_that(str(xopera_util.TASK_RESULTS_PLUGINS_DIR / 'xopera_task_results.py')).exists()
+
+    def test_enable_fact_cache(self, monkeypatch, tmp_path: Path):
+        monkeypatch.setattr(Settings, 'fact_cache_ttl', 60)
+        for var in ("ANSIBLE_GATHERING", "ANSIBLE_CACHE_PLUGIN", "ANSIBLE_CACHE_PLUGIN_CONNECTION",
+                    "ANSIBLE_CACHE_PLUGIN_TIMEOUT"):
+            monkeypatch.delenv(var, raising=False)
+
+        xopera_util.enable_fact_cache(tmp_path)
+        assert_that(os.environ["ANSIBLE_GATHERING"]).is_equal_to("smart")
+        assert_that(os.environ["ANSIBLE_CACHE_PLUGIN_CONNECTION"]).is_equal_to(str(tmp_path))
+        assert_that(os.environ["ANSIBLE_CACHE_PLUGIN_TIMEOUT"]).is_equal_to("60")
+
+        monkeypatch.setattr(Settings, 'fact_cache_ttl', 0)
+        xopera_util.enable_fact_cache(tmp_path)
+        assert_that(os.environ).does_not_contain_key("ANSIBLE_CACHE_PLUGIN")
+
+    def test_fact_cache(self, monkeypatch, tmp_path: Path):
+        monkeypatch.setattr(Settings, 'fact_cache_ttl', 60)
+        now = datetime.datetime.now().timestamp()
+        facts = {
+            "fresh": {"timestamp": now - 10, "facts": {"ansible_facts": {"os": "linux"}}},
+            "expired": {"timestamp": now - 100, "facts": {}},
+            "../escape": {"timestamp": now, "facts": {}}
+        }
+
+        assert_that(xopera_util.write_fact_cache(facts, tmp_path / 'facts')).is_equal_to(1)
+        assert_that(str(tmp_path / 'facts' / 'fresh')).is_file()
+        assert_that((tmp_path / 'facts' / 'fresh').stat().st_mtime).is_close_to(now - 10, 0.01)
+        (tmp_path / 'facts' / 'broken').write_text('{"ans')
+
+        assert_that(xopera_util.read_fact_cache(tmp_path / 'facts')).is_equal_to({"fresh": facts["fresh"]})
+        assert_that(xopera_util.read_fact_cache(tmp_path / 'missing')).is_empty()
+        assert_that(xopera_util.write_fact_cache({}, tmp_path / 'empty')).is_equal_to(0)
+        assert_that(str(tmp_path / 'empty')).does_not_exist()
+
+    def test_read_task_results(self, tmp_path: Path):
+        results_file = tmp_path / 'results.jsonl'
+        results_file.write_text('{"task": "a", "host": "h", "status": "ok"}\n{"task": "b", "ho')
+
+        assert_that(xopera_util.read_task_results(results_file)).is_equal_to(
+            [{"task": "a", "host": "h", "status": "ok"}])
+        assert_that(xopera_util.read_task_results(tmp_path / 'missing.jsonl')).is_empty()
+
+    def test_get_failed_tasks(self):
+        task_results = [
+            {"task": "ok", "status": "ok", "ignored": False},
+            {"task": "ignored", "status": "failed", "ignored": True, "msg": "ignored"},
+            {"task": "Fail", "status": "failed", "ignored": False, "msg": "Failed.", "stderr": "boom"},
+            {"task": "Connect", "status": "unreachable", "ignored": False, "msg": "Unreachable"}
+        ]
+        assert_that(xopera_util.get_failed_tasks(task_results)).is_equal_to({
+            "Fail": {"msg": "Failed.", "stderr": "boom"},
+            "Connect": {"msg": "Unreachable", "stderr": None}
+        })
+
+    def test_token_expired(self):
+        def jwt(claims: dict) -> str:
+            payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+            return f"header.{payload}.signature"
+
+        assert_that(xopera_util.token_expired(jwt({'exp': time.time() - 10}))).is_true()
+        assert_that(xopera_util.token_expired(jwt({'exp': time.time() + 300}))).is_false()
+        # opaque token and token without exp are not taken for expired
+        assert_that(xopera_util.token_expired('opaque')).is_false()
+        assert_that(xopera_util.token_expired(jwt({'sub': 'user'}))).is_false()
+
+    def test_model_to_dict(self):
+        assert_that(xopera_util.model_to_dict(ExecutionProfile(workers=4))).is_equal_to({'workers': 4})
+        assert_that(xopera_util.model_to_dict({'a': None})).is_equal_to({'a': None})
+
+
 class TestTimestampUtil:
 
     def test_datetime_now_to_string(self):
@@ -210,3 +539,53 @@ class TestTimestampUtil:
     def test_datetime_to_str_and_back(self):
         some_time = datetime.datetime.now(tz=datetime.timezone.utc)
         assert_that(timestamp_util.str_to_datetime(timestamp_util.datetime_to_str(some_time))).is_equal_to(some_time)
+
+    def test_seconds_between(self):
+        start = datetime.datetime.now(tz=datetime.timezone.utc)
+        end = start + datetime.timedelta(seconds=90)
+        assert_that(timestamp_util.seconds_between(start.isoformat(), end.isoformat())).is_equal_to(90)
+
+    def test_timing(self):
+        timings = {}
+        with timestamp_util.timing(timings, 'phase'):
+            pass
+        with timestamp_util.timing(timings, 'phase'):
+            pass
+        assert_that(timings).contains_only('phase')
+        assert_that(timings['phase']).is_greater_than_or_equal_to(0)
+
+    def test_timing_none(self):
+        with timestamp_util.timing(None, 'phase'):
+            pass
+
+
+class TestPagination:
+
+    def test_cursor(self):
+        cursor = pagination.encode_cursor('2021-10-15T10:33:50.318695', 'abc')
+        assert_that(pagination.decode_cursor(cursor)).is_equal_to(['2021-10-15T10:33:50.318695', 'abc'])
+        assert_that(pagination.decode_cursor(None)).is_none()
+
+    def test_invalid_cursor(self):
+        for cursor in ['not-a-cursor', pagination.encode_cursor()]:
+            with pytest.raises(ValueError, match="Invalid cursor"):
+                pagination.decode_cursor(cursor)
+
+    def test_check_fields(self):
+        pagination.check_fields(GitLog, ['version_id', 'timestamp'])
+        pagination.check_fields(GitLog, None)
+        with pytest.raises(ValueError, match="Unknown fields: foo"):
+            pagination.check_fields(GitLog, ['version_id', 'foo'])
+
+    def test_select_fields(self):
+        items = [GitLog(version_id='v1.0', job='update', timestamp='a'), GitLog(version_id='v2.0')]
+        assert_that(pagination.select_fields(items, None)).is_equal_to(items)
+        assert_that(pagination.select_fields(items, ['version_id', 'timestamp'])).is_equal_to(
+            [{'version_id': 'v1.0', 'timestamp': 'a'}, {'version_id': 'v2.0'}])
+
+    def test_next_cursor_headers(self):
+        items = [{'timestamp': 'a'}, {'timestamp': 'b'}]
+        assert_that(pagination.next_cursor_headers(items, None, lambda x: (x['timestamp'],))).is_empty()
+        assert_that(pagination.next_cursor_headers(items, 3, lambda x: (x['timestamp'],))).is_empty()
+        headers = pagination.next_cursor_headers(items, 2, lambda x: (x['timestamp'],))
+        assert_that(pagination.decode_cursor(headers['X-Next-Cursor'])).is_equal_to(['b'])
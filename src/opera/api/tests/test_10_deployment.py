@@ -1,12 +1,19 @@
+import datetime
+import os
+import socket
 import uuid
+import zlib
 from pathlib import Path
 
+import pytest
 from assertpy import assert_that
 
-from opera.api.controllers.background_invocation import InvocationService, InvocationWorkerProcess
-from opera.api.openapi.models import OperationType
+from opera.api.controllers.background_invocation import InvocationService, InvocationWorkerProcess, \
+    ExtendedInvocation, Heartbeat, SandboxError, AdmissionRejected, IdempotencyKeyReused
+from opera.api.openapi.models import ExecutionProfile, OperationType, Job, JobType, TaskResult
 from opera.api.openapi.models.invocation import Invocation, InvocationState
 from opera.api.settings import Settings
+from opera.api.util import pagination, xopera_util
 from opera.error import AggregatedOperationError, OperationError
 
 
@@ -43,7 +50,8 @@ class TestDeployFresh:
         workers = 42
         deployment_label = 'production'
         resp = client.post(f"/deployment/deploy?blueprint_id={blueprint_id}&version_id={version_id}"
-                           f"&workers={workers}&deployment_label={deployment_label}",
+                           f"&workers={workers}&deployment_label={deployment_label}"
+                           f"&profile[forks]=20&profile[strategy]=free",
                            data=inputs_1)
         assert resp.status_code == 202
         inv_dict = generic_invocation.to_dict()
@@ -54,9 +62,11 @@ class TestDeployFresh:
             version_id=version_id,
             deployment_label=deployment_label,
             workers=workers,
+            profile={'forks': 20, 'strategy': 'free'},
             inputs={'marker': 'blah'},
             username=None,
-            access_token=None
+            access_token=None,
+            idempotency_key=None
         )
 
     def test_no_inputs(self, client, mocker, generic_invocation, patch_auth_wrapper):
@@ -72,10 +82,12 @@ class TestDeployFresh:
             blueprint_id=str(blueprint_id),
             version_id=None,
             deployment_label=None,
-            workers=1,
+            workers=None,
+            profile={},
             inputs=None,
             username=None,
-            access_token=None
+            access_token=None,
+            idempotency_key=None
         )
 
 
@@ -135,6 +147,41 @@ class TestStatus:
         assert resp.json['state'] == inv.state
         assert resp.status_code == 200
 
+    def test_not_modified(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_status_version',
+                     return_value=('inv', generic_invocation.blueprint_id, InvocationState.SUCCESS, '42'))
+        resp = client.get(f"/deployment/{generic_invocation.deployment_id}/status")
+        assert resp.status_code == 200
+        etag = resp.headers['ETag']
+
+        mock_status = mocker.patch('opera.api.controllers.background_invocation.InvocationService.load_invocation')
+        resp = client.get(f"/deployment/{generic_invocation.deployment_id}/status", headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert_that(resp.headers['ETag']).is_equal_to(etag)
+        assert_that(resp.data).is_empty()
+        mock_status.assert_not_called()
+
+    def test_modified(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        mock_version = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_status_version',
+                                    return_value=('inv', generic_invocation.blueprint_id, InvocationState.PENDING, '1'))
+        etag = client.get(f"/deployment/{generic_invocation.deployment_id}/status").headers['ETag']
+
+        mock_version.return_value = ('inv', generic_invocation.blueprint_id, InvocationState.IN_PROGRESS, '2')
+        resp = client.get(f"/deployment/{generic_invocation.deployment_id}/status", headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert_that(resp.headers['ETag']).is_not_equal_to(etag)
+
+    def test_version_in_progress(self, mocker, generic_invocation: Invocation):
+        deployment_id = str(uuid.uuid4())
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_status_version',
+                     return_value=('inv', generic_invocation.blueprint_id, InvocationState.IN_PROGRESS, '1'))
+        InvocationService.stdstream_dir(deployment_id).mkdir(parents=True, exist_ok=True)
+        InvocationService.stdout_file(deployment_id).write_text('first line')
+        version = InvocationService.status_version(deployment_id)
+
+        InvocationService.stdout_file(deployment_id).write_text('first line, second line')
+        assert_that(InvocationService.status_version(deployment_id)).is_not_equal_to(version)
+
     def test_execution_error(self, mocker, generic_invocation: Invocation):
         inv = generic_invocation
         inv.state = InvocationState.FAILED
@@ -144,6 +191,17 @@ class TestStatus:
         assert len(result) == 1
         assert result["node"] == {"create": {"task": "error"}}
 
+    def test_execution_error_task_results(self, mocker, generic_invocation: Invocation):
+        inv = generic_invocation
+        inv.state = InvocationState.FAILED
+        mock_regex = mocker.MagicMock(name='try_get_failed_tasks')
+        mocker.patch('opera.api.util.xopera_util.try_get_failed_tasks', new=mock_regex)
+        exception = AggregatedOperationError("Failed", {"worker1": OperationError("Failed", "node", "Standard", "create")})
+        task_results = [{"task": "task", "host": "opera", "status": "failed", "ignored": False, "msg": "error"}]
+        result = InvocationWorkerProcess.try_extract_error(inv, exception, task_results)
+        assert result["node"] == {"create": {"task": {"msg": "error", "stderr": None}}}
+        mock_regex.assert_not_called()
+
 class TestHistory:
 
     def test_not_found(self, client, mocker, patch_auth_wrapper):
@@ -157,7 +215,7 @@ class TestHistory:
         inv = generic_invocation
         inv.deployment_id = uuid.uuid4()
 
-        mock_log_data = mocker.MagicMock(name='invoke', return_value=[inv])
+        mock_log_data = mocker.MagicMock(name='invoke', return_value=[('a', inv)])
         mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history', new=mock_log_data)
 
         resp = client.get(f"/deployment/{inv.deployment_id}/history")
@@ -165,7 +223,161 @@ class TestHistory:
         assert_that(resp.json).is_length(1)
         inv_dict = inv.to_dict()
         assert_that(resp.json[0]).contains_only(*[k for k in inv_dict.keys() if inv_dict[k] is not None])
-        mock_log_data.assert_called_with(str(inv.deployment_id))
+        mock_log_data.assert_called_with(str(inv.deployment_id), limit=None, after=None)
+
+
+    def test_page(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        inv = generic_invocation
+        inv.deployment_id = uuid.uuid4()
+        inv.timestamp_submission = '2021-10-15T10:33:50.318695+00:00'
+
+        mock_log_data = mocker.MagicMock(name='invoke', return_value=[('a', inv), ('b', inv)])
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history', new=mock_log_data)
+
+        after = pagination.encode_cursor('2021-10-14T10:33:50.318695+00:00', 'c')
+        resp = client.get(f"/deployment/{inv.deployment_id}/history?limit=2&after={after}&fields=state,operation")
+        assert resp.status_code == 200
+        assert_that(resp.json).is_equal_to([{'state': inv.state, 'operation': inv.operation}] * 2)
+        assert_that(pagination.decode_cursor(resp.headers['X-Next-Cursor'])).is_equal_to(
+            [inv.timestamp_submission, 'b'])
+        mock_log_data.assert_called_with(str(inv.deployment_id), limit=2,
+                                         after=['2021-10-14T10:33:50.318695+00:00', 'c'])
+
+    def test_last_page(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history', return_value=[])
+
+        after = pagination.encode_cursor('2021-10-14T10:33:50.318695+00:00')
+        resp = client.get(f"/deployment/{uuid.uuid4()}/history?limit=2&after={after}")
+        assert resp.status_code == 200
+        assert_that(resp.json).is_empty()
+        assert_that(resp.headers).does_not_contain_key('X-Next-Cursor')
+
+    def test_not_modified(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history_version',
+                     return_value=(3, 42, 0))
+        mock_log_data = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history',
+                                     return_value=[('a', generic_invocation)])
+        deployment_id = generic_invocation.deployment_id
+        etag = client.get(f"/deployment/{deployment_id}/history").headers['ETag']
+
+        resp = client.get(f"/deployment/{deployment_id}/history", headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        # other page has other ETag
+        resp = client.get(f"/deployment/{deployment_id}/history?limit=1", headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert_that(mock_log_data.call_count).is_equal_to(2)
+
+    def test_invalid_params(self, client, mocker, patch_auth_wrapper):
+        mock_log_data = mocker.MagicMock(name='invoke', return_value=[])
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history', new=mock_log_data)
+
+        resp = client.get(f"/deployment/{uuid.uuid4()}/history?after=invalid")
+        assert resp.status_code == 400
+        assert_that(resp.json).contains("Invalid cursor")
+
+        resp = client.get(f"/deployment/{uuid.uuid4()}/history?fields=state,foo")
+        assert resp.status_code == 400
+        assert_that(resp.json).contains("Unknown fields: foo")
+        mock_log_data.assert_not_called()
+
+
+class TestTaskResults:
+
+    def test_success(self, client, mocker, patch_auth_wrapper):
+        task_result = TaskResult(task="task", host="opera", status="failed", msg="error")
+        mock_get = mocker.MagicMock(name='get_task_results', return_value=[task_result])
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_task_results', new=mock_get)
+
+        deployment_id = uuid.uuid4()
+        resp = client.get(f"/deployment/{deployment_id}/tasks?status=failed")
+        assert resp.status_code == 200
+        assert_that(resp.json).is_equal_to([{"task": "task", "host": "opera", "status": "failed", "msg": "error"}])
+        mock_get.assert_called_with(str(deployment_id), None, 'failed')
+
+    def test_no_match(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_task_results', return_value=[])
+
+        resp = client.get(f"/deployment/{uuid.uuid4()}/tasks?status=unreachable")
+        assert resp.status_code == 200
+        assert_that(resp.json).is_empty()
+
+    def test_not_found(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_task_results', return_value=[])
+
+        resp = client.get(f"/deployment/{uuid.uuid4()}/tasks")
+        assert resp.status_code == 404
+
+
+class TestFullLog:
+
+    def test_success(self, client, mocker, patch_auth_wrapper):
+        mock_get = mocker.MagicMock(name='get_invocation_log', return_value=zlib.compress(b'full log'))
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_invocation_log', new=mock_get)
+
+        deployment_id = uuid.uuid4()
+        resp = client.get(f"/deployment/{deployment_id}/log?stream=stderr")
+        assert resp.status_code == 200
+        assert_that(resp.data).is_equal_to(b'full log')
+        mock_get.assert_called_with(str(deployment_id), 'stderr', None)
+
+    def test_not_found(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_invocation_log', return_value=None)
+
+        resp = client.get(f"/deployment/{uuid.uuid4()}/log")
+        assert resp.status_code == 404
+
+
+class TestOutputs:
+
+    def test_saved(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_outputs',
+                     return_value={"output": {"value": 42}})
+        mock_outputs = mocker.MagicMock(name='outputs')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.outputs', new=mock_outputs)
+
+        resp = client.get(f"/deployment/{uuid.uuid4()}/outputs")
+        assert resp.status_code == 200
+        assert_that(resp.json).is_equal_to({"output": {"value": 42}})
+        mock_outputs.assert_not_called()
+
+    def test_reevaluate(self, client, mocker, patch_auth_wrapper):
+        mock_get = mocker.MagicMock(name='get_deployment_outputs', return_value={"output": {"value": 42}})
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_outputs', new=mock_get)
+        mock_save = mocker.MagicMock(name='save_deployment_outputs', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_deployment_outputs', new=mock_save)
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.outputs',
+                     return_value=({"output": {"value": 43}}, None))
+
+        deployment_id = uuid.uuid4()
+        resp = client.get(f"/deployment/{deployment_id}/outputs?reevaluate=true")
+        assert resp.status_code == 200
+        assert_that(resp.json).is_equal_to({"output": {"value": 43}})
+        mock_get.assert_not_called()
+        mock_save.assert_called_with(str(deployment_id), {"output": {"value": 43}})
+
+    def test_stale(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_outputs', return_value=None)
+        mock_save = mocker.MagicMock(name='save_deployment_outputs', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_deployment_outputs', new=mock_save)
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.outputs',
+                     return_value=({"output": {"value": 43}}, None))
+
+        resp = client.get(f"/deployment/{uuid.uuid4()}/outputs")
+        assert resp.status_code == 200
+        assert_that(resp.json).is_equal_to({"output": {"value": 43}})
+        mock_save.assert_called_once()
+
+    def test_error(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_outputs', return_value=None)
+        mock_save = mocker.MagicMock(name='save_deployment_outputs', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_deployment_outputs', new=mock_save)
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.outputs',
+                     return_value=(None, ("DataError", "Unknown output")))
+
+        resp = client.get(f"/deployment/{uuid.uuid4()}/outputs")
+        assert resp.status_code == 500
+        assert_that(resp.json).contains("DataError: Unknown output")
+        mock_save.assert_not_called()
 
 
 class TestDeployContinue:
@@ -210,10 +422,13 @@ class TestDeployContinue:
             deployment_label=inv.deployment_label,
             deployment_id=str(inv.deployment_id),
             workers=inv.workers,
+            profile={},
             inputs={'marker': 'blah'},
             clean_state=inv.clean_state,
             username=None,
-            access_token=None
+            access_token=None,
+            idempotency_key=None,
+            require_idle=True
         )
 
 
@@ -228,7 +443,7 @@ class TestDiff:
 
         class FakeDiff:
             def __init__(self, *args):
-                self.out = args
+                self.out = [str(arg) for arg in args]
 
             def outputs(self):
                 return self.out
@@ -242,7 +457,48 @@ class TestDiff:
                           f"&version_id={inv.version_id}")
 
         assert resp.status_code == 200
-        mock_invoke.assert_called_with(str(inv.deployment_id), str(inv.blueprint_id), inv.version_id, None)
+        assert_that(mock_invoke.call_args.args[:4]).is_equal_to(
+            (str(inv.deployment_id), str(inv.blueprint_id), inv.version_id, None))
+        assert_that(str(mock_invoke.call_args.args[4].parent)).is_equal_to(str(Path(Settings.JOB_DIR).absolute()))
+
+    def test_background(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        inv = generic_invocation
+        job = Job(job_id=str(uuid.uuid4()), job_type=JobType.DIFF, state=InvocationState.PENDING,
+                  timestamp_submission=inv.timestamp_submission)
+        mock_submit = mocker.MagicMock(name='submit', return_value=job)
+        mocker.patch('opera.api.controllers.background_job.JobService.submit', new=mock_submit)
+        mock_diff = mocker.MagicMock(name='diff')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.diff', new=mock_diff)
+
+        resp = client.put(f"/deployment/{inv.deployment_id}/diff"
+                          f"?blueprint_id={inv.blueprint_id}"
+                          f"&version_id={inv.version_id}&background=true")
+
+        assert resp.status_code == 202
+        assert_that(resp.json['job_id']).is_equal_to(job.job_id)
+        mock_submit.assert_called_with(JobType.DIFF, None, blueprint_id=str(inv.blueprint_id),
+                                       version_id=inv.version_id, deployment_id=str(inv.deployment_id), inputs=None,
+                                       username=None)
+        mock_diff.assert_not_called()
+
+    def test_cached(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        inv = generic_invocation
+        job = Job(job_id=str(uuid.uuid4()), job_type=JobType.DIFF, state=InvocationState.SUCCESS,
+                  timestamp_submission=inv.timestamp_submission, result={'nodes': {'added': ['hello']}})
+        mocker.patch('opera.api.controllers.background_job.JobService.diff_cache_key', return_value='key')
+        mock_get_cached_job = mocker.MagicMock(name='get_cached_job', return_value=job)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_cached_job', new=mock_get_cached_job)
+        mock_diff = mocker.MagicMock(name='diff')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.diff', new=mock_diff)
+
+        resp = client.put(f"/deployment/{inv.deployment_id}/diff"
+                          f"?blueprint_id={inv.blueprint_id}"
+                          f"&version_id={inv.version_id}")
+
+        assert resp.status_code == 200
+        assert_that(resp.json).is_equal_to({'nodes': {'added': ['hello']}})
+        mock_get_cached_job.assert_called_with('key')
+        mock_diff.assert_not_called()
 
 
 class TestUpdate:
@@ -282,11 +538,247 @@ class TestUpdate:
             version_id=inv.version_id,
             deployment_id=str(inv.deployment_id),
             workers=inv.workers,
+            profile={},
             inputs={'marker': 'blah'},
             username=None,
-            access_token=None
+            access_token=None,
+            idempotency_key=None,
+            require_idle=True
         )
 
+    def test_prepare_two_workdirs_same_blueprint(self, mocker, generic_invocation: Invocation, patch_db):
+        inv = generic_invocation
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_completed_invocation', return_value=inv)
+        mocker.patch('opera.api.controllers.background_invocation.InvocationService.get_dot_opera_from_db')
+        mocker.patch('opera.api.controllers.background_invocation.entry_definitions', return_value='service.yaml')
+        mocker.patch('opera.api.controllers.background_invocation.Storage')
+        mock_get_revision = mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_revision')
+        mock_get_revisions = mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_revisions')
+
+        location = InvocationService.deployment_location(inv.deployment_id, inv.blueprint_id)
+        _, location_old, _, location_new = InvocationWorkerProcess.prepare_two_workdirs(
+            inv.deployment_id, inv.blueprint_id, 'v2.0', None, location)
+
+        mock_get_revisions.assert_called_once_with(inv.blueprint_id, [inv.version_id, 'v2.0'],
+                                                   [location_old, location_new], None)
+        mock_get_revision.assert_not_called()
+
+    def test_prepare_two_workdirs_other_blueprint(self, mocker, generic_invocation: Invocation, patch_db):
+        inv = generic_invocation
+        new_blueprint_id = str(uuid.uuid4())
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_completed_invocation', return_value=inv)
+        mocker.patch('opera.api.controllers.background_invocation.InvocationService.get_dot_opera_from_db')
+        mocker.patch('opera.api.controllers.background_invocation.entry_definitions', return_value='service.yaml')
+        mocker.patch('opera.api.controllers.background_invocation.Storage')
+        mock_get_revision = mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_revision')
+        mock_get_revisions = mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_revisions')
+
+        location = InvocationService.deployment_location(inv.deployment_id, new_blueprint_id)
+        _, location_old, _, location_new = InvocationWorkerProcess.prepare_two_workdirs(
+            inv.deployment_id, new_blueprint_id, 'v1.0', None, location)
+
+        assert_that(location_new).is_equal_to(location)
+        assert_that(location_old.name).is_equal_to(f'{location.name}-old')
+
+        mock_get_revision.assert_any_call(inv.blueprint_id, location_old, inv.version_id, None)
+        mock_get_revision.assert_any_call(new_blueprint_id, location_new, 'v1.0', None)
+        mock_get_revisions.assert_not_called()
+
+
+class TestTimings:
+
+    def test_deploy_fresh(self, mocker, generic_invocation: Invocation, get_workdir_path):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id, version_id='v1.0',
+                                 timings={'queue': 1.0})
+        mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_revision')
+        mocker.patch('opera.api.controllers.background_invocation.Storage')
+        mocker.patch('opera.api.controllers.background_invocation.entry_definitions')
+        mocker.patch('opera.api.controllers.background_invocation.opera_deploy')
+        mocker.patch('opera.api.controllers.background_invocation.opera_outputs', return_value={'output': 'value'})
+
+        outputs = InvocationWorkerProcess._deploy_fresh(get_workdir_path, inv)
+
+        assert_that(outputs).is_equal_to({'output': 'value'})
+        assert_that(inv.timings).contains_only('queue', 'blueprint_fetch', 'opera_run')
+
+    def test_undeploy(self, mocker, generic_invocation: Invocation, get_workdir_path):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id, version_id='v1.0', timings={})
+        mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_revision')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationService.get_dot_opera_from_db',
+                     return_value=True)
+        mock_facts = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_ansible_facts', return_value={})
+        mocker.patch('opera.api.controllers.background_invocation.Storage')
+        mocker.patch('opera.api.controllers.background_invocation.opera_undeploy')
+
+        InvocationWorkerProcess._undeploy(get_workdir_path, inv)
+
+        assert_that(inv.timings).contains_only('blueprint_fetch', 'session_restore', 'opera_run')
+        mock_facts.assert_called_once_with(inv.deployment_id)
+
+
+class TestSandbox:
+
+    def test_isolated(self, monkeypatch, generic_invocation: Invocation):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id, timings={})
+        monkeypatch.delenv("SANDBOX_TEST", raising=False)
+
+        def run():
+            os.environ["SANDBOX_TEST"] = "child"
+            return os.getpid()
+
+        child_pid = InvocationWorkerProcess.run_sandboxed(inv, [], run)
+        assert_that(child_pid).is_not_equal_to(os.getpid())
+        assert_that(os.environ).does_not_contain_key("SANDBOX_TEST")
+        assert_that(inv.timings).contains_only('opera_run')
+
+    def test_exception(self, generic_invocation: Invocation):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id, timings={})
+
+        def run():
+            raise AggregatedOperationError("Failed", {"worker1": OperationError("Failed", "node", "Standard", "create")})
+
+        try:
+            InvocationWorkerProcess.run_sandboxed(inv, [], run)
+            assert False, "exception not raised"
+        except AggregatedOperationError as e:
+            assert_that(e.inner_exceptions["worker1"].tosca_name).is_equal_to("node")
+            assert_that(e.inner_exceptions["worker1"].operation).is_equal_to("create")
+            assert_that(str(e.__cause__)).contains("Traceback", "in run")
+
+    def test_crash(self, generic_invocation: Invocation):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id, timings={})
+
+        try:
+            InvocationWorkerProcess.run_sandboxed(inv, [], lambda: os._exit(3))
+            assert False, "exception not raised"
+        except SandboxError as e:
+            assert_that(str(e)).contains("status 3")
+
+    def test_user(self, mocker, monkeypatch, generic_invocation: Invocation, get_workdir_path):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id, user_id='test',
+                                 access_token='ACCESS_TOKEN', timings={})
+        monkeypatch.setattr(Settings, 'secure_workdir', True)
+        monkeypatch.delenv("SSH_AUTH_SOCK", raising=False)
+        mock_keys = mocker.patch('opera.api.util.xopera_util.get_user_keys', return_value=['key'])
+        mock_acquire = mocker.patch('opera.api.util.xopera_util.acquire_user_agent', return_value='/tmp/agent.sock')
+        mock_release = mocker.patch('opera.api.util.xopera_util.release_user_agent')
+        mock_setup = mocker.patch('opera.api.util.xopera_util.setup_user')
+
+        setup_args, agent_socket = InvocationWorkerProcess.run_sandboxed(
+            inv, [get_workdir_path], lambda: (mock_setup.call_args.args, os.environ.get("SSH_AUTH_SOCK")))
+        assert_that(setup_args).is_equal_to(([get_workdir_path], 'test'))
+        assert_that(agent_socket).is_equal_to('/tmp/agent.sock')
+        mock_keys.assert_called_once_with('test', 'ACCESS_TOKEN')
+        mock_acquire.assert_called_once_with('test', ['key'])
+        mock_release.assert_called_once_with('test')
+        mock_setup.assert_not_called()
+        assert_that(inv.timings).contains_only('user_setup', 'opera_run')
+
+    def test_ssh_control_dir(self, monkeypatch, tmp_path, generic_invocation: Invocation):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id,
+                                 deployment_id=generic_invocation.deployment_id, timings={})
+        monkeypatch.setattr(Settings, 'ssh_control_dir', str(tmp_path))
+        monkeypatch.setattr(Settings, 'ssh_control_persist', 60)
+        monkeypatch.delenv("ANSIBLE_SSH_CONTROL_PATH_DIR", raising=False)
+
+        control_dir = InvocationWorkerProcess.run_sandboxed(
+            inv, [], lambda: os.environ.get("ANSIBLE_SSH_CONTROL_PATH_DIR"))
+        assert_that(control_dir).is_equal_to(str(xopera_util.ssh_control_dir(inv.deployment_id, None)))
+        assert_that(control_dir).is_directory()
+        assert_that(os.environ).does_not_contain_key("ANSIBLE_SSH_CONTROL_PATH_DIR")
+
+    def test_heartbeat_paused(self, mocker, monkeypatch, generic_invocation: Invocation):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id, timings={})
+        monkeypatch.setattr(Settings, 'heartbeat_interval', 3600)
+        mock_beat = mocker.patch('opera.api.controllers.background_invocation.Heartbeat.beat')
+        heartbeat = Heartbeat('worker')
+        heartbeat.start()
+
+        try:
+            # child is forked, while heartbeat thread is stopped
+            assert_that(InvocationWorkerProcess.run_sandboxed(inv, [], lambda: heartbeat.thread is None)).is_true()
+            assert_that(heartbeat.thread.is_alive()).is_true()
+            mock_beat.assert_called()
+        finally:
+            heartbeat.stop()
+        assert_that(Heartbeat.running).does_not_contain(heartbeat)
+
+    def test_fork_failed(self, mocker, generic_invocation: Invocation):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id, user_id='test',
+                                 access_token='ACCESS_TOKEN', timings={})
+        mocker.patch.object(Settings, 'secure_workdir', True)
+        mocker.patch('opera.api.util.xopera_util.get_user_keys', return_value=['key'])
+        mocker.patch('opera.api.util.xopera_util.acquire_user_agent', return_value='/tmp/agent.sock')
+        mock_release = mocker.patch('opera.api.util.xopera_util.release_user_agent')
+        mocker.patch('opera.api.controllers.background_invocation.os.fork',
+                     side_effect=BlockingIOError("Resource temporarily unavailable"))
+
+        assert_that(InvocationWorkerProcess.run_sandboxed).raises(BlockingIOError).when_called_with(
+            inv, [], lambda: None)
+        mock_release.assert_called_once_with('test')
+
+
+class TestExecutionProfile:
+
+    def test_not_found(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_execution_profile', return_value=None)
+
+        deployment_id = uuid.uuid4()
+        assert_that(client.get(f"/deployment/{deployment_id}/profile").status_code).is_equal_to(404)
+        assert_that(client.delete(f"/deployment/{deployment_id}/profile").status_code).is_equal_to(404)
+
+    def test_put(self, client, mocker, patch_auth_wrapper):
+        mock_save = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_execution_profile',
+                                 return_value=True)
+
+        deployment_id = uuid.uuid4()
+        resp = client.put(f"/deployment/{deployment_id}/profile", json={"forks": 20, "pipelining": False})
+        assert resp.status_code == 200
+        assert_that(resp.json).is_equal_to({"forks": 20, "pipelining": False})
+        mock_save.assert_called_once_with(str(deployment_id), {"forks": 20, "pipelining": False})
+
+    def test_put_invalid(self, client, mocker, patch_auth_wrapper):
+        mock_save = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_execution_profile')
+
+        resp = client.put(f"/deployment/{uuid.uuid4()}/profile", json={"strategy": "fast"})
+        assert resp.status_code == 400
+        mock_save.assert_not_called()
+
+    def test_get_delete(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_execution_profile',
+                     return_value={"strategy": "free"})
+        mock_delete = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.delete_execution_profile',
+                                   return_value=True)
+
+        deployment_id = uuid.uuid4()
+        resp = client.get(f"/deployment/{deployment_id}/profile")
+        assert resp.status_code == 200
+        assert_that(resp.json).is_equal_to({"strategy": "free"})
+        assert_that(client.delete(f"/deployment/{deployment_id}/profile").status_code).is_equal_to(200)
+        mock_delete.assert_called_once_with(str(deployment_id))
+
+    def test_effective_profile(self, mocker):
+        profiles = {'blueprint': {"workers": 4, "forks": 10, "strategy": "free"}, 'deployment': {"forks": 20}}
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_execution_profile',
+                     side_effect=lambda profile_id: profiles.get(profile_id))
+
+        profile = InvocationService.execution_profile('blueprint', 'deployment', {"workers": None, "timeout": 30})
+        assert_that(profile).is_equal_to(ExecutionProfile(workers=4, forks=20, strategy="free", timeout=30))
+        profile = InvocationService.execution_profile('blueprint', None, {"workers": 2})
+        assert_that(profile).is_equal_to(ExecutionProfile(workers=2, forks=10, strategy="free"))
+        assert_that(InvocationService.execution_profile('other', None, {})).is_equal_to(ExecutionProfile())
+
+    def test_applied(self, monkeypatch, generic_invocation: Invocation):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id, timings={},
+                                 profile=ExecutionProfile(forks=20, strategy="free", pipelining=False))
+        monkeypatch.delenv("ANSIBLE_FORKS", raising=False)
+
+        env = InvocationWorkerProcess.run_sandboxed(
+            inv, [], lambda: {key: os.environ.get(key) for key in ("ANSIBLE_FORKS", "ANSIBLE_STRATEGY",
+                                                                   "ANSIBLE_PIPELINING", "ANSIBLE_TIMEOUT")})
+        assert_that(env).is_equal_to({"ANSIBLE_FORKS": "20", "ANSIBLE_STRATEGY": "free",
+                                      "ANSIBLE_PIPELINING": "False", "ANSIBLE_TIMEOUT": None})
+
 
 class TestUndeploy:
 
@@ -320,9 +812,12 @@ class TestUndeploy:
             deployment_label=inv.deployment_label,
             deployment_id=str(inv.deployment_id),
             workers=inv.workers,
+            profile={},
             inputs={'marker': 'blah'},
             username=None,
-            access_token=None
+            access_token=None,
+            idempotency_key=None,
+            require_idle=True
         )
 
 
@@ -364,3 +859,308 @@ class TestDeleteDeployment:
         resp = client.delete(f"/deployment/{inv.deployment_id}")
         assert resp.status_code == 200
         assert_that(resp.json).contains("deleted")
+
+
+class TestReconcile:
+
+    @staticmethod
+    def heartbeat(kind='worker', hostname='other-host', pid=1, fresh=True, invocation_id=None, started=None):
+        return {"owner_id": str(uuid.uuid4()), "kind": kind, "hostname": hostname, "pid": pid,
+                "started": started or datetime.datetime(2000, 1, 1), "invocation_id": invocation_id, "fresh": fresh}
+
+    @staticmethod
+    def patch_reconcile(mocker, heartbeats: list, invocations: list):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_heartbeats', return_value=heartbeats)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_unfinished_invocations', return_value=invocations)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.delete_heartbeats')
+        return mocker.patch('opera.api.service.sqldb_service.PostgreSQL.update_deployment_log')
+
+    def test_claimed(self, mocker, generic_invocation: Invocation):
+        generic_invocation.state = InvocationState.IN_PROGRESS
+        mock_save = self.patch_reconcile(mocker, [self.heartbeat(invocation_id='inv')], [('inv', generic_invocation, None)])
+
+        assert_that(InvocationService(work_queue=mocker.MagicMock()).reconcile()).is_equal_to(0)
+        mock_save.assert_not_called()
+
+    def test_stale_heartbeat(self, mocker, generic_invocation: Invocation):
+        generic_invocation.state = InvocationState.IN_PROGRESS
+        mock_save = self.patch_reconcile(mocker, [self.heartbeat(invocation_id='inv', fresh=False)],
+                                         [('inv', generic_invocation, None)])
+
+        assert_that(InvocationService(work_queue=mocker.MagicMock()).reconcile()).is_equal_to(1)
+        invocation_id, inv, _ = mock_save.call_args.args
+        assert_that(invocation_id).is_equal_to('inv')
+        assert_that(inv.state).is_equal_to(InvocationState.INTERRUPTED)
+        assert_that(inv.timestamp_end).is_not_none()
+
+    def test_stale_heartbeat_local_worker(self, mocker, generic_invocation: Invocation):
+        # worker on this host runs, though it could not record heartbeat
+        generic_invocation.state = InvocationState.IN_PROGRESS
+        mocker.patch('opera.api.util.xopera_util.process_alive', return_value=True)
+        mock_save = self.patch_reconcile(mocker, [self.heartbeat(invocation_id='inv', hostname=socket.gethostname(),
+                                                                 fresh=False)], [('inv', generic_invocation, None)])
+        mock_delete = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.delete_heartbeats')
+
+        assert_that(InvocationService(work_queue=mocker.MagicMock()).reconcile()).is_equal_to(0)
+        mock_save.assert_not_called()
+        mock_delete.assert_called_once_with([])
+
+    def test_stale_heartbeat_unconfirmed(self, mocker, generic_invocation: Invocation):
+        # worker on other host may still run, its workdir is left alone
+        generic_invocation.state = InvocationState.IN_PROGRESS
+        location = InvocationService.deployment_location(generic_invocation.deployment_id,
+                                                         generic_invocation.blueprint_id)
+        location.mkdir(parents=True)
+        self.patch_reconcile(mocker, [self.heartbeat(invocation_id='inv', fresh=False)], [('inv', generic_invocation, None)])
+
+        assert_that(InvocationService(work_queue=mocker.MagicMock()).reconcile()).is_equal_to(1)
+        assert_that(str(location)).exists()
+
+    def test_dead_local_worker(self, mocker, generic_invocation: Invocation):
+        generic_invocation.state = InvocationState.IN_PROGRESS
+        mocker.patch('opera.api.util.xopera_util.process_alive', return_value=False)
+        self.patch_reconcile(mocker, [self.heartbeat(invocation_id='inv', hostname=socket.gethostname())],
+                             [('inv', generic_invocation, None)])
+
+        assert_that(InvocationService(work_queue=mocker.MagicMock()).reconcile()).is_equal_to(1)
+
+    def test_pending_owner(self, mocker, generic_invocation: Invocation):
+        instance = self.heartbeat(kind='instance')
+        self.patch_reconcile(mocker, [instance], [('inv', generic_invocation, instance['owner_id'])])
+        assert_that(InvocationService(work_queue=mocker.MagicMock()).reconcile()).is_equal_to(0)
+
+        # instance, which holds invocation in queue, is dead, though older instance lives
+        self.patch_reconcile(mocker, [self.heartbeat(kind='instance')], [('inv', generic_invocation, 'dead-instance')])
+        assert_that(InvocationService(work_queue=mocker.MagicMock()).reconcile()).is_equal_to(1)
+
+    def test_pending(self, mocker, generic_invocation: Invocation):
+        submitted = datetime.datetime.utcnow()
+        self.patch_reconcile(mocker, [self.heartbeat(kind='instance', started=submitted - datetime.timedelta(hours=1))],
+                             [('inv', generic_invocation, None)])
+        assert_that(InvocationService(work_queue=mocker.MagicMock()).reconcile()).is_equal_to(0)
+
+        # instance, which submitted invocation, has been restarted
+        self.patch_reconcile(mocker, [self.heartbeat(kind='instance', started=submitted + datetime.timedelta(hours=1))],
+                             [('inv', generic_invocation, None)])
+        assert_that(InvocationService(work_queue=mocker.MagicMock()).reconcile()).is_equal_to(1)
+
+    def test_salvage(self, mocker, generic_invocation: Invocation):
+        generic_invocation.state = InvocationState.IN_PROGRESS
+        location = InvocationService.deployment_location(generic_invocation.deployment_id,
+                                                         generic_invocation.blueprint_id)
+        (location / '.opera' / 'instances').mkdir(parents=True)
+        (location / '.opera' / 'instances' / 'node_0').write_text(
+            '{"tosca_name": {"data": "node"}, "state": {"data": "creating"}}')
+        InvocationService.stdstream_dir(generic_invocation.deployment_id).mkdir(parents=True, exist_ok=True)
+        InvocationService.stdout_file(generic_invocation.deployment_id).write_text("partial log")
+        mock_save = self.patch_reconcile(mocker, [], [('inv', generic_invocation, None)])
+        mock_dot_opera = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_opera_session_data')
+
+        InvocationService(work_queue=mocker.MagicMock()).interrupt('inv', generic_invocation)
+
+        inv = mock_save.call_args.args[1]
+        assert_that(inv.instance_state).is_equal_to({'node': 'creating'})
+        assert_that(inv.stdout).is_equal_to("partial log")
+        mock_dot_opera.assert_called_once()
+        assert_that(str(location)).does_not_exist()
+        assert_that(str(InvocationService.stdstream_dir(generic_invocation.deployment_id))).does_not_exist()
+
+    def test_rollout(self, mocker, generic_invocation: Invocation):
+        generic_invocation.rollout_id = 'rollout'
+        self.patch_reconcile(mocker, [], [])
+        mock_advance = mocker.patch('opera.api.controllers.background_invocation.RolloutService.advance')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_rollout_access_token', return_value='token')
+
+        InvocationService(work_queue=mocker.MagicMock()).interrupt('inv', generic_invocation)
+
+        assert_that(mock_advance.call_args.args[:3]).is_equal_to(
+            ('rollout', generic_invocation.deployment_id, InvocationState.INTERRUPTED))
+        # next update is submitted with access token, rollout was started with
+        assert_that(mock_advance.call_args.args[3].keywords).is_equal_to({'username': generic_invocation.user_id,
+                                                                           'access_token': 'token'})
+
+
+class TestAdmission:
+
+    @staticmethod
+    def patch_admission(mocker, total=0, pending=0, user=0, project=0):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.advisory_lock')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_project_domain', return_value='project')
+        return mocker.patch('opera.api.service.sqldb_service.PostgreSQL.count_unfinished_invocations',
+                            return_value={'total': total, 'pending': pending, 'user': user, 'project': project})
+
+    def test_disabled(self, mocker):
+        mock_count = self.patch_admission(mocker, total=1000)
+
+        with InvocationService.admit('blueprint', 'user'):
+            pass
+        mock_count.assert_not_called()
+
+    def test_admitted(self, mocker, monkeypatch):
+        monkeypatch.setattr(Settings, 'admission_max_invocations', 10)
+        monkeypatch.setattr(Settings, 'admission_max_invocations_user', 2)
+        mock_count = self.patch_admission(mocker, total=9, user=1)
+
+        with InvocationService.admit('blueprint', 'user'):
+            pass
+        mock_count.assert_called_once_with('user', None)
+
+    def test_user_limit(self, mocker, monkeypatch):
+        monkeypatch.setattr(Settings, 'admission_max_invocations_user', 2)
+        monkeypatch.setattr(Settings, 'admission_retry_after', 60)
+        self.patch_admission(mocker, total=5, user=2)
+
+        with pytest.raises(AdmissionRejected, match='of user user: 2 pending or running, limit is 2') as e:
+            with InvocationService.admit('blueprint', 'user'):
+                pass
+        assert_that(e.value.retry_after).is_equal_to(60)
+
+        # anonymous invocations are limited only in total
+        with InvocationService.admit('blueprint', None):
+            pass
+
+    def test_project_limit(self, mocker, monkeypatch):
+        monkeypatch.setattr(Settings, 'admission_max_invocations_project', 3)
+        mock_count = self.patch_admission(mocker, total=5, project=3)
+
+        with pytest.raises(AdmissionRejected, match='of project project'):
+            with InvocationService.admit('blueprint', 'user'):
+                pass
+        mock_count.assert_called_once_with('user', 'project')
+
+    def test_invoke_rejected(self, mocker, monkeypatch, generic_invocation: Invocation):
+        monkeypatch.setattr(Settings, 'admission_max_invocations', 1)
+        self.patch_admission(mocker, total=1)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_execution_profile', return_value=None)
+        mock_save = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.update_deployment_log')
+        work_queue = mocker.MagicMock(name='work_queue')
+
+        assert_that(InvocationService(work_queue=work_queue).invoke).raises(AdmissionRejected).when_called_with(
+            OperationType.DEPLOY_FRESH, generic_invocation.blueprint_id, 'v1.0', workers=None, inputs=None)
+        mock_save.assert_not_called()
+        work_queue.put.assert_not_called()
+
+    def test_endpoint(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.controllers.background_invocation.InvocationService.invoke',
+                     side_effect=AdmissionRejected("Too many invocations in total", 30))
+
+        resp = client.post(f"/deployment/deploy?blueprint_id={uuid.uuid4()}")
+        assert resp.status_code == 429
+        assert_that(resp.headers['Retry-After']).is_equal_to('30')
+        assert_that(resp.json).contains('Too many invocations')
+
+
+class TestIdempotency:
+
+    @staticmethod
+    def patch_key(mocker, inv: Invocation = None, fingerprint: str = None):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.advisory_lock')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_execution_profile', return_value=None)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.update_deployment_log')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_idempotency_key',
+                     return_value=(fingerprint, inv) if inv else None)
+        return mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_idempotency_key')
+
+    def test_first_submission(self, mocker, generic_invocation: Invocation):
+        mock_save_key = self.patch_key(mocker)
+        work_queue = mocker.MagicMock(name='work_queue')
+
+        inv = InvocationService(work_queue=work_queue).invoke(
+            OperationType.DEPLOY_FRESH, generic_invocation.blueprint_id, 'v1.0', workers=None, inputs=None,
+            username='user', idempotency_key='key')
+        work_queue.put.assert_called_once_with(inv)
+        key, username, fingerprint, _ = mock_save_key.call_args.args
+        assert_that((key, username)).is_equal_to(('key', 'user'))
+        assert_that(fingerprint).starts_with(f'deploy_fresh/{generic_invocation.blueprint_id}//')
+
+    def test_fingerprint_request(self):
+        fingerprint = InvocationService.fingerprint(OperationType.UPDATE, 'blueprint', 'deployment',
+                                                    dict(version_id='v1.0', inputs={'a': 1}, workers=2))
+        assert_that(fingerprint).is_equal_to(InvocationService.fingerprint(
+            OperationType.UPDATE, 'blueprint', 'deployment', dict(workers=2, inputs={'a': 1}, version_id='v1.0')))
+        assert_that(fingerprint).is_not_equal_to(InvocationService.fingerprint(
+            OperationType.UPDATE, 'blueprint', 'deployment', dict(version_id='v1.0', inputs={'a': 2}, workers=2)))
+        assert_that(fingerprint).is_not_equal_to(InvocationService.fingerprint(
+            OperationType.UPDATE, 'blueprint', 'deployment', dict(version_id='v1.0', inputs={'a': 1}, workers=4)))
+
+    def test_retry(self, mocker, generic_invocation: Invocation):
+        fingerprint = InvocationService.fingerprint(OperationType.DEPLOY_FRESH, generic_invocation.blueprint_id,
+                                                    request=dict(version_id='v1.0', inputs=None, workers=None,
+                                                                 clean_state=None, profile=None,
+                                                                 deployment_label=None))
+        mock_save_key = self.patch_key(mocker, generic_invocation, fingerprint)
+        work_queue = mocker.MagicMock(name='work_queue')
+
+        inv = InvocationService(work_queue=work_queue).invoke(
+            OperationType.DEPLOY_FRESH, generic_invocation.blueprint_id, 'v1.0', workers=None, inputs=None,
+            username='user', idempotency_key='key')
+        assert_that(inv).is_equal_to(generic_invocation)
+        work_queue.put.assert_not_called()
+        mock_save_key.assert_not_called()
+
+    def test_reused_other_inputs(self, mocker, generic_invocation: Invocation):
+        fingerprint = InvocationService.fingerprint(OperationType.DEPLOY_FRESH, generic_invocation.blueprint_id,
+                                                    request=dict(version_id='v1.0', inputs=None, workers=None,
+                                                                 clean_state=None, profile=None,
+                                                                 deployment_label=None))
+        self.patch_key(mocker, generic_invocation, fingerprint)
+        work_queue = mocker.MagicMock(name='work_queue')
+
+        assert_that(InvocationService(work_queue=work_queue).invoke).raises(IdempotencyKeyReused).when_called_with(
+            OperationType.DEPLOY_FRESH, generic_invocation.blueprint_id, 'v1.0', workers=None,
+            inputs={'marker': 'blah'}, username='user', idempotency_key='key')
+        work_queue.put.assert_not_called()
+
+    def test_reused(self, mocker, generic_invocation: Invocation):
+        self.patch_key(mocker, generic_invocation, 'undeploy/blueprint/deployment')
+
+        assert_that(InvocationService.replay).raises(IdempotencyKeyReused).when_called_with(
+            'key', 'user', InvocationService.fingerprint(OperationType.DEPLOY_FRESH, 'blueprint'))
+
+    def test_no_key(self, mocker):
+        mock_get_key = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_idempotency_key')
+
+        assert_that(InvocationService.replay(None, 'user', 'deploy_fresh/blueprint/')).is_none()
+        mock_get_key.assert_not_called()
+
+    def test_retry_while_running(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        # original update is still running, retry gets it instead of 403
+        generic_invocation.state = InvocationState.PENDING
+        blueprint_id = generic_invocation.blueprint_id
+        fingerprint = InvocationService.fingerprint(
+            OperationType.UPDATE, blueprint_id, generic_invocation.deployment_id,
+            dict(version_id=None, inputs=None, workers=None, clean_state=None, profile={}, deployment_label=None))
+        self.patch_key(mocker, generic_invocation, fingerprint)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_status',
+                     return_value=generic_invocation)
+        mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_last_tag', return_value='v1.0')
+        mock_put = mocker.patch('opera.api.controllers.deployment_controller.invocation_service.work_queue.put')
+
+        resp = client.post(f"/deployment/{generic_invocation.deployment_id}/update?blueprint_id={blueprint_id}",
+                           headers={'Idempotency-Key': 'key'})
+        assert resp.status_code == 202
+        assert_that(resp.json['deployment_id']).is_equal_to(generic_invocation.deployment_id)
+        mock_put.assert_not_called()
+
+    def test_busy(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        generic_invocation.state = InvocationState.IN_PROGRESS
+        blueprint_id = generic_invocation.blueprint_id
+        self.patch_key(mocker)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_status',
+                     return_value=generic_invocation)
+        mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_last_tag', return_value='v1.0')
+        mock_put = mocker.patch('opera.api.controllers.deployment_controller.invocation_service.work_queue.put')
+
+        resp = client.post(f"/deployment/{generic_invocation.deployment_id}/update?blueprint_id={blueprint_id}",
+                           headers={'Idempotency-Key': 'key'})
+        assert resp.status_code == 403
+        assert_that(resp.json).contains('still running')
+        mock_put.assert_not_called()
+
+    def test_endpoint_reused(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        self.patch_key(mocker, generic_invocation, 'deploy_fresh/other-blueprint/')
+
+        resp = client.post(f"/deployment/{generic_invocation.deployment_id}/undeploy",
+                           headers={'Idempotency-Key': 'key'})
+        assert resp.status_code == 422
+        assert_that(resp.json).contains('already used')
@@ -3,7 +3,7 @@ import uuid
 from assertpy import assert_that
 
 from opera.api.openapi.models import GitLog, BlueprintVersion, Deployment, InvocationState, OperationType
-from opera.api.util import timestamp_util
+from opera.api.util import timestamp_util, pagination
 
 
 class TestBlueprintMeta:
@@ -30,6 +30,25 @@ class TestBlueprintMeta:
         assert_that(resp.json).contains(*[key for key in blueprint_meta.to_dict().keys() if key is not None])
 
 
+    @staticmethod
+    def test_not_modified(client, mocker, generic_blueprint_meta, patch_auth_wrapper):
+        mock_version = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_meta_version',
+                                    return_value=(1, '42'))
+        mock_meta = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_meta',
+                                 return_value=generic_blueprint_meta.to_dict())
+
+        blueprint_id = uuid.uuid4()
+        etag = client.get(f"/blueprint/{blueprint_id}/meta").headers['ETag']
+        resp = client.get(f"/blueprint/{blueprint_id}/meta", headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        mock_meta.assert_called_once()
+
+        # blueprint renamed
+        mock_version.return_value = (1, '43')
+        resp = client.get(f"/blueprint/{blueprint_id}/meta", headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+
+
 class TestBlueprintVersionMeta:
 
     @staticmethod
@@ -57,6 +76,20 @@ class TestBlueprintVersionMeta:
         assert_that(resp.json).contains(*[key for key in blueprint_meta.to_dict().keys() if key is not None])
 
 
+    @staticmethod
+    def test_not_modified(client, mocker, generic_blueprint_meta, patch_auth_wrapper):
+        mock_version = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_meta_version',
+                                    return_value=(1, '42'))
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_meta',
+                     return_value=generic_blueprint_meta.to_dict())
+
+        blueprint_id = uuid.uuid4()
+        etag = client.get(f"/blueprint/{blueprint_id}/version/v1.0/meta").headers['ETag']
+        resp = client.get(f"/blueprint/{blueprint_id}/version/v1.0/meta", headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        mock_version.assert_called_with(str(blueprint_id), 'v1.0')
+
+
 class TestBlueprintName:
 
     @staticmethod
@@ -94,6 +127,41 @@ class TestBlueprintName:
         assert_that(resp.json).contains('not found')
 
 
+class TestBlueprintProfile:
+
+    @staticmethod
+    def test_put(mocker, client, patch_auth_wrapper):
+        mock_save = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_execution_profile',
+                                 return_value=True)
+
+        blueprint_id = uuid.uuid4()
+        resp = client.put(f"/blueprint/{blueprint_id}/profile", json={"workers": 4, "task_timeout": 600})
+        assert resp.status_code == 200
+        mock_save.assert_called_once_with(str(blueprint_id), {"workers": 4, "task_timeout": 600})
+
+    @staticmethod
+    def test_put_fail(mocker, client, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_execution_profile', return_value=False)
+
+        resp = client.put(f"/blueprint/{uuid.uuid4()}/profile", json={"workers": 4})
+        assert resp.status_code == 500
+
+    @staticmethod
+    def test_get(mocker, client, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_execution_profile', return_value={"forks": 5})
+
+        resp = client.get(f"/blueprint/{uuid.uuid4()}/profile")
+        assert resp.status_code == 200
+        assert_that(resp.json).is_equal_to({"forks": 5})
+
+    @staticmethod
+    def test_delete_not_found(mocker, client, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_execution_profile', return_value=None)
+
+        resp = client.delete(f"/blueprint/{uuid.uuid4()}/profile")
+        assert resp.status_code == 404
+
+
 class TestGetDeployments:
 
     @staticmethod
@@ -162,4 +230,37 @@ class TestGitHistory:
         assert resp.status_code == 200
         assert_that(resp.json).is_length(1)
         assert_that(resp.json[0]).contains_only(*git_data.to_dict().keys())
-        mock_git_data.assert_called_with(git_data.blueprint_id)
+        mock_git_data.assert_called_with(git_data.blueprint_id, limit=None, after=None)
+
+    def test_page(self, client, mocker, patch_auth_wrapper):
+        git_data = GitLog(blueprint_id=str(uuid.uuid4()), commit_sha="commit_sha", git_backend="MockConnector",
+                          job="update", repo_url="local", revision_msg="rev_msg",
+                          timestamp='2021-10-15T10:33:50.318695+00:00', version_id='v1.0')
+        mock_git_data = mocker.MagicMock(name='invoke', return_value=[git_data.to_dict()])
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_git_transaction_data', new=mock_git_data)
+
+        after = pagination.encode_cursor('2021-10-16T10:33:50.318695+00:00', 'v2.0')
+        resp = client.get(f"/blueprint/{git_data.blueprint_id}/git_history?limit=1&after={after}")
+        assert resp.status_code == 200
+        assert_that(pagination.decode_cursor(resp.headers['X-Next-Cursor'])).is_equal_to(
+            [git_data.timestamp, git_data.version_id])
+        mock_git_data.assert_called_with(git_data.blueprint_id, limit=1,
+                                         after=['2021-10-16T10:33:50.318695+00:00', 'v2.0'])
+
+    def test_not_modified(self, client, mocker, patch_auth_wrapper):
+        mock_version = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_git_transaction_data_version',
+                                    return_value=(2, 7))
+        git_data = GitLog(blueprint_id=str(uuid.uuid4()), commit_sha="commit_sha", git_backend="MockConnector",
+                          job="update", repo_url="local", revision_msg="rev_msg",
+                          timestamp=timestamp_util.datetime_now_to_string(), version_id='v1.0')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_git_transaction_data',
+                     return_value=[git_data.to_dict()])
+
+        etag = client.get(f"/blueprint/{git_data.blueprint_id}/git_history").headers['ETag']
+        resp = client.get(f"/blueprint/{git_data.blueprint_id}/git_history", headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+
+        # new transaction
+        mock_version.return_value = (3, 8)
+        resp = client.get(f"/blueprint/{git_data.blueprint_id}/git_history", headers={'If-None-Match': etag})
+        assert resp.status_code == 200
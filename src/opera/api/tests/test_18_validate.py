@@ -2,6 +2,14 @@ import uuid
 
 from assertpy import assert_that
 
+from opera.api.openapi.models import Job, JobType, InvocationState
+from opera.api.util import timestamp_util
+
+
+def generic_job(job_type, result=None):
+    return Job(job_id=str(uuid.uuid4()), job_type=job_type, state=InvocationState.PENDING,
+               timestamp_submission=timestamp_util.datetime_now_to_string(), result=result)
+
 
 class TestValidateExisting:
 
@@ -42,6 +50,58 @@ class TestValidateExisting:
         assert_that(resp.json['blueprint_valid']).is_true()
         mock_validate.assert_called_with(str(blueprint_token), None, {'marker': 'blah'})
 
+    def test_background(self, client, mocker, patch_db):
+        blueprint_id = uuid.uuid4()
+        mocker.patch('opera.api.service.csardb_service.GitDB.version_exists', return_value=True)
+        mock_submit = mocker.MagicMock(name='submit', return_value=generic_job(JobType.VALIDATE))
+        mocker.patch('opera.api.controllers.background_job.JobService.submit', new=mock_submit)
+        mock_validate = mocker.MagicMock(name='validate')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.validate', new=mock_validate)
+
+        resp = client.put(f"/blueprint/{blueprint_id}/validate?background=true")
+
+        assert resp.status_code == 202
+        assert_that(resp.json).contains("job_id", "job_type", "state", "timestamp_submission")
+        mock_submit.assert_called_with(JobType.VALIDATE, None, blueprint_id=str(blueprint_id), version_id=None,
+                                       inputs=None, username=None)
+        mock_validate.assert_not_called()
+
+    def test_cached(self, client, mocker, patch_db, generic_blueprint_meta):
+        blueprint_id = uuid.uuid4()
+        mocker.patch('opera.api.service.csardb_service.GitDB.version_exists', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_meta',
+                     return_value=generic_blueprint_meta.to_dict())
+        mock_get_cached_job = mocker.MagicMock(name='get_cached_job', return_value=generic_job(
+            JobType.VALIDATE, {'blueprint_valid': False, 'error': 'Cached error'}))
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_cached_job', new=mock_get_cached_job)
+        mock_validate = mocker.MagicMock(name='validate')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.validate', new=mock_validate)
+
+        resp = client.put(f"/blueprint/{blueprint_id}/validate")
+
+        assert resp.status_code == 200
+        assert_that(resp.json['blueprint_valid']).is_false()
+        assert_that(resp.json['error']).is_equal_to('Cached error')
+        mock_get_cached_job.assert_called_once()
+        mock_validate.assert_not_called()
+
+    def test_save_result(self, client, mocker, patch_db, generic_blueprint_meta):
+        blueprint_id = uuid.uuid4()
+        mocker.patch('opera.api.service.csardb_service.GitDB.version_exists', return_value=True)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_meta',
+                     return_value=generic_blueprint_meta.to_dict())
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.validate', return_value=None)
+        mock_update_job = mocker.MagicMock(name='update_job')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.update_job', new=mock_update_job)
+
+        resp = client.put(f"/blueprint/{blueprint_id}/validate")
+
+        assert resp.status_code == 200
+        job, cache_key, *_ = mock_update_job.call_args[0]
+        assert_that(job.state).is_equal_to(InvocationState.SUCCESS)
+        assert_that(job.result).is_equal_to({'blueprint_valid': True})
+        assert_that(cache_key).is_not_none()
+
 
 class TestValidateExistingVersion:
 
@@ -84,6 +144,19 @@ class TestValidateExistingVersion:
         assert_that(resp.json['blueprint_valid']).is_true()
         mock_validate.assert_called_with(str(blueprint_token), version_id, {'marker': 'blah'})
 
+    def test_background(self, client, mocker, patch_db):
+        blueprint_id = uuid.uuid4()
+        version_id = 'v1.0'
+        mocker.patch('opera.api.service.csardb_service.GitDB.version_exists', return_value=True)
+        mock_submit = mocker.MagicMock(name='submit', return_value=generic_job(JobType.VALIDATE))
+        mocker.patch('opera.api.controllers.background_job.JobService.submit', new=mock_submit)
+
+        resp = client.put(f"/blueprint/{blueprint_id}/version/{version_id}/validate?background=true")
+
+        assert resp.status_code == 202
+        mock_submit.assert_called_with(JobType.VALIDATE, None, blueprint_id=str(blueprint_id),
+                                       version_id=version_id, inputs=None, username=None)
+
 
 class TestValidateNew:
 
@@ -104,3 +177,32 @@ class TestValidateNew:
         assert resp.status_code == 200
         assert_that(resp.json).contains_only("blueprint_valid")
         assert_that(resp.json['blueprint_valid']).is_true()
+
+    def test_background(self, client, mocker, csar_1):
+        mock_submit = mocker.MagicMock(name='submit', return_value=generic_job(JobType.VALIDATE_NEW))
+        mocker.patch('opera.api.controllers.background_job.JobService.submit', new=mock_submit)
+        mock_validate_new = mocker.MagicMock(name='validate_new')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.validate_new',
+                     new=mock_validate_new)
+
+        resp = client.put(f"/blueprint/validate?background=true", data=csar_1)
+
+        assert resp.status_code == 202
+        assert_that(resp.json['job_type']).is_equal_to(JobType.VALIDATE_NEW)
+        args, kwargs = mock_submit.call_args
+        assert_that(args).contains(JobType.VALIDATE_NEW)
+        assert_that(kwargs['csar'].filename).is_equal_to('CSAR-hello_fast.zip')
+        mock_validate_new.assert_not_called()
+
+    def test_cached(self, client, mocker, csar_1):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_cached_job', return_value=generic_job(
+            JobType.VALIDATE_NEW, {'blueprint_valid': True}))
+        mock_validate_new = mocker.MagicMock(name='validate_new')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.validate_new',
+                     new=mock_validate_new)
+
+        resp = client.put(f"/blueprint/validate", data=csar_1)
+
+        assert resp.status_code == 200
+        assert_that(resp.json).contains_only("blueprint_valid")
+        mock_validate_new.assert_not_called()
@@ -0,0 +1,275 @@
+import datetime
+import uuid
+from pathlib import Path
+
+import pytest
+from assertpy import assert_that
+from werkzeug.datastructures import FileStorage
+
+from opera.api.controllers.background_invocation import InvocationWorkerProcess
+from opera.api.controllers.background_job import ExtendedJob, JobService, JobWorkerProcess
+from opera.api.openapi.models import JobType, InvocationState
+from opera.api.service.sqldb_service import SqlDBFailedException
+from opera.api.util import timestamp_util
+
+
+def generic_job(job_type=JobType.VALIDATE, blueprint_id=None, result=None):
+    return ExtendedJob(job_id=str(uuid.uuid4()), job_type=job_type, state=InvocationState.SUCCESS,
+                       blueprint_id=blueprint_id, timestamp_submission=timestamp_util.datetime_now_to_string(),
+                       result=result)
+
+
+def job_service(mocker):
+    service = JobService.__new__(JobService)
+    service.work_queue = mocker.MagicMock(name='work_queue')
+    service.heartbeat = mocker.MagicMock(name='heartbeat', owner_id='instance')
+    return service
+
+
+class TestGetJob:
+
+    def test_not_found(self, client, mocker, patch_db):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_job', return_value=None)
+
+        resp = client.get(f"/job/{uuid.uuid4()}")
+        assert resp.status_code == 404
+        assert_that(resp.json).contains('does not exist')
+
+    def test_unauthorized(self, client, mocker, patch_db):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_job',
+                     return_value=generic_job(blueprint_id=str(uuid.uuid4())))
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_project_domain', return_value='foo')
+        mocker.patch('opera.api.controllers.security_controller.check_roles', return_value=False)
+
+        resp = client.get(f"/job/{uuid.uuid4()}")
+        assert resp.status_code == 401
+
+    def test_unauthorized_deployment(self, client, mocker, patch_db, generic_invocation):
+        job = generic_job(JobType.DIFF)
+        job.deployment_id = generic_invocation.deployment_id
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_job', return_value=job)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_status',
+                     return_value=generic_invocation)
+        mock_project_domain = mocker.MagicMock(name='get_project_domain', return_value='foo')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_project_domain', new=mock_project_domain)
+        mocker.patch('opera.api.controllers.security_controller.check_roles', return_value=False)
+
+        resp = client.get(f"/job/{job.job_id}")
+        assert resp.status_code == 401
+        mock_project_domain.assert_called_with(generic_invocation.blueprint_id)
+
+    def test_other_user(self, client, mocker, patch_db):
+        mocker.patch('opera.api.controllers.security_controller.get_username', return_value='alice')
+        mock_get_job = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_job', return_value=None)
+        job_id = str(uuid.uuid4())
+
+        resp = client.get(f"/job/{job_id}")
+        assert resp.status_code == 404
+        mock_get_job.assert_called_with(job_id, 'alice')
+
+    def test_success(self, client, mocker, patch_db):
+        job = generic_job(result={'blueprint_valid': True})
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_job', return_value=job)
+
+        resp = client.get(f"/job/{job.job_id}")
+        assert resp.status_code == 200
+        assert_that(resp.json['job_id']).is_equal_to(job.job_id)
+        assert_that(resp.json['state']).is_equal_to(InvocationState.SUCCESS)
+        assert_that(resp.json['result']).is_equal_to({'blueprint_valid': True})
+
+
+class TestJobWorkerProcess:
+
+    def test_validate(self, mocker):
+        mock_validate = mocker.MagicMock(name='validate', return_value=None)
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.validate', new=mock_validate)
+        job = generic_job(blueprint_id=str(uuid.uuid4()))
+        job.version_id = 'v1.0'
+        job.inputs = {'marker': 'blah'}
+
+        assert_that(JobWorkerProcess.run_job(job)).is_equal_to({'blueprint_valid': True})
+        mock_validate.assert_called_with(job.blueprint_id, 'v1.0', {'marker': 'blah'})
+
+    def test_validate_new(self, mocker):
+        mock_validate_csar = mocker.MagicMock(name='validate_csar', return_value="ParseError: error")
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.validate_csar',
+                     new=mock_validate_csar)
+        job = generic_job(JobType.VALIDATE_NEW)
+        job.csar_path = Path('CSAR.zip')
+
+        assert_that(JobWorkerProcess.run_job(job)).is_equal_to({'blueprint_valid': False,
+                                                                'error': "ParseError: error"})
+        mock_validate_csar.assert_called_with(Path('CSAR.zip'), None)
+
+
+    def test_diff(self, mocker):
+        mock_diff = mocker.MagicMock(name='diff')
+        mock_diff.return_value.outputs.return_value = {'nodes': {}}
+        mocker.patch('opera.api.controllers.background_invocation.InvocationWorkerProcess.diff', new=mock_diff)
+        job = generic_job(JobType.DIFF, blueprint_id=str(uuid.uuid4()))
+        job.deployment_id = str(uuid.uuid4())
+
+        assert_that(JobWorkerProcess.run_job(job)).is_equal_to({'nodes': {}})
+        mock_diff.assert_called_with(job.deployment_id, job.blueprint_id, None, None, JobService.job_dir(job.job_id))
+
+    def test_diff_workdirs(self, mocker, generic_invocation):
+        job_dir = JobService.job_dir(uuid.uuid4())
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_completed_invocation',
+                     return_value=generic_invocation)
+        mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_revisions',
+                     side_effect=lambda blueprint_id, version_ids, dsts, owner=None: [dst.mkdir() for dst in dsts])
+        mocker.patch('opera.api.controllers.background_invocation.InvocationService.get_dot_opera_from_db')
+        mocker.patch('opera.api.controllers.background_invocation.opera_diff_instances',
+                     side_effect=RuntimeError("diff failed"))
+
+        with pytest.raises(RuntimeError, match="diff failed"):
+            InvocationWorkerProcess.diff(generic_invocation.deployment_id, generic_invocation.blueprint_id, 'v2.0',
+                                         None, job_dir)
+        # workdirs are reclaimed after failed diff as well
+        assert_that(str(job_dir)).does_not_exist()
+
+
+class TestJobService:
+
+    def test_submit(self, mocker, patch_db):
+        mock_update_job = mocker.MagicMock(name='update_job')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.update_job', new=mock_update_job)
+        service = job_service(mocker)
+        blueprint_id = uuid.uuid4()
+
+        job = service.submit(JobType.VALIDATE, 'key', blueprint_id=blueprint_id, version_id='v1.0',
+                             username='alice')
+
+        assert_that(job.state).is_equal_to(InvocationState.PENDING)
+        assert_that(job.blueprint_id).is_equal_to(str(blueprint_id))
+        mock_update_job.assert_called_with(job, 'key', 'alice', 'instance')
+        service.work_queue.put.assert_called_with(job)
+
+    def test_submit_cached(self, mocker, patch_db):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_cached_job',
+                     return_value=generic_job(result={'blueprint_valid': True}))
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.update_job')
+        service = job_service(mocker)
+
+        job = service.submit(JobType.VALIDATE, 'key', blueprint_id=uuid.uuid4())
+
+        assert_that(job.state).is_equal_to(InvocationState.SUCCESS)
+        assert_that(job.cached).is_true()
+        assert_that(job.result).is_equal_to({'blueprint_valid': True})
+        service.work_queue.put.assert_not_called()
+
+    def test_submit_csar(self, mocker, patch_db):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.update_job')
+        service = job_service(mocker)
+        csar_path = Path(__file__).parent / 'CSAR' / 'CSAR-hello_fast.zip'
+        csar = FileStorage(stream=csar_path.open('rb'), filename=csar_path.name)
+
+        job = service.submit(JobType.VALIDATE_NEW, csar=csar)
+
+        assert_that(str(job.csar_path)).is_file().ends_with(csar_path.name)
+        assert_that(job.csar_path.read_bytes()).is_equal_to(csar_path.read_bytes())
+        service.work_queue.put.assert_called_with(job)
+
+    def test_blueprint_cache_key(self, mocker, patch_db, generic_blueprint_meta):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_meta',
+                     return_value=generic_blueprint_meta.to_dict())
+        blueprint_id = generic_blueprint_meta.blueprint_id
+
+        key = JobService.blueprint_cache_key(JobType.VALIDATE, blueprint_id, None, {'a': 1})
+        assert_that(key).is_length(64)
+        assert_that(JobService.blueprint_cache_key(JobType.VALIDATE, blueprint_id, None, {'a': 1})).is_equal_to(key)
+        assert_that(JobService.blueprint_cache_key(JobType.VALIDATE, blueprint_id, None, {'a': 2})).is_not_equal_to(key)
+
+    def test_blueprint_cache_key_no_commit(self, mocker, patch_db):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_meta', return_value=None)
+
+        assert_that(JobService.blueprint_cache_key(JobType.VALIDATE, uuid.uuid4(), None, None)).is_none()
+
+    def test_csar_cache_key(self):
+        csar_path = Path(__file__).parent / 'CSAR' / 'CSAR-hello_fast.zip'
+        csar = FileStorage(stream=csar_path.open('rb'), filename=csar_path.name)
+
+        key = JobService.csar_cache_key(JobType.VALIDATE_NEW, csar, None, 'alice')
+        assert_that(JobService.csar_cache_key(JobType.VALIDATE_NEW, csar, None, 'alice')).is_equal_to(key)
+        assert_that(JobService.csar_cache_key(JobType.VALIDATE_NEW, csar, None, 'bob')).is_not_equal_to(key)
+        assert_that(csar.stream.read()).is_equal_to(csar_path.read_bytes())
+
+    def test_load_cached_db_down(self, mocker):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_cached_job',
+                     side_effect=SqlDBFailedException('Could not connect'))
+
+        assert_that(JobService.load_cached('key')).is_none()
+
+    def test_diff_cache_key(self, mocker, patch_db, generic_blueprint_meta, generic_invocation):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_blueprint_meta',
+                     return_value=generic_blueprint_meta.to_dict())
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_completed_invocation',
+                     return_value=generic_invocation)
+        mock_state_hash = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_opera_session_data_hash',
+                                       return_value='hash_1')
+        deployment_id = generic_invocation.deployment_id
+        blueprint_id = generic_blueprint_meta.blueprint_id
+
+        key = JobService.diff_cache_key(deployment_id, blueprint_id, 'v1.0', None)
+        assert_that(key).is_length(64)
+        assert_that(JobService.diff_cache_key(deployment_id, blueprint_id, 'v1.0', None)).is_equal_to(key)
+
+        # deployment state changed
+        mock_state_hash.return_value = 'hash_2'
+        assert_that(JobService.diff_cache_key(deployment_id, blueprint_id, 'v1.0', None)).is_not_equal_to(key)
+
+    def test_diff_cache_key_no_state(self, mocker, patch_db):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_opera_session_data_hash', return_value=None)
+
+        assert_that(JobService.diff_cache_key(uuid.uuid4(), uuid.uuid4(), None, None)).is_none()
+
+
+class TestReconcileJobs:
+
+    @staticmethod
+    def patch_reconcile(mocker, heartbeats: list, jobs: list):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_heartbeats', return_value=heartbeats)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_unfinished_jobs', return_value=jobs)
+        return mocker.patch('opera.api.service.sqldb_service.PostgreSQL.update_job')
+
+    @staticmethod
+    def heartbeat(kind='worker', invocation_id=None, started=None, owner_id=None):
+        return {"owner_id": owner_id or str(uuid.uuid4()), "kind": kind, "hostname": 'other-host', "pid": 1,
+                "started": started or datetime.datetime(2000, 1, 1), "invocation_id": invocation_id, "fresh": True}
+
+    def test_running(self, mocker):
+        job = generic_job()
+        job.state = InvocationState.IN_PROGRESS
+        mock_update_job = self.patch_reconcile(mocker, [self.heartbeat(invocation_id=job.job_id)], [(job, 'instance')])
+        assert_that(JobService.reconcile()).is_equal_to(0)
+        mock_update_job.assert_not_called()
+
+        # worker, which claimed job, is gone
+        mock_update_job = self.patch_reconcile(mocker, [], [(job, 'instance')])
+        assert_that(JobService.reconcile()).is_equal_to(1)
+        saved_job, = mock_update_job.call_args.args
+        assert_that(saved_job.state).is_equal_to(InvocationState.INTERRUPTED)
+        assert_that(saved_job.timestamp_end).is_not_none()
+
+    def test_pending(self, mocker):
+        job = generic_job()
+        job.state = InvocationState.PENDING
+        self.patch_reconcile(mocker, [self.heartbeat('instance', owner_id='instance')], [(job, 'instance')])
+        assert_that(JobService.reconcile()).is_equal_to(0)
+
+        # instance, which held job in queue, is dead, though older instance lives
+        self.patch_reconcile(mocker, [self.heartbeat('instance')], [(job, 'instance')])
+        assert_that(JobService.reconcile()).is_equal_to(1)
+
+    def test_pending_without_instance(self, mocker):
+        job = generic_job()
+        job.state = InvocationState.PENDING
+        submitted = datetime.datetime.utcnow()
+        self.patch_reconcile(mocker, [self.heartbeat('instance', started=submitted - datetime.timedelta(hours=1))],
+                             [(job, None)])
+        assert_that(JobService.reconcile()).is_equal_to(0)
+
+        # instance, which held job in queue, has been restarted
+        self.patch_reconcile(mocker, [self.heartbeat('instance', started=submitted + datetime.timedelta(hours=1))],
+                             [(job, None)])
+        assert_that(JobService.reconcile()).is_equal_to(1)
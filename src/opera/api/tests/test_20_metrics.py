@@ -0,0 +1,64 @@
+import subprocess
+import uuid
+
+from assertpy import assert_that
+
+from opera.api.service.sqldb_service import PostgreSQL
+from opera.api.util import metrics
+
+
+def sample(name, labels=None):
+    for line in metrics.collect().decode().splitlines():
+        if line.startswith(name) and all(f'{key}="{value}"' in line for key, value in (labels or {}).items()):
+            return float(line.rsplit(' ', 1)[-1])
+    return None
+
+
+class TestMetrics:
+
+    def test_endpoint(self, client):
+        resp = client.get("/metrics")
+
+        assert resp.status_code == 200
+        assert_that(resp.content_type).starts_with('text/plain')
+        assert_that(resp.data.decode()).contains('# TYPE xopera_oidc_introspection_duration_seconds histogram')
+
+    def test_sql_latency(self, patch_db):
+        count = sample('xopera_sql_query_duration_seconds_count', {'method': 'get_deployment_status'}) or 0
+
+        PostgreSQL.get_deployment_status(uuid.uuid4())
+
+        assert_that(sample('xopera_sql_query_duration_seconds_count',
+                           {'method': 'get_deployment_status'})).is_equal_to(count + 1)
+
+    def test_git_duration(self, db, generic_dir):
+        count = sample('xopera_git_operation_duration_seconds_count',
+                       {'connector': 'MockConnector', 'operation': 'push'}) or 0
+
+        db.save_CSAR(csar_path=generic_dir, csar_token=uuid.uuid4())
+
+        assert_that(sample('xopera_git_operation_duration_seconds_count',
+                           {'connector': 'MockConnector', 'operation': 'push'})).is_equal_to(count + 1)
+        assert_that(sample('xopera_git_operation_duration_seconds_count',
+                           {'connector': 'MockConnector', 'operation': 'clone'})).is_not_none()
+
+    def test_queue_depth(self, client, mocker):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.count_unfinished_invocations',
+                     return_value={'total': 7, 'pending': 4, 'user': 0, 'project': 0})
+
+        resp = client.get("/metrics")
+        assert resp.status_code == 200
+        assert_that(sample('xopera_invocation_queue_depth', {'state': 'pending'})).is_equal_to(4)
+        assert_that(sample('xopera_invocation_queue_depth', {'state': 'in_progress'})).is_equal_to(3)
+
+    def test_mark_dead_processes(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        dead_file = metrics.METRICS_DIR / f'gauge_livesum_{process.pid}.db'
+        dead_file.touch()
+        metrics.WORKERS_BUSY.labels('test').inc()
+
+        metrics.mark_dead_processes()
+        assert_that(str(dead_file)).does_not_exist()
+        assert_that(list(metrics.METRICS_DIR.glob('gauge_livesum_*.db'))).is_not_empty()
+        metrics.WORKERS_BUSY.labels('test').dec()
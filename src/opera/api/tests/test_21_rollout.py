@@ -0,0 +1,333 @@
+import shutil
+import uuid
+from pathlib import Path
+
+import pytest
+from assertpy import assert_that
+
+from opera.api.controllers.background_invocation import ExtendedInvocation, InvocationService, InvocationWorkerProcess
+from opera.api.controllers.background_rollout import RolloutCredentialsExpired, RolloutService
+from opera.api.openapi.models import Invocation, InvocationState, OperationType, Rollout, RolloutRequest
+from opera.api.service.sqldb_service import PostgreSQL
+from opera.api.settings import Settings
+from opera.api.util import timestamp_util
+
+
+def generic_rollout(deployments=4, max_parallel=2, failure_budget=0, canary=1) -> Rollout:
+    request = RolloutRequest(deployment_ids=[str(uuid.uuid4()) for _ in range(deployments)],
+                             max_parallel=max_parallel, failure_budget=failure_budget, canary=canary)
+    return RolloutService.create(uuid.uuid4(), 'v2.0', request, {"forks": 20})
+
+
+def states(rollout: Rollout) -> list:
+    return [item.state for item in rollout.deployments]
+
+
+def finish(rollout: Rollout, index: int, state: str):
+    rollout.deployments[index].state = state
+
+
+class TestSchedule:
+
+    def test_canary_first(self):
+        rollout = generic_rollout()
+
+        assert_that(RolloutService.schedule(rollout)).is_length(1)
+        assert_that(states(rollout)).is_equal_to(['in_progress', 'pending', 'pending', 'pending'])
+        assert_that(RolloutService.schedule(rollout)).is_empty()
+
+        finish(rollout, 0, 'success')
+        assert_that(RolloutService.schedule(rollout)).is_length(2)
+        assert_that(states(rollout)).is_equal_to(['success', 'in_progress', 'in_progress', 'pending'])
+        assert_that(rollout.progress).is_equal_to(
+            {'pending': 1, 'in_progress': 2, 'success': 1, 'failed': 0, 'skipped': 0})
+
+    def test_no_canary(self):
+        rollout = generic_rollout(max_parallel=10, canary=0)
+
+        assert_that(RolloutService.schedule(rollout)).is_length(4)
+
+    def test_canary_failed(self):
+        rollout = generic_rollout(failure_budget=5)
+        RolloutService.schedule(rollout)
+
+        finish(rollout, 0, 'failed')
+        assert_that(RolloutService.schedule(rollout)).is_empty()
+        assert_that(states(rollout)).is_equal_to(['failed', 'skipped', 'skipped', 'skipped'])
+        assert_that(rollout.state).is_equal_to('failed')
+        assert_that(rollout.timestamp_end).is_not_none()
+
+    def test_failure_budget(self):
+        rollout = generic_rollout(max_parallel=1, failure_budget=1, canary=0)
+
+        for index, expected_state in [(0, 'in_progress'), (1, 'in_progress'), (2, 'in_progress')]:
+            RolloutService.schedule(rollout)
+            assert_that(rollout.state).is_equal_to(expected_state)
+            finish(rollout, index, 'failed' if index > 0 else 'success')
+        # second failure exceeds budget
+        RolloutService.schedule(rollout)
+        assert_that(states(rollout)).is_equal_to(['success', 'failed', 'failed', 'skipped'])
+        assert_that(rollout.state).is_equal_to('failed')
+
+    def test_success_within_budget(self):
+        rollout = generic_rollout(deployments=2, failure_budget=1, canary=0)
+        RolloutService.schedule(rollout)
+
+        finish(rollout, 0, 'success')
+        finish(rollout, 1, 'failed')
+        RolloutService.schedule(rollout)
+        assert_that(rollout.state).is_equal_to('success')
+
+
+class TestAdvance:
+
+    def test_start(self, mocker):
+        rollout = generic_rollout()
+        mock_save = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_rollout')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.advisory_lock')
+        submitted = []
+
+        def submit(r, deployment_id):
+            submitted.append(deployment_id)
+            return Invocation(timestamp_submission=timestamp_util.datetime_now_to_string())
+
+        RolloutService.start(rollout, submit, 'token')
+        assert_that(submitted).is_equal_to([rollout.deployments[0].deployment_id])
+        assert_that(rollout.deployments[0].timestamp_submission).is_not_none()
+        mock_save.assert_called_once_with(rollout, 'token')
+
+    def test_submit_failed(self, mocker):
+        rollout = generic_rollout(deployments=2, failure_budget=1, canary=0)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_rollout')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.advisory_lock')
+
+        def submit(r, deployment_id):
+            raise RuntimeError("still running")
+
+        RolloutService.start(rollout, submit)
+        assert_that(states(rollout)).is_equal_to(['failed', 'failed'])
+        assert_that(rollout.state).is_equal_to('failed')
+
+    def test_credentials_expired(self, mocker):
+        rollout = generic_rollout(canary=0)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_rollout')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.advisory_lock')
+        submit = mocker.MagicMock(name='submit', side_effect=RolloutCredentialsExpired("Access token expired"))
+
+        RolloutService.start(rollout, submit)
+        submit.assert_called_once()
+        assert_that(states(rollout)).is_equal_to(['skipped', 'skipped', 'skipped', 'skipped'])
+        assert_that(rollout.state).is_equal_to('failed')
+        assert_that(rollout.exception).is_equal_to("Access token expired")
+
+    def test_advance(self, mocker):
+        rollout = generic_rollout()
+        RolloutService.schedule(rollout)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_rollout', return_value=rollout)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_rollout')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.advisory_lock')
+        submit = mocker.MagicMock(name='submit', return_value=Invocation())
+
+        RolloutService.advance(rollout.rollout_id, rollout.deployments[0].deployment_id, InvocationState.SUCCESS,
+                               submit)
+        assert_that(states(rollout)).is_equal_to(['success', 'in_progress', 'in_progress', 'pending'])
+        submit.assert_called_with(rollout, rollout.deployments[2].deployment_id)
+
+    def test_rollout_update(self, mocker, generic_invocation: Invocation):
+        rollout = generic_rollout()
+        generic_invocation.state = InvocationState.SUCCESS
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_status',
+                     return_value=generic_invocation)
+        service = InvocationService(work_queue=mocker.MagicMock(name='work_queue'))
+        mock_invoke = mocker.patch.object(service, 'invoke')
+
+        service.rollout_update(rollout, generic_invocation.deployment_id, username='user')
+        mock_invoke.assert_called_once_with(
+            OperationType.UPDATE, rollout.blueprint_id, 'v2.0', workers=None, inputs=None,
+            deployment_id=generic_invocation.deployment_id, username='user', access_token=None,
+            profile=rollout.profile.to_dict(), rollout_id=rollout.rollout_id,
+            admission=False)
+
+    def test_rollout_update_token_expired(self, mocker, generic_invocation: Invocation):
+        rollout = generic_rollout()
+        mocker.patch('opera.api.util.xopera_util.token_expired', return_value=True)
+        service = InvocationService(work_queue=mocker.MagicMock(name='work_queue'))
+        mock_invoke = mocker.patch.object(service, 'invoke')
+
+        with pytest.raises(RolloutCredentialsExpired, match='Access token of user user expired'):
+            service.rollout_update(rollout, generic_invocation.deployment_id, username='user', access_token='token')
+        mock_invoke.assert_not_called()
+
+    def test_revision(self, mocker, monkeypatch, tmp_path: Path):
+        monkeypatch.setattr(Settings, 'ROLLOUT_DIR', str(tmp_path))
+        mock_get_revision = mocker.patch('opera.api.controllers.background_rollout.CSAR_db.get_revision',
+                                         side_effect=lambda blueprint_id, dst, version_id: dst.mkdir() or dst)
+
+        revision = RolloutService.revision('rollout', 'blueprint', 'v2.0')
+        assert_that(RolloutService.revision('rollout', 'blueprint', 'v2.0')).is_equal_to(revision)
+        assert_that(str(revision)).is_directory()
+        mock_get_revision.assert_called_once()
+
+
+class TestRolloutEndpoint:
+
+    def test_success(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_completed_invocation',
+                     return_value=generic_invocation)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_rollout')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.advisory_lock')
+        mock_invoke = mocker.patch('opera.api.controllers.background_invocation.InvocationService.invoke',
+                                   return_value=generic_invocation)
+
+        blueprint_id = uuid.uuid4()
+        deployment_ids = [str(uuid.uuid4()), str(uuid.uuid4())]
+        resp = client.post(f"/rollout?blueprint_id={blueprint_id}&version_id=v2.0&profile[forks]=20",
+                           json={"deployment_ids": deployment_ids, "max_parallel": 5})
+        assert resp.status_code == 202
+        assert_that(resp.json['state']).is_equal_to('in_progress')
+        assert_that(resp.json['progress']).contains_entry({'in_progress': 1}, {'pending': 1})
+        assert_that(resp.json['profile']).is_equal_to({'forks': 20})
+        mock_invoke.assert_called_once()
+        assert_that(mock_invoke.call_args.kwargs['deployment_id']).is_equal_to(deployment_ids[0])
+
+    def test_still_running(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        generic_invocation.state = InvocationState.IN_PROGRESS
+        mock_save = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_rollout')
+
+        resp = client.post(f"/rollout?blueprint_id={uuid.uuid4()}", json={"deployment_ids": [str(uuid.uuid4())]})
+        assert resp.status_code == 403
+        mock_save.assert_not_called()
+
+    def test_not_deployed(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        undeployed = Invocation(state=InvocationState.SUCCESS, operation=OperationType.UNDEPLOY)
+        mock_save = mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_rollout')
+
+        for last_completed in [None, undeployed]:
+            mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_completed_invocation',
+                         return_value=last_completed)
+            resp = client.post(f"/rollout?blueprint_id={uuid.uuid4()}", json={"deployment_ids": [str(uuid.uuid4())]})
+            assert resp.status_code == 400
+            assert_that(resp.json).contains('must be deployed first')
+        mock_save.assert_not_called()
+
+    def test_no_deployment(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_status', return_value=None)
+
+        resp = client.post(f"/rollout?blueprint_id={uuid.uuid4()}", json={"deployment_ids": [str(uuid.uuid4())]})
+        assert resp.status_code == 404
+
+    def test_get(self, client, mocker, patch_auth_wrapper):
+        rollout = generic_rollout()
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_rollout', return_value=rollout)
+
+        resp = client.get(f"/rollout/{rollout.rollout_id}")
+        assert resp.status_code == 200
+        assert_that(resp.json['deployments']).is_length(4)
+
+    def test_get_not_found(self, client, mocker, patch_db):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_rollout', return_value=None)
+
+        resp = client.get(f"/rollout/{uuid.uuid4()}")
+        assert resp.status_code == 404
+
+
+class StopWorker(BaseException):
+    pass
+
+
+class TestWorker:
+
+    @staticmethod
+    def run_worker(mocker, inv: ExtendedInvocation, csar: Path,
+                   states=(InvocationState.PENDING, InvocationState.IN_PROGRESS)) -> list:
+        """
+        Runs single invocation in worker with real workdirs and sandbox, opera and database are mocked.
+        States are states of invocation in database, when worker takes it and when it finished.
+        Returns saved states of invocation.
+        """
+        old_inv = Invocation(blueprint_id=inv.blueprint_id, deployment_id=inv.deployment_id, version_id='v1.0',
+                             state=InvocationState.SUCCESS)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_invocation_id', return_value='inv')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_invocation_state', side_effect=states)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_last_completed_invocation', return_value=old_inv)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_status', return_value=old_inv)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_ansible_facts', return_value={})
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_deployment_outputs')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.save_task_results')
+        mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_revision',
+                     side_effect=lambda blueprint_id, dst, version_id, owner=None: shutil.copytree(
+                         csar, dst, dirs_exist_ok=True))
+        mocker.patch('opera.api.controllers.background_invocation.CSAR_db.get_revisions',
+                     side_effect=lambda blueprint_id, version_ids, dsts, owner=None: [
+                         shutil.copytree(csar, dst, dirs_exist_ok=True) for dst in dsts])
+        mocker.patch('opera.api.controllers.background_invocation.InvocationService.get_dot_opera_from_db')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationService.save_dot_opera_to_db')
+        mocker.patch('opera.api.controllers.background_invocation.InvocationService.save_ansible_facts')
+        mocker.patch('opera.api.controllers.background_invocation.opera_diff_instances')
+        mocker.patch('opera.api.controllers.background_invocation.opera_update')
+        mocker.patch('opera.api.controllers.background_invocation.opera_outputs', return_value={'output': 'value'})
+        saved = []
+        mocker.patch('opera.api.controllers.background_invocation.InvocationService.save_invocation',
+                     side_effect=lambda invocation_id, saved_inv: saved.append(saved_inv.state))
+        # created on submission
+        InvocationService.stdstream_dir(inv.deployment_id).mkdir(parents=True, exist_ok=True)
+        work_queue = mocker.MagicMock(name='work_queue')
+        work_queue.get.side_effect = [inv, StopWorker()]
+
+        try:
+            InvocationWorkerProcess.run_internal(work_queue)
+        except StopWorker:
+            pass
+        return saved
+
+    def test_update(self, mocker, csar_unpacked: Path, generic_invocation: Invocation):
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id,
+                                 deployment_id=generic_invocation.deployment_id, version_id='v2.0',
+                                 operation=OperationType.UPDATE,
+                                 timestamp_submission=timestamp_util.datetime_now_to_string())
+
+        saved = self.run_worker(mocker, inv, csar_unpacked / 'CSAR-ok')
+        assert_that(inv.exception).is_none()
+        assert_that(saved).is_equal_to([InvocationState.IN_PROGRESS, InvocationState.SUCCESS])
+        assert_that(inv.outputs).is_equal_to({'output': 'value'})
+
+    def test_rollout_step(self, mocker, monkeypatch, tmp_path: Path, csar_unpacked: Path,
+                          generic_invocation: Invocation):
+        monkeypatch.setattr(Settings, 'ROLLOUT_DIR', str(tmp_path))
+        rollout = generic_rollout()
+        inv = ExtendedInvocation(blueprint_id=rollout.blueprint_id, deployment_id=rollout.deployments[0].deployment_id,
+                                 version_id='v2.0', operation=OperationType.UPDATE, rollout_id=rollout.rollout_id,
+                                 timestamp_submission=timestamp_util.datetime_now_to_string())
+        mock_advance = mocker.patch('opera.api.controllers.background_rollout.RolloutService.advance')
+
+        saved = self.run_worker(mocker, inv, csar_unpacked / 'CSAR-ok')
+        assert_that(saved).is_equal_to([InvocationState.IN_PROGRESS, InvocationState.SUCCESS])
+        assert_that(mock_advance.call_args.args[:3]).is_equal_to(
+            (rollout.rollout_id, inv.deployment_id, InvocationState.SUCCESS))
+
+    def test_interrupted(self, mocker, monkeypatch, tmp_path: Path, csar_unpacked: Path,
+                         generic_invocation: Invocation):
+        # reconciler took worker for dead, while it ran
+        monkeypatch.setattr(Settings, 'ROLLOUT_DIR', str(tmp_path))
+        rollout = generic_rollout()
+        inv = ExtendedInvocation(blueprint_id=rollout.blueprint_id, deployment_id=rollout.deployments[0].deployment_id,
+                                 version_id='v2.0', operation=OperationType.UPDATE, rollout_id=rollout.rollout_id,
+                                 timestamp_submission=timestamp_util.datetime_now_to_string())
+        mock_advance = mocker.patch('opera.api.controllers.background_rollout.RolloutService.advance')
+
+        saved = self.run_worker(mocker, inv, csar_unpacked / 'CSAR-ok',
+                                states=(InvocationState.PENDING, InvocationState.INTERRUPTED))
+        assert_that(saved).is_equal_to([InvocationState.IN_PROGRESS])
+        PostgreSQL.save_deployment_outputs.assert_not_called()
+        mock_advance.assert_not_called()
+
+    def test_interrupted_pending(self, mocker, csar_unpacked: Path, generic_invocation: Invocation):
+        # reconciler took instance, holding invocation in queue, for dead
+        inv = ExtendedInvocation(blueprint_id=generic_invocation.blueprint_id,
+                                 deployment_id=generic_invocation.deployment_id, version_id='v2.0',
+                                 operation=OperationType.UPDATE,
+                                 timestamp_submission=timestamp_util.datetime_now_to_string())
+
+        saved = self.run_worker(mocker, inv, csar_unpacked / 'CSAR-ok', states=(InvocationState.INTERRUPTED,))
+        assert_that(saved).is_empty()
+        assert_that(inv.timestamp_end).is_none()
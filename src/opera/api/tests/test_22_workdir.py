@@ -0,0 +1,144 @@
+import fcntl
+import os
+import time
+import uuid
+from pathlib import Path
+
+import pytest
+from assertpy import assert_that
+
+from opera.api.controllers.background_invocation import InvocationService
+from opera.api.gitCsarDB import GitCsarDB
+from opera.api.openapi.models import Invocation, Rollout, RolloutState
+from opera.api.service.workdir_service import WorkdirService
+from opera.api.settings import Settings
+
+
+@pytest.fixture()
+def workdirs(monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(Settings, 'API_WORKDIR', str(tmp_path))
+    for name in ('DEPLOYMENT_DIR', 'STDFILE_DIR', 'ROLLOUT_DIR', 'JOB_DIR'):
+        monkeypatch.setattr(Settings, name, str(tmp_path / name.lower()))
+    monkeypatch.setattr(Settings, 'git_config', {'workdir': str(tmp_path / 'git')})
+    monkeypatch.setattr(Settings, 'tmpfs_workdir', None)
+    return tmp_path
+
+
+def make_dir(path: Path, size: int = 1024, age: int = 0) -> Path:
+    path.mkdir(parents=True)
+    (path / 'file').write_bytes(b'0' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+class TestReclaim:
+
+    def test_reclaim(self, workdirs: Path):
+        location = make_dir(workdirs / 'deployment_dir' / 'blueprint' / 'deployment')
+        trash_queue = WorkdirService.start_trash()
+
+        WorkdirService.reclaim(location)
+        assert_that(str(location)).does_not_exist()
+        trash_queue.join()
+        assert_that(list(WorkdirService.trash_dir().iterdir())).is_empty()
+
+    def test_reclaim_worker(self, monkeypatch, workdirs: Path):
+        # worker, which has no trash thread, leaves workdir in trash for main process
+        monkeypatch.setattr(WorkdirService, '_trash_pid', None)
+        location = make_dir(workdirs / 'deployment_dir' / 'blueprint' / 'deployment')
+
+        WorkdirService.reclaim(location)
+        assert_that(str(location)).does_not_exist()
+        assert_that(list(WorkdirService.trash_dir().iterdir())).is_length(1)
+
+        WorkdirService.sweep_trash()
+        assert_that(list(WorkdirService.trash_dir().iterdir())).is_empty()
+
+    def test_reclaim_missing(self, workdirs: Path):
+        WorkdirService.reclaim(workdirs / 'missing')
+        assert_that(str(WorkdirService.trash_dir())).does_not_exist()
+
+    def test_reclaim_other_filesystem(self, mocker, workdirs: Path):
+        location = make_dir(workdirs / 'tmpfs' / 'deployment')
+        rename = os.rename
+        mocker.patch('os.rename', side_effect=lambda src, dst: rename(src, dst) if WorkdirService.trash_dir()
+                     not in Path(dst).parents else (_ for _ in ()).throw(OSError(18, 'Invalid cross-device link')))
+
+        trash_queue = WorkdirService.start_trash()
+
+        WorkdirService.reclaim(location)
+        assert_that(str(location)).does_not_exist()
+        trash_queue.join()
+        assert_that(list((workdirs / 'tmpfs').iterdir())).is_empty()
+
+
+class TestTmpfs:
+
+    def test_tmpfs(self, monkeypatch, workdirs: Path):
+        monkeypatch.setattr(Settings, 'tmpfs_workdir', str(workdirs / 'tmpfs'))
+        monkeypatch.setattr(Settings, 'tmpfs_min_free_mb', 0)
+
+        location = InvocationService.deployment_location('deployment', 'blueprint')
+        assert_that(str(location)).starts_with(str(workdirs / 'tmpfs'))
+
+    def test_fallback(self, monkeypatch, workdirs: Path):
+        monkeypatch.setattr(Settings, 'tmpfs_workdir', str(workdirs / 'tmpfs'))
+        monkeypatch.setattr(Settings, 'tmpfs_min_free_mb', 1 << 40)
+
+        location = InvocationService.deployment_location('deployment', 'blueprint')
+        assert_that(str(location)).starts_with(Settings.DEPLOYMENT_DIR)
+
+    def test_existing(self, monkeypatch, workdirs: Path):
+        monkeypatch.setattr(Settings, 'tmpfs_workdir', str(workdirs / 'tmpfs'))
+        monkeypatch.setattr(Settings, 'tmpfs_min_free_mb', 0)
+        existing = make_dir(Path(Settings.DEPLOYMENT_DIR) / 'blueprint' / 'deployment')
+
+        assert_that(InvocationService.deployment_location('deployment', 'blueprint')).is_equal_to(existing)
+
+
+class TestCollect:
+
+    def test_collect(self, mocker, workdirs: Path):
+        running = Invocation(deployment_id=str(uuid.uuid4()))
+        job_id = str(uuid.uuid4())
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_unfinished_deployment_ids',
+                     return_value={running.deployment_id})
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_unfinished_job_ids', return_value={job_id})
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_rollout',
+                     return_value=Rollout(state=RolloutState.IN_PROGRESS))
+        deployment_dir = Path(Settings.DEPLOYMENT_DIR) / 'blueprint'
+        in_use = make_dir(deployment_dir / running.deployment_id, age=7200)
+        in_use_old = make_dir(deployment_dir / f'{running.deployment_id}-old', age=7200)
+        leaked = make_dir(deployment_dir / str(uuid.uuid4()), age=7200)
+        young = make_dir(deployment_dir / str(uuid.uuid4()), age=600)
+        rollout = make_dir(Path(Settings.ROLLOUT_DIR) / str(uuid.uuid4()), age=7200)
+        job = make_dir(Path(Settings.JOB_DIR) / job_id, age=7200)
+        finished_job = make_dir(Path(Settings.JOB_DIR) / str(uuid.uuid4()), age=7200)
+        locked_job = make_dir(Path(Settings.JOB_DIR) / str(uuid.uuid4()), age=7200)
+        clone = make_dir(workdirs / 'git' / str(uuid.uuid4()), age=7200)
+        locked_clone = make_dir(workdirs / 'git' / str(uuid.uuid4()), age=7200)
+        trash = make_dir(WorkdirService.trash_dir() / str(uuid.uuid4()), age=120)
+
+        with open(locked_clone / GitCsarDB.CLONE_LOCK, 'w') as lock, WorkdirService.locked_job_dir(locked_job):
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for path in (locked_clone, locked_job):
+                os.utime(path, (time.time() - 7200, time.time() - 7200))
+            assert_that(WorkdirService.collect()).is_equal_to(4 * 1024)
+        for path in (in_use, in_use_old, young, rollout, job, locked_clone, locked_job):
+            assert_that(str(path)).exists()
+        for path in (leaked, finished_job, clone, trash):
+            assert_that(str(path)).does_not_exist()
+
+    def test_quota(self, mocker, monkeypatch, workdirs: Path):
+        monkeypatch.setattr(Settings, 'workdir_quota_mb', 1)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_unfinished_deployment_ids', return_value=set())
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_unfinished_job_ids', return_value=set())
+        older = make_dir(Path(Settings.STDFILE_DIR) / str(uuid.uuid4()), size=400 * 1024, age=900)
+        newer = make_dir(Path(Settings.STDFILE_DIR) / str(uuid.uuid4()), size=400 * 1024, age=600)
+        recent = make_dir(Path(Settings.STDFILE_DIR) / str(uuid.uuid4()), size=400 * 1024)
+
+        assert_that(WorkdirService.collect()).is_equal_to(400 * 1024)
+        assert_that(str(older)).does_not_exist()
+        assert_that(str(newer)).exists()
+        assert_that(str(recent)).exists()
@@ -0,0 +1,105 @@
+import gzip
+import json
+import uuid
+import zlib
+
+import pytest
+from assertpy import assert_that
+
+from opera.api.openapi import encoder
+from opera.api.openapi.models import BlueprintVersion, Deployment, ExecutionProfile, Invocation, InvocationState, \
+    OperationType
+from opera.api.settings import Settings
+from opera.api.util import file_util, serialization
+
+
+def large_history(generic_invocation: Invocation, size=50) -> list:
+    generic_invocation.stdout = 'ok: [localhost]\n' * 100
+    return [(str(i), generic_invocation) for i in range(size)]
+
+
+class TestSerialization:
+
+    def test_response_fields(self, generic_invocation: Invocation):
+        generic_invocation.profile = ExecutionProfile(forks=20)
+        blueprint = BlueprintVersion(blueprint_id=str(uuid.uuid4()), version_id='v1.0', timestamp='timestamp')
+        deployment = Deployment(deployment_id=str(uuid.uuid4()), state=InvocationState.SUCCESS,
+                                operation=OperationType.DEPLOY_FRESH, last_inputs={'a': 1})
+
+        for model in [generic_invocation, blueprint, deployment, [blueprint, deployment]]:
+            assert_that(json.loads(json.dumps(model, cls=serialization.JSONEncoder))).is_equal_to(
+                json.loads(json.dumps(model, cls=encoder.JSONEncoder)))
+
+    def test_log(self, generic_invocation: Invocation):
+        generic_invocation.deployment_id = uuid.uuid4()
+        generic_invocation.profile = ExecutionProfile(forks=20)
+
+        assert_that(json.loads(serialization.dumps(generic_invocation))).is_equal_to(
+            json.loads(json.dumps(generic_invocation.to_dict(), cls=file_util.UUIDEncoder)))
+
+    def test_compact_response(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history',
+                     return_value=[('a', generic_invocation)])
+
+        resp = client.get(f"/deployment/{generic_invocation.deployment_id}/history")
+        assert resp.status_code == 200
+        assert_that(resp.data.decode()).does_not_contain('\n  ', '": ')
+
+
+class TestCompression:
+
+    def test_gzip(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history',
+                     return_value=large_history(generic_invocation))
+
+        resp = client.get(f"/deployment/{generic_invocation.deployment_id}/history",
+                          headers={'Accept-Encoding': 'gzip'})
+        assert resp.status_code == 200
+        assert_that(resp.headers['Content-Encoding']).is_equal_to('gzip')
+        assert_that(resp.headers['Vary']).contains('Accept-Encoding')
+        assert_that(json.loads(gzip.decompress(resp.data))).is_length(50)
+
+    def test_brotli(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        brotli = pytest.importorskip('brotli')
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history',
+                     return_value=large_history(generic_invocation))
+
+        resp = client.get(f"/deployment/{generic_invocation.deployment_id}/history",
+                          headers={'Accept-Encoding': 'gzip, deflate, br'})
+        assert_that(resp.headers['Content-Encoding']).is_equal_to('br')
+        assert_that(json.loads(brotli.decompress(resp.data))).is_length(50)
+
+    def test_not_accepted(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history',
+                     return_value=large_history(generic_invocation))
+
+        resp = client.get(f"/deployment/{generic_invocation.deployment_id}/history")
+        assert_that(resp.headers).does_not_contain_key('Content-Encoding')
+        assert_that(resp.json).is_length(50)
+
+    def test_below_threshold(self, client, mocker, generic_invocation: Invocation, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history',
+                     return_value=[('a', generic_invocation)])
+
+        resp = client.get(f"/deployment/{generic_invocation.deployment_id}/history",
+                          headers={'Accept-Encoding': 'gzip'})
+        assert_that(len(resp.data)).is_less_than(Settings.compression_min_size)
+        assert_that(resp.headers).does_not_contain_key('Content-Encoding')
+
+    def test_disabled(self, client, mocker, monkeypatch, generic_invocation: Invocation, patch_auth_wrapper):
+        monkeypatch.setattr(Settings, 'response_compression', False)
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_deployment_history',
+                     return_value=large_history(generic_invocation))
+
+        resp = client.get(f"/deployment/{generic_invocation.deployment_id}/history",
+                          headers={'Accept-Encoding': 'gzip'})
+        assert_that(resp.headers).does_not_contain_key('Content-Encoding')
+
+    def test_streamed(self, client, mocker, patch_auth_wrapper):
+        mocker.patch('opera.api.service.sqldb_service.PostgreSQL.get_invocation_log',
+                     return_value=zlib.compress(b'ok: [localhost]\n' * 1000))
+
+        resp = client.get(f"/deployment/{uuid.uuid4()}/log", headers={'Accept-Encoding': 'gzip'})
+        assert resp.status_code == 200
+        assert_that(resp.headers).does_not_contain_key('Content-Encoding')
+        assert_that(resp.data).is_equal_to(b'ok: [localhost]\n' * 1000)
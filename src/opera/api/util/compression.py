@@ -0,0 +1,54 @@
+import gzip
+
+from flask import Response, request
+
+from opera.api.log import get_logger
+from opera.api.settings import Settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = get_logger(__name__)
+
+# JSON of invocations and logs compresses well already on fast levels, higher ones cost more than they save
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/problem+json', 'application/x-yaml', 'text/')
+
+
+def encodings() -> list:
+    """
+    Supported encodings, preferred first
+    """
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+
+def compress_response(response: Response) -> Response:
+    """
+    Compresses response body with encoding, accepted by client, if it is larger than compression_min_size.
+    Streamed responses (full logs, files) are passed as they are.
+    """
+    if not Settings.response_compression or response.direct_passthrough or response.is_streamed \
+            or not 200 <= response.status_code < 300 or response.status_code == 204 \
+            or 'Content-Encoding' in response.headers \
+            or not response.mimetype.startswith(COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < Settings.compression_min_size:
+        return response
+    encoding = request.accept_encodings.best_match(encodings())
+    if not encoding:
+        return response
+
+    data = response.get_data()
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    logger.debug(f"Compressed response from {len(data)} to {response.content_length} bytes with {encoding}")
+    return response
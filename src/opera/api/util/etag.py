@@ -0,0 +1,34 @@
+import hashlib
+import json
+from typing import Optional
+
+import connexion
+from flask import Response
+from werkzeug.http import quote_etag
+
+
+def make(*parts) -> str:
+    """
+    Returns ETag of resource, identified by parts (version of resource and parameters of request)
+    """
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+def matches(tag: Optional[str]) -> bool:
+    """
+    Returns True, if client's If-None-Match header contains tag
+    """
+    return tag is not None and connexion.request.if_none_match.contains_weak(tag)
+
+
+def headers(tag: Optional[str]) -> dict:
+    """
+    Returns ETag header, tag is weak, since representation depends on Content-Encoding
+    """
+    if tag is None:
+        return {}
+    return {'ETag': quote_etag(tag, weak=True)}
+
+
+def not_modified(tag: str) -> Response:
+    return Response(status=304, headers=headers(tag))
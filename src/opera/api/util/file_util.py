@@ -1,6 +1,9 @@
 import json
+import os
 import pathlib
 import shutil
+import zlib
+from typing import Iterable, Iterator, Optional, Tuple
 from uuid import UUID
 
 
@@ -12,16 +15,111 @@ def dir_to_json(dir_path: pathlib.Path) -> dict:
     return tree
 
 
-def json_to_dir(tree: dict, dir_path: pathlib.Path) -> None:
+def json_to_dir(tree: dict, dir_path: pathlib.Path, owner: Optional[Tuple[int, int]] = None) -> None:
     """
-    Convert json to file tree
+    Convert json to file tree, owned by owner (uid, gid) if given
     """
     shutil.rmtree(dir_path, ignore_errors=True)
 
     for subpath, text in tree.items():
         file_path = (dir_path / subpath)
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        file_path.write_text(text)
+        if owner:
+            make_dirs(file_path.parent, owner)
+            write_owned(file_path, text.encode(), owner)
+        else:
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_text(text)
+
+
+def make_dirs(dir_path: pathlib.Path, owner: Tuple[int, int]) -> None:
+    """
+    Creates directory and its missing parents, owned by owner (uid, gid) with mode 0o700
+    """
+    if dir_path.is_dir():
+        return
+    make_dirs(dir_path.parent, owner)
+    dir_path.mkdir(mode=0o700, exist_ok=True)
+    os.chown(dir_path, *owner)
+
+
+def write_owned(file_path: pathlib.Path, data: bytes, owner: Tuple[int, int]) -> None:
+    """
+    Writes file, owned by owner (uid, gid) with mode 0o700 from the moment it is created
+    """
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o700)
+    with os.fdopen(fd, 'wb') as f:
+        os.fchown(fd, *owner)
+        os.fchmod(fd, 0o700)
+        f.write(data)
+
+
+def copy_tree(src: pathlib.Path, dst: pathlib.Path, owner: Tuple[int, int], ignore: Iterable[str] = ()) -> None:
+    """
+    Copies directory tree, creating every directory and file owned by owner (uid, gid) with mode 0o700, so copy does
+    not have to be walked again to change ownership. Entries with names in ignore are skipped.
+    """
+    dst.mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.chown(dst, *owner)
+    os.chmod(dst, 0o700)
+    with os.scandir(src) as entries:
+        for entry in entries:
+            if entry.name in ignore:
+                continue
+            target = dst / entry.name
+            if entry.is_dir():
+                copy_tree(pathlib.Path(entry.path), target, owner, ignore)
+            else:
+                fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o700)
+                with open(entry.path, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdst:
+                    os.fchown(fd, *owner)
+                    os.fchmod(fd, 0o700)
+                    shutil.copyfileobj(fsrc, fdst)
+
+
+def read_head_tail(path: pathlib.Path, head: int, tail: int) -> Tuple[str, bool]:
+    """
+    Reads first head and last tail bytes of text file, with note on omitted part in between, so memory is bounded
+    regardless of file size. If head and tail are 0, entire file is read. Returns text and if it was truncated
+    """
+    size = path.stat().st_size
+    if (not head and not tail) or size <= head + tail:
+        return path.read_text(errors='replace'), False
+
+    with path.open('rb') as f:
+        head_bytes = f.read(head)
+        f.seek(size - tail)
+        tail_bytes = f.read(tail)
+    omitted = size - head - tail
+    text = "{}\n\n[... {} bytes omitted ...]\n\n{}".format(head_bytes.decode(errors='replace'), omitted,
+                                                           tail_bytes.decode(errors='replace'))
+    return text, True
+
+
+def compress_file(path: pathlib.Path, chunk_size: int = 1 << 20) -> bytes:
+    """
+    Compresses file with zlib, reading it in chunks
+    """
+    compressor = zlib.compressobj()
+    compressed = []
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            compressed.append(compressor.compress(chunk))
+    compressed.append(compressor.flush())
+    return b''.join(compressed)
+
+
+def decompress_chunks(data: bytes, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """
+    Decompresses zlib data in chunks of at most chunk_size bytes
+    """
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(data, chunk_size)
+    while data:
+        yield data
+        data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+    remainder = decompressor.flush()
+    if remainder:
+        yield remainder
 
 
 class UUIDEncoder(json.JSONEncoder):
@@ -30,3 +128,17 @@ class UUIDEncoder(json.JSONEncoder):
             # if the obj is uuid, we simply return the value of uuid
             return str(obj)
         return json.JSONEncoder.default(self, obj)
+
+
+def dir_size(path: pathlib.Path) -> int:
+    """
+    Returns size of files in directory tree in bytes, ignoring files, deleted while walking it
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
@@ -0,0 +1,103 @@
+import functools
+import os
+from pathlib import Path
+
+from opera.api.settings import Settings
+
+# prometheus_client decides between single and multiprocess mode on import, so the directory, shared by all
+# processes of workers pools, must be known before. Path is absolute, since workers change their cwd.
+METRICS_DIR = Path(os.getenv("PROMETHEUS_MULTIPROC_DIR",
+                             f"{os.getenv('XOPERA_API_WORKDIR', Settings.API_WORKDIR)}/metrics")).absolute()
+os.environ["PROMETHEUS_MULTIPROC_DIR"] = str(METRICS_DIR)
+METRICS_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# remove leftovers of processes from previous runs
+for _metrics_file in METRICS_DIR.glob("*.db"):
+    _pid = _metrics_file.stem.rsplit("_", 1)[-1]
+    if _pid.isdigit() and not _pid_alive(int(_pid)):
+        _metrics_file.unlink(missing_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess  # noqa: E402
+from prometheus_client import CONTENT_TYPE_LATEST  # noqa: E402,F401
+
+# invocations last from seconds to hours
+INVOCATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, float("inf"))
+
+INVOCATION_QUEUE_WAIT = Histogram('xopera_invocation_queue_wait_seconds',
+                                  'Time between submission and start of invocation',
+                                  ['operation'], buckets=INVOCATION_BUCKETS)
+INVOCATION_DURATION = Histogram('xopera_invocation_duration_seconds',
+                                'Execution time of invocation',
+                                ['operation', 'state'], buckets=INVOCATION_BUCKETS)
+INVOCATIONS_INTERRUPTED = Counter('xopera_invocations_interrupted',
+                                  'Invocations, left behind by dead workers and marked interrupted',
+                                  ['operation'])
+INVOCATION_QUEUE_DEPTH = Gauge('xopera_invocation_queue_depth', 'Number of pending and running invocations',
+                               ['state'], multiprocess_mode='livemax')
+INVOCATIONS_REJECTED = Counter('xopera_invocations_rejected', 'Invocations, rejected by admission control',
+                               ['limit'])
+WORKERS = Gauge('xopera_workers', 'Number of workers in pool', ['pool'], multiprocess_mode='liveall')
+WORKERS_BUSY = Gauge('xopera_workers_busy', 'Number of workers in pool, running a task', ['pool'],
+                     multiprocess_mode='livesum')
+
+GIT_DURATION = Histogram('xopera_git_operation_duration_seconds',
+                         'Duration of git operation against git backend',
+                         ['connector', 'operation'])
+SQL_DURATION = Histogram('xopera_sql_query_duration_seconds',
+                         'Duration of PostgreSQL query',
+                         ['method'], buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, float("inf")))
+VAULT_DURATION = Histogram('xopera_vault_request_duration_seconds',
+                           'Duration of request to Vault',
+                           ['operation'])
+OIDC_DURATION = Histogram('xopera_oidc_introspection_duration_seconds',
+                          'Duration of OAuth 2.0 token introspection request')
+
+
+def observe_sql(func):
+    """
+    Observes duration of PostgreSQL method, labeled with method name
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with SQL_DURATION.labels(func.__name__).time():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def mark_process_dead(pid: int):
+    """
+    Removes live gauge files of exited process (forked child or worker), so its values are not reported any more
+    """
+    multiprocess.mark_process_dead(pid, str(METRICS_DIR))
+
+
+def mark_dead_processes():
+    """
+    Marks dead all processes with live gauge files, which are gone, e.g. workers, replaced by pool
+    """
+    for metrics_file in METRICS_DIR.glob("gauge_live*.db"):
+        pid = metrics_file.stem.rsplit("_", 1)[-1]
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            mark_process_dead(int(pid))
+
+
+def collect() -> bytes:
+    """
+    Collects metrics of all processes
+    """
+    mark_dead_processes()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
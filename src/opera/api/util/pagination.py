@@ -0,0 +1,57 @@
+import base64
+import binascii
+import json
+from typing import Callable, List, Optional, Type
+
+from opera.api.openapi.models.base_model_ import Model
+
+
+def encode_cursor(*keys) -> str:
+    """
+    Encodes keyset of last item of page into opaque cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(keys, default=str).encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[list]:
+    """
+    Decodes cursor to keyset, raises ValueError if cursor is invalid
+    """
+    if not cursor:
+        return None
+    try:
+        keys = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.decoder.JSONDecodeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if not isinstance(keys, list) or not keys:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return keys
+
+
+def check_fields(model: Type[Model], fields: Optional[List[str]]):
+    """
+    Raises ValueError, if any of fields is not field of model
+    """
+    attributes = model().attribute_map.values()
+    unknown = [field for field in fields or [] if field not in attributes]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+
+def select_fields(items: list, fields: Optional[List[str]]) -> list:
+    """
+    Returns items with selected fields only, or items as they are, if fields is empty
+    """
+    if not fields:
+        return items
+    return [{item.attribute_map[attr]: getattr(item, attr) for attr in item.openapi_types
+             if item.attribute_map[attr] in fields and getattr(item, attr) is not None} for item in items]
+
+
+def next_cursor_headers(items: list, limit: Optional[int], keyset: Callable) -> dict:
+    """
+    Returns X-Next-Cursor header with keyset of last item, if page is full
+    """
+    if not limit or len(items) < limit:
+        return {}
+    return {'X-Next-Cursor': encode_cursor(*keyset(items[-1]))}
@@ -0,0 +1,74 @@
+import json
+
+import flask
+from connexion.apis.flask_api import FlaskApi
+from connexion.jsonifier import Jsonifier
+
+from opera.api.openapi import encoder
+from opera.api.openapi.models import BlueprintVersion, Deployment, Invocation
+from opera.api.openapi.models.base_model_ import Model
+from opera.api.util import file_util
+
+# models, large or numerous in responses and logs, are serialized from their private attributes, without property
+# access and reflection per attribute
+FAST_MODELS = (Invocation, BlueprintVersion, Deployment)
+
+_fields = {}
+
+
+def fields(model: Model) -> list:
+    """
+    Returns (private attribute, JSON key) of model's fields, cached per model class
+    """
+    model_fields = _fields.get(type(model))
+    if model_fields is None:
+        model_fields = [(f'_{attr}', model.attribute_map[attr]) for attr in model.openapi_types]
+        _fields[type(model)] = model_fields
+    return model_fields
+
+
+def to_json_dict(model: Model, include_nulls: bool = False) -> dict:
+    """
+    Returns fields of model by JSON key, nested models are left to encoder
+    """
+    values = vars(model)
+    if include_nulls:
+        return {key: values[private] for private, key in fields(model)}
+    return {key: values[private] for private, key in fields(model) if values[private] is not None}
+
+
+class JSONEncoder(encoder.JSONEncoder):
+    """
+    Encoder of API responses with fast path for FAST_MODELS
+    """
+
+    def default(self, o):
+        if isinstance(o, FAST_MODELS):
+            return to_json_dict(o, self.include_nulls)
+        return super().default(o)
+
+
+class LogEncoder(file_util.UUIDEncoder):
+    """
+    Encoder of models, stored as JSON in PostgreSQL, with the same fields as Model.to_dict
+    """
+
+    def default(self, o):
+        if isinstance(o, FAST_MODELS):
+            return to_json_dict(o, include_nulls=True)
+        if isinstance(o, Model):
+            return o.to_dict()
+        return super().default(o)
+
+
+def dumps(model: Model) -> str:
+    return json.dumps(model, cls=LogEncoder)
+
+
+def configure(app: flask.Flask):
+    """
+    Sets JSON encoder of app and compact JSON responses of connexion, which are serialized with C encoder of json
+    module, while indented ones fall back to pure Python encoder
+    """
+    app.json_encoder = JSONEncoder
+    FlaskApi.jsonifier = Jsonifier(flask.json, separators=(',', ':'))
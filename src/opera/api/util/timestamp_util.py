@@ -1,4 +1,7 @@
 import datetime
+import time
+from contextlib import contextmanager
+from typing import Optional
 
 
 def datetime_now_to_string():
@@ -11,3 +14,20 @@ def datetime_to_str(timestamp: datetime.datetime):
 
 def str_to_datetime(time_str: str):
     return datetime.datetime.fromisoformat(time_str)
+
+
+def seconds_between(start: str, end: str):
+    return (str_to_datetime(end) - str_to_datetime(start)).total_seconds()
+
+
+@contextmanager
+def timing(timings: Optional[dict], phase: str):
+    """
+    Adds seconds spent in block to timings[phase], if timings is not None
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[phase] = round(timings.get(phase, 0) + time.perf_counter() - start, 3)
@@ -5,6 +5,7 @@ from requests.exceptions import ConnectionError
 
 from opera.api.log import get_logger
 from opera.api.settings import Settings
+from opera.api.util import metrics
 
 adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=100)
 session = requests.Session()
@@ -21,7 +22,8 @@ def get_vault_token(vault_role, access_token):
         )
     request = {'jwt': access_token, 'role': vault_role}
     secret_vault_login_uri = Settings.vault_login_uri
-    token_request = session.post(secret_vault_login_uri, data=request)
+    with metrics.VAULT_DURATION.labels('login').time():
+        token_request = session.post(secret_vault_login_uri, data=request)
     if not token_request.ok:
         raise ConnectionError(
             "Vault auth error. {}".format(token_request.text)
@@ -34,9 +36,10 @@ def get_secret(secret_path, vault_role, access_token) -> dict:
     vault_token = get_vault_token(vault_role, access_token)
     headers = {'X-Vault-Token': vault_token}
     secret_vault_uri = Settings.vault_secret_storage_uri
-    secret_request = session.get(
-        urllib.parse.urljoin(secret_vault_uri, secret_path), headers=headers
-    )
+    with metrics.VAULT_DURATION.labels('get_secret').time():
+        secret_request = session.get(
+            urllib.parse.urljoin(secret_vault_uri, secret_path), headers=headers
+        )
     if not secret_request.ok:
         raise ConnectionError(
             "Vault secret retrieval error. {}".format(secret_request.text)
@@ -49,9 +52,10 @@ def list_secrets(secret_path, vault_role, access_token) -> list:
     vault_token = get_vault_token(vault_role, access_token)
     headers = {'X-Vault-Token': vault_token}
     secret_vault_uri = Settings.vault_secret_storage_uri
-    secret_request = session.get(
-        urllib.parse.urljoin(secret_vault_uri, secret_path + "?list=true"), headers=headers
-    )
+    with metrics.VAULT_DURATION.labels('list_secrets').time():
+        secret_request = session.get(
+            urllib.parse.urljoin(secret_vault_uri, secret_path + "?list=true"), headers=headers
+        )
     if not secret_request.ok:
         raise ConnectionError(
             "Vault secret retrieval error. {}".format(secret_request.text)
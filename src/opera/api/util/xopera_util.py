@@ -1,4 +1,6 @@
+import base64
 import grp
+import hashlib
 import os
 import pwd
 import re
@@ -6,8 +8,10 @@ import shutil
 import subprocess
 import atexit
 import tempfile
+import time
 from contextlib import contextmanager
 from pathlib import Path
+from typing import Optional
 from cryptography.hazmat.primitives import serialization
 
 import connexion
@@ -16,7 +20,9 @@ import regex
 import json
 
 from opera.api.log import get_logger
+from opera.api.openapi.models.base_model_ import Model
 from opera.api.settings import Settings
+from opera.api.util import file_util
 from opera.api.util.vault_client import get_secret, list_secrets
 
 logger = get_logger(__name__)
@@ -100,9 +106,11 @@ def init_dir(dir_path: str, clean=False):
 
 
 def init_data():
-    init_dir(Settings.STDFILE_DIR, clean=True)
+    # workdirs of interrupted invocations are kept for reconciler, workdir collector removes them afterwards
+    init_dir(Settings.STDFILE_DIR)
     init_dir(Settings.INVOCATION_DIR)
-    init_dir(Settings.DEPLOYMENT_DIR, clean=True)
+    init_dir(Settings.DEPLOYMENT_DIR)
+    init_dir(Settings.JOB_DIR, clean=True)
 
 
 def get_preprocessed_inputs():
@@ -148,6 +156,10 @@ def preprocess_inputs(inputs, access_token):
     return refined_inputs
 
 
+def get_idempotency_key():
+    return connexion.request.headers.get("Idempotency-Key") or None
+
+
 def get_access_token():
     authorization = connexion.request.headers.get("Authorization")
     if not authorization:
@@ -161,6 +173,28 @@ def get_access_token():
     return token
 
 
+def token_expired(access_token: str) -> bool:
+    """
+    Checks exp claim of JWT access token. Signature is not verified, token was verified, when request was
+    authorized. Token, which is not JWT, is never taken for expired.
+    """
+    try:
+        payload = access_token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp']) <= time.time()
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return False
+
+
+def model_to_dict(model):
+    """
+    Converts model to dict without unset attributes, other values are returned as they are
+    """
+    if isinstance(model, Model):
+        return {key: value for key, value in model.to_dict().items() if value is not None}
+    return model
+
+
 def mask_workdir(location: Path, stacktrace: str, placeholder="$BLUEPRINT_DIR"):
     """
     replaces real workdir with placeholder
@@ -204,25 +238,273 @@ def kill_agent():
         pass
 
 
-def add_key(key: str):
-    process = subprocess.run(['/usr/bin/ssh-add', '-'], input=key, text=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+def add_key(key: str, agent_socket: str = None):
+    env = dict(os.environ, SSH_AUTH_SOCK=agent_socket) if agent_socket else None
+    process = subprocess.run(['/usr/bin/ssh-add', '-'], input=key, text=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             env=env)
     if process.returncode != 0:
         logger.error( "Failed to add SSH key.")
 
 
-def setup_user(locations: list, username: str, access_token: str):
+# long-lived ssh-agents of system users, kept by worker: username -> {process, dir, socket, fingerprint, expires}
+_agents = {}
+
+
+def acquire_user_agent(username: str, keys: list) -> Optional[str]:
+    """
+    Returns socket of ssh-agent of system user with keys loaded. Running agent is reused, keys are reloaded only if
+    they changed since they were loaded. Returns None, if user has no keys.
+    """
+    kill_expired_agents()
+    if not keys:
+        kill_user_agent(username)
+        return None
+
+    agent = _agents.get(username)
+    if agent and agent['process'].poll() is not None:
+        kill_user_agent(username)
+        agent = None
+    if agent is None:
+        agent = _start_user_agent(username)
+        _agents[username] = agent
+
+    fingerprint = hashlib.sha256("\n".join(sorted(keys)).encode()).hexdigest()
+    if agent['fingerprint'] != fingerprint:
+        subprocess.run(['/usr/bin/ssh-add', '-D'], env=dict(os.environ, SSH_AUTH_SOCK=agent['socket']),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for key in keys:
+            add_key(key, agent['socket'])
+        agent['fingerprint'] = fingerprint
+    agent['expires'] = None
+    return agent['socket']
+
+
+def release_user_agent(username: str):
+    """
+    Marks agent of user idle, it is stopped after Settings.ssh_agent_ttl seconds without use
+    """
+    agent = _agents.get(username)
+    if not agent:
+        return
+    if Settings.ssh_agent_ttl <= 0:
+        kill_user_agent(username)
+    else:
+        agent['expires'] = time.monotonic() + Settings.ssh_agent_ttl
+
+
+def kill_expired_agents():
+    now = time.monotonic()
+    for username in [name for name, agent in _agents.items() if agent['expires'] and agent['expires'] <= now]:
+        kill_user_agent(username)
+
+
+def kill_user_agent(username: str):
+    agent = _agents.pop(username, None)
+    if not agent:
+        return
+    logger.debug(f"Stopping ssh-agent of user {username}")
+    agent['process'].terminate()
+    try:
+        agent['process'].wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        agent['process'].kill()
+    shutil.rmtree(agent['dir'], ignore_errors=True)
+
+
+def kill_user_agents():
+    for username in list(_agents):
+        kill_user_agent(username)
+
+
+atexit.register(kill_user_agents)
+
+
+def _start_user_agent(username: str) -> dict:
+    """
+    Starts ssh-agent as system user, so user's processes can use it, with socket in private directory
+    """
+    user = get_system_user(username)
+    agents_dir = Path(Settings.API_WORKDIR).absolute() / "agents"
+    agents_dir.mkdir(parents=True, exist_ok=True)
+    agent_dir = Path(tempfile.mkdtemp(prefix=f"{username}-", dir=agents_dir))
+    os.chown(agent_dir, user.pw_uid, user.pw_gid)
+    socket = agent_dir / "agent.sock"
+
+    logger.debug(f"Starting ssh-agent of user {username}")
+    process = subprocess.Popen(["/usr/bin/ssh-agent", "-D", "-a", str(socket)], user=user.pw_uid,
+                               group=user.pw_gid, extra_groups=[], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 5
+    while not socket.exists():
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            shutil.rmtree(agent_dir, ignore_errors=True)
+            raise RuntimeError(f"Could not start ssh-agent of user {username}")
+        time.sleep(0.01)
+    (agent_dir / "agent.pid").write_text(str(process.pid))
+    return {'process': process, 'dir': agent_dir, 'socket': str(socket), 'fingerprint': None, 'expires': None}
+
+
+def ssh_control_dir(deployment_id: str, username: Optional[str]) -> Path:
+    """
+    Directory of SSH control sockets of deployment and user. Names are hashed, since path of socket is limited to
+    about 100 characters.
+    """
+    deployment_dir = hashlib.sha1(str(deployment_id).encode()).hexdigest()[:12]
+    user_dir = hashlib.sha1(str(username).encode()).hexdigest()[:8]
+    return Path(Settings.ssh_control_dir).absolute() / deployment_dir / user_dir
+
+
+def prepare_ssh_control_dir(deployment_id: str, username: Optional[str], owner: Optional[tuple]) -> Path:
+    control_dir = ssh_control_dir(deployment_id, username)
+    control_dir.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    control_dir.mkdir(mode=0o700, exist_ok=True)
+    if owner:
+        os.chown(control_dir, *owner)
+    return control_dir
+
+
+def ansible_ssh_env(control_dir: Optional[Path]) -> dict:
+    """
+    Environment, which makes Ansible reuse SSH master connections with sockets in control_dir across invocations
+    """
+    env = {"ANSIBLE_PIPELINING": str(Settings.ansible_pipelining)}
+    if control_dir and Settings.ssh_control_persist > 0:
+        env.update({
+            "ANSIBLE_SSH_ARGS": f"-C -o ControlMaster=auto -o ControlPersist={Settings.ssh_control_persist}s",
+            "ANSIBLE_SSH_CONTROL_PATH_DIR": str(control_dir),
+            "ANSIBLE_SSH_CONTROL_PATH": "%(directory)s/%%C"
+        })
+    return env
+
+
+PROFILE_ANSIBLE_ENV = {
+    "forks": "ANSIBLE_FORKS",
+    "strategy": "ANSIBLE_STRATEGY",
+    "pipelining": "ANSIBLE_PIPELINING",
+    "timeout": "ANSIBLE_TIMEOUT",
+    "task_timeout": "ANSIBLE_TASK_TIMEOUT"
+}
+
+
+def ansible_profile_env(profile) -> dict:
+    """
+    Environment, which applies Ansible settings of execution profile
+    """
+    if not profile:
+        return {}
+    return {var: str(getattr(profile, key)) for key, var in PROFILE_ANSIBLE_ENV.items()
+            if getattr(profile, key) is not None}
+
+
+def close_ssh_masters(deployment_id: str):
+    """
+    Stops SSH master connections of deployment (of all users) and removes their sockets
+    """
+    deployment_dir = ssh_control_dir(deployment_id, None).parent
+    if not deployment_dir.exists():
+        return
+    for control_socket in deployment_dir.glob("*/*"):
+        if control_socket.is_socket():
+            subprocess.run(["/usr/bin/ssh", "-o", f"ControlPath={control_socket}", "-O", "exit", "xopera"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+    shutil.rmtree(deployment_dir, ignore_errors=True)
+
+
+def cleanup_ssh_control_dirs():
+    """
+    Removes control dirs, left without sockets after master connections exited on idle timeout
+    """
+    control_dir = Path(Settings.ssh_control_dir).absolute()
+    if not control_dir.exists():
+        return
+    expired = time.time() - Settings.ssh_control_persist
+    for user_dir in control_dir.glob("*/*"):
+        try:
+            if user_dir.stat().st_mtime < expired:
+                user_dir.rmdir()
+                user_dir.parent.rmdir()
+        except OSError:
+            # not empty
+            pass
+
+
+def process_alive(pid: int) -> bool:
+    """
+    Checks if process with pid runs on this host
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def cleanup_stale_agents():
+    """
+    Stops ssh-agents, left behind by workers of previous run, and removes their sockets
+    """
+    agents_dir = Path(Settings.API_WORKDIR).absolute() / "agents"
+    if not agents_dir.exists():
+        return
+    for agent_dir in agents_dir.iterdir():
+        pid_file = agent_dir / "agent.pid"
+        try:
+            pid = int(pid_file.read_text())
+            cmdline = Path(f"/proc/{pid}/cmdline").read_bytes()
+            if str(agent_dir).encode() in cmdline:
+                os.kill(pid, 15)
+        except (OSError, ValueError):
+            pass
+        shutil.rmtree(agent_dir, ignore_errors=True)
+
+
+# system users, provisioned (with home and SSH config) by this process
+_system_users = {}
+
+
+def get_system_user(username: str):
+    """
+    Returns system user, creating it with home and SSH config on first use. Users are remembered, so following
+    invocations of user do not look them up or provision them again.
+    """
     if not validate_username(username):
         raise ValueError("Username {} contains illegal characters".format(username))
 
-    try:
-        user = pwd.getpwnam(username)
-    except KeyError:
-        user = create_user(username)
+    user = _system_users.get(username)
+    if user is None:
+        try:
+            user = pwd.getpwnam(username)
+        except KeyError:
+            user = create_user(username)
+        _system_users[username] = user
+    return user
+
+
+def get_owner(username: str) -> tuple:
+    """
+    Returns (uid, gid) of system user
+    """
+    user = get_system_user(username)
+    return user.pw_uid, user.pw_gid
+
+
+def setup_user(locations: list, username: str, keys: list = None, owned: bool = False):
+    """
+    Switches process to system user. If locations are not owned by user yet (owned=False), their ownership is changed.
+    """
+    user = get_system_user(username)
 
     tmp = (locations[0] / "tmp")
     os.mkdir(tmp)
-    for location in locations:
-        setup_user_dir(location, user.pw_uid, user.pw_gid)
+    if owned:
+        os.chown(tmp, user.pw_uid, user.pw_gid)
+        os.chmod(tmp, 0o700)
+    else:
+        for location in locations:
+            setup_user_dir(location, user.pw_uid, user.pw_gid)
 
     tempfile.tempdir = str(tmp)
 
@@ -235,9 +517,9 @@ def setup_user(locations: list, username: str, access_token: str):
     os.setgid(user.pw_gid)
     os.setuid(user.pw_uid)
 
-    if access_token:
+    if keys:
         try:
-            setup_user_keys(username, access_token)
+            add_user_keys(keys)
 
         except Exception as e:
             logger.warning("An error occurred adding SSH key: " + str(e))
@@ -263,17 +545,31 @@ def cleanup_user():
 
 
 def setup_user_keys(username: str, access_token: str):
+    add_user_keys(get_user_keys(username, access_token))
+
+
+def get_user_keys(username: str, access_token: str) -> list:
+    """
+    Returns valid SSH keys of user from Vault
+    """
+    keys = []
     secrets = list_secrets(Settings.ssh_key_path_template.format(username=username), username, access_token)
-    if secrets:
+    for secret in secrets or []:
+        ssh_key = get_secret(Settings.ssh_key_path_template.format(username=username) + f"/{secret}", username, access_token)
+        key = ssh_key.get(Settings.ssh_key_secret_name)
+        if key:
+            if vaildate_key(key):
+                keys.append(key)
+            else:
+                logger.warning("Provided key value is not a valid SSH key.")
+    return keys
+
+
+def add_user_keys(keys: list):
+    if keys:
         setup_agent()
-        for secret in secrets:
-            ssh_key = get_secret(Settings.ssh_key_path_template.format(username=username) + f"/{secret}", username, access_token)
-            key = ssh_key.get(Settings.ssh_key_secret_name)
-            if key:
-                if vaildate_key(key):
-                    add_key(key)
-                else:
-                    logger.warning("Provided key value is not a valid SSH key.")
+        for key in keys:
+            add_key(key)
 
 
 
@@ -311,6 +607,110 @@ def validate_username(username: str):
     return False
 
 
+TASK_RESULTS_CALLBACK = 'xopera_task_results'
+TASK_RESULTS_PLUGINS_DIR = Path(__file__).parent.parent / 'ansible_plugins' / 'callback'
+
+
+def enable_task_results(results_file: Path):
+    """
+    Enables callback plugin, which makes ansible-playbook, run by opera, append task results to results_file
+    """
+    plugin_dirs = [x for x in os.getenv("ANSIBLE_CALLBACK_PLUGINS", "").split(os.pathsep) if x]
+    if str(TASK_RESULTS_PLUGINS_DIR) not in plugin_dirs:
+        os.environ["ANSIBLE_CALLBACK_PLUGINS"] = os.pathsep.join(plugin_dirs + [str(TASK_RESULTS_PLUGINS_DIR)])
+    callbacks = [x for x in os.getenv("ANSIBLE_CALLBACKS_ENABLED", "").split(",") if x]
+    if TASK_RESULTS_CALLBACK not in callbacks:
+        os.environ["ANSIBLE_CALLBACKS_ENABLED"] = ",".join(callbacks + [TASK_RESULTS_CALLBACK])
+    os.environ["XOPERA_TASK_RESULTS_FILE"] = str(results_file)
+
+
+def enable_fact_cache(facts_dir: Path):
+    """
+    Makes ansible-playbook, run by opera, keep facts of hosts in facts_dir and gather them only if they are not cached
+    """
+    if Settings.fact_cache_ttl > 0:
+        os.environ["ANSIBLE_GATHERING"] = "smart"
+        os.environ["ANSIBLE_CACHE_PLUGIN"] = "jsonfile"
+        os.environ["ANSIBLE_CACHE_PLUGIN_CONNECTION"] = str(facts_dir)
+        os.environ["ANSIBLE_CACHE_PLUGIN_TIMEOUT"] = str(Settings.fact_cache_ttl)
+    else:
+        for var in ("ANSIBLE_GATHERING", "ANSIBLE_CACHE_PLUGIN", "ANSIBLE_CACHE_PLUGIN_CONNECTION",
+                    "ANSIBLE_CACHE_PLUGIN_TIMEOUT"):
+            os.environ.pop(var, None)
+
+
+def read_fact_cache(facts_dir: Path) -> dict:
+    """
+    Reads facts, cached by Ansible, to {host: {"timestamp": time of gathering, "facts": facts}}, skipping expired
+    """
+    expired = time.time() - Settings.fact_cache_ttl
+    facts = {}
+    if not facts_dir.is_dir():
+        return facts
+    for facts_file in facts_dir.iterdir():
+        try:
+            timestamp = facts_file.stat().st_mtime
+            if facts_file.is_file() and timestamp > expired:
+                facts[facts_file.name] = {"timestamp": timestamp, "facts": json.loads(facts_file.read_text())}
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            logger.warning(f"Could not read facts of {facts_file.name}: {str(e)}")
+    return facts
+
+
+def write_fact_cache(facts: dict, facts_dir: Path, owner: Optional[tuple] = None) -> int:
+    """
+    Writes facts, which have not expired yet, to Ansible's fact cache in facts_dir. Files keep time of gathering, so
+    Ansible expires them on time. Returns number of hosts, restored.
+    """
+    expired = time.time() - Settings.fact_cache_ttl
+    valid = {host: item for host, item in facts.items() if item["timestamp"] > expired and validate_hostname(host)}
+    if not valid:
+        return 0
+    if owner:
+        file_util.make_dirs(facts_dir, owner)
+    else:
+        facts_dir.mkdir(parents=True, exist_ok=True)
+    for host, item in valid.items():
+        facts_file = facts_dir / host
+        data = json.dumps(item["facts"]).encode()
+        if owner:
+            file_util.write_owned(facts_file, data, owner)
+        else:
+            facts_file.write_bytes(data)
+        os.utime(facts_file, (item["timestamp"], item["timestamp"]))
+    return len(valid)
+
+
+def validate_hostname(host: str) -> bool:
+    return bool(host) and "/" not in host and host not in (".", "..")
+
+
+def read_task_results(results_file: Path) -> list:
+    """
+    Reads task results, written by callback plugin, skipping incomplete lines
+    """
+    task_results = []
+    try:
+        with open(results_file, "r") as f:
+            for line in f:
+                try:
+                    task_results.append(json.loads(line))
+                except json.decoder.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        return []
+    return task_results
+
+
+def get_failed_tasks(task_results: list) -> dict:
+    """
+    Returns failed tasks (not ignored) with their msg and stderr
+    """
+    return {result["task"]: {"msg": result.get("msg"), "stderr": result.get("stderr")}
+            for result in task_results
+            if result.get("status") in ("failed", "unreachable") and not result.get("ignored")}
+
+
 def try_get_failed_tasks(stdout: str):
     failed_tasks = {}
     try: